@@ -0,0 +1,380 @@
+"""
+Answer cache for repeated questions.
+
+Bots such as ``docs-searcher`` are asked the same things over and over, and
+each question costs a full agent run. ``AnswerCache`` keeps successful answers
+keyed on the normalized question text plus the agent name, with a TTL, a size
+bound and LRU eviction. A hit is answered straight from the callback, inside
+WeCom's 5 second window, in both reply modes.
+
+Invalidation:
+
+- ``ANSWER_CACHE_VERSION`` tags the cached answers; bump it when the docs
+  change (also picked up by ``/admin/reload-config``) and the cache is cleared;
+- ``POST /admin/answer-cache/invalidate`` drops everything, or one question.
+
+Questions asked in a conversation that already has an OpenCode session are
+neither answered from nor stored in the cache (see
+``opencode_sessions.in_conversation``): their answers depend on the context.
+
+With ``ANSWER_CACHE_SIMILAR=1`` an exact miss also consults a MinHash index
+of the cached questions (``similarity_index``), so paraphrases such as
+"怎么配置X" / "X 如何配置" reuse the answer; such replies are tagged with the
+question they were answered for. Latin / identifier words (product names,
+versions) must be the same in both questions.
+
+With ``ANSWER_CACHE_PATH`` the cache is also written to a JSON file and loaded
+at startup, so it survives restarts. Each write is a full snapshot, so changes
+are batched: the file is written at most every ``ANSWER_CACHE_SAVE_SECONDS``
+and once more at shutdown. The file belongs to
+one process; multi-worker deployments should give each worker its own path.
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import metrics
+from config import (
+    get_answer_cache_enabled,
+    get_answer_cache_max_size,
+    get_answer_cache_min_chars,
+    get_answer_cache_path,
+    get_answer_cache_save_seconds,
+    get_answer_cache_similar,
+    get_answer_cache_similarity_threshold,
+    get_answer_cache_ttl,
+    get_answer_cache_version,
+)
+from opencode_agents import AGENT_MISSING_REPLY
+from similarity_index import MinHashIndex, identifier_tokens
+
+logger = logging.getLogger(__name__)
+
+# replies that are not answers and must never be cached
+NON_ANSWERS = frozenset(
+    ("OpenCode 暂时不可用，请稍后再试。", "请发送要咨询的内容。", "当前消息较多，请稍后再试。")
+)
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！.。~～…,，;；:："
+
+SIMILAR_TAG = "（相似问题「{question}」的缓存回答）\n\n"
+
+
+def normalize_question(text: str) -> str:
+    """Case, width, whitespace and trailing-punctuation insensitive form of a question."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _SPACE_RE.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCT + " ")
+
+
+class AnswerCache:
+    """Thread-safe LRU + TTL map of (agent, normalized question) -> answer."""
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 86400,
+        version: str = "",
+        path: str = "",
+        min_chars: int = 4,
+        similarity_threshold: float | None = None,
+        save_interval: float = 0.0,
+        clock=time.time,
+    ):
+        """
+        :param path: JSON file to persist to; empty keeps the cache in memory only.
+        :param min_chars: Shorter questions ("继续", "详细点") depend on the
+            conversation and are never cached.
+        :param similarity_threshold: Enables near-duplicate matching; the
+            minimum estimated similarity (0..1) of a paraphrase.
+        :param save_interval: Seconds changes may wait before the file is
+            rewritten (``flush()`` writes them at once); 0 saves on every change.
+        :param clock: Wall clock, so persisted expiry times survive restarts.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.path = path
+        self.min_chars = min_chars
+        self.similarity_threshold = similarity_threshold
+        self.save_interval = save_interval
+        self._index = MinHashIndex() if similarity_threshold is not None else None
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._save_timer: threading.Timer | None = None
+        self._counters = {
+            "hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "evicted": 0, "invalidated": 0,
+        }
+        if path:
+            self._load()
+
+    def _key(self, question: str, agent_name: str) -> str | None:
+        normalized = normalize_question(question)
+        if len(normalized) < self.min_chars:
+            return None
+        return f"{agent_name}\x00{normalized}"
+
+    def _live_locked(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= self._clock():
+            self._remove_locked(key)
+            entry = None
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _remove_locked(self, key: str) -> None:
+        del self._entries[key]
+        if self._index is not None:
+            self._index.remove(key)
+
+    def get(self, question: str, agent_name: str) -> str | None:
+        """Answer cached for exactly this (normalized) question."""
+        result = self.match(question, agent_name, similar=False)
+        return result[0] if result is not None else None
+
+    def match(
+        self, question: str, agent_name: str, similar: bool = True
+    ) -> tuple[str, str | None, float] | None:
+        """
+        Look up ``question``: ``(answer, None, 1.0)`` for an exact hit,
+        ``(answer, cached_question, score)`` for a near-duplicate, else None.
+        """
+        key = self._key(question, agent_name)
+        if key is None:
+            return None
+        use_index = similar and self._index is not None
+        with self._lock:
+            answer = self._live_locked(key)
+            if answer is not None:
+                self._counters["hits"] += 1
+                return answer, None, 1.0
+            if not use_index:
+                self._counters["misses"] += 1
+                return None
+        normalized = key.split("\x00", 1)[1]
+        sig = self._index.signature(normalized)
+        prefix = f"{agent_name}\x00"
+        identifiers = identifier_tokens(normalized)
+
+        def accept(k: str) -> bool:
+            # "nginx" vs "redis" is a different question, however alike the rest
+            return k.startswith(prefix) and identifier_tokens(k[len(prefix):]) == identifiers
+
+        with self._lock:
+            found = self._index.query(sig, self.similarity_threshold, accept=accept)
+            answer = self._live_locked(found[0]) if found is not None else None
+            if answer is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["similar_hits"] += 1
+            return answer, found[0].split("\x00", 1)[1], found[1]
+
+    def put(self, question: str, agent_name: str, answer: str) -> bool:
+        """Store a successful answer; returns False when it is not cacheable."""
+        key = self._key(question, agent_name)
+        if key is None or not answer or not answer.strip() or answer in NON_ANSWERS:
+            return False
+        if answer == AGENT_MISSING_REPLY.format(agent=agent_name):
+            # a configuration error, gone once the agent exists
+            return False
+        sig = self._index.signature(key.split("\x00", 1)[1]) if self._index is not None else None
+        with self._lock:
+            self._entries[key] = (answer, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            if sig is not None:
+                self._index.add(key, sig)
+            self._counters["stores"] += 1
+            while len(self._entries) > self.max_size:
+                self._remove_locked(next(iter(self._entries)))
+                self._counters["evicted"] += 1
+        self._changed()
+        return True
+
+    def invalidate(self, question: str | None = None, agent_name: str | None = None) -> int:
+        """
+        Drop cached answers: all of them, those of one agent, or one question
+        (of ``agent_name``, or of every agent). Returns the number removed.
+        """
+        normalized = normalize_question(question) if question is not None else None
+        with self._lock:
+            removed = [
+                key for key in self._entries
+                if (agent_name is None or key.split("\x00", 1)[0] == agent_name)
+                and (normalized is None or key.split("\x00", 1)[1] == normalized)
+            ]
+            for key in removed:
+                self._remove_locked(key)
+            self._counters["invalidated"] += len(removed)
+        if removed:
+            # dropped answers must not come back after a restart
+            self._changed(at_once=True)
+        return len(removed)
+
+    def set_version(self, version: str) -> bool:
+        """Switch the docs version; answers of the previous version are dropped."""
+        if version == self.version:
+            return False
+        with self._lock:
+            self.version = version
+            self._counters["invalidated"] += len(self._entries)
+            self._entries.clear()
+            if self._index is not None:
+                self._index.clear()
+        logger.info("[AnswerCache] docs version changed to %r, cache cleared", version)
+        self._changed(at_once=True)
+        return True
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("[AnswerCache] cannot load %s: %s", self.path, e)
+            return
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            logger.info("[AnswerCache] %s is for another docs version, ignored", self.path)
+            return
+        now = self._clock()
+        with self._lock:
+            for key, answer, expires in data.get("entries", [])[-self.max_size:]:
+                if expires > now:
+                    self._entries[key] = (answer, expires)
+                    if self._index is not None:
+                        self._index.add(key, self._index.signature(key.split("\x00", 1)[1]))
+        logger.info("[AnswerCache] loaded %d answers from %s", len(self._entries), self.path)
+
+    def _changed(self, at_once: bool = False) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            self._dirty = True
+            if not at_once and self.save_interval > 0:
+                if self._save_timer is None:
+                    self._save_timer = threading.Timer(self.save_interval, self.flush)
+                    self._save_timer.daemon = True
+                    self._save_timer.start()
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Write pending changes to the file now."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, False
+            timer, self._save_timer = self._save_timer, None
+        if timer is not None:
+            timer.cancel()
+        if dirty:
+            self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "version": self.version,
+                "entries": [[k, a, e] for k, (a, e) in self._entries.items()],
+            }
+        tmp = f"{self.path}.tmp"
+        with self._save_lock:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.warning("[AnswerCache] cannot save %s: %s", self.path, e)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "version": self.version,
+                "persistent": bool(self.path),
+                "similar": self._index is not None,
+                **self._counters,
+            }
+
+
+_cache: AnswerCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache | None:
+    """Process-wide answer cache; None when ``ANSWER_CACHE`` is off."""
+    global _cache
+    if not get_answer_cache_enabled():
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache(
+                max_size=get_answer_cache_max_size(),
+                ttl=get_answer_cache_ttl(),
+                version=get_answer_cache_version(),
+                path=get_answer_cache_path(),
+                min_chars=get_answer_cache_min_chars(),
+                similarity_threshold=(
+                    get_answer_cache_similarity_threshold() if get_answer_cache_similar() else None
+                ),
+                save_interval=get_answer_cache_save_seconds(),
+            )
+        else:
+            _cache.set_version(get_answer_cache_version())
+        return _cache
+
+
+def flush_answer_cache() -> None:
+    """Write the process-wide cache's pending changes (at shutdown)."""
+    with _cache_lock:
+        cache = _cache
+    if cache is not None:
+        cache.flush()
+
+
+atexit.register(flush_answer_cache)
+
+
+def lookup_answer(question: str, agent_name: str) -> str | None:
+    """
+    Cached answer for ``question``, or None (also when caching is off). A
+    near-duplicate match is prefixed with the question it was answered for.
+    """
+    cache = get_answer_cache()
+    if cache is None:
+        return None
+    with metrics.ANSWER_CACHE_SECONDS.time():
+        result = cache.match(question, agent_name)
+    if result is None:
+        metrics.ANSWER_CACHE_LOOKUPS.inc(result="miss")
+        return None
+    answer, similar_to, _ = result
+    if similar_to is None:
+        metrics.ANSWER_CACHE_LOOKUPS.inc(result="hit")
+        return answer
+    metrics.ANSWER_CACHE_LOOKUPS.inc(result="similar")
+    return SIMILAR_TAG.format(question=similar_to) + answer
+
+
+def store_answer(question: str, agent_name: str, answer) -> None:
+    """Remember a finished answer; streamed (non-string) replies are skipped."""
+    cache = get_answer_cache()
+    if cache is not None and isinstance(answer, str):
+        cache.put(question, agent_name, answer)
@@ -4,40 +4,98 @@ import json
 import logging
 import os
 import secrets
+import signal
+import threading
 import time
+from dataclasses import dataclass
 from pathlib import Path
 
 from flask import Flask, Response, jsonify, request
 
+import answer_cache
+import metrics
+import tracing
+
+from answer_cache import get_answer_cache, lookup_answer, store_answer
+from async_reply import ReplyDispatcher, deliver_parts
+from callback_dedup import CallbackDedup, build_dedup, dedup_key
 from config import (
-    get_opencode_agent_name,
-    get_opencode_api_url,
+    get_admin_token,
+    get_async_queue_size,
+    get_async_worker_count,
+    get_dedup_backend,
+    get_dedup_max_size,
+    get_dedup_sqlite_path,
+    get_dedup_ttl,
+    get_dedup_wait_seconds,
+    get_opencode_stream,
+    get_single_flight_enabled,
+    get_wework_corp_secret,
     get_wework_encoding_aes_key,
     get_wework_receive_id,
+    get_wework_reply_mode,
     get_wework_token,
 )
+from job_journal import get_job_journal
+from message_debounce import build_debouncer
+from opencode_agents import agent_for, get_agent_catalog
+from opencode_admission import BUSY_REPLY, admission_stats, admitted, message_priority
+from opencode_backends import get_backend_pool, routed
+from opencode_breaker import breaker_stats
 from opencode_client import ask_opencode
+import opencode_agents
+import opencode_session_pool
+import opencode_sessions
+from opencode_sessions import in_conversation, session_key_for
+from opencode_stream import get_stream_stats
+from reply_segmenter import MAX_TEXT_BYTES, split_reply, utf8_len
+from single_flight import ask_coalesced, get_single_flight
+import state_store
+import wework_send_queue
 from wework_crypto import get_wxbiz_class
 
 # Load .env from repo root if present
 _env = Path(__file__).resolve().parent / ".env"
-if _env.exists():
-    try:
-        from dotenv import load_dotenv
 
-        load_dotenv(_env)
-    except ImportError:
-        pass
+
+def _load_env_file(override: bool = False) -> None:
+    if _env.exists():
+        try:
+            from dotenv import load_dotenv
+
+            load_dotenv(_env, override=override)
+        except ImportError:
+            pass
+
+
+_load_env_file()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
+TRUNCATED_NOTE = "\n\n……（回复过长，已截断）"
+
+_dispatcher: ReplyDispatcher | None = None
+_dispatcher_lock = threading.Lock()
+
+# WXBizJsonMsgCrypt built once per credential generation, see _get_crypto()
+_crypto = None
+_crypto_credentials: tuple[str, str, str] | None = None
+_crypto_generation = 0
+_crypto_lock = threading.Lock()
+
+_dedup: CallbackDedup | None = None
+_dedup_initialized = False
+_dedup_lock = threading.Lock()
+
+
+def _crypto_credentials_from_env() -> tuple[str, str, str]:
+    return get_wework_token(), get_wework_encoding_aes_key(), get_wework_receive_id()
+
 
 def _build_crypto():
-    token = get_wework_token()
-    aes_key = get_wework_encoding_aes_key()
-    receive_id = get_wework_receive_id()
+    token, aes_key, receive_id = _crypto_credentials_from_env()
     if not token or not aes_key or not receive_id:
         raise ValueError(
             "WEWORK_TOKEN / WEWORK_ENCODING_AES_KEY / WEWORK_RECEIVE_ID must be configured"
@@ -46,6 +104,63 @@ def _build_crypto():
     return wxbiz_cls(token, aes_key, receive_id)
 
 
+def _get_crypto():
+    """Return the cached crypto object, building it on first use."""
+    global _crypto, _crypto_credentials, _crypto_generation
+    crypt = _crypto
+    if crypt is not None:
+        return crypt
+    with _crypto_lock:
+        if _crypto is None:
+            _crypto_credentials = _crypto_credentials_from_env()
+            _crypto = _build_crypto()
+            _crypto_generation += 1
+        return _crypto
+
+
+def reload_crypto(reload_env: bool = True) -> bool:
+    """
+    Re-read the callback credentials and rebuild the crypto object if they changed.
+
+    :param reload_env: Also re-read ``.env`` (overriding the process environment).
+    :return: True if a new crypto object was built.
+    """
+    global _crypto, _crypto_credentials, _crypto_generation
+    if reload_env:
+        _load_env_file(override=True)
+    credentials = _crypto_credentials_from_env()
+    with _crypto_lock:
+        if _crypto is not None and credentials == _crypto_credentials:
+            return False
+        _crypto = _build_crypto()
+        _crypto_credentials = credentials
+        _crypto_generation += 1
+    logger.info("Callback crypto rebuilt, generation=%s", _crypto_generation)
+    return True
+
+
+def _handle_sighup(signum, frame):
+    # Reload off the signal handler so it never waits on _crypto_lock.
+    threading.Thread(target=reload_crypto, name="crypto-reload", daemon=True).start()
+
+
+def install_reload_signal() -> None:
+    """Rebuild the crypto object on SIGHUP (main thread only, POSIX only)."""
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, _handle_sighup)
+
+
+def _admin_authorized(headers) -> bool:
+    admin_token = get_admin_token()
+    if not admin_token:
+        return False
+    supplied = headers.get("X-Admin-Token", "")
+    auth_header = headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        supplied = auth_header[len("Bearer "):]
+    return secrets.compare_digest(supplied.encode(), admin_token.encode())
+
+
 def _extract_text_message(message_obj: dict) -> str:
     if not isinstance(message_obj, dict):
         return ""
@@ -66,80 +181,359 @@ def _build_passive_reply(incoming: dict, reply_text: str) -> dict:
     }
 
 
-@app.route("/health", methods=["GET"])
-def health():
-    return jsonify({"status": "ok"})
+def _get_dispatcher() -> ReplyDispatcher:
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ReplyDispatcher(
+                workers=get_async_worker_count(),
+                queue_size=get_async_queue_size(),
+                journal=get_job_journal(),
+                debouncer=build_debouncer(),
+            )
+        return _dispatcher
 
 
-@app.route("/webhook/wework", methods=["GET", "POST"])
-def webhook_wework():
-    crypt = _build_crypto()
-    msg_signature = request.args.get("msg_signature", "")
-    timestamp = request.args.get("timestamp", "")
-    nonce = request.args.get("nonce", "")
+def _get_dedup() -> CallbackDedup | None:
+    global _dedup, _dedup_initialized
+    with _dedup_lock:
+        if not _dedup_initialized:
+            _dedup = build_dedup(
+                get_dedup_backend(),
+                ttl=get_dedup_ttl(),
+                max_size=get_dedup_max_size(),
+                sqlite_path=get_dedup_sqlite_path(),
+            )
+            _dedup_initialized = True
+        return _dedup
+
+
+# Framework-neutral results: (body, status, mimetype). The Flask app and the
+# ASGI app in asgi_app.py both build on the helpers below.
+ACK = ("", 200, "text/plain")
 
-    if request.method == "GET":
-        echostr = request.args.get("echostr", "")
+
+def _encrypt_reply(crypt, message_obj: dict, reply_text: str) -> tuple[str, int, str]:
+    with metrics.stage("reply_build"):
+        reply_obj = _build_passive_reply(message_obj, reply_text)
+        reply_json = json.dumps(reply_obj, ensure_ascii=False)
+
+    reply_nonce = secrets.token_hex(8)
+    reply_ts = str(int(time.time()))
+    with metrics.stage("encrypt"):
+        ret, encrypted_reply = crypt.EncryptMsg(reply_json, reply_nonce, reply_ts)
+    if ret != 0 or encrypted_reply is None:
+        logger.warning("EncryptMsg failed, ret=%s", ret)
+        metrics.FAILURES.inc(reason="encrypt_failed")
+        return "encrypt failed", 500, "text/plain"
+
+    return encrypted_reply, 200, "application/json"
+
+
+@dataclass
+class CallbackContext:
+    """A decrypted text callback that still needs an answer."""
+
+    crypt: object
+    message_obj: dict
+    user_message: str
+    async_mode: bool
+    dedup: CallbackDedup | None = None
+    dedup_key: str | None = None
+    duplicate: bool = False
+    # the claim was resolved, or handed to the async dispatcher that answers it
+    settled: bool = False
+
+    def resolve(self, reply_text: str) -> None:
+        if self.dedup_key is not None:
+            self.dedup.resolve(self.dedup_key, reply_text)
+        self.settled = True
+
+    def release(self) -> None:
+        """Drop this delivery's claim if it never got an answer (e.g. the handler raised)."""
+        if self.dedup_key is not None and not self.duplicate and not self.settled:
+            self.dedup.release(self.dedup_key)
+
+
+def _prepare_callback(method: str, args, post_data: str):
+    """
+    Verify / decrypt a callback request.
+
+    :return: (result, None) when the request is already answered, otherwise
+        (None, CallbackContext) for a text message that needs a reply.
+    """
+    crypt = _get_crypto()
+    msg_signature = args.get("msg_signature", "")
+    timestamp = args.get("timestamp", "")
+    nonce = args.get("nonce", "")
+
+    if method == "GET":
+        echostr = args.get("echostr", "")
         if not echostr:
-            return Response("missing echostr", status=400, mimetype="text/plain")
-        ret, s_echo_str = crypt.VerifyURL(msg_signature, timestamp, nonce, echostr)
+            metrics.FAILURES.inc(reason="missing_echostr")
+            return ("missing echostr", 400, "text/plain"), None
+        with metrics.stage("verify"):
+            ret, s_echo_str = crypt.VerifyURL(msg_signature, timestamp, nonce, echostr)
         if ret != 0 or s_echo_str is None:
             logger.warning("VerifyURL failed, ret=%s", ret)
-            return Response("verify failed", status=403, mimetype="text/plain")
-        return Response(s_echo_str, status=200, mimetype="text/plain")
+            metrics.FAILURES.inc(reason="verify_failed")
+            return ("verify failed", 403, "text/plain"), None
+        return (s_echo_str, 200, "text/plain"), None
 
-    post_data = request.get_data(as_text=True) or ""
     if not post_data:
-        return Response("missing body", status=400, mimetype="text/plain")
+        metrics.FAILURES.inc(reason="missing_body")
+        return ("missing body", 400, "text/plain"), None
 
-    ret, plain_text = crypt.DecryptMsg(post_data, msg_signature, timestamp, nonce)
+    with metrics.stage("decrypt"):
+        ret, plain_text = crypt.DecryptMsg(post_data, msg_signature, timestamp, nonce)
     if ret != 0 or plain_text is None:
         logger.warning("DecryptMsg failed, ret=%s", ret)
-        return Response("decrypt failed", status=403, mimetype="text/plain")
+        metrics.FAILURES.inc(reason="decrypt_failed")
+        return ("decrypt failed", 403, "text/plain"), None
 
-    try:
-        message_obj = json.loads(plain_text)
-    except json.JSONDecodeError:
-        return Response("invalid message json", status=400, mimetype="text/plain")
+    with metrics.stage("parse"):
+        try:
+            message_obj = json.loads(plain_text)
+        except json.JSONDecodeError:
+            message_obj = None
+        user_message = _extract_text_message(message_obj)
+    if message_obj is None:
+        metrics.FAILURES.inc(reason="invalid_json")
+        return ("invalid message json", 400, "text/plain"), None
+    tracing.annotate(
+        msg_id=message_obj.get("MsgId"),
+        from_user=message_obj.get("FromUserName"),
+        agent_id=message_obj.get("AgentID"),
+    )
 
-    user_message = _extract_text_message(message_obj)
     if not user_message:
-        reply_text = "请发送文本消息。"
-    else:
-        reply_text = ask_opencode(
-            user_message=user_message,
-            api_url=get_opencode_api_url(),
-            agent_name=get_opencode_agent_name(),
+        return _encrypt_reply(crypt, message_obj, "请发送文本消息。"), None
+
+    ctx = CallbackContext(crypt, message_obj, user_message, get_wework_reply_mode() == "async")
+    dedup = _get_dedup()
+    key = dedup_key(message_obj) if dedup is not None else None
+    if key is not None:
+        ctx.dedup, ctx.dedup_key = dedup, key
+        ctx.duplicate = not dedup.claim(key)
+        if ctx.duplicate and ctx.async_mode:
+            # WeCom retry of a message that is already queued or answered.
+            return ACK, None
+    return None, ctx
+
+
+def _attach_to_first_delivery(ctx: CallbackContext) -> tuple[str, int, str]:
+    """WeCom retry in passive mode: reuse the first delivery's reply."""
+    reply_text = ctx.dedup.attach(ctx.dedup_key, timeout=get_dedup_wait_seconds())
+    if not reply_text:
+        # timed out, or the first delivery pushed its reply actively
+        return ACK
+    return _encrypt_reply(ctx.crypt, ctx.message_obj, reply_text)
+
+
+def _split_passive_reply(reply_text: str) -> tuple[str, list[str]]:
+    """
+    Fit a reply into one passive response.
+
+    Returns ``(passive_text, [])`` when it fits. A longer reply is returned as
+    ``("", parts)``: all numbered parts are pushed actively, in order, and the
+    callback is only acked. Without an app secret there is no active path, so
+    the reply is cut at a paragraph boundary instead.
+    """
+    parts = split_reply(reply_text)
+    if len(parts) <= 1:
+        return reply_text, []
+    if get_wework_corp_secret():
+        return "", parts
+    budget = MAX_TEXT_BYTES - utf8_len(TRUNCATED_NOTE)
+    return split_reply(reply_text, budget, numbered=False)[0] + TRUNCATED_NOTE, []
+
+
+def _reply_passively(ctx: CallbackContext, reply_text: str) -> tuple[str, int, str]:
+    """Answer a passive-mode callback; long replies are pushed in parts from a thread."""
+    passive_text, parts = _split_passive_reply(reply_text)
+    ctx.resolve(passive_text)
+    if parts:
+        threading.Thread(
+            target=tracing.bind(deliver_parts),
+            args=(ctx.message_obj, parts),
+            name="reply-parts",
+            daemon=True,
+        ).start()
+        return ACK
+    return _encrypt_reply(ctx.crypt, ctx.message_obj, passive_text)
+
+
+def _handle_webhook(method: str, args, post_data: str) -> tuple[str, int, str]:
+    result, ctx = _prepare_callback(method, args, post_data)
+    if result is not None:
+        return result
+    if ctx.duplicate:
+        return _attach_to_first_delivery(ctx)
+    try:
+        return _answer_callback(ctx)
+    finally:
+        ctx.release()
+
+
+def _answer_callback(ctx: CallbackContext) -> tuple[str, int, str]:
+    agent_name = agent_for(ctx.message_obj)
+    session_key = session_key_for(ctx.message_obj, agent_name)
+    # a follow-up in an ongoing conversation depends on its context: never cached
+    follow_up = in_conversation(session_key)
+    # a cached answer is replied passively in either mode
+    reply_text = None if follow_up else lookup_answer(ctx.user_message, agent_name)
+    if reply_text is not None:
+        return _reply_passively(ctx, reply_text)
+
+    if ctx.async_mode:
+        # Ack within WeCom's 5s window; the answer is pushed by a worker.
+        if _get_dispatcher().submit(ctx.message_obj, ctx.user_message):
+            ctx.settled = True
+            return ACK
+        ctx.resolve(BUSY_REPLY)
+        return _encrypt_reply(ctx.crypt, ctx.message_obj, BUSY_REPLY)
+
+    with metrics.stage("opencode"):
+        reply_text = ask_coalesced(
+            routed(admitted(ask_opencode, message_priority(ctx.message_obj))),
+            user_message=ctx.user_message,
+            agent_name=agent_name,
+            session_key=session_key,
         )
+    if not follow_up:
+        store_answer(ctx.user_message, agent_name, reply_text)
+    return _reply_passively(ctx, reply_text)
 
-    reply_obj = _build_passive_reply(message_obj, reply_text)
-    reply_json = json.dumps(reply_obj, ensure_ascii=False)
 
-    reply_nonce = secrets.token_hex(8)
-    reply_ts = str(int(time.time()))
-    ret, encrypted_reply = crypt.EncryptMsg(reply_json, reply_nonce, reply_ts)
-    if ret != 0 or encrypted_reply is None:
-        logger.warning("EncryptMsg failed, ret=%s", ret)
-        return Response("encrypt failed", status=500, mimetype="text/plain")
+def _health_body(dispatcher=None) -> dict:
+    dispatcher = dispatcher if dispatcher is not None else _dispatcher
+    body = {"status": "ok", "reply_mode": get_wework_reply_mode()}
+    if dispatcher is not None:
+        body["async_queue"] = dispatcher.stats()
+        if get_opencode_stream():
+            body["stream"] = get_stream_stats().snapshot()
+    if wework_send_queue._queue is not None:
+        body["send_queue"] = wework_send_queue._queue.stats()
+    if _dedup is not None:
+        body["dedup"] = _dedup.stats()
+    if opencode_sessions._registry is not None:
+        body["sessions"] = opencode_sessions._registry.stats()
+    if opencode_session_pool._pool is not None:
+        body["session_pool"] = opencode_session_pool._pool.stats()
+    if opencode_agents._catalog is not None:
+        body["agent_catalog"] = opencode_agents._catalog.stats()
+    if state_store._store is not None:
+        body["state_store"] = state_store._store.stats()
+    if answer_cache._cache is not None:
+        body["answer_cache"] = answer_cache._cache.stats()
+    if get_single_flight_enabled():
+        body["single_flight"] = get_single_flight().stats()
+    body["opencode_backends"] = get_backend_pool().stats()
+    breakers = breaker_stats()
+    if breakers:
+        body["opencode_breakers"] = breakers
+    admission = admission_stats()
+    if admission:
+        body["opencode_admission"] = admission
+    journal = get_job_journal()
+    if journal is not None:
+        body["job_journal"] = journal.stats()
+    return body
+
 
-    return Response(encrypted_reply, status=200, mimetype="application/json")
+INDEX_BODY = {
+    "service": "wework-robot-opencode",
+    "callback": "/webhook/wework",
+    "mode": "enterprise-wechat-self-built-app",
+}
+
+
+def _reload_config() -> tuple[dict, int]:
+    try:
+        rebuilt = reload_crypto()
+    except ValueError as e:
+        return {"status": "error", "error": str(e)}, 400
+    return {"status": "ok", "rebuilt": rebuilt, "generation": _crypto_generation}, 200
+
+
+def _invalidate_answer_cache(body) -> tuple[dict, int]:
+    """
+    Drop cached answers. ``body`` may name a ``question`` and/or an ``agent``;
+    without either the whole cache is cleared.
+    """
+    if not isinstance(body, dict):
+        return {"status": "error", "error": "expected a JSON object"}, 400
+    cache = get_answer_cache()
+    if cache is None:
+        return {"status": "ok", "enabled": False, "removed": 0}, 200
+    removed = cache.invalidate(question=body.get("question"), agent_name=body.get("agent"))
+    logger.info("Answer cache invalidated, removed=%s", removed)
+    return {"status": "ok", "enabled": True, "removed": removed}, 200
+
+
+def _to_response(result: tuple[str, int, str]) -> Response:
+    body, status, mimetype = result
+    return Response(body, status=status, mimetype=mimetype)
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify(_health_body())
+
+
+@app.route("/webhook/wework", methods=["GET", "POST"])
+def webhook_wework():
+    metrics.CALLBACKS.inc(method=request.method)
+    with (
+        tracing.start_trace(),
+        metrics.CALLBACKS_IN_FLIGHT.track_inprogress(),
+        metrics.stage("callback"),
+    ):
+        tracing.annotate(method=request.method)
+        post_data = request.get_data(as_text=True) or ""
+        response = _to_response(_handle_webhook(request.method, request.args, post_data))
+        response.headers[tracing.TRACE_HEADER] = tracing.current_trace_id()
+        return response
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/admin/reload-config", methods=["POST"])
+def admin_reload_config():
+    if not _admin_authorized(request.headers):
+        return Response("forbidden", status=403, mimetype="text/plain")
+    body, status = _reload_config()
+    return jsonify(body), status
+
+
+@app.route("/admin/answer-cache/invalidate", methods=["POST"])
+def admin_invalidate_answer_cache():
+    if not _admin_authorized(request.headers):
+        return Response("forbidden", status=403, mimetype="text/plain")
+    body, status = _invalidate_answer_cache(request.get_json(silent=True) or {})
+    return jsonify(body), status
 
 
 @app.route("/", methods=["GET"])
 def index():
-    return (
-        jsonify(
-            {
-                "service": "wework-robot-opencode",
-                "callback": "/webhook/wework",
-                "mode": "enterprise-wechat-self-built-app",
-            }
-        ),
-        200,
-    )
+    return jsonify(INDEX_BODY), 200
+
+
+def recover_jobs() -> int:
+    """Replay async-mode jobs accepted before the last restart (needs ``JOB_JOURNAL_PATH``)."""
+    if get_job_journal() is None:
+        return 0
+    return _get_dispatcher().replay()
 
 
 def main():
+    install_reload_signal()
+    # load the agent catalog before the first callback needs it
+    get_agent_catalog()
+    recover_jobs()
     port = int(os.environ.get("PORT", "5000"))
     host = os.environ.get("HOST", "0.0.0.0")
     app.run(host=host, port=port, debug=os.environ.get("FLASK_DEBUG", "0") == "1")
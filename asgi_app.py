@@ -0,0 +1,242 @@
+"""
+ASGI variant of the Enterprise WeChat callback server.
+
+Serves the same routes as the Flask app in ``app.py`` (``/health``, ``/``,
+``/metrics``, ``/webhook/wework``, ``/admin/reload-config``,
+``/admin/answer-cache/invalidate``) and shares its decrypt /
+dedup / encrypt helpers, but calls OpenCode and WeCom through the async
+httpx client. A slow agent run only parks a coroutine, so one process can
+hold thousands of them instead of pinning a thread each.
+
+Run with any ASGI server, e.g. ``uvicorn asgi_app:app`` or ``python main_asgi.py``.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qsl
+
+import app as callback_app
+import metrics
+import tracing
+from answer_cache import flush_answer_cache, lookup_answer, store_answer
+from async_reply import AsyncioReplyDispatcher, deliver_parts_async
+from config import (
+    get_async_queue_size,
+    get_async_worker_count,
+)
+from http_transport import close_async_client
+from job_journal import get_job_journal
+from message_debounce import build_debouncer
+from opencode_agents import agent_for, get_agent_catalog
+from opencode_admission import admitted_async, message_priority
+from opencode_backends import routed_async
+from opencode_client import ask_opencode_async
+from opencode_session_pool import stop_session_pool
+from opencode_sessions import in_conversation, session_key_for
+from single_flight import ask_coalesced_async
+
+logger = logging.getLogger(__name__)
+
+_dispatcher: AsyncioReplyDispatcher | None = None
+# strong references to fire-and-forget delivery tasks
+_background: set[asyncio.Task] = set()
+
+
+def _get_dispatcher() -> AsyncioReplyDispatcher:
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = AsyncioReplyDispatcher(
+            workers=get_async_worker_count(),
+            queue_size=get_async_queue_size(),
+            journal=get_job_journal(),
+            debouncer=build_debouncer(),
+        )
+    return _dispatcher
+
+
+async def handle_webhook(method: str, args: dict, post_data: str) -> tuple[str, int, str]:
+    """
+    Async counterpart of ``app._handle_webhook``. Decryption, the dedup claim,
+    answer cache and encryption are synchronous (and may hit sqlite or Redis),
+    so they run in worker threads instead of stalling the event loop.
+    """
+    result, ctx = await asyncio.to_thread(callback_app._prepare_callback, method, args, post_data)
+    if result is not None:
+        return result
+    if ctx.duplicate:
+        return await asyncio.to_thread(callback_app._attach_to_first_delivery, ctx)
+
+    try:
+        return await _answer_callback(ctx)
+    finally:
+        await asyncio.to_thread(ctx.release)
+
+
+async def _answer_callback(ctx) -> tuple[str, int, str]:
+    agent_name = agent_for(ctx.message_obj)
+    session_key = session_key_for(ctx.message_obj, agent_name)
+    follow_up, reply_text = await asyncio.to_thread(_cached_answer, ctx, agent_name, session_key)
+    if reply_text is None:
+        if ctx.async_mode:
+            if await _get_dispatcher().submit_async(ctx.message_obj, ctx.user_message):
+                ctx.settled = True
+                return callback_app.ACK
+            return await asyncio.to_thread(_resolve_and_encrypt, ctx, callback_app.BUSY_REPLY)
+
+        with metrics.stage("opencode"):
+            reply_text = await ask_coalesced_async(
+                routed_async(admitted_async(ask_opencode_async, message_priority(ctx.message_obj))),
+                user_message=ctx.user_message,
+                agent_name=agent_name,
+                session_key=session_key,
+            )
+        if not follow_up:
+            await asyncio.to_thread(store_answer, ctx.user_message, agent_name, reply_text)
+    passive_text, parts = callback_app._split_passive_reply(reply_text)
+    if parts:
+        await asyncio.to_thread(ctx.resolve, passive_text)
+        task = asyncio.create_task(deliver_parts_async(ctx.message_obj, parts))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        return callback_app.ACK
+    return await asyncio.to_thread(_resolve_and_encrypt, ctx, passive_text)
+
+
+def _cached_answer(ctx, agent_name: str, session_key: tuple | None) -> tuple[bool, str | None]:
+    """(whether the message continues a conversation, cached answer or None)."""
+    if in_conversation(session_key):
+        return True, None
+    return False, lookup_answer(ctx.user_message, agent_name)
+
+
+def _resolve_and_encrypt(ctx, reply_text: str) -> tuple[str, int, str]:
+    ctx.resolve(reply_text)
+    return callback_app._encrypt_reply(ctx.crypt, ctx.message_obj, reply_text)
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def _respond(send, body, status: int = 200, mimetype: str = "text/plain", headers=()) -> None:
+    if isinstance(body, (dict, list)):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        mimetype = "application/json"
+    else:
+        payload = str(body).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", f"{mimetype}; charset=utf-8".encode()),
+                (b"content-length", str(len(payload)).encode()),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # load the agent catalog before the first callback needs it
+            await asyncio.to_thread(get_agent_catalog)
+            # answer the questions a previous process accepted but never finished
+            _get_dispatcher().replay()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # delete the pre-created sessions no conversation will use
+            await asyncio.to_thread(stop_session_pool)
+            await asyncio.to_thread(flush_answer_cache)
+            await close_async_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path = scope["path"].rstrip("/") or "/"
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+    headers = {k.decode("latin-1").title(): v.decode("latin-1") for k, v in scope["headers"]}
+
+    if path == "/health" and method == "GET":
+        # counts the state store, the dedup file and the job journal
+        await _respond(send, await asyncio.to_thread(callback_app._health_body, _dispatcher))
+    elif path == "/" and method == "GET":
+        await _respond(send, callback_app.INDEX_BODY)
+    elif path == "/webhook/wework" and method in ("GET", "POST"):
+        metrics.CALLBACKS.inc(method=method)
+        with (
+            tracing.start_trace(),
+            metrics.CALLBACKS_IN_FLIGHT.track_inprogress(),
+            metrics.stage("callback"),
+        ):
+            tracing.annotate(method=method)
+            # undecodable bytes fail decryption (403), as in the Flask app
+            post_data = (await _read_body(receive)).decode("utf-8", "replace") if method == "POST" else ""
+            body, status, mimetype = await handle_webhook(method, args, post_data)
+            await _respond(
+                send, body, status, mimetype,
+                headers=[(tracing.TRACE_HEADER.lower().encode(), tracing.current_trace_id().encode())],
+            )
+    elif path == "/metrics" and method == "GET":
+        await _respond(send, metrics.render(), mimetype="text/plain; version=0.0.4")
+    elif path == "/admin/reload-config" and method == "POST":
+        if not callback_app._admin_authorized(headers):
+            await _respond(send, "forbidden", 403)
+        else:
+            body, status = await asyncio.to_thread(callback_app._reload_config)
+            await _respond(send, body, status)
+    elif path == "/admin/answer-cache/invalidate" and method == "POST":
+        if not callback_app._admin_authorized(headers):
+            await _respond(send, "forbidden", 403)
+        else:
+            raw = await _read_body(receive)
+            try:
+                payload = json.loads(raw) if raw.strip() else {}
+            except ValueError:
+                payload = {}
+            body, status = await asyncio.to_thread(callback_app._invalidate_answer_cache, payload)
+            await _respond(send, body, status)
+    elif path in (
+        "/health", "/", "/webhook/wework", "/admin/reload-config", "/admin/answer-cache/invalidate",
+        "/metrics",
+    ):
+        await _respond(send, "method not allowed", 405)
+    else:
+        await _respond(send, "not found", 404)
+
+
+def main():
+    import uvicorn
+
+    callback_app.install_reload_signal()
+    uvicorn.run(
+        "asgi_app:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "5000")),
+        log_level="info",
+    )
+
+
+if __name__ == "__main__":
+    main()
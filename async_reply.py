@@ -0,0 +1,594 @@
+"""
+Ack-then-push reply mode.
+
+The callback handler only decrypts and enqueues the message, then acks WeCom
+immediately. A pool of worker threads runs OpenCode and pushes the answer
+back through the active-send path in ``wework_send``. The ASGI server uses
+``AsyncioReplyDispatcher``, which does the same with asyncio tasks.
+
+A handler may return the whole answer as a string or an iterable of chunks
+(see ``opencode_stream``); each chunk is pushed as soon as it is produced.
+
+Given a ``JobJournal`` (``job_journal``), both dispatchers record each job
+before accepting it and mark it finished after the push, and ``replay()``
+re-queues the jobs a previous process accepted but never finished. A job the
+journal fails to write is still answered, but logged as not journaled: it is
+lost if the process restarts before it is pushed.
+
+Given a ``MessageDebouncer`` (``message_debounce``), a sender's rapid
+consecutive messages are acked one by one but answered together: each joins
+the sender's open batch, and the batch becomes one reply job once its
+debounce window has passed.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+import metrics
+import tracing
+from answer_cache import store_answer
+from config import (
+    get_opencode_stream,
+    get_wework_api_base,
+    get_wework_corp_secret,
+    get_wework_receive_id,
+    get_wework_send_queue_enabled,
+    get_wework_webhook_url,
+)
+from job_journal import JournalError
+from opencode_agents import agent_for
+from opencode_admission import (
+    admitted,
+    admitted_async,
+    admitted_stream,
+    admitted_stream_async,
+    message_priority,
+)
+from opencode_backends import routed, routed_async, routed_stream, routed_stream_async
+from opencode_client import ask_opencode, ask_opencode_async
+from opencode_sessions import in_conversation, session_key_for
+from opencode_stream import stream_opencode, stream_opencode_async
+from reply_segmenter import split_reply
+from single_flight import ask_coalesced, ask_coalesced_async
+from wework_send import (
+    send_wework_app_text,
+    send_wework_app_text_async,
+    send_wework_text,
+    send_wework_text_async,
+)
+from wework_send_queue import (
+    queue_wework_app_text,
+    queue_wework_app_text_async,
+    queue_wework_text,
+    queue_wework_text_async,
+)
+
+logger = logging.getLogger(__name__)
+
+# number of recent jobs kept for latency percentiles
+_LATENCY_WINDOW = 1024
+
+
+def _webhook_can_answer(incoming: dict) -> bool:
+    # the robot webhook posts into its group: a private question must not be answered there
+    if incoming.get("ChatId"):
+        return True
+    logger.error(
+        "[Async] private message from %s cannot be answered through the group webhook; set WEWORK_CORP_SECRET",
+        incoming.get("FromUserName"),
+    )
+    metrics.FAILURES.inc(reason="wework_dm_via_webhook")
+    return False
+
+
+def deliver_reply(incoming: dict, reply_text: str) -> bool:
+    """
+    Push a reply to the sender of ``incoming``.
+
+    Uses the self-built app ``message/send`` API when ``WEWORK_CORP_SECRET`` is
+    configured, otherwise falls back to the group robot webhook, which only
+    answers group messages (a private message is refused). Long replies
+    are split into numbered parts (``reply_segmenter``). Sends go through the
+    rate-limited ``wework_send_queue`` unless ``WEWORK_SEND_QUEUE=0``.
+    """
+    return deliver_parts(incoming, split_reply(reply_text))
+
+
+def deliver_parts(incoming: dict, parts: list[str]) -> bool:
+    """Send ``parts`` in order; True only if every part was sent."""
+    if not parts:
+        logger.warning("[Async] empty reply, not sending")
+        return False
+    queued = get_wework_send_queue_enabled()
+    corp_secret = get_wework_corp_secret()
+    if corp_secret:
+        app_args = dict(
+            to_user=incoming.get("FromUserName", ""),
+            agent_id=incoming.get("AgentID"),
+            corp_id=get_wework_receive_id(),
+            corp_secret=corp_secret,
+            api_base=get_wework_api_base(),
+        )
+        if queued:
+            return queue_wework_app_text(content=parts, **app_args)
+        return all(send_wework_app_text(content=part, **app_args) for part in parts)
+    if not _webhook_can_answer(incoming):
+        return False
+    webhook_url = get_wework_webhook_url()
+    if queued:
+        return queue_wework_text(webhook_url, parts)
+    return all(send_wework_text(webhook_url, part) for part in parts)
+
+
+async def deliver_reply_async(incoming: dict, reply_text: str) -> bool:
+    """Async variant of ``deliver_reply``."""
+    return await deliver_parts_async(incoming, split_reply(reply_text))
+
+
+async def deliver_parts_async(incoming: dict, parts: list[str]) -> bool:
+    """Async variant of ``deliver_parts``."""
+    if not parts:
+        logger.warning("[Async] empty reply, not sending")
+        return False
+    queued = get_wework_send_queue_enabled()
+    corp_secret = get_wework_corp_secret()
+    if corp_secret:
+        app_args = dict(
+            to_user=incoming.get("FromUserName", ""),
+            agent_id=incoming.get("AgentID"),
+            corp_id=get_wework_receive_id(),
+            corp_secret=corp_secret,
+            api_base=get_wework_api_base(),
+        )
+        if queued:
+            return await queue_wework_app_text_async(content=parts, **app_args)
+        for part in parts:
+            if not await send_wework_app_text_async(content=part, **app_args):
+                return False
+        return True
+    if not _webhook_can_answer(incoming):
+        return False
+    webhook_url = get_wework_webhook_url()
+    if queued:
+        return await queue_wework_text_async(webhook_url, parts)
+    for part in parts:
+        if not await send_wework_text_async(webhook_url, part):
+            return False
+    return True
+
+
+async def _single(text: str):
+    yield text
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class _ReplyStats:
+    """Counters and latency windows shared by both dispatchers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {
+            "submitted": 0, "rejected": 0, "delivered": 0, "failed": 0, "messages_sent": 0,
+            "unjournaled": 0,
+        }
+        self.queue_wait = deque(maxlen=_LATENCY_WINDOW)
+        self.first_reply = deque(maxlen=_LATENCY_WINDOW)
+        self.total_latency = deque(maxlen=_LATENCY_WINDOW)
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] += 1
+
+    def started(self, enqueued_at: float) -> None:
+        waited = time.monotonic() - enqueued_at
+        metrics.REPLY_JOBS_IN_FLIGHT.inc()
+        metrics.STAGE_SECONDS.observe(waited, stage="queue_wait")
+        tracing.record("queue_wait", waited)
+        with self.lock:
+            self.in_flight += 1
+            self.queue_wait.append(waited)
+
+    def sent(self, enqueued_at: float, first: bool) -> None:
+        with self.lock:
+            self.counters["messages_sent"] += 1
+            if first:
+                self.first_reply.append(time.monotonic() - enqueued_at)
+
+    def finished(self, enqueued_at: float, ok: bool) -> None:
+        metrics.REPLY_JOBS_IN_FLIGHT.dec()
+        if not ok:
+            metrics.FAILURES.inc(reason="reply_push_failed")
+        with self.lock:
+            self.in_flight -= 1
+            self.counters["delivered" if ok else "failed"] += 1
+            self.total_latency.append(time.monotonic() - enqueued_at)
+
+    def snapshot(self, queue_depth: int, queue_capacity: int, workers: int) -> dict:
+        with self.lock:
+            waits = sorted(self.queue_wait)
+            firsts = sorted(self.first_reply)
+            totals = sorted(self.total_latency)
+            return {
+                "queue_depth": queue_depth,
+                "queue_capacity": queue_capacity,
+                "in_flight": self.in_flight,
+                "workers": workers,
+                **self.counters,
+                "queue_wait_p50": _percentile(waits, 50),
+                "queue_wait_p95": _percentile(waits, 95),
+                "first_reply_p50": _percentile(firsts, 50),
+                "first_reply_p95": _percentile(firsts, 95),
+                "latency_p50": _percentile(totals, 50),
+                "latency_p95": _percentile(totals, 95),
+                "latency_max": totals[-1] if totals else 0.0,
+            }
+
+
+def _not_journaled(stats: _ReplyStats, error: JournalError) -> tuple:
+    stats.count("unjournaled")
+    logger.error("[Async] job not journaled, it will not be replayed after a restart: %s", error)
+    return ()
+
+
+def _journal_append(journal, stats: _ReplyStats, message_obj: dict, user_message: str) -> tuple:
+    """Job ids to complete after the push; empty when the journal could not record the job."""
+    try:
+        return (journal.append(message_obj, user_message),)
+    except JournalError as e:
+        return _not_journaled(stats, e)
+
+
+class ReplyDispatcher:
+    """Bounded job queue plus worker threads that answer and push messages."""
+
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 100,
+        handler=None,
+        deliver=None,
+        journal=None,
+        debouncer=None,
+    ):
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers = workers
+        self._handler = handler or self._ask
+        self._deliver = deliver or deliver_reply
+        self._journal = journal
+        self._debouncer = debouncer
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._stats = _ReplyStats()
+        # batches opened but not yet queued; they count against queue_size
+        self._batches_waiting = 0
+        self._batch_cond = threading.Condition()
+
+    @staticmethod
+    def _ask(message_obj: dict, user_message: str):
+        agent_name = agent_for(message_obj)
+        kwargs = dict(
+            user_message=user_message,
+            agent_name=agent_name,
+            session_key=session_key_for(message_obj, agent_name),
+        )
+        priority = message_priority(message_obj)
+        if get_opencode_stream():
+            return routed_stream(admitted_stream(stream_opencode, priority))(**kwargs)
+        follow_up = in_conversation(kwargs["session_key"])
+        reply = ask_coalesced(routed(admitted(ask_opencode, priority)), **kwargs)
+        if not follow_up:
+            store_answer(user_message, agent_name, reply)
+        return reply
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for i in range(self._workers):
+                t = threading.Thread(target=self._run, name=f"reply-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            if self._debouncer is not None:
+                t = threading.Thread(target=self._flush_batches, name="reply-debounce", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, message_obj: dict, user_message: str) -> bool:
+        """Enqueue a message (journaled first, if enabled); returns False when the queue is full."""
+        self.start()
+        if self._debouncer is not None:
+            return self._submit_batched(message_obj, user_message)
+        job_ids = ()
+        if self._journal is not None and not self._queue.full():
+            job_ids = _journal_append(self._journal, self._stats, message_obj, user_message)
+        try:
+            self._queue.put_nowait((message_obj, user_message, time.monotonic(), tracing.current(), job_ids))
+        except queue.Full:
+            for job_id in job_ids:
+                self._journal.complete(job_id, ok=False)
+            return self._reject()
+        self._stats.count("submitted")
+        return True
+
+    def _reject(self) -> bool:
+        self._stats.count("rejected")
+        logger.warning("[Async] reply queue full, rejecting message")
+        return False
+
+    def _submit_batched(self, message_obj: dict, user_message: str) -> bool:
+        with self._lock:
+            if self._queue.qsize() + self._batches_waiting >= self._queue.maxsize:
+                return self._reject()
+            self._batches_waiting += 1
+        job_ids = ()
+        if self._journal is not None:
+            job_ids = _journal_append(self._journal, self._stats, message_obj, user_message)
+        batch = self._debouncer.add(message_obj, user_message, job_ids, trace=tracing.current())
+        if batch is None:
+            # joined the sender's open batch
+            with self._lock:
+                self._batches_waiting -= 1
+        with self._batch_cond:
+            self._batch_cond.notify()
+        self._stats.count("submitted")
+        return True
+
+    def _flush_batches(self) -> None:
+        """Queue each debounced batch as one job once its window has passed."""
+        while self._started:
+            with self._batch_cond:
+                deadline = self._debouncer.next_deadline()
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is None or timeout > 0:
+                    self._batch_cond.wait(timeout)
+            for batch in self._debouncer.pop_due():
+                message_obj, user_message, job_ids = self._debouncer.merged(batch)
+                # blocks while the queue is full; the batch already holds its place
+                self._queue.put((message_obj, user_message, time.monotonic(), batch.trace, job_ids))
+                with self._lock:
+                    self._batches_waiting -= 1
+
+    def replay(self) -> int:
+        """Re-queue the journal's unfinished jobs in the background; returns how many."""
+        if self._journal is None:
+            return 0
+        jobs = self._journal.pending()
+        if not jobs:
+            return 0
+        logger.info("[Async] replaying %d unfinished reply jobs", len(jobs))
+        self.start()
+
+        def enqueue():
+            for job_id, message_obj, user_message in jobs:
+                # blocks while the queue is full instead of rejecting replayed jobs
+                self._queue.put((message_obj, user_message, time.monotonic(), None, (job_id,)))
+                self._stats.count("submitted")
+
+        threading.Thread(target=enqueue, name="reply-replay", daemon=True).start()
+        return len(jobs)
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            message_obj, user_message, enqueued_at, trace, job_ids = job
+            with tracing.activate(trace), tracing.span("reply_job") as span:
+                self._stats.started(enqueued_at)
+                ok = False
+                try:
+                    ok = self._push(message_obj, self._handler(message_obj, user_message), enqueued_at)
+                except Exception:
+                    logger.exception("[Async] reply job failed")
+                finally:
+                    for job_id in job_ids:
+                        self._journal.complete(job_id, ok)
+                    span.set(ok=ok)
+                    self._stats.finished(enqueued_at, ok)
+                    self._queue.task_done()
+
+    def _push(self, message_obj: dict, reply, enqueued_at: float) -> bool:
+        """Deliver a reply or each chunk of a streamed reply; True if all were sent."""
+        ok, sent_any = True, False
+        for chunk in [reply] if isinstance(reply, str) else reply:
+            if not chunk:
+                continue
+            sent = bool(self._deliver(message_obj, chunk))
+            if sent:
+                self._stats.sent(enqueued_at, first=not sent_any)
+                sent_any = True
+            ok = ok and sent
+        return ok and sent_any
+
+    def wait_idle(self, timeout: float | None = None) -> bool:
+        """Block until all queued jobs are processed; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._batches_waiting:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def shutdown(self, timeout: float | None = None) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._started = False
+        with self._batch_cond:
+            self._batch_cond.notify()
+        for _ in range(self._workers if threads else 0):
+            self._queue.put(None)
+        for t in threads:
+            t.join(timeout)
+
+    def stats(self) -> dict:
+        body = self._stats.snapshot(self._queue.qsize(), self._queue.maxsize, self._workers)
+        if self._debouncer is not None:
+            body["debounce"] = self._debouncer.stats()
+        return body
+
+
+class AsyncioReplyDispatcher:
+    """
+    ``ReplyDispatcher`` for the ASGI server: one task per message, at most
+    ``workers`` running OpenCode concurrently and ``queue_size`` waiting.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 100,
+        handler=None,
+        deliver=None,
+        journal=None,
+        debouncer=None,
+    ):
+        self._workers = workers
+        self._queue_size = queue_size
+        self._handler = handler or self._ask
+        self._deliver = deliver or deliver_reply_async
+        self._journal = journal
+        self._debouncer = debouncer
+        self._semaphore: asyncio.Semaphore | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._waiting = 0
+        self._stats = _ReplyStats()
+
+    @staticmethod
+    async def _ask(message_obj: dict, user_message: str):
+        agent_name = agent_for(message_obj)
+        kwargs = dict(
+            user_message=user_message,
+            agent_name=agent_name,
+            session_key=session_key_for(message_obj, agent_name),
+        )
+        priority = message_priority(message_obj)
+        if get_opencode_stream():
+            return routed_stream_async(admitted_stream_async(stream_opencode_async, priority))(**kwargs)
+        follow_up = await asyncio.to_thread(in_conversation, kwargs["session_key"])
+        reply = await ask_coalesced_async(
+            routed_async(admitted_async(ask_opencode_async, priority)), **kwargs
+        )
+        if not follow_up:
+            await asyncio.to_thread(store_answer, user_message, agent_name, reply)
+        return reply
+
+    def submit(self, message_obj: dict, user_message: str, job_id: int | None = None) -> bool:
+        """Schedule a message on the running loop; returns False when the queue is full."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._workers)
+        if self._waiting >= self._queue_size and job_id is None:
+            self._stats.count("rejected")
+            logger.warning("[Async] reply queue full, rejecting message")
+            return False
+        self._stats.count("submitted")
+        job_ids = () if job_id is None else (job_id,)
+        if self._debouncer is None:
+            self._schedule(self._run(message_obj, user_message, time.monotonic(), job_ids))
+            return True
+        batch = self._debouncer.add(message_obj, user_message, job_ids)
+        if batch is not None:
+            self._schedule(self._run_batch(batch))
+        return True
+
+    def _schedule(self, coro) -> None:
+        self._waiting += 1
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit_async(self, message_obj: dict, user_message: str) -> bool:
+        """``submit()`` that first records the job in the journal, if one is configured."""
+        if self._journal is None or self._waiting >= self._queue_size:
+            return self.submit(message_obj, user_message)
+        try:
+            job_id = await self._journal.append_async(message_obj, user_message)
+        except JournalError as e:
+            _not_journaled(self._stats, e)
+            job_id = None
+        return self.submit(message_obj, user_message, job_id)
+
+    def replay(self) -> int:
+        """Schedule the journal's unfinished jobs on the running loop; returns how many."""
+        if self._journal is None:
+            return 0
+        jobs = self._journal.pending()
+        if jobs:
+            logger.info("[Async] replaying %d unfinished reply jobs", len(jobs))
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._workers)
+        for job_id, message_obj, user_message in jobs:
+            self._stats.count("submitted")
+            self._schedule(self._run(message_obj, user_message, time.monotonic(), (job_id,)))
+        return len(jobs)
+
+    async def _run_batch(self, batch) -> None:
+        """Wait out the batch's debounce window (extended by later messages), then answer it."""
+        while (wait := self._debouncer.remaining(batch)) > 0:
+            await asyncio.sleep(wait)
+        message_obj, user_message, job_ids = self._debouncer.close(batch)
+        await self._run(message_obj, user_message, time.monotonic(), job_ids)
+
+    async def _run(self, message_obj: dict, user_message: str, enqueued_at: float, job_ids=()) -> None:
+        async with self._semaphore:
+            self._waiting -= 1
+            # the task inherited the callback's trace context from submit()
+            with tracing.span("reply_job") as span:
+                self._stats.started(enqueued_at)
+                ok = False
+                cancelled = False
+                try:
+                    reply = await self._handler(message_obj, user_message)
+                    ok = await self._push(message_obj, reply, enqueued_at)
+                except asyncio.CancelledError:
+                    cancelled = True  # shutting down: leave the job for replay
+                    raise
+                except Exception:
+                    logger.exception("[Async] reply job failed")
+                finally:
+                    if not cancelled:
+                        for job_id in job_ids:
+                            self._journal.complete(job_id, ok)
+                    span.set(ok=ok)
+                    self._stats.finished(enqueued_at, ok)
+
+    async def _push(self, message_obj: dict, reply, enqueued_at: float) -> bool:
+        """``ReplyDispatcher._push`` for a string or an async iterator of chunks."""
+        if isinstance(reply, str):
+            reply = _single(reply)
+        ok, sent_any = True, False
+        async for chunk in reply:
+            if not chunk:
+                continue
+            sent = bool(await self._deliver(message_obj, chunk))
+            if sent:
+                self._stats.sent(enqueued_at, first=not sent_any)
+                sent_any = True
+            ok = ok and sent
+        return ok and sent_any
+
+    async def wait_idle(self, timeout: float | None = None) -> bool:
+        """Wait until all scheduled jobs are done; returns False on timeout."""
+        if not self._tasks:
+            return True
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        return not pending
+
+    def stats(self) -> dict:
+        body = self._stats.snapshot(self._waiting, self._queue_size, self._workers)
+        if self._debouncer is not None:
+            body["debounce"] = self._debouncer.stats()
+        return body
@@ -0,0 +1 @@
+# Benchmarks for wework-robot-opencode (run with: python -m benchmarks.<name>)
@@ -0,0 +1,268 @@
+"""
+Throughput, latency and memory of the full callback path.
+
+Starts the app in a child process for each server mode (``wsgi``: Flask on
+werkzeug's threaded server, ``asgi``: uvicorn) and reply mode (``passive``,
+``async``), backed by the local stub OpenCode (with ``--opencode-latency``
+per agent run) and stub qyapi from ``tests/stubs.py``. Callbacks are real
+WeCom envelopes encrypted with the in-repo crypto, from ``--users`` distinct
+senders with unique questions, so the callback dedup, session reuse and
+single-flight paths behave as in production; the answer cache is off.
+
+Each mode is driven by ``--concurrency`` closed-loop clients sending
+``--requests`` callbacks. Latency is callback to HTTP response: the whole
+agent run in passive mode, the ack in async mode, where ``delivered_per_sec``
+counts answers pushed to qyapi. Memory is the server process's RSS before the
+run and its peak during it.
+
+    python -m benchmarks.bench_callback --requests 2000 --concurrency 1 8 32 \\
+        --output bench-callback.json --baseline previous.json
+
+``--output`` writes the results with the commit and parameters;
+``--baseline`` prints the change against such a file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from tests.stubs import FakeOpenCode, FakeQyapi, WorkerProcess
+from wework_crypto import FastWXBizJsonMsgCrypt
+
+TOKEN = "QDG6eK"
+AES_KEY = "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C"
+RECEIVE_ID = "wwbenchcorp"
+
+_TOPICS = ("nginx 网关", "k8s 部署", "redis 集群", "发布流程", "告警规则", "SDK 鉴权", "CI 流水线", "日志检索")
+_ASKS = ("怎么配置{}？", "{}出错了怎么排查", "请问{}的文档在哪里", "{}和旧版本有什么区别", "如何回滚{}")
+
+# keep the app's own limits out of the measurement unless overridden with --env
+_DEFAULT_ENV = {
+    "ANSWER_CACHE": "0",
+    "OPENCODE_MAX_CONCURRENCY": "0",
+    "WEWORK_SEND_RATE_PER_MINUTE": "1000000",
+    "WEWORK_SEND_BURST": "1000",
+    "WEWORK_ASYNC_QUEUE_SIZE": "100000",
+    "WEWORK_ASYNC_WORKERS": "32",
+}
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _callbacks(count: int, users: int, seed: int, start_id: int) -> list[tuple[dict, str]]:
+    """Encrypted callbacks as ``(query params, body)``."""
+    rng = random.Random(seed)
+    crypt = FastWXBizJsonMsgCrypt(TOKEN, AES_KEY, RECEIVE_ID)
+    out = []
+    for i in range(count):
+        msg_id = start_id + i
+        message = {
+            "ToUserName": RECEIVE_ID,
+            "FromUserName": f"user{rng.randrange(users)}",
+            "CreateTime": 1700000000 + msg_id,
+            "MsgType": "text",
+            "Content": rng.choice(_ASKS).format(rng.choice(_TOPICS)) + f"（{msg_id}）",
+            "MsgId": str(msg_id),
+            "AgentID": 1000002,
+        }
+        nonce = f"n{msg_id}"
+        _, encrypted = crypt.EncryptMsg(json.dumps(message, ensure_ascii=False), nonce, str(message["CreateTime"]))
+        envelope = json.loads(encrypted)
+        params = {"msg_signature": envelope["msgsignature"], "timestamp": envelope["timestamp"], "nonce": nonce}
+        out.append((params, json.dumps({"encrypt": envelope["encrypt"]})))
+    return out
+
+
+def _drive(url: str, callbacks: list, concurrency: int) -> tuple[float, list[float], int]:
+    local = threading.local()
+    errors = []
+
+    def one(callback) -> float:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        params, body = callback
+        t0 = time.perf_counter()
+        try:
+            resp = session.post(f"{url}/webhook/wework", params=params, data=body, timeout=60)
+            if resp.status_code != 200:
+                errors.append(resp.status_code)
+        except requests.RequestException as e:
+            errors.append(type(e).__name__)
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, callbacks))
+    return time.perf_counter() - start, latencies, len(errors)
+
+
+def _wait_delivered(qyapi: FakeQyapi, expected: int, timeout: float = 120.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if len(qyapi.calls("POST", "/cgi-bin/message/send")) >= expected:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def _run_mode(server: str, reply_mode: str, concurrency: int, args, opencode, qyapi) -> dict:
+    env = {
+        k: v for k, v in os.environ.items()
+        if not k.startswith(("WEWORK_", "OPENCODE_", "ANSWER_CACHE", "JOB_JOURNAL"))
+    }
+    env.update(_DEFAULT_ENV)
+    env.update(
+        WEWORK_TOKEN=TOKEN,
+        WEWORK_ENCODING_AES_KEY=AES_KEY,
+        WEWORK_RECEIVE_ID=RECEIVE_ID,
+        WEWORK_REPLY_MODE=reply_mode,
+        WEWORK_CORP_SECRET="bench-secret",
+        WEWORK_API_BASE=qyapi.url,
+        OPENCODE_API_URL=opencode.url,
+    )
+    env.update(args.env)
+
+    warmup = _callbacks(args.warmup, args.users, args.seed, 1)
+    callbacks = _callbacks(args.requests, args.users, args.seed + 1, 1 + args.warmup)
+    with WorkerProcess(server, env) as worker:
+        _drive(worker.url, warmup, concurrency)
+        sent_before = len(qyapi.calls("POST", "/cgi-bin/message/send"))
+        if reply_mode == "async":
+            _wait_delivered(qyapi, sent_before)
+        rss_start = worker.rss_bytes()
+        peak = [rss_start]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                peak[0] = max(peak[0], worker.rss_bytes())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        seconds, latencies, errors = _drive(worker.url, callbacks, concurrency)
+        delivered_per_sec = None
+        if reply_mode == "async" and _wait_delivered(qyapi, sent_before + args.requests):
+            delivered_per_sec = round(args.requests / (time.perf_counter() - started), 1)
+        done.set()
+        sampler.join()
+    return {
+        "server": server,
+        "reply_mode": reply_mode,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "req_per_sec": round(args.requests / seconds, 1),
+        "delivered_per_sec": delivered_per_sec,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+        "rss_start_mb": round(rss_start / 2**20, 1),
+        "rss_peak_mb": round(peak[0] / 2**20, 1),
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def _key(r: dict) -> tuple:
+    return r["server"], r["reply_mode"], r["concurrency"]
+
+
+def _print_comparison(results: list[dict], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {_key(r): r for r in baseline["results"]}
+    print(f"vs {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for r in results:
+        old = previous.get(_key(r))
+        if old is None:
+            continue
+        print(
+            f"  {r['server']:>4} {r['reply_mode']:>7} c={r['concurrency']:<3} "
+            f"req/s {(r['req_per_sec'] / old['req_per_sec'] - 1) * 100:+6.1f}%  "
+            f"p99 {(r['p99_ms'] / old['p99_ms'] - 1) * 100:+6.1f}%  "
+            f"rss peak {r['rss_peak_mb'] - old['rss_peak_mb']:+.1f} MiB"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--servers", nargs="+", choices=["wsgi", "asgi"], default=["wsgi", "asgi"])
+    parser.add_argument("--reply-modes", nargs="+", choices=["passive", "async"], default=["passive", "async"])
+    parser.add_argument("--opencode-latency", type=float, default=0.05, help="seconds per agent run")
+    parser.add_argument("--reply-chars", type=int, default=300, help="length of each stub answer")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the app"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+    args.env = dict(item.split("=", 1) for item in args.env)
+
+    answer = ("根据文档，" + "请参考部署手册中的对应章节。" * args.reply_chars)[: args.reply_chars]
+    results = []
+    with FakeOpenCode(reply=answer, latency=args.opencode_latency) as opencode, FakeQyapi() as qyapi:
+        for server in args.servers:
+            for reply_mode in args.reply_modes:
+                for concurrency in args.concurrency:
+                    r = _run_mode(server, reply_mode, concurrency, args, opencode, qyapi)
+                    results.append(r)
+                    delivered = f"  delivered {r['delivered_per_sec']}/s" if r["delivered_per_sec"] else ""
+                    print(
+                        f"{server:>4} {reply_mode:>7} c={concurrency:<3} {r['req_per_sec']:>8.1f} req/s  "
+                        f"p50/p95/p99 {r['p50_ms']}/{r['p95_ms']}/{r['p99_ms']} ms  "
+                        f"rss {r['rss_start_mb']}->{r['rss_peak_mb']} MiB  errors {r['errors']}{delivered}",
+                        flush=True,
+                    )
+
+    if args.output:
+        report = {
+            "benchmark": "callback",
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "params": {
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "opencode_latency": args.opencode_latency,
+                "reply_chars": args.reply_chars,
+                "users": args.users,
+                "env": args.env,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        _print_comparison(results, args.baseline)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Encrypt/decrypt throughput of the callback crypto.
+
+Measures ``FastWXBizJsonMsgCrypt`` and, when ``weworkapi_python`` is checked
+out, the official ``WXBizJsonMsgCrypt`` for a typical callback and a 2 KB
+message.
+
+    python -m benchmarks.bench_crypto --iterations 20000
+"""
+
+import argparse
+import json
+import time
+
+from wework_crypto import FastWXBizJsonMsgCrypt, get_official_wxbiz_class
+
+TOKEN = "QDG6eK"
+AES_KEY = "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C"
+RECEIVE_ID = "wx5823bf96d3bd56c7"
+
+TYPICAL = json.dumps(
+    {
+        "ToUserName": RECEIVE_ID,
+        "FromUserName": "zhangsan",
+        "CreateTime": 1700000000,
+        "MsgType": "text",
+        "Content": "怎么配置 OpenCode 的 agent？",
+        "MsgId": "7000000000000000001",
+        "AgentID": 1000002,
+    },
+    ensure_ascii=False,
+)
+LARGE = json.dumps({"MsgType": "text", "Content": "文" * 680}, ensure_ascii=False)  # ~2 KB
+
+
+def _bench(crypt, message: str, iterations: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _, encrypted = crypt.EncryptMsg(message, "nonce", "1700000000")
+    encrypt_s = time.perf_counter() - start
+
+    data = json.loads(encrypted)
+    body = json.dumps({"encrypt": data["encrypt"]})
+    signature = data["msgsignature"]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ret, _ = crypt.DecryptMsg(body, signature, "1700000000", "nonce")
+    decrypt_s = time.perf_counter() - start
+    assert ret == 0
+    return {
+        "encrypt_per_sec": round(iterations / encrypt_s),
+        "decrypt_per_sec": round(iterations / decrypt_s),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    impls = {"fast": FastWXBizJsonMsgCrypt}
+    try:
+        impls["official"] = get_official_wxbiz_class()
+    except ImportError:
+        print("official weworkapi_python not found, benchmarking the fast implementation only")
+
+    results = []
+    for impl_name, cls in impls.items():
+        crypt = cls(TOKEN, AES_KEY, RECEIVE_ID)
+        for size_name, message in (("typical", TYPICAL), ("2kb", LARGE)):
+            row = {
+                "impl": impl_name,
+                "message": size_name,
+                "bytes": len(message.encode()),
+                **_bench(crypt, message, args.iterations),
+            }
+            results.append(row)
+            print(
+                f"{impl_name:>8} {size_name:>7} ({row['bytes']:>4} B)  "
+                f"encrypt {row['encrypt_per_sec']:>8}/s  decrypt {row['decrypt_per_sec']:>8}/s"
+            )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Enqueue cost of the durable job journal at high message rates.
+
+Several threads (standing in for callback handlers) append jobs to a
+``JobJournal`` as fast as they can, each append waiting for its commit, and
+the completions are marked as the workers would. Reports appends per second,
+append latency and how many appends each fsync carried, next to the cost of a
+plain in-memory ``queue.Queue.put``.
+
+    python -m benchmarks.bench_job_journal --jobs 20000 --threads 1 8 32
+"""
+
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from job_journal import JobJournal
+
+MESSAGE = {
+    "ToUserName": "wwcorp",
+    "FromUserName": "zhangsan",
+    "MsgType": "text",
+    "Content": "怎么重启 nginx 网关？",
+    "MsgId": "1234567890",
+    "AgentID": 1000002,
+}
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _drive(threads: int, jobs: int, enqueue) -> tuple[float, list[float]]:
+    per_thread = jobs // threads
+    latencies: list[list[float]] = [[] for _ in range(threads)]
+    start_gate = threading.Barrier(threads + 1)
+
+    def worker(out: list[float]) -> None:
+        start_gate.wait()
+        for i in range(per_thread):
+            t0 = time.perf_counter()
+            enqueue(i)
+            out.append(time.perf_counter() - t0)
+
+    pool = [threading.Thread(target=worker, args=(out,)) for out in latencies]
+    for t in pool:
+        t.start()
+    start_gate.wait()
+    started = time.perf_counter()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - started, [x for out in latencies for x in out]
+
+
+def _run(threads: int, jobs: int, directory: str) -> dict:
+    memory = queue.Queue()
+    mem_seconds, mem_latency = _drive(threads, jobs, lambda i: memory.put((MESSAGE, "q", i)))
+
+    path = os.path.join(directory, f"jobs-{threads}.sqlite3")
+    journal = JobJournal(path)
+
+    def enqueue(i: int) -> None:
+        job_id = journal.append(MESSAGE, MESSAGE["Content"])
+        journal.complete(job_id, ok=True)
+
+    seconds, latency = _drive(threads, jobs, enqueue)
+    journal.flush()
+    stats = journal.stats()
+    journal.close()
+    appended = stats["appended"]
+    return {
+        "threads": threads,
+        "jobs": appended,
+        "appends_per_sec": round(appended / seconds, 1),
+        "append_p50_us": round(_percentile(latency, 50) * 1e6, 1),
+        "append_p99_us": round(_percentile(latency, 99) * 1e6, 1),
+        "commits": stats["commits"],
+        "appends_per_commit": round(appended / max(1, stats["commits"]), 1),
+        "memory_puts_per_sec": round(len(mem_latency) / mem_seconds, 1),
+        "memory_put_p99_us": round(_percentile(mem_latency, 99) * 1e6, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--dir", default=None, help="directory for the journal files (default: a temp dir)")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for threads in args.threads:
+            r = _run(threads, args.jobs, directory)
+            results.append(r)
+            print(
+                f"threads={r['threads']:<3} journal {r['appends_per_sec']:>8.0f}/s  "
+                f"append p50/p99 {r['append_p50_us']}/{r['append_p99_us']} us  "
+                f"{r['appends_per_commit']} appends/commit  "
+                f"(in-memory {r['memory_puts_per_sec']:.0f}/s, p99 {r['memory_put_p99_us']} us)",
+                flush=True,
+            )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
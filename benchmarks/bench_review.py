@@ -0,0 +1,75 @@
+"""
+Wall time of a wave of MR reviews, reviewed one by one or concurrently.
+
+A batch of ``--mrs`` MR URLs, plus ``--duplicates`` repeats of some of them,
+goes through ``ReviewDispatcher.review_many`` against a local stub OpenCode
+whose agent run takes ``--review-latency`` seconds. Concurrency 1 matches
+the old one-``send_opencode_review``-at-a-time behaviour.
+
+    python -m benchmarks.bench_review --mrs 24 --concurrency 1 4 8
+"""
+
+import argparse
+import json
+import os
+import time
+
+from opencode_review import ReviewDispatcher
+from tests.stubs import FakeOpenCode
+
+MR = "https://gitlab.example.com/group/project/-/merge_requests/{}"
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mrs", type=int, default=16)
+    parser.add_argument("--duplicates", type=int, default=4, help="repeated URLs added to the batch")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--review-latency", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = []
+    with FakeOpenCode(latency=args.review_latency, agents=("code-reviewer",)) as stub:
+        os.environ["OPENCODE_ENABLED"] = "1"
+        os.environ["OPENCODE_API_URL"] = stub.url
+        os.environ["OPENCODE_AGENT_NAME"] = "code-reviewer"
+        for run, concurrency in enumerate(args.concurrency):
+            # distinct URLs per run keep the stub's sessions apart
+            urls = [MR.format(f"{run}{i}") for i in range(args.mrs)]
+            urls += urls[: args.duplicates]
+            dispatcher = ReviewDispatcher(concurrency=concurrency)
+            sent_before = len(stub.calls("POST", "/session/"))
+            start = time.perf_counter()
+            reviews = dispatcher.review_many(urls)
+            elapsed = time.perf_counter() - start
+            dispatcher.close()
+            done = [r for r in reviews if r["status"] == "ok"]
+            results.append(
+                {
+                    "concurrency": concurrency,
+                    "urls": len(urls),
+                    "reviewed": len(done),
+                    "duplicates": sum(r["status"] == "duplicate" for r in reviews),
+                    "agent_runs": len(stub.calls("POST", "/session/")) - sent_before,
+                    "wall_seconds": round(elapsed, 3),
+                    "review_p50_ms": round(_percentile([r["seconds"] for r in done], 50) * 1000, 1),
+                    "queued_p95_ms": round(_percentile([r["queued_seconds"] for r in done], 95) * 1000, 1),
+                }
+            )
+
+    for r in results:
+        print(
+            f"concurrency={r['concurrency']:<3} {r['reviewed']}/{r['urls']} reviewed "
+            f"({r['duplicates']} duplicates, {r['agent_runs']} agent runs)  wall {r['wall_seconds']} s  "
+            f"review p50 {r['review_p50_ms']} ms  queued p95 {r['queued_p95_ms']} ms"
+        )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+First-message latency of new conversations with and without the session pool.
+
+New conversations arrive at ``--rate`` per second (Poisson) and each sends
+one message through ``ask_opencode`` to a local stub OpenCode whose
+``POST /session`` takes ``--session-latency`` seconds and each agent run
+``--message-latency``. Without the pool every first message creates its
+session first; with ``OPENCODE_SESSION_POOL_MAX`` set it starts on a
+pre-created one while the pool refills in the background.
+
+    python -m benchmarks.bench_session_pool --conversations 200 --rate 5 20
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+import opencode_session_pool
+from opencode_client import ask_opencode
+from tests.stubs import FakeOpenCode
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _run(url: str, conversations: int, rate: float, seed: int, run: int) -> list[float]:
+    rng = random.Random(seed)
+    latencies = []
+    for i in range(conversations):
+        time.sleep(rng.expovariate(rate))
+        start = time.perf_counter()
+        # a fresh sender per conversation and run, so the session table never has it
+        key = (f"user{run}-{i}", 1, "bench")
+        ask_opencode("怎么部署？", api_url=url, agent_name="docs-searcher", session_key=key)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--rate", type=float, nargs="+", default=[2.0, 10.0], help="new conversations per second")
+    parser.add_argument("--session-latency", type=float, default=0.1)
+    parser.add_argument("--message-latency", type=float, default=0.05)
+    parser.add_argument("--pool-max", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    results = []
+    with FakeOpenCode(latency=args.message_latency, session_latency=args.session_latency) as stub:
+        os.environ["OPENCODE_API_URL"] = stub.url
+        os.environ["OPENCODE_AGENT_NAME"] = "docs-searcher"
+        for run, (rate, pool_max) in enumerate((r, m) for r in args.rate for m in (0, args.pool_max)):
+            os.environ["OPENCODE_SESSION_POOL_MAX"] = str(pool_max)
+            pool = opencode_session_pool.get_session_pool()
+            if pool is not None:
+                # let the pool create its minimum before the first arrival
+                time.sleep(args.session_latency * 2)
+            latencies = _run(stub.url, args.conversations, rate, args.seed, run)
+            stats = pool.stats() if pool is not None else {}
+            if pool is not None:
+                pool.stop()
+                opencode_session_pool._pool = None
+            results.append(
+                {
+                    "mode": "pool" if pool_max else "no-pool",
+                    "rate": rate,
+                    "conversations": args.conversations,
+                    "first_message_p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+                    "first_message_p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+                    "pool_hits": stats.get("hits", 0),
+                    "pool_misses": stats.get("misses", 0),
+                    "estimated_saved_seconds": stats.get("saved_seconds", 0.0),
+                }
+            )
+
+    for r in results:
+        print(
+            f"{r['mode']:>7}  rate={r['rate']:<5} first message p50/p95 "
+            f"{r['first_message_p50_ms']}/{r['first_message_p95_ms']} ms  "
+            f"hits {r['pool_hits']}/{r['pool_hits'] + r['pool_misses']}  "
+            f"saved ~{r['estimated_saved_seconds']} s"
+        )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
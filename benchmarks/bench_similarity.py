@@ -0,0 +1,121 @@
+"""
+Lookup latency and memory of the near-duplicate question index.
+
+Builds a ``MinHashIndex`` over synthetic Chinese / mixed questions at several
+sizes, then times lookups of paraphrases of indexed questions (reordered
+terms, different interrogative) and of unrelated questions.
+
+    python -m benchmarks.bench_similarity --sizes 10000 100000 1000000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import time
+
+from answer_cache import normalize_question
+from similarity_index import MinHashIndex
+
+_PREFIXES = ("怎么", "如何", "请问怎么", "")
+_SUFFIXES = ("", "？", "吗", "呢")
+_LATIN = ("nginx", "k8s", "redis", "gateway", "sdk", "api", "docker", "mysql", "webhook", "ci")
+
+
+def _vocabulary(rng: random.Random, size: int) -> list[str]:
+    return ["".join(chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(2)) for _ in range(size)]
+
+
+def _question(rng: random.Random, vocab: list[str]) -> list[str]:
+    terms = rng.sample(vocab, rng.randint(2, 4))
+    if rng.random() < 0.5:
+        terms.append(rng.choice(_LATIN))
+    return terms
+
+
+def _render(rng: random.Random, terms: list[str]) -> str:
+    return rng.choice(_PREFIXES) + " ".join(terms) + rng.choice(_SUFFIXES)
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _run(size: int, lookups: int, threshold: float, seed: int) -> dict:
+    rng = random.Random(seed)
+    vocab = _vocabulary(rng, 20000)
+    questions = [_question(rng, vocab) for _ in range(size)]
+
+    gc.collect()
+    rss_before = _rss_bytes()
+    index = MinHashIndex()
+    start = time.perf_counter()
+    for i, terms in enumerate(questions):
+        index.add(str(i), index.signature(normalize_question(_render(rng, terms))))
+    build_seconds = time.perf_counter() - start
+    rss_after = _rss_bytes()
+
+    def timed(texts):
+        latencies, found = [], []
+        for text in texts:
+            t0 = time.perf_counter()
+            result = index.query(index.signature(normalize_question(text)), threshold)
+            latencies.append(time.perf_counter() - t0)
+            found.append(result)
+        return latencies, found
+
+    targets = [rng.randrange(size) for _ in range(lookups)]
+    paraphrases = [_render(rng, rng.sample(questions[t], len(questions[t]))) for t in targets]
+    hit_latency, hits = timed(paraphrases)
+    miss_latency, misses = timed(_render(rng, _question(rng, vocab)) for _ in range(lookups))
+
+    return {
+        "size": size,
+        "build_seconds": round(build_seconds, 2),
+        "inserts_per_sec": round(size / build_seconds, 1),
+        "index_bytes": index.approx_bytes(),
+        "rss_growth_bytes": rss_after - rss_before,
+        "hit_rate": round(sum(r is not None and r[0] == str(t) for r, t in zip(hits, targets)) / lookups, 3),
+        "false_match_rate": round(sum(r is not None for r in misses) / lookups, 3),
+        "hit_p50_us": round(_percentile(hit_latency, 50) * 1e6, 1),
+        "hit_p99_us": round(_percentile(hit_latency, 99) * 1e6, 1),
+        "miss_p50_us": round(_percentile(miss_latency, 50) * 1e6, 1),
+        "miss_p99_us": round(_percentile(miss_latency, 99) * 1e6, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        r = _run(size, args.lookups, args.threshold, args.seed)
+        results.append(r)
+        print(
+            f"n={r['size']:<8} build {r['inserts_per_sec']:>8.0f}/s  "
+            f"index {r['index_bytes'] / 2**20:>7.1f} MiB (rss +{r['rss_growth_bytes'] / 2**20:.1f})  "
+            f"hit p50/p99 {r['hit_p50_us']}/{r['hit_p99_us']} us  "
+            f"miss p50/p99 {r['miss_p50_us']}/{r['miss_p99_us']} us  "
+            f"hit rate {r['hit_rate']:.3f}  false {r['false_match_rate']:.3f}",
+            flush=True,
+        )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Connection-setup savings of the shared pooled transport.
+
+Compares a fresh ``requests.post`` per call (the old behaviour) with the
+shared keep-alive session from ``http_transport`` against a local stub
+OpenCode server, at several concurrency levels.
+
+    python -m benchmarks.bench_transport --requests 2000 --concurrency 1 8 32
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_transport
+from tests.stubs import FakeOpenCode
+
+
+def _run(post, url: str, total: int, concurrency: int) -> float:
+    def one(_):
+        resp = post(url, json={"title": "bench"}, timeout=(5, 30))
+        resp.raise_for_status()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args(argv)
+
+    results = []
+    with FakeOpenCode() as stub:
+        url = f"{stub.url}/session"
+        for concurrency in args.concurrency:
+            for mode, post in (
+                ("fresh-connection", requests.post),
+                ("pooled-session", lambda *a, **kw: http_transport.get_session().post(*a, **kw)),
+            ):
+                http_transport.reset_session()
+                before = stub.connections
+                elapsed = _run(post, url, args.requests, concurrency)
+                results.append(
+                    {
+                        "mode": mode,
+                        "concurrency": concurrency,
+                        "requests": args.requests,
+                        "seconds": round(elapsed, 4),
+                        "req_per_sec": round(args.requests / elapsed, 1),
+                        "connections_opened": stub.connections - before,
+                    }
+                )
+
+    for r in results:
+        print(
+            f"{r['mode']:>17}  c={r['concurrency']:<3} {r['req_per_sec']:>9.1f} req/s  "
+            f"{r['connections_opened']:>6} connections"
+        )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+De-duplication of WeCom callback retries.
+
+WeCom retries the same callback (up to three times) when we do not answer
+within 5 seconds. Each message is keyed on ``MsgId`` (or ``FromUserName`` +
+``CreateTime`` when ``MsgId`` is absent); the first delivery claims the key and
+computes the reply, retries attach to the in-flight or completed result. A
+delivery that fails before resolving releases its claim, so a later retry is
+answered instead of waiting out the TTL.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from state_store import StateStoreError, get_state_store
+
+logger = logging.getLogger(__name__)
+
+# value stored while the first delivery is still being answered
+PENDING = "\x00pending"
+
+
+class MemoryDedupBackend:
+    """Process-local LRU + TTL store."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._data: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _get_locked(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item[0]
+
+    def _set_locked(self, key: str, value: str, ttl: float) -> None:
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+        self._cond.notify_all()
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        """Store ``value`` only if ``key`` is absent; returns True when stored."""
+        with self._cond:
+            if self._get_locked(key) is not None:
+                return False
+            self._set_locked(key, value, ttl)
+            return True
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        with self._cond:
+            self._set_locked(key, value, ttl)
+
+    def get(self, key: str) -> str | None:
+        with self._cond:
+            return self._get_locked(key)
+
+    def delete(self, key: str) -> None:
+        with self._cond:
+            self._data.pop(key, None)
+            self._cond.notify_all()
+
+    def wait_for(self, key: str, timeout: float) -> str | None:
+        """Wait until ``key`` holds a non-pending value."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                value = self._get_locked(key)
+                if value is not None and value != PENDING:
+                    return value
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or value is None:
+                    return None
+                self._cond.wait(remaining)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SqliteDedupBackend:
+    """
+    Store shared by every worker process on one host, backed by a SQLite file.
+
+    Suitable for gunicorn-style multi-worker deployments where the retry may
+    land on a different worker than the original callback.
+    """
+
+    _POLL_INTERVAL = 0.05
+
+    def __init__(self, path: str, max_size: int = 10000):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS callback_dedup ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS callback_dedup_expires ON callback_dedup (expires)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        with self._writes_lock:
+            self._writes += 1
+            if self._writes % 100:
+                return
+        conn.execute("DELETE FROM callback_dedup WHERE expires <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM callback_dedup WHERE key IN ("
+            "SELECT key FROM callback_dedup ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,),
+        )
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM callback_dedup WHERE key = ? AND expires <= ?", (key, now)
+            )
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO callback_dedup (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, now + ttl),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if cur.rowcount == 1:
+            self._prune(conn)
+            return True
+        return False
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO callback_dedup (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl),
+        )
+
+    def get(self, key: str) -> str | None:
+        row = self._conn().execute(
+            "SELECT value FROM callback_dedup WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM callback_dedup WHERE key = ?", (key,))
+
+    def wait_for(self, key: str, timeout: float) -> str | None:
+        deadline = time.monotonic() + timeout
+        while True:
+            value = self.get(key)
+            if value is not None and value != PENDING:
+                return value
+            if value is None or time.monotonic() >= deadline:
+                return None
+            time.sleep(self._POLL_INTERVAL)
+
+    def __len__(self) -> int:
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM callback_dedup WHERE expires > ?", (time.time(),)
+        ).fetchone()
+        return row[0]
+
+
+class SharedDedupBackend:
+    """
+    Store shared by every worker through ``state_store`` (e.g. Redis), so a
+    retry is recognised whichever worker or host it lands on.
+
+    When the store is unreachable a callback is treated as a first delivery:
+    answering a retry twice beats not answering at all.
+    """
+
+    _POLL_INTERVAL = 0.05
+
+    def __init__(self, store, namespace: str = "dedup:"):
+        self.store = store
+        self.namespace = namespace
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        try:
+            return self.store.add(self.namespace + key, value, ttl)
+        except StateStoreError as e:
+            logger.warning("[Dedup] state store unavailable, not deduplicating %s: %s", key, e)
+            return True
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        try:
+            self.store.set(self.namespace + key, value, ttl)
+        except StateStoreError as e:
+            logger.warning("[Dedup] could not record the reply of %s: %s", key, e)
+
+    def get(self, key: str) -> str | None:
+        try:
+            return self.store.get(self.namespace + key)
+        except StateStoreError as e:
+            logger.warning("[Dedup] state store unavailable: %s", e)
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            self.store.delete(self.namespace + key)
+        except StateStoreError as e:
+            logger.warning("[Dedup] could not release %s: %s", key, e)
+
+    def wait_for(self, key: str, timeout: float) -> str | None:
+        deadline = time.monotonic() + timeout
+        while True:
+            value = self.get(key)
+            if value is not None and value != PENDING:
+                return value
+            if value is None or time.monotonic() >= deadline:
+                return None
+            time.sleep(self._POLL_INTERVAL)
+
+    def __len__(self) -> int:
+        try:
+            return self.store.count(self.namespace)
+        except StateStoreError:
+            return 0
+
+
+def dedup_key(message_obj: dict) -> str | None:
+    """``MsgId`` when present, else ``FromUserName:CreateTime``; None if neither."""
+    if not isinstance(message_obj, dict):
+        return None
+    msg_id = message_obj.get("MsgId")
+    if msg_id not in (None, ""):
+        return f"msgid:{msg_id}"
+    from_user = message_obj.get("FromUserName")
+    create_time = message_obj.get("CreateTime")
+    if from_user and create_time not in (None, ""):
+        return f"user:{from_user}:{create_time}"
+    return None
+
+
+class CallbackDedup:
+    """Claim / resolve / attach protocol on top of a dedup backend."""
+
+    def __init__(self, backend, ttl: float = 600):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {
+            "misses": 0,
+            "hits_in_flight": 0,
+            "hits_completed": 0,
+            "wait_timeouts": 0,
+            "released": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def claim(self, key: str) -> bool:
+        """True if this is the first delivery of ``key`` and the caller must answer it."""
+        if self.backend.add(key, PENDING, self.ttl):
+            self._count("misses")
+            return True
+        return False
+
+    def resolve(self, key: str, reply_text: str) -> None:
+        self.backend.set(key, reply_text, self.ttl)
+
+    def release(self, key: str) -> None:
+        """Drop an unresolved claim, so the next retry is answered as a first delivery."""
+        self.backend.delete(key)
+        self._count("released")
+
+    def attach(self, key: str, timeout: float) -> str | None:
+        """Return the reply of an earlier delivery, waiting up to ``timeout`` if in flight."""
+        value = self.backend.get(key)
+        if value is not None and value != PENDING:
+            self._count("hits_completed")
+            return value
+        self._count("hits_in_flight")
+        value = self.backend.wait_for(key, timeout) if timeout > 0 else None
+        if value is None:
+            self._count("wait_timeouts")
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        counters["hits"] = counters["hits_in_flight"] + counters["hits_completed"]
+        counters["size"] = len(self.backend)
+        counters["backend"] = type(self.backend).__name__
+        return counters
+
+
+def build_dedup(backend_name: str, ttl: float, max_size: int, sqlite_path: str) -> CallbackDedup | None:
+    """Build the dedup layer from config; returns None when disabled."""
+    if backend_name == "off":
+        return None
+    if backend_name == "shared":
+        backend = SharedDedupBackend(get_state_store())
+    elif backend_name == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+        backend = SqliteDedupBackend(sqlite_path, max_size=max_size)
+    else:
+        backend = MemoryDedupBackend(max_size=max_size)
+    logger.info("[Dedup] using %s backend, ttl=%ss", type(backend).__name__, ttl)
+    return CallbackDedup(backend, ttl=ttl)
@@ -9,10 +9,39 @@ def get_opencode_api_url() -> str:
     return os.environ.get("OPENCODE_API_URL", "http://127.0.0.1:4096")
 
 
+def get_opencode_api_urls() -> list[str]:
+    """OpenCode 后端列表：OPENCODE_API_URLS（逗号分隔），未设置时为 OPENCODE_API_URL。"""
+    urls = [u.strip() for u in os.environ.get("OPENCODE_API_URLS", "").split(",") if u.strip()]
+    return urls or [get_opencode_api_url()]
+
+
 def get_opencode_agent_name() -> str:
     return os.environ.get("OPENCODE_AGENT_NAME", "docs-searcher")
 
 
+def get_opencode_agent_overrides() -> dict[str, str]:
+    """
+    按会话覆盖 agent：OPENCODE_AGENT_OVERRIDES="群聊ChatId或成员UserID=agent,..."，
+    群聊按 ChatId 匹配，其次按发送者匹配。
+    """
+    overrides = {}
+    for item in os.environ.get("OPENCODE_AGENT_OVERRIDES", "").split(","):
+        key, sep, agent = item.partition("=")
+        if sep and key.strip() and agent.strip():
+            overrides[key.strip()] = agent.strip()
+    return overrides
+
+
+def get_opencode_agent_catalog_ttl() -> float:
+    """agent 列表（GET /agent）缓存的刷新间隔（秒）；0 表示不缓存也不校验 agent。"""
+    return max(0.0, _get_float("OPENCODE_AGENT_CATALOG_TTL", 300.0))
+
+
+def get_opencode_review_concurrency() -> int:
+    """批量 MR review 时同时进行的 review 数上限。"""
+    return max(1, _get_int("OPENCODE_REVIEW_CONCURRENCY", 4))
+
+
 def get_wework_webhook_url() -> str:
     return os.environ.get(
         "WEWORK_WEBHOOK_URL",
@@ -41,3 +70,383 @@ def get_wework_encoding_aes_key() -> str:
 def get_wework_receive_id() -> str:
     """回调接收方 ID：自建应用通常是企业 CorpID。"""
     return os.environ.get("WEWORK_RECEIVE_ID", os.environ.get("WEWORK_CORP_ID", ""))
+
+
+def _get_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, "") or default)
+    except ValueError:
+        return default
+
+
+def _get_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, "") or default)
+    except ValueError:
+        return default
+
+
+def get_wework_corp_secret() -> str:
+    """自建应用的 Secret，用于主动发送应用消息（message/send）。"""
+    return os.environ.get("WEWORK_CORP_SECRET", "")
+
+
+def get_wework_api_base() -> str:
+    """企业微信 API 根地址，测试时可指向本地 fake qyapi。"""
+    return os.environ.get("WEWORK_API_BASE", "https://qyapi.weixin.qq.com").rstrip("/")
+
+
+def get_wework_reply_mode() -> str:
+    """回调回复模式：passive（同步被动回复）或 async（立即 ack，再主动推送）。"""
+    mode = os.environ.get("WEWORK_REPLY_MODE", "passive").strip().lower()
+    return mode if mode in ("passive", "async") else "passive"
+
+
+def get_async_worker_count() -> int:
+    """async 模式下处理 OpenCode 请求的 worker 线程数。"""
+    return max(1, _get_int("WEWORK_ASYNC_WORKERS", 4))
+
+
+def get_async_queue_size() -> int:
+    """async 模式下待处理消息队列的最大长度。"""
+    return max(1, _get_int("WEWORK_ASYNC_QUEUE_SIZE", 100))
+
+
+def get_debounce_ms() -> int:
+    """async 模式下同一用户连续消息的合并窗口（毫秒）：窗口内再到的消息并入同一次 agent 调用；0 表示关闭。"""
+    return max(0, _get_int("WEWORK_DEBOUNCE_MS", 0))
+
+
+def get_debounce_max_ms() -> int:
+    """合并窗口从第一条消息起最多延长到多少毫秒，持续输入时也不会无限等待。"""
+    return max(0, _get_int("WEWORK_DEBOUNCE_MAX_MS", 3000))
+
+
+def get_debounce_max_messages() -> int:
+    """一次最多合并多少条消息，达到后立即发送。"""
+    return max(1, _get_int("WEWORK_DEBOUNCE_MAX_MESSAGES", 10))
+
+
+def get_dedup_backend() -> str:
+    """
+    回调去重缓存后端：memory、sqlite（同机多 worker 共享）、shared（WEWORK_STATE_STORE）或 off。
+    未设置时，配置了共享存储则为 shared，否则为 memory。
+    """
+    default = "memory" if get_state_store_url() == "memory" else "shared"
+    backend = os.environ.get("WEWORK_DEDUP_BACKEND", default).strip().lower()
+    return backend if backend in ("memory", "sqlite", "shared", "off") else default
+
+
+def get_dedup_ttl() -> float:
+    """去重记录保留时间（秒）。"""
+    return _get_float("WEWORK_DEDUP_TTL", 600.0)
+
+
+def get_dedup_max_size() -> int:
+    """去重缓存最多保留的消息数。"""
+    return max(1, _get_int("WEWORK_DEDUP_MAX_SIZE", 10000))
+
+
+def get_dedup_sqlite_path() -> str:
+    return os.environ.get("WEWORK_DEDUP_SQLITE_PATH", "/tmp/wework-robot-dedup.sqlite3")
+
+
+def get_dedup_wait_seconds() -> float:
+    """重试回调等待首个请求结果的最长时间，需小于企业微信 5 秒超时。"""
+    return _get_float("WEWORK_DEDUP_WAIT_SECONDS", 4.0)
+
+
+def get_http_pool_connections() -> int:
+    """共享 HTTP 连接池缓存的 host 数量。"""
+    return max(1, _get_int("HTTP_POOL_CONNECTIONS", 10))
+
+
+def get_http_pool_maxsize() -> int:
+    """每个 host 保持的 keep-alive 连接数上限。"""
+    return max(1, _get_int("HTTP_POOL_MAXSIZE", 32))
+
+
+def get_http_connect_timeout() -> float:
+    """建立 TCP 连接的超时时间（秒），与读超时分开配置。"""
+    return _get_float("HTTP_CONNECT_TIMEOUT", 5.0)
+
+
+def get_read_timeout(env_name: str, default: float) -> float:
+    """按 endpoint 配置的读超时（秒）。"""
+    return _get_float(env_name, default)
+
+
+def get_opencode_session_reuse() -> bool:
+    """是否按用户复用 OpenCode session（默认开启）。"""
+    return os.environ.get("OPENCODE_SESSION_REUSE", "1") == "1"
+
+
+def get_opencode_session_idle_ttl() -> float:
+    """复用的 session 空闲多久（秒）后失效。"""
+    return _get_float("OPENCODE_SESSION_IDLE_TTL", 1800.0)
+
+
+def get_opencode_session_max() -> int:
+    """最多同时复用的 session 数，超出按 LRU 淘汰。"""
+    return max(1, _get_int("OPENCODE_SESSION_MAX", 1000))
+
+
+def get_opencode_session_delete_on_evict() -> bool:
+    """淘汰 session 时是否在 OpenCode 服务端 DELETE 该 session。"""
+    return os.environ.get("OPENCODE_SESSION_DELETE_ON_EVICT", "0") == "1"
+
+
+def get_opencode_session_pool_max() -> int:
+    """每个 (后端, agent) 最多预创建多少个空闲 session 供新会话直接使用；0 表示关闭预热池。"""
+    return max(0, _get_int("OPENCODE_SESSION_POOL_MAX", 0))
+
+
+def get_opencode_session_pool_min() -> int:
+    """预热池的最小容量，即使一段时间内没有新会话也保留。"""
+    return max(0, _get_int("OPENCODE_SESSION_POOL_MIN", 1))
+
+
+def get_opencode_session_pool_ttl() -> float:
+    """预创建的 session 闲置多久（秒）后丢弃并重新创建。"""
+    return _get_float("OPENCODE_SESSION_POOL_TTL", 600.0)
+
+
+def get_opencode_session_pool_lead_seconds() -> float:
+    """预热池容量按最近新会话到达速率估算：保留约这么多秒内会到达的新会话所需的 session。"""
+    return _get_float("OPENCODE_SESSION_POOL_LEAD_SECONDS", 60.0)
+
+
+def get_admin_token() -> str:
+    """管理接口（如 /admin/reload-config）的访问令牌；为空时管理接口禁用。"""
+    return os.environ.get("ADMIN_TOKEN", "")
+
+
+def get_opencode_stream() -> bool:
+    """async 回复模式下是否订阅 OpenCode 事件流、分段推送回复（默认关闭）。"""
+    return os.environ.get("OPENCODE_STREAM", "0") == "1"
+
+
+def get_opencode_stream_first_chunk_seconds() -> float:
+    """流式模式下，回复超过该秒数仍未完成时才开始推送已生成的段落。"""
+    return max(0.0, _get_float("OPENCODE_STREAM_FIRST_CHUNK_SECONDS", 8.0))
+
+
+def get_opencode_stream_min_chunk_chars() -> int:
+    """首段之后，累计至少这么多字符的完整段落才推送一次，避免刷屏。"""
+    return max(1, _get_int("OPENCODE_STREAM_MIN_CHUNK_CHARS", 300))
+
+
+def get_wework_send_queue_enabled() -> bool:
+    """async 回复是否经过限速发送队列（默认开启）。"""
+    return os.environ.get("WEWORK_SEND_QUEUE", "1") == "1"
+
+
+def get_wework_send_rate_per_minute() -> float:
+    """每个发送目标（群机器人 key / 应用成员）每分钟最多发送的消息数。"""
+    return max(0.1, _get_float("WEWORK_SEND_RATE_PER_MINUTE", 20.0))
+
+
+def get_wework_send_burst() -> int:
+    """令牌桶容量：空闲一段时间后允许连续发送的消息数。"""
+    return max(1, _get_int("WEWORK_SEND_BURST", 3))
+
+
+def get_wework_send_queue_size() -> int:
+    """每个发送目标最多排队的消息数，超出时丢弃新消息。"""
+    return max(1, _get_int("WEWORK_SEND_QUEUE_SIZE", 100))
+
+
+def get_wework_send_max_retries() -> int:
+    """遇到限频错误码（45009）时的最大重试次数。"""
+    return max(0, _get_int("WEWORK_SEND_MAX_RETRIES", 3))
+
+
+def get_wework_send_backoff() -> float:
+    """限频重试的初始退避时间（秒），每次翻倍。"""
+    return max(0.0, _get_float("WEWORK_SEND_BACKOFF", 2.0))
+
+
+def get_wework_send_wait_seconds() -> float:
+    """调用方等待排队消息发出的最长时间（秒）。"""
+    return max(0.1, _get_float("WEWORK_SEND_WAIT_SECONDS", 120.0))
+
+
+def get_trace_export_path() -> str:
+    """请求追踪 span 导出文件（JSON lines）；为空时只传播 trace ID，不记录 span。"""
+    return os.environ.get("TRACE_EXPORT_PATH", "")
+
+
+def get_answer_cache_enabled() -> bool:
+    """是否缓存重复问题的回答（默认关闭）。"""
+    return os.environ.get("ANSWER_CACHE", "0") == "1"
+
+
+def get_answer_cache_ttl() -> float:
+    """缓存回答的有效期（秒）。"""
+    return _get_float("ANSWER_CACHE_TTL", 86400.0)
+
+
+def get_answer_cache_max_size() -> int:
+    """最多缓存的问题数，超出按 LRU 淘汰。"""
+    return max(1, _get_int("ANSWER_CACHE_MAX_SIZE", 1000))
+
+
+def get_answer_cache_path() -> str:
+    """回答缓存的持久化文件（JSON）；为空时只保存在内存中。"""
+    return os.environ.get("ANSWER_CACHE_PATH", "")
+
+
+def get_answer_cache_save_seconds() -> float:
+    """持久化文件最多每隔多少秒重写一次（合并期间的新回答）；0 表示每次写入都保存。"""
+    return max(0.0, _get_float("ANSWER_CACHE_SAVE_SECONDS", 5.0))
+
+
+def get_answer_cache_version() -> str:
+    """文档版本号；变化时清空回答缓存。"""
+    return os.environ.get("ANSWER_CACHE_VERSION", "")
+
+
+def get_answer_cache_min_chars() -> int:
+    """归一化后短于该长度的问题（如“继续”）依赖上下文，不缓存。"""
+    return max(1, _get_int("ANSWER_CACHE_MIN_CHARS", 4))
+
+
+def get_answer_cache_similar() -> bool:
+    """回答缓存未精确命中时，是否按相似问题（MinHash）匹配（默认关闭）。"""
+    return os.environ.get("ANSWER_CACHE_SIMILAR", "0") == "1"
+
+
+def get_answer_cache_similarity_threshold() -> float:
+    """相似问题的最低相似度（0~1）。"""
+    return min(1.0, max(0.0, _get_float("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.7)))
+
+
+def get_single_flight_enabled() -> bool:
+    """相同问题同时到达时是否只调用一次 OpenCode、共享回答（默认开启）。"""
+    return os.environ.get("OPENCODE_SINGLE_FLIGHT", "1") == "1"
+
+
+def get_single_flight_min_chars() -> int:
+    """归一化后短于该长度的问题依赖各自上下文，不合并。"""
+    return max(1, _get_int("OPENCODE_SINGLE_FLIGHT_MIN_CHARS", 4))
+
+
+def get_opencode_max_concurrency() -> int:
+    """每个 OpenCode 后端同时进行的 agent 调用上限；0 表示不限制。"""
+    return _get_int("OPENCODE_MAX_CONCURRENCY", 8)
+
+
+def get_opencode_max_waiting() -> int:
+    """等待 OpenCode 空闲的最大排队数，超出时直接回复“当前消息较多”。"""
+    return max(0, _get_int("OPENCODE_MAX_WAITING", 32))
+
+
+def get_opencode_max_wait_seconds() -> float:
+    """
+    排队等待 OpenCode 的最长时间（秒），超时后回复“当前消息较多”。
+    被动回复模式下企业微信约 5 秒未收到响应即重试，排队时间最多 3 秒。
+    """
+    wait = max(0.0, _get_float("OPENCODE_MAX_WAIT_SECONDS", 30.0))
+    if get_wework_reply_mode() == "passive":
+        return min(wait, 3.0)
+    return wait
+
+
+def get_opencode_dm_priority() -> bool:
+    """排队时单聊消息是否优先于群聊消息（默认开启）。"""
+    return os.environ.get("OPENCODE_DM_PRIORITY", "1") == "1"
+
+
+def get_opencode_health_interval() -> float:
+    """多个 OpenCode 后端时健康检查（GET /agent）的间隔（秒）；0 表示不检查。"""
+    return max(0.0, _get_float("OPENCODE_HEALTH_INTERVAL", 10.0))
+
+
+def get_opencode_health_threshold() -> int:
+    """连续多少次健康检查失败后摘除后端，连续多少次成功后恢复。"""
+    return max(1, _get_int("OPENCODE_HEALTH_THRESHOLD", 2))
+
+
+def get_opencode_breaker_enabled() -> bool:
+    """是否为每个 OpenCode 后端启用熔断（默认开启）。"""
+    return os.environ.get("OPENCODE_BREAKER", "1") == "1"
+
+
+def get_opencode_breaker_window() -> int:
+    """熔断统计最近多少次调用。"""
+    return max(1, _get_int("OPENCODE_BREAKER_WINDOW", 20))
+
+
+def get_opencode_breaker_min_calls() -> int:
+    """窗口内至少多少次调用后才可能熔断。"""
+    return max(1, _get_int("OPENCODE_BREAKER_MIN_CALLS", 5))
+
+
+def get_opencode_breaker_failure_rate() -> float:
+    """失败（或慢调用）占比达到该值时熔断（0~1）。"""
+    return min(1.0, max(0.0, _get_float("OPENCODE_BREAKER_FAILURE_RATE", 0.5)))
+
+
+def get_opencode_breaker_slow_seconds() -> float:
+    """超过该秒数的调用计为慢调用；0 表示不按耗时熔断。"""
+    return max(0.0, _get_float("OPENCODE_BREAKER_SLOW_SECONDS", 0.0))
+
+
+def get_opencode_breaker_open_seconds() -> float:
+    """熔断后多久（秒）放行探测请求。"""
+    return max(0.0, _get_float("OPENCODE_BREAKER_OPEN_SECONDS", 30.0))
+
+
+def get_opencode_breaker_probes() -> int:
+    """半开状态放行的探测请求数，全部成功后恢复。"""
+    return max(1, _get_int("OPENCODE_BREAKER_PROBES", 2))
+
+
+def get_adaptive_timeout_enabled() -> bool:
+    """OpenCode 读超时是否按观测到的 p99 耗时自适应（默认关闭，使用配置的固定读超时）。"""
+    return os.environ.get("OPENCODE_ADAPTIVE_TIMEOUT", "0") == "1"
+
+
+def get_adaptive_timeout_multiplier() -> float:
+    """自适应读超时 = p99 耗时 × 该倍数。"""
+    return max(1.0, _get_float("OPENCODE_ADAPTIVE_TIMEOUT_MULTIPLIER", 3.0))
+
+
+def get_adaptive_timeout_min() -> float:
+    """自适应读超时的下限（秒）。"""
+    return max(0.1, _get_float("OPENCODE_ADAPTIVE_TIMEOUT_MIN", 10.0))
+
+
+def get_adaptive_timeout_min_samples() -> int:
+    """至少观测到多少次成功调用后才按 p99 调整超时。"""
+    return max(1, _get_int("OPENCODE_ADAPTIVE_TIMEOUT_MIN_SAMPLES", 20))
+
+
+def get_job_journal_path() -> str:
+    """async 模式任务日志（SQLite）路径；为空时不记录，重启后未完成的任务会丢失。"""
+    return os.environ.get("JOB_JOURNAL_PATH", "")
+
+
+def get_job_journal_compact_every() -> int:
+    """每完成多少个任务压缩一次日志（删除已完成的记录）。"""
+    return max(1, _get_int("JOB_JOURNAL_COMPACT_EVERY", 1000))
+
+
+def get_job_journal_max_attempts() -> int:
+    """任务最多重放次数，超过后标记为失败。"""
+    return max(1, _get_int("JOB_JOURNAL_MAX_ATTEMPTS", 3))
+
+
+def get_state_store_url() -> str:
+    """多 worker 共享状态的存储：memory（默认，进程内）或 redis://[:password@]host:port/db。"""
+    return os.environ.get("WEWORK_STATE_STORE", "memory").strip() or "memory"
+
+
+def get_state_prefix() -> str:
+    """共享存储中所有键的前缀，多个部署可共用同一个 Redis。"""
+    return os.environ.get("WEWORK_STATE_PREFIX", "wework-robot:")
+
+
+def get_state_store_timeout() -> float:
+    """访问共享存储的连接 / 读超时（秒）。"""
+    return max(0.05, _get_float("WEWORK_STATE_STORE_TIMEOUT", 1.0))
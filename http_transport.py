@@ -0,0 +1,224 @@
+"""
+Shared HTTP transport for OpenCode and WeCom calls.
+
+One ``requests.Session`` is reused by ``opencode_client`` and ``wework_send``
+so TCP (and TLS for qyapi) connections are kept alive and pooled per host
+instead of being opened on every call. Timeouts are (connect, read) pairs
+configured per endpoint. Requests made inside a trace carry its ID in the
+``X-Trace-Id`` header (see ``tracing``).
+
+The ASGI server uses ``get_async_client()``, an ``httpx.AsyncClient`` with the
+same pool limits, one per event loop.
+
+With ``OPENCODE_ADAPTIVE_TIMEOUT=1`` the read timeout of the OpenCode request
+endpoints follows their observed latency: p99 of recent calls times
+``OPENCODE_ADAPTIVE_TIMEOUT_MULTIPLIER``, never below
+``OPENCODE_ADAPTIVE_TIMEOUT_MIN`` and never above the configured timeout.
+Latencies are kept per endpoint and backend, and MR reviews
+(``opencode.review``) have their own window. A timed-out call counts as the
+configured read timeout, so a cut that turns out too short recovers.
+"""
+
+import asyncio
+import functools
+import threading
+import weakref
+from collections import deque
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from config import (
+    get_adaptive_timeout_enabled,
+    get_adaptive_timeout_min,
+    get_adaptive_timeout_min_samples,
+    get_adaptive_timeout_multiplier,
+    get_http_connect_timeout,
+    get_http_pool_connections,
+    get_http_pool_maxsize,
+    get_read_timeout,
+)
+import metrics
+import tracing
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+# httpx clients are bound to the event loop that first used them
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# endpoint -> (env var for the read timeout, default read timeout in seconds)
+ENDPOINT_READ_TIMEOUTS = {
+    "opencode.session": ("OPENCODE_SESSION_TIMEOUT", 30.0),
+    "opencode.message": ("OPENCODE_MESSAGE_TIMEOUT", 300.0),
+    "opencode.review": ("OPENCODE_MESSAGE_TIMEOUT", 300.0),
+    "opencode.agent": ("OPENCODE_AGENT_TIMEOUT", 10.0),
+    "opencode.delete": ("OPENCODE_DELETE_TIMEOUT", 10.0),
+    "opencode.event": ("OPENCODE_EVENT_TIMEOUT", 300.0),
+    "wework.send": ("WEWORK_SEND_TIMEOUT", 10.0),
+    "wework.token": ("WEWORK_TOKEN_TIMEOUT", 10.0),
+}
+
+
+# endpoints whose read timeout adapts to observed latency (not the long-lived event stream)
+ADAPTIVE_ENDPOINTS = (
+    "opencode.session", "opencode.message", "opencode.review", "opencode.agent", "opencode.delete",
+)
+
+# calls kept per (endpoint, backend) for the p99
+_LATENCY_WINDOW = 512
+
+
+class _LatencyWindow:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=_LATENCY_WINDOW)
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def p99(self, min_samples: int) -> float | None:
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(round(0.99 * (len(ordered) - 1))))]
+
+
+# (endpoint, backend) -> window; backend is None for calls made without one
+_latencies: dict[tuple[str, str | None], _LatencyWindow] = {}
+_latencies_lock = threading.Lock()
+
+
+def _window(endpoint: str, target: str | None) -> _LatencyWindow:
+    key = (endpoint, target.rstrip("/") if target else None)
+    with _latencies_lock:
+        window = _latencies.get(key)
+        if window is None:
+            window = _latencies[key] = _LatencyWindow()
+        return window
+
+
+def _record_latency(service: str, endpoint: str, status, seconds: float, target=None) -> None:
+    name = f"{service}.{endpoint}"
+    if name not in ADAPTIVE_ENDPOINTS:
+        return
+    if status == "timeout":
+        # the call took at least the full configured timeout, however short the adapted one was
+        env_name, default = ENDPOINT_READ_TIMEOUTS[name]
+        seconds = max(seconds, get_read_timeout(env_name, default))
+    elif not (isinstance(status, int) and status < 500):
+        return
+    _window(name, target).add(seconds)
+
+
+metrics.observe_http(_record_latency)
+
+
+def reset_latencies() -> None:
+    """Forget observed latencies; timeouts fall back to the configured values."""
+    with _latencies_lock:
+        _latencies.clear()
+
+
+class _TracingAdapter(HTTPAdapter):
+    """Adds the current trace ID (``X-Trace-Id``) to every request."""
+
+    def add_headers(self, request, **kwargs):
+        tracing.inject(request.headers)
+
+
+async def _inject_trace(request: httpx.Request) -> None:
+    tracing.inject(request.headers)
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    # pool_connections: number of per-host pools kept; pool_maxsize: keep-alive
+    # connections per host. pool_block=False lets bursts open extra connections.
+    adapter = _TracingAdapter(
+        pool_connections=get_http_pool_connections(),
+        pool_maxsize=get_http_pool_maxsize(),
+        max_retries=0,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide pooled session."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def reset_session() -> None:
+    """Close pooled connections; the next ``get_session()`` builds a new pool."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Return the pooled async client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=get_http_pool_connections() * get_http_pool_maxsize(),
+                max_keepalive_connections=get_http_pool_maxsize(),
+            ),
+            event_hooks={"request": [_inject_trace]},
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client() -> None:
+    """Close the async client of the running event loop, if any."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_timeout(endpoint: str, target: str | None = None) -> tuple[float, float]:
+    """(connect, read) timeout for a named endpoint, adapted to ``target``'s latency if enabled."""
+    env_name, default = ENDPOINT_READ_TIMEOUTS[endpoint]
+    read = get_read_timeout(env_name, default)
+    if endpoint in ADAPTIVE_ENDPOINTS and get_adaptive_timeout_enabled():
+        p99 = _window(endpoint, target).p99(get_adaptive_timeout_min_samples())
+        if p99 is not None:
+            adapted = max(get_adaptive_timeout_min(), p99 * get_adaptive_timeout_multiplier())
+            read = min(read, adapted)
+    return get_http_connect_timeout(), read
+
+
+def get_async_timeout(endpoint: str, target: str | None = None) -> httpx.Timeout:
+    """``get_timeout()`` as an ``httpx.Timeout``."""
+    connect, read = get_timeout(endpoint, target)
+    return httpx.Timeout(read, connect=connect)
+
+
+@functools.lru_cache(maxsize=8)
+def get_basic_auth(username: str, password: str) -> HTTPBasicAuth:
+    """Cached auth object, so it is not rebuilt on every call."""
+    return HTTPBasicAuth(username, password)
+
+
+@functools.lru_cache(maxsize=8)
+def get_async_basic_auth(username: str, password: str) -> httpx.BasicAuth:
+    """``get_basic_auth()`` for the httpx client."""
+    return httpx.BasicAuth(username, password)
@@ -0,0 +1,303 @@
+"""
+Durable journal of accepted async-mode reply jobs.
+
+In ``async`` mode the callback is acked as soon as the message is queued, so a
+process restart used to lose every question still being answered. With
+``JOB_JOURNAL_PATH`` set, each accepted job is first recorded in a SQLite
+database (WAL mode) and marked delivered or failed once its answer has been
+pushed. On startup, jobs that were accepted but never finished are replayed.
+
+Writes go through one writer thread that commits everything queued since its
+last commit in a single transaction (group commit): ``append()`` waits for
+the commit that contains its job, so one fsync is shared by every callback
+that arrived in the meantime, and raises ``JournalError`` when that commit
+fails. Completion marks are not waited for. Finished
+rows are deleted every ``JOB_JOURNAL_COMPACT_EVERY`` completions and on
+startup, after which the WAL file is truncated.
+
+Each process needs its own journal file; a shared file would replay jobs that
+another worker is still answering.
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from config import (
+    get_job_journal_compact_every,
+    get_job_journal_max_attempts,
+    get_job_journal_path,
+)
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED = "accepted"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+# queued op that makes the writer thread exit
+_STOP = object()
+
+
+class JournalError(Exception):
+    """A job could not be written to the journal."""
+
+
+class _Waiter(threading.Event):
+    """Event that also carries the error of the commit it waited for."""
+
+    error: Exception | None = None
+
+    def fail(self, error: Exception) -> None:
+        self.error = error
+        self.set()
+
+
+class _LoopEvent:
+    """``_Waiter``-like ``set()`` / ``fail()`` that complete a future on its event loop."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def set(self) -> None:
+        self.loop.call_soon_threadsafe(self._resolve, None)
+
+    def fail(self, error: Exception) -> None:
+        self.loop.call_soon_threadsafe(self._resolve, error)
+
+    def _resolve(self, error: Exception | None) -> None:
+        if self.future.done():
+            return
+        if error is None:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(error)
+
+
+class JobJournal:
+    """SQLite WAL job log with a group-committing writer thread."""
+
+    def __init__(self, path: str, compact_every: int = 1000, max_attempts: int = 3, max_batch: int = 512):
+        """
+        :param path: Database file.
+        :param compact_every: Delete finished rows after this many completions.
+        :param max_attempts: Jobs replayed this many times are marked failed instead.
+        :param max_batch: Most operations committed in one transaction.
+        """
+        self.path = path
+        self.compact_every = max(1, compact_every)
+        self.max_attempts = max(1, max_attempts)
+        self.max_batch = max(1, max_batch)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: every commit is fsynced; batching commits is what keeps this cheap
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reply_jobs ("
+            "id INTEGER PRIMARY KEY, message TEXT NOT NULL, user_message TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, finished REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS reply_jobs_status ON reply_jobs (status, id)"
+        )
+        row = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM reply_jobs").fetchone()
+        self._next_id = row[0] + 1
+        self._id_lock = threading.Lock()
+        self._ops: queue.Queue = queue.Queue()
+        # the counters and the connection are only touched by the writer thread
+        self._finished_since_compact = 0
+        self._counters = {"appended": 0, "completed": 0, "commits": 0, "replayed": 0, "compactions": 0}
+        self._compact()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="job-journal", daemon=True)
+        self._writer.start()
+
+    def _queue_append(self, message_obj: dict, user_message: str, done) -> int:
+        with self._id_lock:
+            job_id = self._next_id
+            self._next_id += 1
+        row = (job_id, json.dumps(message_obj, ensure_ascii=False), user_message, ACCEPTED, time.time())
+        self._ops.put(("append", row, done))
+        return job_id
+
+    def append(self, message_obj: dict, user_message: str, wait: bool = True) -> int:
+        """
+        Record an accepted job and return its id; by default returns once it is
+        on disk, and raises ``JournalError`` if it could not be written.
+        """
+        done = _Waiter() if wait else None
+        job_id = self._queue_append(message_obj, user_message, done)
+        if done is not None:
+            done.wait()
+            if done.error is not None:
+                raise done.error
+        return job_id
+
+    async def append_async(self, message_obj: dict, user_message: str) -> int:
+        """``append()`` that waits for the commit without blocking the event loop."""
+        done = _LoopEvent()
+        job_id = self._queue_append(message_obj, user_message, done)
+        await done.future
+        return job_id
+
+    def complete(self, job_id: int, ok: bool) -> None:
+        """Mark a job delivered (or failed); it is no longer replayed."""
+        self._ops.put(("complete", (DELIVERED if ok else FAILED, time.time(), job_id), None))
+
+    def _call(self, fn):
+        """Run ``fn()`` on the writer thread, after everything queued before it, and return its result."""
+        done, result = threading.Event(), []
+        self._ops.put(("call", lambda: result.append(fn()), done))
+        done.wait()
+        if not result:
+            raise RuntimeError("job journal operation failed")
+        return result[0]
+
+    def flush(self) -> None:
+        """Wait until every queued operation is committed."""
+        self._call(lambda: None)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._ops.get()]
+            # group commit: take whatever else arrived while the last commit ran
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._ops.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(op is _STOP for op in batch)
+            ops = [op for op in batch if op is not _STOP]
+            error = None
+            try:
+                self._commit(ops)
+            except Exception as e:
+                logger.exception("[Journal] commit of %d operations failed", len(ops))
+                error = JournalError(f"commit failed: {e}")
+            for kind, fn, done in ops:
+                if kind == "call":
+                    try:
+                        fn()
+                    except Exception:
+                        logger.exception("[Journal] operation failed")
+                if done is None:
+                    continue
+                if kind == "append" and error is not None:
+                    done.fail(error)
+                else:
+                    done.set()
+            if stop:
+                return
+
+    def _commit(self, ops: list) -> None:
+        appends = [row for kind, row, _ in ops if kind == "append"]
+        completes = [row for kind, row, _ in ops if kind == "complete"]
+        if not appends and not completes:
+            return
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            if appends:
+                conn.executemany(
+                    "INSERT INTO reply_jobs (id, message, user_message, status, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    appends,
+                )
+            if completes:
+                conn.executemany("UPDATE reply_jobs SET status = ?, finished = ? WHERE id = ?", completes)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._counters["commits"] += 1
+        self._counters["appended"] += len(appends)
+        self._counters["completed"] += len(completes)
+        self._finished_since_compact += len(completes)
+        if self._finished_since_compact >= self.compact_every:
+            self._compact()
+
+    def _compact(self) -> int:
+        removed = self._conn.execute("DELETE FROM reply_jobs WHERE status != ?", (ACCEPTED,)).rowcount
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._finished_since_compact = 0
+        self._counters["compactions"] += 1
+        return removed
+
+    def compact(self) -> int:
+        """Delete finished jobs now; returns how many rows were removed."""
+        return self._call(self._compact)
+
+    def _take_pending(self) -> list[tuple[int, dict, str]]:
+        conn = self._conn
+        rows = conn.execute(
+            "SELECT id, message, user_message, attempts FROM reply_jobs WHERE status = ? ORDER BY id",
+            (ACCEPTED,),
+        ).fetchall()
+        jobs, given_up = [], []
+        for job_id, message, user_message, attempts in rows:
+            if attempts >= self.max_attempts:
+                given_up.append((FAILED, time.time(), job_id))
+            else:
+                jobs.append((job_id, json.loads(message), user_message))
+        conn.execute("BEGIN")
+        conn.executemany("UPDATE reply_jobs SET status = ?, finished = ? WHERE id = ?", given_up)
+        conn.executemany(
+            "UPDATE reply_jobs SET attempts = attempts + 1 WHERE id = ?", [(j[0],) for j in jobs]
+        )
+        conn.execute("COMMIT")
+        if given_up:
+            logger.warning(
+                "[Journal] giving up on %d jobs after %d attempts", len(given_up), self.max_attempts
+            )
+        self._counters["replayed"] += len(jobs)
+        return jobs
+
+    def pending(self) -> list[tuple[int, dict, str]]:
+        """
+        Jobs accepted but never finished, oldest first, for replay. Each call
+        counts as an attempt; jobs past ``max_attempts`` are marked failed.
+        """
+        return self._call(self._take_pending)
+
+    def _stats(self) -> dict:
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM reply_jobs WHERE status = ?", (ACCEPTED,)
+        ).fetchone()
+        return {"path": self.path, "unfinished": row[0], **self._counters}
+
+    def stats(self) -> dict:
+        return self._call(self._stats)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._ops.put(_STOP)
+        self._writer.join(timeout=10)
+        self._conn.close()
+
+
+_journal: JobJournal | None = None
+_journal_lock = threading.Lock()
+
+
+def get_job_journal() -> JobJournal | None:
+    """Process-wide journal; None unless ``JOB_JOURNAL_PATH`` is set."""
+    global _journal
+    path = get_job_journal_path()
+    if not path:
+        return None
+    with _journal_lock:
+        if _journal is None or _journal.path != path:
+            _journal = JobJournal(
+                path,
+                compact_every=get_job_journal_compact_every(),
+                max_attempts=get_job_journal_max_attempts(),
+            )
+        return _journal
@@ -0,0 +1,5 @@
+from asgi_app import main
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Per-sender debounce of rapid consecutive messages (async reply mode).
+
+People often type one question as several quick WeCom messages ("我想问下",
+"nginx 网关", "怎么配置超时？"). Answered one by one, each starts its own agent
+run and the answers come back fragmented. ``MessageDebouncer`` collects the
+messages a sender (user, app and chat) sends within ``WEWORK_DEBOUNCE_MS`` of
+each other into one batch; when the window passes without a new message, the
+batch is answered by a single agent run on the texts joined in order.
+
+Every callback is still acked at once: batching happens behind the ack, in
+the reply dispatchers of ``async_reply``. The window is extended by each new
+message but never past ``WEWORK_DEBOUNCE_MAX_MS`` after the first one, and a
+batch of ``WEWORK_DEBOUNCE_MAX_MESSAGES`` is sent immediately. Passive mode
+answers within the callback and is not debounced.
+"""
+
+import threading
+import time
+from collections import deque
+
+import metrics
+import tracing
+from config import get_debounce_max_messages, get_debounce_max_ms, get_debounce_ms
+
+# number of recent batches kept for wait percentiles
+_WAIT_WINDOW = 1024
+
+
+def debounce_key(message_obj: dict) -> tuple | None:
+    """Messages with the same key are merged; None (no sender) is never merged."""
+    if not isinstance(message_obj, dict) or not message_obj.get("FromUserName"):
+        return None
+    return (message_obj["FromUserName"], message_obj.get("AgentID"), message_obj.get("ChatId"))
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+class _Batch:
+    __slots__ = ("key", "message_obj", "texts", "job_ids", "trace", "opened_at", "deadline", "closed")
+
+    def __init__(self, key, message_obj: dict, trace, opened_at: float):
+        self.key = key
+        self.message_obj = message_obj
+        self.texts: list[str] = []
+        self.job_ids: list = []
+        self.trace = trace
+        self.opened_at = opened_at
+        self.deadline = opened_at
+        self.closed = False
+
+
+class MessageDebouncer:
+    """Open batches per sender; the dispatcher answers each batch once it is due."""
+
+    def __init__(
+        self, window: float, max_window: float | None = None, max_messages: int = 10, clock=time.monotonic
+    ):
+        """
+        :param window: Seconds a batch waits for the sender's next message.
+        :param max_window: Seconds after the first message at which a batch is due
+            regardless; None for no cap.
+        :param max_messages: Batch size at which it is due immediately.
+        """
+        self.window = window
+        self.max_window = float("inf") if max_window is None else max(window, max_window)
+        self.max_messages = max(1, max_messages)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._open: dict[tuple, _Batch] = {}
+        self._counters = {"batches": 0, "merged": 0}
+        self._waits = deque(maxlen=_WAIT_WINDOW)
+
+    def add(self, message_obj: dict, user_message: str, job_ids=(), trace=None) -> _Batch | None:
+        """
+        Add a message to its sender's open batch and return None, or open a
+        new batch and return it for the caller to schedule.
+
+        ``job_ids`` (journal ids) are completed with the batch; ``trace`` is
+        kept from the first message for the batch's reply job.
+        """
+        key = debounce_key(message_obj)
+        with self._lock:
+            now = self._clock()
+            batch = self._open.get(key) if key is not None else None
+            joined = batch is not None
+            if not joined:
+                batch = _Batch(key, message_obj, trace, now)
+                if key is None:
+                    # due at once, but still flushed through pop_due()
+                    batch.key = (None, id(batch))
+                self._open[batch.key] = batch
+                self._counters["batches"] += 1
+            else:
+                # the latest message supplies the reply target (same sender, same chat)
+                batch.message_obj = message_obj
+                self._counters["merged"] += 1
+            batch.texts.append(user_message)
+            batch.job_ids.extend(job_ids)
+            if key is None or len(batch.texts) >= self.max_messages:
+                batch.deadline = now
+            else:
+                batch.deadline = min(now + self.window, batch.opened_at + self.max_window)
+        if joined:
+            metrics.DEBOUNCE_MERGED.inc()
+            return None
+        return batch
+
+    def remaining(self, batch: _Batch) -> float:
+        """Seconds until ``batch`` is due (0 when due)."""
+        with self._lock:
+            return max(0.0, batch.deadline - self._clock())
+
+    def next_deadline(self) -> float | None:
+        """Earliest deadline of the open batches, on this debouncer's clock."""
+        with self._lock:
+            return min((batch.deadline for batch in self._open.values()), default=None)
+
+    def pop_due(self) -> list[_Batch]:
+        """Close and return every open batch whose deadline has passed."""
+        with self._lock:
+            now = self._clock()
+            due = [batch for batch in self._open.values() if batch.deadline <= now]
+            for batch in due:
+                self._close_locked(batch, now)
+        for batch in due:
+            self._observe(batch)
+        return due
+
+    def close(self, batch: _Batch) -> tuple[dict, str, list]:
+        """Close ``batch`` (later messages open a new one); returns ``(message_obj, text, job_ids)``."""
+        with self._lock:
+            if not batch.closed:
+                self._close_locked(batch, self._clock())
+        self._observe(batch)
+        return self.merged(batch)
+
+    @staticmethod
+    def merged(batch: _Batch) -> tuple[dict, str, list]:
+        return batch.message_obj, "\n".join(batch.texts), list(batch.job_ids)
+
+    def _close_locked(self, batch: _Batch, now: float) -> None:
+        batch.closed = True
+        batch.deadline = now
+        if self._open.get(batch.key) is batch:
+            del self._open[batch.key]
+
+    def _observe(self, batch: _Batch) -> None:
+        waited = batch.deadline - batch.opened_at
+        metrics.STAGE_SECONDS.observe(waited, stage="debounce")
+        with tracing.activate(batch.trace):
+            tracing.record("debounce", waited)
+        with self._lock:
+            self._waits.append(waited)
+
+    def open_count(self) -> int:
+        with self._lock:
+            return len(self._open)
+
+    def stats(self) -> dict:
+        """``merged`` is the number of agent runs saved; ``wait_*`` the delay added per batch."""
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "window_ms": round(self.window * 1000),
+                "open": len(self._open),
+                **self._counters,
+                "wait_p50": _percentile(waits, 50),
+                "wait_p95": _percentile(waits, 95),
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+
+def build_debouncer() -> MessageDebouncer | None:
+    """Debouncer from ``WEWORK_DEBOUNCE_*``; None when ``WEWORK_DEBOUNCE_MS`` is 0."""
+    window_ms = get_debounce_ms()
+    if window_ms <= 0:
+        return None
+    return MessageDebouncer(
+        window=window_ms / 1000,
+        max_window=get_debounce_max_ms() / 1000,
+        max_messages=get_debounce_max_messages(),
+    )
@@ -0,0 +1,349 @@
+"""
+Prometheus metrics for the callback pipeline.
+
+A small in-process implementation of counters, gauges and histograms rendered
+in the Prometheus text exposition format (``GET /metrics``), so no client
+library is needed. Metrics are process-wide module globals; with several
+worker processes each one exposes its own values, as with the default
+``prometheus_client`` registry.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds; covers crypto (~10us) up to multi-minute agent runs
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        self.clear()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values, extra)} {_format_value(value)}")
+        return lines
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            if not self.labelnames and self.kind in ("counter", "gauge"):
+                # unlabelled counters / gauges are exported as 0 from the start
+                self._values[()] = 0
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield "_total", self.labelnames, key, "", value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        """:param function: optional callable returning the current value(s) at scrape time."""
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = function
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        if self._function is not None:
+            current = self._function()
+            items = sorted(current.items()) if isinstance(current, dict) else [((), current)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        for key, value in items:
+            yield "", self.labelnames, key, "", value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[2] if state else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", self.labelnames, key, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", self.labelnames, key, "", total
+            yield "_count", self.labelnames, key, "", count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        """Reset every recorded value (tests)."""
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+CALLBACKS = Counter(
+    "wework_robot_callbacks", "WeCom callback requests received.", ("method",)
+)
+CALLBACKS_IN_FLIGHT = Gauge(
+    "wework_robot_callbacks_in_flight", "WeCom callback requests being handled."
+)
+STAGE_SECONDS = Histogram(
+    "wework_robot_stage_seconds",
+    "Time spent per callback pipeline stage "
+    "(verify, decrypt, parse, opencode, reply_build, encrypt, queue_wait, admission_wait, debounce, "
+    "callback).",
+    ("stage",),
+)
+FAILURES = Counter(
+    "wework_robot_failures",
+    "Failures per path (decrypt_failed, encrypt_failed, opencode_timeout, ...).",
+    ("reason",),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "wework_robot_http_in_flight", "Outbound HTTP requests in flight.", ("service", "endpoint")
+)
+HTTP_SECONDS = Histogram(
+    "wework_robot_http_seconds", "Outbound HTTP request latency.", ("service", "endpoint")
+)
+HTTP_RESPONSES = Counter(
+    "wework_robot_http_responses",
+    "Outbound HTTP responses by status code (or timeout / error).",
+    ("service", "endpoint", "status"),
+)
+REPLY_JOBS_IN_FLIGHT = Gauge(
+    "wework_robot_reply_jobs_in_flight", "Async-mode reply jobs being answered and pushed."
+)
+ANSWER_CACHE_LOOKUPS = Counter(
+    "wework_robot_answer_cache_lookups",
+    "Answer cache lookups by result (hit / similar / miss).",
+    ("result",),
+)
+ANSWER_CACHE_SECONDS = Histogram(
+    "wework_robot_answer_cache_seconds", "Answer cache lookup latency, including similarity search."
+)
+SINGLE_FLIGHT_COALESCED = Counter(
+    "wework_robot_single_flight_coalesced",
+    "Questions answered by joining an identical in-flight OpenCode call (agent runs saved).",
+)
+DEBOUNCE_MERGED = Counter(
+    "wework_robot_debounce_merged",
+    "Messages merged into a sender's pending batch instead of starting their own agent run.",
+)
+OPENCODE_SESSION_POOL_TAKES = Counter(
+    "wework_robot_opencode_session_pool_takes",
+    "New conversations served from the pre-created session pool (hit) or not (miss).",
+    ("result",),
+)
+OPENCODE_SESSION_POOL_SAVED_SECONDS = Counter(
+    "wework_robot_opencode_session_pool_saved_seconds",
+    "Estimated first-message latency saved by pre-created sessions (POST /session time).",
+)
+OPENCODE_REVIEWS = Counter(
+    "wework_robot_opencode_reviews",
+    "MR reviews by outcome (ok / failed / duplicate / in_progress / agent_missing / disabled).",
+    ("status",),
+)
+OPENCODE_ADMISSIONS = Counter(
+    "wework_robot_opencode_admissions",
+    "OpenCode admission decisions (admitted / rejected_full / rejected_timeout).",
+    ("result",),
+)
+OPENCODE_BACKEND_UP = Gauge(
+    "wework_robot_opencode_backend_up",
+    "1 while an OpenCode backend passes health probes, 0 while it is ejected.",
+    ("backend",),
+)
+OPENCODE_BREAKER_STATE = Gauge(
+    "wework_robot_opencode_breaker_state",
+    "Circuit breaker state per OpenCode backend (0 closed, 1 half-open, 2 open).",
+    ("backend",),
+)
+WEWORK_ERRCODES = Counter(
+    "wework_robot_wework_errcodes", "errcode returned by WeCom send APIs.", ("api", "errcode")
+)
+
+
+class _Call:
+    def __init__(self):
+        self.status = None
+
+
+# callables observer(service, endpoint, status, seconds, target) run after each http_call
+_http_observers = []
+
+
+def observe_http(observer) -> None:
+    """Register ``observer(service, endpoint, status, seconds, target)`` for every ``http_call``."""
+    _http_observers.append(observer)
+
+
+@contextmanager
+def http_call(service: str, endpoint: str, target: str | None = None):
+    """
+    Time one outbound HTTP request (metrics and a ``service.endpoint`` trace span).
+    Set ``call.status`` to the response status code; an exception leaving the
+    block is recorded as ``timeout`` or ``error``. ``target`` (e.g. the backend
+    URL) is passed to observers only, not used as a metric label.
+    """
+    call = _Call()
+    labels = {"service": service, "endpoint": endpoint}
+    HTTP_IN_FLIGHT.inc(**labels)
+    start = time.perf_counter()
+    with tracing.span(f"{service}.{endpoint}") as span:
+        try:
+            yield call
+        except BaseException as e:
+            if call.status is None:
+                call.status = "timeout" if "Timeout" in type(e).__name__ else "error"
+            raise
+        finally:
+            status = call.status if call.status is not None else "error"
+            elapsed = time.perf_counter() - start
+            span.set(status=status)
+            HTTP_IN_FLIGHT.dec(**labels)
+            HTTP_SECONDS.observe(elapsed, **labels)
+            HTTP_RESPONSES.inc(status=status, **labels)
+            for observer in _http_observers:
+                observer(service, endpoint, status, elapsed, target)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a callback pipeline stage into ``STAGE_SECONDS`` and the current trace."""
+    with tracing.span(name), STAGE_SECONDS.time(stage=name):
+        yield
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,310 @@
+"""
+Admission control in front of the OpenCode server.
+
+Each backend (API URL) gets an ``AdmissionLimiter``: at most
+``OPENCODE_MAX_CONCURRENCY`` agent runs at a time, up to
+``OPENCODE_MAX_WAITING`` callers queued for a slot, each for at most
+``OPENCODE_MAX_WAIT_SECONDS``. A caller that finds the queue full, or waits too
+long, gets ``BUSY_REPLY`` right away instead of piling another request onto a
+saturated server and timing out after minutes. Direct messages are queued
+ahead of group messages.
+
+The limiter serves both worker threads and asyncio tasks; a released slot is
+handed straight to the next waiter in priority order.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import (
+    get_opencode_api_url,
+    get_opencode_dm_priority,
+    get_opencode_max_concurrency,
+    get_opencode_max_wait_seconds,
+    get_opencode_max_waiting,
+)
+
+logger = logging.getLogger(__name__)
+
+BUSY_REPLY = "当前消息较多，请稍后再试。"
+
+PRIORITY_DIRECT = 0
+PRIORITY_GROUP = 1
+
+# number of recent waits kept for percentiles
+_WAIT_WINDOW = 1024
+
+
+def message_priority(message_obj: dict) -> int:
+    """``PRIORITY_GROUP`` for group chat callbacks, ``PRIORITY_DIRECT`` otherwise."""
+    if not get_opencode_dm_priority() or not isinstance(message_obj, dict):
+        return PRIORITY_GROUP
+    chat_type = message_obj.get("ChatType") or message_obj.get("chattype")
+    if chat_type == "group" or message_obj.get("ChatId") or message_obj.get("chatid"):
+        return PRIORITY_GROUP
+    return PRIORITY_DIRECT
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(True)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "wake", "granted", "cancelled")
+
+    def __init__(self, priority: int, seq: int, wake):
+        self.priority = priority
+        self.seq = seq
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionLimiter:
+    """Concurrency limit with a bounded, prioritized, time-limited wait queue."""
+
+    def __init__(self, max_concurrent: int = 8, max_waiting: int = 32, max_wait: float = 30.0):
+        """
+        :param max_concurrent: Agent runs allowed at the same time.
+        :param max_waiting: Callers allowed to queue for a slot; more are rejected at once.
+        :param max_wait: Seconds a caller may queue before it is rejected.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting = 0
+        self._heap: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=_WAIT_WINDOW)
+        self._counters = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    def _try_enter_locked(self, priority: int, wake):
+        """(admitted, waiter); waiter is None when admitted at once or rejected."""
+        if self._active < self.max_concurrent and not self._waiting:
+            self._active += 1
+            self._counters["admitted"] += 1
+            return True, None
+        if self._waiting >= self.max_waiting:
+            self._counters["rejected_full"] += 1
+            metrics.OPENCODE_ADMISSIONS.inc(result="rejected_full")
+            return False, None
+        waiter = _Waiter(priority, next(self._seq), wake)
+        heapq.heappush(self._heap, waiter)
+        self._waiting += 1
+        self._counters["queued"] += 1
+        return False, waiter
+
+    def _finish_wait_locked(self, waiter: _Waiter, started: float) -> bool:
+        waited = time.monotonic() - started
+        if not waiter.granted:
+            waiter.cancelled = True
+            self._waiting -= 1
+            self._counters["rejected_timeout"] += 1
+            metrics.OPENCODE_ADMISSIONS.inc(result="rejected_timeout")
+            return False
+        self._counters["admitted"] += 1
+        self._waits.append(waited)
+        metrics.STAGE_SECONDS.observe(waited, stage="admission_wait")
+        return True
+
+    def acquire(self, priority: int = PRIORITY_GROUP) -> bool:
+        """Wait for a slot; False when the queue is full or ``max_wait`` passed."""
+        event = threading.Event()
+        with self._lock:
+            admitted, waiter = self._try_enter_locked(priority, event.set)
+        if waiter is None:
+            if admitted:
+                metrics.OPENCODE_ADMISSIONS.inc(result="admitted")
+            return admitted
+        started = time.monotonic()
+        event.wait(self.max_wait)
+        with self._lock:
+            admitted = self._finish_wait_locked(waiter, started)
+        if admitted:
+            metrics.OPENCODE_ADMISSIONS.inc(result="admitted")
+        return admitted
+
+    async def acquire_async(self, priority: int = PRIORITY_GROUP) -> bool:
+        """``acquire()`` for asyncio tasks; waits without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            admitted, waiter = self._try_enter_locked(
+                priority, lambda: loop.call_soon_threadsafe(_resolve, future)
+            )
+        if waiter is None:
+            if admitted:
+                metrics.OPENCODE_ADMISSIONS.inc(result="admitted")
+            return admitted
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    waiter.cancelled = True
+                    self._waiting -= 1
+            if granted:
+                self.release()
+            raise
+        with self._lock:
+            admitted = self._finish_wait_locked(waiter, started)
+        if admitted:
+            metrics.OPENCODE_ADMISSIONS.inc(result="admitted")
+        return admitted
+
+    def release(self) -> None:
+        """Give the slot to the next waiter, or free it."""
+        with self._lock:
+            while self._heap:
+                waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._waiting -= 1
+                break
+            else:
+                self._active -= 1
+                return
+        waiter.wake()
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_waiting": self.max_waiting,
+                "active": self._active,
+                "waiting": self._waiting,
+                **self._counters,
+                "wait_p50": _percentile(waits, 50),
+                "wait_p95": _percentile(waits, 95),
+            }
+
+
+_limiters: dict[str, AdmissionLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api_url: str | None = None) -> AdmissionLimiter | None:
+    """Limiter of one OpenCode backend; None when ``OPENCODE_MAX_CONCURRENCY=0``."""
+    max_concurrent = get_opencode_max_concurrency()
+    if max_concurrent <= 0:
+        return None
+    api_url = (api_url or get_opencode_api_url()).rstrip("/")
+    with _limiters_lock:
+        limiter = _limiters.get(api_url)
+        if limiter is None:
+            limiter = _limiters[api_url] = AdmissionLimiter(
+                max_concurrent, get_opencode_max_waiting(), get_opencode_max_wait_seconds()
+            )
+        return limiter
+
+
+def admission_stats() -> dict:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {url: limiter.stats() for url, limiter in limiters.items()}
+
+
+def _log_busy(api_url: str | None) -> None:
+    logger.warning("[OpenCode] %s busy, replying %r", api_url or get_opencode_api_url(), BUSY_REPLY)
+
+
+def admitted(ask, priority: int = PRIORITY_GROUP):
+    """Wrap ``ask(**kwargs)`` so it runs within the backend's limit, else returns ``BUSY_REPLY``."""
+
+    def call(**kwargs) -> str:
+        limiter = get_limiter(kwargs.get("api_url"))
+        if limiter is None:
+            return ask(**kwargs)
+        if not limiter.acquire(priority):
+            _log_busy(kwargs.get("api_url"))
+            return BUSY_REPLY
+        try:
+            return ask(**kwargs)
+        finally:
+            limiter.release()
+
+    return call
+
+
+def admitted_async(ask, priority: int = PRIORITY_GROUP):
+    """``admitted()`` for a coroutine function such as ``ask_opencode_async``."""
+
+    async def call(**kwargs) -> str:
+        limiter = get_limiter(kwargs.get("api_url"))
+        if limiter is None:
+            return await ask(**kwargs)
+        if not await limiter.acquire_async(priority):
+            _log_busy(kwargs.get("api_url"))
+            return BUSY_REPLY
+        try:
+            return await ask(**kwargs)
+        finally:
+            limiter.release()
+
+    return call
+
+
+def admitted_stream(stream, priority: int = PRIORITY_GROUP):
+    """``admitted()`` for a chunk generator; the slot is held until the stream ends."""
+
+    def call(**kwargs):
+        limiter = get_limiter(kwargs.get("api_url"))
+        if limiter is None:
+            yield from stream(**kwargs)
+            return
+        if not limiter.acquire(priority):
+            _log_busy(kwargs.get("api_url"))
+            yield BUSY_REPLY
+            return
+        try:
+            yield from stream(**kwargs)
+        finally:
+            limiter.release()
+
+    return call
+
+
+def admitted_stream_async(stream, priority: int = PRIORITY_GROUP):
+    """``admitted_stream()`` for an async chunk generator."""
+
+    async def call(**kwargs):
+        limiter = get_limiter(kwargs.get("api_url"))
+        if limiter is None:
+            async for chunk in stream(**kwargs):
+                yield chunk
+            return
+        if not await limiter.acquire_async(priority):
+            _log_busy(kwargs.get("api_url"))
+            yield BUSY_REPLY
+            return
+        try:
+            async for chunk in stream(**kwargs):
+                yield chunk
+        finally:
+            limiter.release()
+
+    return call
@@ -0,0 +1,239 @@
+"""
+Cached catalog of the agents each OpenCode backend serves.
+
+A misconfigured ``OPENCODE_AGENT_NAME`` used to surface only when the agent
+run timed out, and ``send_opencode_review`` paid a ``GET /agent`` round trip
+per review to log a warning about it. ``AgentCatalog`` loads ``GET /agent``
+from every backend at startup and refreshes it in the background every
+``OPENCODE_AGENT_CATALOG_TTL`` seconds (0 disables the catalog); the backend
+health probes of ``opencode_backends`` update it as well.
+
+Before dispatch, ``ask_opencode`` and the review path check the agent
+against the chosen backend's catalog and answer at once when it is missing.
+A backend whose catalog could not be loaded is not checked (fail open).
+
+``agent_for()`` picks the agent for a callback: ``OPENCODE_AGENT_OVERRIDES``
+maps a group chat's ChatId, or a sender's UserID, to another agent. An
+override naming an agent no backend serves falls back to the default.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+from config import (
+    get_opencode_agent_catalog_ttl,
+    get_opencode_agent_name,
+    get_opencode_agent_overrides,
+    get_opencode_api_urls,
+)
+
+logger = logging.getLogger(__name__)
+
+# seconds between retries for a backend whose catalog could not be loaded
+_RETRY_INTERVAL = 5.0
+
+# reply sent at once for an agent no backend serves
+AGENT_MISSING_REPLY = "OpenCode agent「{agent}」不存在，请联系管理员检查配置。"
+
+
+class _Entry:
+    __slots__ = ("names", "loaded_at", "errors")
+
+    def __init__(self):
+        self.names: frozenset[str] | None = None
+        self.loaded_at = 0.0
+        self.errors = 0
+
+
+class AgentCatalog:
+    """Agent names per backend, refreshed in the background."""
+
+    def __init__(self, urls: list[str], ttl: float = 300.0, list_agents=None, clock=time.monotonic):
+        """
+        :param urls: OpenCode API root URLs to load at startup.
+        :param ttl: Seconds after which a backend's agent list is reloaded.
+        :param list_agents: ``list_agents(api_url) -> list``; defaults to ``GET /agent``.
+        """
+        if list_agents is None:
+            from opencode_client import list_opencode_agents as list_agents
+        self._list_agents = list_agents
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {url.rstrip("/"): _Entry() for url in urls}
+        self._counters = {"refreshes": 0, "rejected": 0}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def record(self, api_url: str, agents: list) -> None:
+        """Store an agent list fetched elsewhere (e.g. by a health probe)."""
+        names = frozenset(a.get("name") for a in agents if isinstance(a, dict) and a.get("name"))
+        with self._lock:
+            entry = self._entries.setdefault(api_url.rstrip("/"), _Entry())
+            if entry.names is not None and entry.names != names:
+                logger.info("[OpenCode] agents on %s changed: %s", api_url, sorted(names))
+            entry.names = names
+            entry.loaded_at = self._clock()
+
+    def refresh(self, api_url: str) -> bool:
+        """Reload one backend's agents; on failure the last known list is kept."""
+        try:
+            agents = self._list_agents(api_url)
+        except Exception as e:
+            with self._lock:
+                self._entries.setdefault(api_url.rstrip("/"), _Entry()).errors += 1
+            logger.warning("[OpenCode] could not load the agents of %s: %s", api_url, e)
+            return False
+        self.record(api_url, agents)
+        with self._lock:
+            self._counters["refreshes"] += 1
+        return True
+
+    def refresh_all(self) -> None:
+        with self._lock:
+            urls = list(self._entries)
+        for url in urls:
+            self.refresh(url)
+
+    def agents(self, api_url: str) -> frozenset[str] | None:
+        """Agent names served by ``api_url``; None while unknown."""
+        with self._lock:
+            entry = self._entries.get(api_url.rstrip("/"))
+            if entry is None:
+                # a backend not configured at startup: load it in the background
+                self._entries[api_url.rstrip("/")] = _Entry()
+                self._wake.set()
+                return None
+            return entry.names
+
+    def exists(self, agent_name: str, api_url: str | None = None) -> bool | None:
+        """
+        Whether ``api_url`` (or, without it, any backend) serves ``agent_name``;
+        None when no agent list is known yet.
+        """
+        if api_url is not None:
+            names = self.agents(api_url)
+            return None if names is None else agent_name in names
+        with self._lock:
+            known = [entry.names for entry in self._entries.values() if entry.names is not None]
+        if not known:
+            return None
+        return any(agent_name in names for names in known)
+
+    def check(self, api_url: str, agent_name: str) -> bool:
+        """False only when ``api_url``'s known agent list lacks ``agent_name``."""
+        if self.exists(agent_name, api_url) is not False:
+            return True
+        with self._lock:
+            self._counters["rejected"] += 1
+        metrics.FAILURES.inc(reason="opencode_agent_missing")
+        logger.error(
+            "[OpenCode] agent '%s' is not served by %s (agents: %s); check OPENCODE_AGENT_NAME",
+            agent_name, api_url, sorted(self.agents(api_url) or ()),
+        )
+        return False
+
+    def _next_wait(self) -> float:
+        now = self._clock()
+        with self._lock:
+            waits = [
+                _RETRY_INTERVAL if entry.names is None else entry.loaded_at + self.ttl - now
+                for entry in self._entries.values()
+            ]
+        return max(0.0, min(waits, default=self.ttl))
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            now = self._clock()
+            with self._lock:
+                due = [
+                    url for url, entry in self._entries.items()
+                    if entry.names is None or now - entry.loaded_at >= self.ttl
+                ]
+            for url in due:
+                self.refresh(url)
+            self._wake.wait(self._next_wait())
+            self._wake.clear()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="opencode-agents", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> dict:
+        now = self._clock()
+        with self._lock:
+            return {
+                **self._counters,
+                "backends": {
+                    url: {
+                        "agents": sorted(entry.names) if entry.names is not None else None,
+                        "age_seconds": round(now - entry.loaded_at, 1) if entry.names is not None else None,
+                        "errors": entry.errors,
+                    }
+                    for url, entry in self._entries.items()
+                },
+            }
+
+
+_catalog: AgentCatalog | None = None
+_catalog_lock = threading.Lock()
+
+
+def get_agent_catalog() -> AgentCatalog | None:
+    """
+    Process-wide catalog, loaded from every backend on first use and then
+    refreshed in the background; None when ``OPENCODE_AGENT_CATALOG_TTL`` is 0.
+    """
+    global _catalog
+    ttl = get_opencode_agent_catalog_ttl()
+    if ttl <= 0:
+        return None
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = AgentCatalog(get_opencode_api_urls(), ttl=ttl)
+            _catalog.refresh_all()
+            _catalog.start()
+        return _catalog
+
+
+def agent_for(message_obj: dict) -> str:
+    """Agent for a callback: its chat's or sender's override if served anywhere, else the default."""
+    default = get_opencode_agent_name()
+    overrides = get_opencode_agent_overrides()
+    if not overrides or not isinstance(message_obj, dict):
+        return default
+    for field in ("ChatId", "FromUserName"):
+        agent = overrides.get(message_obj.get(field) or "")
+        if not agent:
+            continue
+        catalog = get_agent_catalog()
+        if catalog is not None and catalog.exists(agent) is False:
+            logger.warning("[OpenCode] override agent '%s' for %s is not served; using '%s'", agent, field, default)
+            return default
+        return agent
+    return default
+
+
+def record_agents(api_url: str, agents: list) -> None:
+    """Feed an agent list fetched elsewhere into the catalog, if one is running."""
+    catalog = _catalog
+    if catalog is not None:
+        catalog.record(api_url, agents)
+
+
+def agent_missing(api_url: str, agent_name: str) -> bool:
+    """True when the catalog knows ``api_url``'s agents and ``agent_name`` is not among them."""
+    catalog = get_agent_catalog()
+    return catalog is not None and not catalog.check(api_url, agent_name)
@@ -0,0 +1,237 @@
+"""
+Routing across several OpenCode servers.
+
+``OPENCODE_API_URLS`` lists the backends (comma separated; defaults to the
+single ``OPENCODE_API_URL``). Each agent run goes to the healthy backend with
+the fewest outstanding requests, except that a conversation with a reused
+OpenCode session stays on the server that holds the session.
+
+With more than one backend a background thread probes each one with
+``GET /agent`` every ``OPENCODE_HEALTH_INTERVAL`` seconds. A backend is
+ejected after ``OPENCODE_HEALTH_THRESHOLD`` consecutive failed probes and
+re-admitted after as many consecutive successful ones. Backends whose circuit
+breaker is open (see ``opencode_breaker``) are skipped as well. When every
+backend is unavailable, requests are still spread over all of them rather than
+refused.
+"""
+
+import asyncio
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+
+import metrics
+from config import (
+    get_opencode_api_urls,
+    get_opencode_health_interval,
+    get_opencode_health_threshold,
+)
+from opencode_breaker import is_open
+from opencode_sessions import get_session_registry
+
+logger = logging.getLogger(__name__)
+
+
+class _Backend:
+    __slots__ = ("url", "healthy", "outstanding", "streak", "requests", "ejections")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        # consecutive probe results that disagree with ``healthy``
+        self.streak = 0
+        self.requests = 0
+        self.ejections = 0
+
+
+class BackendPool:
+    """Least-outstanding-requests routing with session affinity and health probing."""
+
+    def __init__(self, urls: list[str], threshold: int = 2, interval: float = 10.0, probe=None):
+        """
+        :param urls: OpenCode API root URLs.
+        :param threshold: Consecutive probe results needed to eject / re-admit a backend.
+        :param interval: Seconds between probe rounds; 0 disables probing.
+        :param probe: ``probe(url) -> bool``; defaults to ``GET /agent``.
+        """
+        if not urls:
+            raise ValueError("at least one OpenCode backend is required")
+        self._backends = {url.rstrip("/"): _Backend(url.rstrip("/")) for url in urls}
+        self.threshold = max(1, threshold)
+        self.interval = interval
+        if probe is None:
+            from opencode_client import probe_opencode as probe
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()
+        self._counters = {"affinity": 0, "balanced": 0}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        for url in self._backends:
+            metrics.OPENCODE_BACKEND_UP.set(1, backend=url)
+
+    @property
+    def urls(self) -> list[str]:
+        return list(self._backends)
+
+    def acquire(self, session_key: tuple | None = None) -> str:
+        """Pick a backend for one request and count it as outstanding; pair with ``release()``."""
+        sticky = get_session_registry().backend_of(session_key) if session_key is not None else None
+        tripped = {url for url in self._backends if is_open(url)}
+        with self._lock:
+            backend = self._backends.get(sticky)
+            if backend is not None and backend.healthy and backend.url not in tripped:
+                self._counters["affinity"] += 1
+            else:
+                candidates = [b for b in self._backends.values() if b.healthy and b.url not in tripped]
+                candidates = candidates or list(self._backends.values())
+                # rotate the start so ties are spread round-robin
+                offset = next(self._rotation) % len(candidates)
+                candidates = candidates[offset:] + candidates[:offset]
+                backend = min(candidates, key=lambda b: b.outstanding)
+                self._counters["balanced"] += 1
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend.url
+
+    def release(self, url: str) -> None:
+        with self._lock:
+            self._backends[url].outstanding -= 1
+
+    @contextmanager
+    def use(self, session_key: tuple | None = None):
+        url = self.acquire(session_key)
+        try:
+            yield url
+        finally:
+            self.release(url)
+
+    def record_probe(self, url: str, ok: bool) -> None:
+        """Apply one probe result; flips the backend's state after ``threshold`` in a row."""
+        with self._lock:
+            backend = self._backends[url]
+            if ok == backend.healthy:
+                backend.streak = 0
+                return
+            backend.streak += 1
+            if backend.streak < self.threshold:
+                return
+            backend.healthy, backend.streak = ok, 0
+            if not ok:
+                backend.ejections += 1
+        metrics.OPENCODE_BACKEND_UP.set(1 if ok else 0, backend=url)
+        if ok:
+            logger.info("[OpenCode] backend %s re-admitted", url)
+        else:
+            logger.warning("[OpenCode] backend %s ejected after %d failed probes", url, self.threshold)
+
+    def probe_all(self) -> None:
+        for url in self.urls:
+            self.record_probe(url, self._probe(url))
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.probe_all()
+            except Exception:
+                logger.exception("[OpenCode] backend probe round failed")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self) -> None:
+        """Start probing in the background; a single backend is never probed."""
+        if len(self._backends) < 2 or self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="opencode-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "backends": {
+                    b.url: {
+                        "healthy": b.healthy,
+                        "outstanding": b.outstanding,
+                        "requests": b.requests,
+                        "ejections": b.ejections,
+                    }
+                    for b in self._backends.values()
+                },
+            }
+
+
+_pool: BackendPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_backend_pool() -> BackendPool:
+    """Process-wide pool built from the configuration on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BackendPool(
+                get_opencode_api_urls(),
+                threshold=get_opencode_health_threshold(),
+                interval=get_opencode_health_interval(),
+            )
+            _pool.start()
+        return _pool
+
+
+def routed(ask):
+    """Wrap ``ask(**kwargs)`` so it is sent to the backend chosen for ``session_key``."""
+
+    def call(**kwargs) -> str:
+        with get_backend_pool().use(kwargs.get("session_key")) as url:
+            return ask(**{**kwargs, "api_url": url})
+
+    return call
+
+
+def routed_async(ask):
+    """``routed()`` for a coroutine function such as ``ask_opencode_async``."""
+
+    async def call(**kwargs) -> str:
+        pool = get_backend_pool()
+        # the sticky-backend lookup may be a state store round-trip
+        url = await asyncio.to_thread(pool.acquire, kwargs.get("session_key"))
+        try:
+            return await ask(**{**kwargs, "api_url": url})
+        finally:
+            pool.release(url)
+
+    return call
+
+
+def routed_stream(stream):
+    """``routed()`` for a chunk generator; the request is outstanding until the stream ends."""
+
+    def call(**kwargs):
+        with get_backend_pool().use(kwargs.get("session_key")) as url:
+            yield from stream(**{**kwargs, "api_url": url})
+
+    return call
+
+
+def routed_stream_async(stream):
+    """``routed_stream()`` for an async chunk generator."""
+
+    async def call(**kwargs):
+        pool = get_backend_pool()
+        url = await asyncio.to_thread(pool.acquire, kwargs.get("session_key"))
+        try:
+            async for chunk in stream(**{**kwargs, "api_url": url}):
+                yield chunk
+        finally:
+            pool.release(url)
+
+    return call
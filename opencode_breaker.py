@@ -0,0 +1,221 @@
+"""
+Circuit breaker per OpenCode backend.
+
+Every ``ask_opencode`` call records its outcome with the backend's breaker: a
+failure (connection error, timeout, HTTP error) or a call slower than
+``OPENCODE_BREAKER_SLOW_SECONDS`` (off by default: agent runs of several
+minutes are normal). Once at least
+``OPENCODE_BREAKER_MIN_CALLS`` of the last ``OPENCODE_BREAKER_WINDOW`` calls
+are recorded and the share of failed (or of slow) calls reaches
+``OPENCODE_BREAKER_FAILURE_RATE``, the breaker opens: calls return the
+fallback reply at once instead of tying up a worker until the connection
+error or read timeout. After ``OPENCODE_BREAKER_OPEN_SECONDS`` it half-opens
+and lets ``OPENCODE_BREAKER_PROBES`` requests through; the breaker closes when
+they all succeed and opens again on the first failure.
+
+Streamed replies only check whether the breaker is open; their outcome is
+not recorded. Routing skips backends whose breaker rejects calls, including
+half-open ones whose probes are all in flight.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import (
+    get_opencode_breaker_enabled,
+    get_opencode_breaker_failure_rate,
+    get_opencode_breaker_min_calls,
+    get_opencode_breaker_open_seconds,
+    get_opencode_breaker_probes,
+    get_opencode_breaker_slow_seconds,
+    get_opencode_breaker_window,
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """Count-based closed / open / half-open breaker."""
+
+    def __init__(
+        self,
+        name: str = "",
+        window: int = 20,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_seconds: float = 0.0,
+        open_seconds: float = 30.0,
+        probes: int = 2,
+        clock=time.monotonic,
+    ):
+        """
+        :param name: Backend URL, used in logs and metrics.
+        :param window: Number of recent calls the rates are computed over.
+        :param min_calls: Calls needed in the window before the breaker may open.
+        :param failure_rate: Share of failed, or of slow, calls that opens the breaker.
+        :param slow_seconds: Calls at least this slow count as slow; 0 disables.
+        :param open_seconds: Time spent open before probing again.
+        :param probes: Requests let through while half-open.
+        """
+        self.name = name
+        self.min_calls = max(1, min_calls)
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window: deque[tuple[bool, bool]] = deque(maxlen=max(self.min_calls, window))
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_passed = 0
+        self._counters = {"opened": 0, "rejected": 0}
+        self._publish()
+
+    def _publish(self) -> None:
+        metrics.OPENCODE_BREAKER_STATE.set(_STATE_VALUES[self._state], backend=self.name)
+
+    def _refresh_locked(self) -> None:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_started = self._probes_passed = 0
+            self._publish()
+            logger.info("[OpenCode] circuit for %s half-open, probing", self.name)
+
+    def _open_locked(self, reason: str) -> None:
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._window.clear()
+        self._counters["opened"] += 1
+        self._publish()
+        logger.warning(
+            "[OpenCode] circuit for %s opened (%s), failing fast for %.0fs",
+            self.name, reason, self.open_seconds,
+        )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_locked()
+            return self._state
+
+    def accepting(self) -> bool:
+        """Whether ``allow()`` would let a call through, without using up a probe."""
+        with self._lock:
+            self._refresh_locked()
+            return self._state == CLOSED or (
+                self._state == HALF_OPEN and self._probes_started < self.probes
+            )
+
+    def allow(self) -> bool:
+        """Whether a call may go to the backend; a True while half-open uses up a probe."""
+        with self._lock:
+            self._refresh_locked()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_started < self.probes:
+                self._probes_started += 1
+                return True
+            self._counters["rejected"] += 1
+            return False
+
+    def record(self, ok: bool, duration: float) -> None:
+        """Outcome of a call that ``allow()`` let through."""
+        slow = self.slow_seconds > 0 and duration >= self.slow_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if not ok or slow:
+                    self._open_locked("probe failed" if not ok else "probe slow")
+                    return
+                self._probes_passed += 1
+                if self._probes_passed >= self.probes:
+                    self._state = CLOSED
+                    self._publish()
+                    logger.info("[OpenCode] circuit for %s closed", self.name)
+                return
+            if self._state == OPEN:
+                return  # a call admitted before the breaker opened
+            self._window.append((not ok, slow))
+            calls = len(self._window)
+            if calls < self.min_calls:
+                return
+            failed = sum(f for f, _ in self._window) / calls
+            slowed = sum(s for _, s in self._window) / calls
+            if failed >= self.failure_rate:
+                self._open_locked(f"{failed:.0%} of {calls} calls failed")
+            elif slowed >= self.failure_rate:
+                self._open_locked(f"{slowed:.0%} of {calls} calls slower than {self.slow_seconds:g}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh_locked()
+            calls = len(self._window)
+            return {
+                "state": self._state,
+                "calls": calls,
+                "failure_rate": round(sum(f for f, _ in self._window) / calls, 3) if calls else 0.0,
+                "slow_rate": round(sum(s for _, s in self._window) / calls, 3) if calls else 0.0,
+                **self._counters,
+            }
+
+
+class BreakerCall:
+    """Times one call and reports it to ``breaker`` (which may be None) on ``finish()``."""
+
+    def __init__(self, breaker: CircuitBreaker | None):
+        self.breaker = breaker
+        self.ok = False
+        self._started = time.monotonic()
+
+    def finish(self) -> None:
+        if self.breaker is not None:
+            self.breaker.record(self.ok, time.monotonic() - self._started)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(api_url: str) -> CircuitBreaker | None:
+    """Breaker of one backend; None when ``OPENCODE_BREAKER=0``."""
+    if not get_opencode_breaker_enabled():
+        return None
+    api_url = api_url.rstrip("/")
+    with _breakers_lock:
+        breaker = _breakers.get(api_url)
+        if breaker is None:
+            breaker = _breakers[api_url] = CircuitBreaker(
+                api_url,
+                window=get_opencode_breaker_window(),
+                min_calls=get_opencode_breaker_min_calls(),
+                failure_rate=get_opencode_breaker_failure_rate(),
+                slow_seconds=get_opencode_breaker_slow_seconds(),
+                open_seconds=get_opencode_breaker_open_seconds(),
+                probes=get_opencode_breaker_probes(),
+            )
+        return breaker
+
+
+def is_open(api_url: str) -> bool:
+    """
+    True while the backend's breaker rejects calls: open and not yet due for
+    probing, or half-open with every probe already in flight.
+    """
+    breaker = get_breaker(api_url)
+    return breaker is not None and not breaker.accepting()
+
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {url: breaker.stats() for url, breaker in breakers.items()}
@@ -3,13 +3,31 @@ OpenCode Serve API 客户端
 负责与 opencode serve 后端通信，创建 session 并发送 review 请求
 """
 
+import asyncio
 import logging
 import os
+import threading
 import time
 from urllib.parse import urlparse
 
+import httpx
 import requests
 
+from http_transport import (
+    get_async_basic_auth,
+    get_async_client,
+    get_async_timeout,
+    get_basic_auth,
+    get_session,
+    get_timeout,
+)
+import metrics
+import tracing
+from opencode_agents import AGENT_MISSING_REPLY, agent_missing, record_agents
+from opencode_breaker import BreakerCall, get_breaker
+from opencode_session_pool import take_warm_session
+from opencode_sessions import get_session_registry
+
 logger = logging.getLogger(__name__)
 
 def _extract_title_from_url(mr_url: str) -> str:
@@ -64,6 +82,24 @@ def _extract_title_from_url(mr_url: str) -> str:
         return "Webhook Code Review"
 
 
+def _get_auth():
+    """根据 OPENCODE_SERVER_PASSWORD / OPENCODE_SERVER_USERNAME 返回（缓存的）认证对象"""
+    server_password = os.environ.get("OPENCODE_SERVER_PASSWORD")
+    if not server_password:
+        return None
+    server_username = os.environ.get("OPENCODE_SERVER_USERNAME", "opencode")
+    return get_basic_auth(server_username, server_password)
+
+
+def _get_async_auth():
+    """_get_auth() 的 httpx 版本"""
+    server_password = os.environ.get("OPENCODE_SERVER_PASSWORD")
+    if not server_password:
+        return None
+    server_username = os.environ.get("OPENCODE_SERVER_USERNAME", "opencode")
+    return get_async_basic_auth(server_username, server_password)
+
+
 def is_opencode_enabled() -> bool:
     """检查 OpenCode Review 是否启用"""
     return os.environ.get("OPENCODE_ENABLED", "0") == "1"
@@ -91,10 +127,114 @@ def _extract_reply_text_from_response(result) -> str:
     return ""
 
 
+def _create_session(api_url: str, title: str, auth) -> str | None:
+    """POST /session，返回新 session 的 id"""
+    with metrics.http_call("opencode", "session", api_url) as call:
+        create_resp = get_session().post(
+            f"{api_url}/session",
+            json={"title": title},
+            headers={"Content-Type": "application/json"},
+            auth=auth,
+            timeout=get_timeout("opencode.session", api_url),
+        )
+        call.status = create_resp.status_code
+    create_resp.raise_for_status()
+    session_data = create_resp.json()
+    session_id = session_data.get("id")
+    if not session_id:
+        logger.error(f"[OpenCode] 创建 session 失败，响应中没有 id: {session_data}")
+    return session_id
+
+
+def _find_session(registry, session_key, api_url: str, agent_name: str) -> tuple[str | None, bool]:
+    """会话已有的 session，否则从预热池取一个；返回 (session_id, 是否为复用的 session)"""
+    session_id = registry.get(session_key, api_url) if registry is not None else None
+    if session_id:
+        return session_id, True
+    session_id = take_warm_session(api_url, agent_name)
+    if session_id and tracing.current_trace_id():
+        # 预创建时还没有 trace ID：后台补上标题，不占用本次请求的时间
+        threading.Thread(
+            target=rename_opencode_session,
+            args=(api_url, session_id, tracing.session_title("Wework Robot")),
+            name="opencode-session-title",
+            daemon=True,
+        ).start()
+    return session_id, False
+
+
+def _agent_missing_reply(agent_name: str) -> str:
+    """agent 不存在时立即返回的提示，避免等到消息超时"""
+    return AGENT_MISSING_REPLY.format(agent=agent_name)
+
+
+def create_pool_session(api_url: str) -> str | None:
+    """为预热池创建一个尚未分配的 session"""
+    return _create_session(api_url.rstrip("/"), "Wework Robot", _get_auth())
+
+
+def _message_payload(agent_name: str, text: str) -> dict:
+    return {
+        "agent": agent_name,
+        "parts": [{"type": "text", "text": text}],
+    }
+
+
+def _send_message(api_url: str, session_id: str, agent_name: str, text: str, auth):
+    """POST /session/{id}/message，返回解析后的 JSON 响应"""
+    with metrics.http_call("opencode", "message", api_url) as call:
+        message_resp = get_session().post(
+            f"{api_url}/session/{session_id}/message",
+            json=_message_payload(agent_name, text),
+            headers={"Content-Type": "application/json"},
+            auth=auth,
+            timeout=get_timeout("opencode.message", api_url),
+        )
+        call.status = message_resp.status_code
+    message_resp.raise_for_status()
+    return message_resp.json()
+
+
+def delete_opencode_session(api_url: str, session_id: str) -> bool:
+    """DELETE /session/{id}，用于清理被淘汰的复用 session"""
+    try:
+        with metrics.http_call("opencode", "delete", api_url) as call:
+            resp = get_session().delete(
+                f"{api_url.rstrip('/')}/session/{session_id}",
+                auth=_get_auth(),
+                timeout=get_timeout("opencode.delete", api_url),
+            )
+            call.status = resp.status_code
+        resp.raise_for_status()
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"[OpenCode] 删除 session {session_id} 失败: {e}")
+        return False
+
+
+def rename_opencode_session(api_url: str, session_id: str, title: str) -> bool:
+    """PATCH /session/{id}，更新 session 标题"""
+    try:
+        with metrics.http_call("opencode", "rename", api_url) as call:
+            resp = get_session().patch(
+                f"{api_url.rstrip('/')}/session/{session_id}",
+                json={"title": title},
+                auth=_get_auth(),
+                timeout=get_timeout("opencode.session", api_url),
+            )
+            call.status = resp.status_code
+        resp.raise_for_status()
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"[OpenCode] 更新 session {session_id} 标题失败: {e}")
+        return False
+
+
 def ask_opencode(
     user_message: str,
     api_url: str | None = None,
     agent_name: str | None = None,
+    session_key: tuple | None = None,
 ) -> str:
     """
     向 OpenCode 发送一条用户消息，返回助手回复文本。
@@ -103,99 +243,229 @@ def ask_opencode(
     :param user_message: 用户输入文本
     :param api_url: OpenCode API 根 URL，默认从环境 OPENCODE_API_URL 读取
     :param agent_name: Agent 名称，默认从环境 OPENCODE_AGENT_NAME 读取
+    :param session_key: 会话键，如 (FromUserName, AgentID, agent_name)；传入时复用该会话的 session
     :return: 助手回复的文本；失败时返回简短错误提示
     """
     api_url = (api_url or os.environ.get("OPENCODE_API_URL", "http://127.0.0.1:4096")).rstrip("/")
     agent_name = agent_name or os.environ.get("OPENCODE_AGENT_NAME", "docs-searcher")
-    auth = None
-    server_password = os.environ.get("OPENCODE_SERVER_PASSWORD")
-    server_username = os.environ.get("OPENCODE_SERVER_USERNAME", "opencode")
-    if server_password:
-        from requests.auth import HTTPBasicAuth
-        auth = HTTPBasicAuth(server_username, server_password)
+    auth = _get_auth()
 
     fallback = "OpenCode 暂时不可用，请稍后再试。"
     if not (user_message or user_message.strip()):
         return "请发送要咨询的内容。"
 
+    if agent_missing(api_url, agent_name):
+        return _agent_missing_reply(agent_name)
+    breaker = get_breaker(api_url)
+    if breaker is not None and not breaker.allow():
+        logger.warning(f"[OpenCode] {api_url} 已熔断，直接返回兜底回复")
+        metrics.FAILURES.inc(reason="opencode_circuit_open")
+        return fallback
+    call = BreakerCall(breaker)
+    registry = get_session_registry() if session_key is not None else None
     try:
-        session_url = f"{api_url}/session"
-        create_resp = requests.post(
-            session_url,
-            json={"title": "Wework Robot"},
-            headers={"Content-Type": "application/json"},
-            auth=auth,
-            timeout=30,
-        )
-        create_resp.raise_for_status()
-        session_data = create_resp.json()
-        session_id = session_data.get("id")
+        # 新会话：优先使用预热池中预创建的 session
+        session_id, _ = _find_session(registry, session_key, api_url, agent_name)
+        if session_id:
+            try:
+                result = _send_message(api_url, session_id, agent_name, user_message.strip(), auth)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # 服务端 session 已不存在（重启或被清理），重新创建
+                logger.info(f"[OpenCode] 复用的 session {session_id} 已失效，重新创建")
+                if registry is not None:
+                    registry.discard(session_key)
+                session_id = None
         if not session_id:
-            logger.error(f"[OpenCode] 创建 session 失败，响应中没有 id: {session_data}")
-            return fallback
+            session_id = _create_session(api_url, tracing.session_title("Wework Robot"), auth)
+            if not session_id:
+                metrics.FAILURES.inc(reason="opencode_no_session_id")
+                return fallback
+            result = _send_message(api_url, session_id, agent_name, user_message.strip(), auth)
+        call.ok = True
+        if registry is not None:
+            registry.put(session_key, api_url, session_id)
+        tracing.annotate(session_id=session_id)
 
-        message_url = f"{api_url}/session/{session_id}/message"
-        payload = {
-            "agent": agent_name,
-            "parts": [{"type": "text", "text": user_message.strip()}],
-        }
-        message_resp = requests.post(
-            message_url,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            auth=auth,
-            timeout=300,
-        )
-        message_resp.raise_for_status()
-        result = message_resp.json()
         reply = _extract_reply_text_from_response(result)
         if reply:
             return reply
         logger.warning(f"[OpenCode] 无法从响应中解析回复文本: {result}")
+        metrics.FAILURES.inc(reason="opencode_empty_reply")
         return fallback
     except requests.exceptions.ConnectionError as e:
         logger.error(f"[OpenCode] 连接失败: {e}")
+        metrics.FAILURES.inc(reason="opencode_connect_error")
         return fallback
     except requests.exceptions.Timeout:
         logger.error("[OpenCode] 请求超时")
+        metrics.FAILURES.inc(reason="opencode_timeout")
         return fallback
     except requests.exceptions.HTTPError as e:
         logger.error(f"[OpenCode] HTTP 错误: {e}")
+        metrics.FAILURES.inc(reason="opencode_http_error")
         return fallback
     except Exception as e:
         logger.exception(f"[OpenCode] 未知错误: {e}")
+        metrics.FAILURES.inc(reason="opencode_unknown_error")
         return fallback
+    finally:
+        call.finish()
 
 
-def _check_agent_exists(api_url: str, agent_name: str, auth=None) -> bool:
+async def _create_session_async(api_url: str, title: str, auth) -> str | None:
+    """_create_session() 的异步版本"""
+    with metrics.http_call("opencode", "session", api_url) as call:
+        create_resp = await get_async_client().post(
+            f"{api_url}/session",
+            json={"title": title},
+            auth=auth,
+            timeout=get_async_timeout("opencode.session", api_url),
+        )
+        call.status = create_resp.status_code
+    create_resp.raise_for_status()
+    session_data = create_resp.json()
+    session_id = session_data.get("id")
+    if not session_id:
+        logger.error(f"[OpenCode] 创建 session 失败，响应中没有 id: {session_data}")
+    return session_id
+
+
+async def _send_message_async(api_url: str, session_id: str, agent_name: str, text: str, auth):
+    """_send_message() 的异步版本"""
+    with metrics.http_call("opencode", "message", api_url) as call:
+        message_resp = await get_async_client().post(
+            f"{api_url}/session/{session_id}/message",
+            json=_message_payload(agent_name, text),
+            auth=auth,
+            timeout=get_async_timeout("opencode.message", api_url),
+        )
+        call.status = message_resp.status_code
+    message_resp.raise_for_status()
+    return message_resp.json()
+
+
+async def ask_opencode_async(
+    user_message: str,
+    api_url: str | None = None,
+    agent_name: str | None = None,
+    session_key: tuple | None = None,
+) -> str:
     """
-    检查指定的 agent 是否存在
-    
-    :param api_url: OpenCode API URL
-    :param agent_name: Agent 名称
-    :param auth: 认证信息
-    :return: True 如果 agent 存在，False 否则
+    ask_opencode() 的异步版本，供 ASGI 服务使用：等待 agent 回复期间不占用线程。
+    参数与返回值同 ask_opencode()。
     """
+    api_url = (api_url or os.environ.get("OPENCODE_API_URL", "http://127.0.0.1:4096")).rstrip("/")
+    agent_name = agent_name or os.environ.get("OPENCODE_AGENT_NAME", "docs-searcher")
+    auth = _get_async_auth()
+
+    fallback = "OpenCode 暂时不可用，请稍后再试。"
+    if not (user_message or user_message.strip()):
+        return "请发送要咨询的内容。"
+
+    # agent 列表、session 表（可能在 Redis 中）与预热池都是同步调用，放到线程中执行，不阻塞事件循环
+    if await asyncio.to_thread(agent_missing, api_url, agent_name):
+        return _agent_missing_reply(agent_name)
+    breaker = get_breaker(api_url)
+    if breaker is not None and not breaker.allow():
+        logger.warning(f"[OpenCode] {api_url} 已熔断，直接返回兜底回复")
+        metrics.FAILURES.inc(reason="opencode_circuit_open")
+        return fallback
+    call = BreakerCall(breaker)
+    registry = get_session_registry() if session_key is not None else None
     try:
-        agents_url = f"{api_url.rstrip('/')}/agent"
-        logger.info(f"[OpenCode] 检查 agent 是否存在: GET {agents_url}")
-        resp = requests.get(agents_url, auth=auth, timeout=10)
-        resp.raise_for_status()
-        agents = resp.json()
-        
-        agent_names = [agent.get("name") for agent in agents if isinstance(agent, dict)]
-        exists = agent_name in agent_names
-        
-        if exists:
-            logger.info(f"[OpenCode] Agent '{agent_name}' 存在")
-        else:
-            logger.warning(
-                f"[OpenCode] Agent '{agent_name}' 不存在！可用 agents: {agent_names}"
+        session_id, _ = await asyncio.to_thread(
+            _find_session, registry, session_key, api_url, agent_name
+        )
+        if session_id:
+            try:
+                result = await _send_message_async(
+                    api_url, session_id, agent_name, user_message.strip(), auth
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                logger.info(f"[OpenCode] 复用的 session {session_id} 已失效，重新创建")
+                if registry is not None:
+                    await asyncio.to_thread(registry.discard, session_key)
+                session_id = None
+        if not session_id:
+            session_id = await _create_session_async(
+                api_url, tracing.session_title("Wework Robot"), auth
             )
-        return exists
+            if not session_id:
+                metrics.FAILURES.inc(reason="opencode_no_session_id")
+                return fallback
+            result = await _send_message_async(
+                api_url, session_id, agent_name, user_message.strip(), auth
+            )
+        call.ok = True
+        if registry is not None:
+            await asyncio.to_thread(registry.put, session_key, api_url, session_id)
+        tracing.annotate(session_id=session_id)
+
+        reply = _extract_reply_text_from_response(result)
+        if reply:
+            return reply
+        logger.warning(f"[OpenCode] 无法从响应中解析回复文本: {result}")
+        metrics.FAILURES.inc(reason="opencode_empty_reply")
+        return fallback
+    except httpx.ConnectError as e:
+        logger.error(f"[OpenCode] 连接失败: {e}")
+        metrics.FAILURES.inc(reason="opencode_connect_error")
+        return fallback
+    except httpx.TimeoutException:
+        logger.error("[OpenCode] 请求超时")
+        metrics.FAILURES.inc(reason="opencode_timeout")
+        return fallback
+    except httpx.HTTPStatusError as e:
+        logger.error(f"[OpenCode] HTTP 错误: {e}")
+        metrics.FAILURES.inc(reason="opencode_http_error")
+        return fallback
     except Exception as e:
-        logger.warning(f"[OpenCode] 无法检查 agent 是否存在: {e}")
-        return True  # 如果检查失败，假设存在（向后兼容）
+        logger.exception(f"[OpenCode] 未知错误: {e}")
+        metrics.FAILURES.inc(reason="opencode_unknown_error")
+        return fallback
+    finally:
+        call.finish()
+
+
+def _list_agents(api_url: str, auth=None) -> list:
+    """GET /agent，返回 agent 列表；请求失败时抛出异常"""
+    with metrics.http_call("opencode", "agent", api_url) as call:
+        resp = get_session().get(
+            f"{api_url.rstrip('/')}/agent", auth=auth, timeout=get_timeout("opencode.agent", api_url)
+        )
+        call.status = resp.status_code
+    resp.raise_for_status()
+    agents = resp.json()
+    if not isinstance(agents, list):
+        raise ValueError(f"unexpected /agent response: {agents!r}")
+    return agents
+
+
+def probe_opencode(api_url: str) -> bool:
+    """健康检查：GET /agent 成功返回 agent 列表即视为可用"""
+    try:
+        record_agents(api_url, _list_agents(api_url, _get_auth()))
+        return True
+    except Exception as e:
+        logger.warning(f"[OpenCode] 健康检查失败 {api_url}: {e}")
+        return False
+
+
+def list_opencode_agents(api_url: str) -> list:
+    """GET /agent（带认证），供 agent 列表缓存刷新使用"""
+    return _list_agents(api_url, _get_auth())
+
+
+def review_target() -> tuple[str, str]:
+    """MR review 使用的 (OpenCode API URL, agent 名称)"""
+    return (
+        os.environ.get("OPENCODE_API_URL", "http://localhost:4096"),
+        os.environ.get("OPENCODE_AGENT_NAME", "code-reviewer"),
+    )
 
 
 def send_opencode_review(mr_url: str):
@@ -210,30 +480,34 @@ def send_opencode_review(mr_url: str):
     if not is_opencode_enabled():
         return
 
-    api_url = os.environ.get("OPENCODE_API_URL", "http://localhost:4096")
-    agent_name = os.environ.get("OPENCODE_AGENT_NAME", "code-reviewer")
+    api_url, agent_name = review_target()
     review_message = f"review this mr: {mr_url}"
 
+    # agent 不存在时直接放弃，而不是等到消息超时
+    if agent_missing(api_url, agent_name):
+        logger.error(
+            f"[OpenCode] Agent '{agent_name}' 不存在，跳过 review: {mr_url}。"
+            f"请检查 OPENCODE_AGENT_NAME 配置或创建相应的 agent。"
+        )
+        return
+
     # 准备认证信息（如果配置了密码）
-    auth = None
-    server_password = os.environ.get("OPENCODE_SERVER_PASSWORD")
-    server_username = os.environ.get("OPENCODE_SERVER_USERNAME", "opencode")
-    if server_password:
-        from requests.auth import HTTPBasicAuth
-        auth = HTTPBasicAuth(server_username, server_password)
+    auth = _get_auth()
 
     try:
         # Step 1: 创建 session
         session_url = f"{api_url.rstrip('/')}/session"
         session_title = _extract_title_from_url(mr_url)
         logger.info(f"[OpenCode] 创建 session: POST {session_url}")
-        create_resp = requests.post(
-            session_url,
-            json={"title": session_title},
-            headers={"Content-Type": "application/json"},
-            auth=auth,
-            timeout=30,
-        )
+        with metrics.http_call("opencode", "session", api_url) as call:
+            create_resp = get_session().post(
+                session_url,
+                json={"title": session_title},
+                headers={"Content-Type": "application/json"},
+                auth=auth,
+                timeout=get_timeout("opencode.session", api_url),
+            )
+            call.status = create_resp.status_code
         create_resp.raise_for_status()
         session_data = create_resp.json()
         session_id = session_data.get("id")
@@ -243,15 +517,6 @@ def send_opencode_review(mr_url: str):
 
         logger.info(f"[OpenCode] Session 创建成功: {session_id}")
 
-        # Step 1.5: 验证 agent 是否存在（可选，用于调试）
-        agent_exists = _check_agent_exists(api_url, agent_name, auth)
-        if not agent_exists:
-            logger.error(
-                f"[OpenCode] Agent '{agent_name}' 不存在，请求可能会失败。"
-                f"请检查 OPENCODE_AGENT_NAME 配置或创建相应的 agent。"
-            )
-            # 继续执行，让 API 返回明确的错误信息
-
         # Step 2: 发送 review 消息
         message_url = f"{api_url.rstrip('/')}/session/{session_id}/message"
         payload = {
@@ -271,17 +536,21 @@ def send_opencode_review(mr_url: str):
         )
 
         # 使用较长的超时，因为 AI review 可能需要较长时间
+        # review 与聊天的耗时差别很大，使用单独的自适应超时窗口
+        message_timeout = get_timeout("opencode.review", api_url)
         start_time = time.time()
-        logger.info(f"[OpenCode] 开始发送请求，超时时间: 300秒")
+        logger.info(f"[OpenCode] 开始发送请求，超时时间: {message_timeout[1]:.0f}秒")
         
         try:
-            message_resp = requests.post(
-                message_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                auth=auth,
-                timeout=300,
-            )
+            with metrics.http_call("opencode", "review", api_url) as call:
+                message_resp = get_session().post(
+                    message_url,
+                    json=payload,
+                    headers={"Content-Type": "application/json"},
+                    auth=auth,
+                    timeout=message_timeout,
+                )
+                call.status = message_resp.status_code
             elapsed_time = time.time() - start_time
             logger.info(
                 f"[OpenCode] 请求完成，耗时: {elapsed_time:.2f}秒, 状态码: {message_resp.status_code}"
@@ -295,7 +564,7 @@ def send_opencode_review(mr_url: str):
         except requests.exceptions.Timeout:
             elapsed_time = time.time() - start_time
             logger.error(
-                f"[OpenCode] 请求超时！耗时: {elapsed_time:.2f}秒 (超时设置: 300秒)"
+                f"[OpenCode] 请求超时！耗时: {elapsed_time:.2f}秒 (超时设置: {message_timeout[1]:.0f}秒)"
             )
             logger.error(
                 f"[OpenCode] 可能的原因: 1) agent '{agent_name}' 不存在或配置错误 "
@@ -0,0 +1,139 @@
+"""
+Concurrent dispatch of many MR / PR reviews.
+
+``send_opencode_review`` reviews one MR and blocks until the agent answers,
+which can take minutes; a CI wave that opens dozens of MRs was reviewed one
+after another. ``ReviewDispatcher.review_many`` runs a batch of URLs on a
+shared pool of ``OPENCODE_REVIEW_CONCURRENCY`` threads, so concurrent batches
+share the same cap.
+
+Within a batch, repeated URLs (ignoring surrounding whitespace and a trailing
+slash) are reviewed once; a URL whose review is still running, from this or
+an earlier batch, is skipped. The enabled flag and the agent are checked once
+per batch. Each URL gets a result with its session title (from
+``_extract_title_from_url``), status, time spent queued and time spent in
+the review.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from config import get_opencode_review_concurrency
+from opencode_agents import agent_missing
+from opencode_client import _extract_title_from_url, is_opencode_enabled, review_target, send_opencode_review
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(mr_url: str) -> str:
+    return mr_url.strip().rstrip("/")
+
+
+class ReviewDispatcher:
+    """Runs ``send_opencode_review`` for many URLs with a concurrency cap."""
+
+    def __init__(self, concurrency: int = 4, review=None, clock=time.monotonic):
+        """
+        :param concurrency: Reviews running at the same time, across all batches.
+        :param review: ``review(mr_url) -> result | None``; defaults to ``send_opencode_review``.
+        """
+        self._review = review or send_opencode_review
+        self.concurrency = max(1, concurrency)
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="opencode-review")
+        self._lock = threading.Lock()
+        self._running: set[str] = set()
+        self._counters: dict[str, int] = {}
+
+    def review_many(self, mr_urls: list[str]) -> list[dict]:
+        """
+        Review every URL and wait for all of them; returns one result per input
+        URL, in input order: ``{"url", "title", "status", "queued_seconds",
+        "seconds", "error"}`` with status ``ok``, ``failed``, ``duplicate``,
+        ``in_progress``, ``agent_missing`` or ``disabled``.
+        """
+        results = [
+            {"url": url, "title": _extract_title_from_url(url), "status": None,
+             "queued_seconds": 0.0, "seconds": 0.0, "error": None}
+            for url in mr_urls
+        ]
+        batch_status = None
+        if not is_opencode_enabled():
+            batch_status = "disabled"
+        elif agent_missing(*review_target()):
+            batch_status = "agent_missing"
+
+        futures, seen = [], set()
+        for result in results:
+            key = _normalize(result["url"])
+            if batch_status is not None:
+                result["status"] = batch_status
+            elif key in seen:
+                result["status"] = "duplicate"
+            else:
+                seen.add(key)
+                with self._lock:
+                    running = key in self._running
+                    self._running.add(key)
+                if running:
+                    result["status"] = "in_progress"
+                else:
+                    futures.append(self._executor.submit(self._run, key, result, self._clock()))
+        for future in futures:
+            future.result()
+
+        for result in results:
+            self._count(result["status"])
+        return results
+
+    def _run(self, key: str, result: dict, submitted_at: float) -> None:
+        started = self._clock()
+        result["queued_seconds"] = round(started - submitted_at, 3)
+        try:
+            outcome = self._review(result["url"].strip())
+            result["status"] = "ok" if outcome is not None else "failed"
+        except Exception as e:
+            logger.exception("[OpenCode] review of %s failed", result["url"])
+            result["status"] = "failed"
+            result["error"] = str(e)
+        finally:
+            result["seconds"] = round(self._clock() - started, 3)
+            with self._lock:
+                self._running.discard(key)
+
+    def _count(self, status: str) -> None:
+        with self._lock:
+            self._counters[status] = self._counters.get(status, 0) + 1
+        metrics.OPENCODE_REVIEWS.inc(status=status)
+
+    def in_progress(self) -> list[str]:
+        with self._lock:
+            return sorted(self._running)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"concurrency": self.concurrency, "running": len(self._running), **self._counters}
+
+
+_dispatcher: ReviewDispatcher | None = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_review_dispatcher() -> ReviewDispatcher:
+    """Process-wide dispatcher built from the configuration on first use."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ReviewDispatcher(get_opencode_review_concurrency())
+        return _dispatcher
+
+
+def send_opencode_reviews(mr_urls: list[str]) -> list[dict]:
+    """Review many MR / PR URLs concurrently; see ``ReviewDispatcher.review_many``."""
+    return get_review_dispatcher().review_many(mr_urls)
@@ -0,0 +1,317 @@
+"""
+Pre-created OpenCode sessions for new conversations.
+
+Session reuse (``opencode_sessions``) saves ``POST /session`` on follow-up
+messages, but each new conversation still creates its session before the
+agent can start. ``SessionPool`` keeps a few unassigned sessions per backend
+and agent name, created ahead of time by a background thread, and hands one
+out instantly when a conversation has no session yet.
+
+``OPENCODE_SESSION_POOL_MAX`` (0 disables the pool) caps each group. Its
+target size follows the arrival rate of new conversations over the last five
+minutes: enough sessions for ``OPENCODE_SESSION_POOL_LEAD_SECONDS`` of
+arrivals, and at least ``OPENCODE_SESSION_POOL_MIN``. A take wakes the
+refill thread at once. Sessions idle for ``OPENCODE_SESSION_POOL_TTL``
+seconds are deleted and replaced, and backends whose circuit breaker is open
+are not refilled. ``stop()`` deletes the sessions still idle; the process-wide
+pool is stopped on ASGI lifespan shutdown and at interpreter exit.
+
+The saved latency is estimated from the measured duration of the pool's own
+``POST /session`` calls: each hit saves about one of them.
+"""
+
+import atexit
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import (
+    get_opencode_agent_name,
+    get_opencode_api_urls,
+    get_opencode_session_pool_lead_seconds,
+    get_opencode_session_pool_max,
+    get_opencode_session_pool_min,
+    get_opencode_session_pool_ttl,
+)
+from opencode_breaker import is_open
+
+logger = logging.getLogger(__name__)
+
+# seconds of new-conversation arrivals used to estimate the arrival rate
+_RATE_WINDOW = 300.0
+# number of recent session creations kept for the latency estimate
+_LATENCY_WINDOW = 256
+
+
+class _Group:
+    """Idle sessions and arrival history of one (api_url, agent_name)."""
+
+    __slots__ = ("idle", "arrivals", "creating", "hits", "misses", "created", "expired", "failed")
+
+    def __init__(self):
+        # (session_id, created_at), oldest first
+        self.idle: deque[tuple[str, float]] = deque()
+        self.arrivals: deque[float] = deque()
+        self.creating = 0
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.expired = 0
+        self.failed = 0
+
+
+class SessionPool:
+    """Per-(backend, agent) pools of pre-created sessions, refilled in the background."""
+
+    def __init__(
+        self,
+        create=None,
+        delete=None,
+        min_size: int = 1,
+        max_size: int = 8,
+        ttl: float = 600.0,
+        lead_time: float = 60.0,
+        interval: float = 5.0,
+        clock=time.monotonic,
+    ):
+        """
+        :param create: ``create(api_url) -> session_id | None``; defaults to ``POST /session``.
+        :param delete: ``delete(api_url, session_id)`` for expired and leftover sessions; defaults to ``DELETE /session/{id}``.
+        :param min_size: Sessions kept per group regardless of traffic.
+        :param max_size: Upper bound of each group's target size.
+        :param ttl: Seconds after which an unused session is replaced.
+        :param lead_time: Seconds of new-conversation arrivals the pool should cover.
+        :param interval: Seconds between refill rounds when no take wakes the thread.
+        """
+        if create is None or delete is None:
+            from opencode_client import create_pool_session, delete_opencode_session
+
+            create = create or create_pool_session
+            delete = delete or delete_opencode_session
+        self._create = create
+        self._delete = delete
+        self.max_size = max(1, max_size)
+        self.min_size = min(max(0, min_size), self.max_size)
+        self.ttl = ttl
+        self.lead_time = lead_time
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._groups: dict[tuple[str, str], _Group] = {}
+        self._create_seconds: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self._saved_seconds = 0.0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        # held by a running refill(), so stop() can wait for its creates to land
+        self._refilling = threading.Lock()
+
+    def warm(self, api_url: str, agent_name: str) -> None:
+        """Start keeping sessions for a group before its first take."""
+        with self._lock:
+            self._groups.setdefault((api_url.rstrip("/"), agent_name), _Group())
+        self._wake.set()
+
+    def take(self, api_url: str, agent_name: str) -> str | None:
+        """An unassigned session for a new conversation, or None if the group is empty."""
+        now = self._clock()
+        with self._lock:
+            group = self._groups.setdefault((api_url.rstrip("/"), agent_name), _Group())
+            group.arrivals.append(now)
+            session_id = None
+            # oldest fresh session first; expired ones are left for the refill thread to delete
+            for i, (candidate, created_at) in enumerate(group.idle):
+                if now - created_at < self.ttl:
+                    del group.idle[i]
+                    session_id = candidate
+                    break
+            if session_id is None:
+                group.misses += 1
+            else:
+                group.hits += 1
+                saved = self._create_estimate_locked()
+                self._saved_seconds += saved
+        self._wake.set()
+        if session_id is None:
+            metrics.OPENCODE_SESSION_POOL_TAKES.inc(result="miss")
+            return None
+        metrics.OPENCODE_SESSION_POOL_TAKES.inc(result="hit")
+        metrics.OPENCODE_SESSION_POOL_SAVED_SECONDS.inc(saved)
+        return session_id
+
+    def _create_estimate_locked(self) -> float:
+        if not self._create_seconds:
+            return 0.0
+        ordered = sorted(self._create_seconds)
+        return ordered[len(ordered) // 2]
+
+    def _target_locked(self, group: _Group, now: float) -> int:
+        while group.arrivals and now - group.arrivals[0] > _RATE_WINDOW:
+            group.arrivals.popleft()
+        rate = len(group.arrivals) / _RATE_WINDOW
+        return min(self.max_size, max(self.min_size, math.ceil(rate * self.lead_time)))
+
+    def refill(self) -> None:
+        """One round: drop expired sessions and create the missing ones for each group."""
+        with self._refilling:
+            if not self._stop.is_set():
+                self._refill()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        expired, plan = [], []
+        with self._lock:
+            for (api_url, agent_name), group in self._groups.items():
+                while group.idle and now - group.idle[0][1] >= self.ttl:
+                    expired.append((api_url, group.idle.popleft()[0]))
+                    group.expired += 1
+                target = self._target_locked(group, now)
+                # surplus beyond a shrunken target is left to expire
+                missing = target - len(group.idle) - group.creating
+                if missing > 0 and not is_open(api_url):
+                    group.creating += missing
+                    plan.append((api_url, group, missing))
+        for api_url, session_id in expired:
+            self._delete_quietly(api_url, session_id)
+        for api_url, group, missing in plan:
+            for i in range(missing):
+                if self._stop.is_set():
+                    with self._lock:
+                        group.creating -= missing - i
+                    break
+                session_id = self._create_one(api_url)
+                with self._lock:
+                    group.creating -= 1
+                    if session_id is None:
+                        group.failed += 1
+                    else:
+                        group.created += 1
+                        group.idle.append((session_id, self._clock()))
+                if session_id is None:
+                    # the backend is struggling; give back the rest of this round's slots
+                    with self._lock:
+                        group.creating -= missing - i - 1
+                    break
+
+    def _create_one(self, api_url: str) -> str | None:
+        started = time.monotonic()
+        try:
+            session_id = self._create(api_url)
+        except Exception as e:
+            logger.warning("[OpenCode] pre-creating a session on %s failed: %s", api_url, e)
+            return None
+        if session_id:
+            with self._lock:
+                self._create_seconds.append(time.monotonic() - started)
+        return session_id or None
+
+    def _delete_quietly(self, api_url: str, session_id: str) -> None:
+        try:
+            self._delete(api_url, session_id)
+        except Exception as e:
+            logger.warning("[OpenCode] deleting pool session %s failed: %s", session_id, e)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.refill()
+            except Exception:
+                logger.exception("[OpenCode] session pool refill failed")
+            self._wake.wait(self.interval)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="opencode-session-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the refill thread and delete the idle sessions, which nothing would ever use."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        # a refill still creating sessions past the join timeout adds them to idle first
+        with self._refilling:
+            pass
+        orphans = []
+        with self._lock:
+            for (api_url, _), group in self._groups.items():
+                orphans.extend((api_url, session_id) for session_id, _ in group.idle)
+                group.idle.clear()
+        for api_url, session_id in orphans:
+            self._delete_quietly(api_url, session_id)
+
+    def stats(self) -> dict:
+        now = self._clock()
+        with self._lock:
+            groups = {
+                f"{api_url} {agent_name}": {
+                    "idle": len(group.idle),
+                    "target": self._target_locked(group, now),
+                    "hits": group.hits,
+                    "misses": group.misses,
+                    "created": group.created,
+                    "expired": group.expired,
+                    "failed": group.failed,
+                }
+                for (api_url, agent_name), group in self._groups.items()
+            }
+            return {
+                "hits": sum(g["hits"] for g in groups.values()),
+                "misses": sum(g["misses"] for g in groups.values()),
+                "create_seconds_p50": self._create_estimate_locked(),
+                "saved_seconds": round(self._saved_seconds, 3),
+                "groups": groups,
+            }
+
+
+_pool: SessionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_session_pool() -> SessionPool | None:
+    """
+    Process-wide pool built from the configuration on first use, warming the
+    default agent on every backend; None when the pool is disabled.
+    """
+    global _pool
+    max_size = get_opencode_session_pool_max()
+    if max_size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool(
+                min_size=get_opencode_session_pool_min(),
+                max_size=max_size,
+                ttl=get_opencode_session_pool_ttl(),
+                lead_time=get_opencode_session_pool_lead_seconds(),
+            )
+            agent_name = get_opencode_agent_name()
+            for url in get_opencode_api_urls():
+                _pool.warm(url, agent_name)
+            _pool.start()
+        return _pool
+
+
+def stop_session_pool() -> None:
+    """Stop the process-wide pool, if any, deleting its idle sessions."""
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        pool.stop()
+
+
+# python app.py / gunicorn workers have no shutdown hook of their own
+atexit.register(stop_session_pool)
+
+
+def take_warm_session(api_url: str, agent_name: str) -> str | None:
+    """A pre-created session for a new conversation, if the pool is enabled and has one."""
+    pool = get_session_pool()
+    return pool.take(api_url, agent_name) if pool is not None else None
@@ -0,0 +1,246 @@
+"""
+OpenCode session 复用
+
+按 (FromUserName, AgentID, agent_name) 记录每个会话对应的 OpenCode session，
+后续消息只需调用 /session/{id}/message，既省去一次 POST /session，也保留上下文。
+空闲超时或超过容量（LRU）时淘汰，可选地在服务端 DELETE 该 session。
+配置 WEWORK_STATE_STORE 后改用 SharedSessionRegistry，多个 worker / 主机共享同一张表。
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from config import (
+    get_opencode_session_delete_on_evict,
+    get_opencode_session_idle_ttl,
+    get_opencode_session_max,
+    get_opencode_session_reuse,
+)
+from state_store import StateStoreError, get_state_store, is_shared
+
+logger = logging.getLogger(__name__)
+
+
+def _notify_evicted(on_evict, evicted: list[tuple[str, str]]) -> None:
+    if not on_evict:
+        return
+    for api_url, session_id in evicted:
+        try:
+            on_evict(api_url, session_id)
+        except Exception as e:
+            logger.warning(f"[OpenCode] 淘汰 session {session_id} 回调失败: {e}")
+
+
+class SessionRegistry:
+    """线程安全的 LRU + 空闲 TTL session 表"""
+
+    def __init__(self, max_size: int = 1000, idle_ttl: float = 1800, on_evict=None):
+        """
+        :param max_size: 最多保留的会话数，超出时淘汰最久未使用的
+        :param idle_ttl: 会话空闲超过该秒数后失效
+        :param on_evict: 淘汰回调 on_evict(api_url, session_id)，在锁外调用
+        """
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self._entries: OrderedDict[tuple, tuple[str, str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evicted_lru": 0, "evicted_idle": 0}
+
+    def _expire_locked(self, now: float) -> list[tuple[str, str]]:
+        evicted = []
+        while self._entries:
+            key, (api_url, session_id, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._entries[key]
+            self._counters["evicted_idle"] += 1
+            evicted.append((api_url, session_id))
+        return evicted
+
+    def _notify(self, evicted: list[tuple[str, str]]) -> None:
+        _notify_evicted(self.on_evict, evicted)
+
+    def get(self, key: tuple, api_url: str) -> str | None:
+        """返回 key 对应且属于 api_url 的 session id，并刷新其最近使用时间"""
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._expire_locked(now)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != api_url:
+                self._counters["misses"] += 1
+                session_id = None
+            else:
+                self._counters["hits"] += 1
+                session_id = entry[1]
+                self._entries[key] = (api_url, session_id, now)
+                self._entries.move_to_end(key)
+        self._notify(evicted)
+        return session_id
+
+    def put(self, key: tuple, api_url: str, session_id: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._expire_locked(now)
+            old = self._entries.pop(key, None)
+            if old is not None and old[1] != session_id:
+                evicted.append((old[0], old[1]))
+            self._entries[key] = (api_url, session_id, now)
+            while len(self._entries) > self.max_size:
+                _, (old_url, old_id, _) = self._entries.popitem(last=False)
+                self._counters["evicted_lru"] += 1
+                evicted.append((old_url, old_id))
+        self._notify(evicted)
+
+    def backend_of(self, key: tuple) -> str | None:
+        """key 当前 session 所在的 api_url（用于把会话路由回同一后端），不计入命中统计"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[2] >= self.idle_ttl:
+                return None
+            return entry[0]
+
+    def discard(self, key: tuple) -> None:
+        """移除 key（例如服务端 session 已失效），不触发淘汰回调"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, **self._counters}
+
+
+class SharedSessionRegistry:
+    """
+    多 worker 共享的 session 表，存放在 state_store（如 Redis）中，
+    同一会话的消息落到任意 worker 都能复用同一个 OpenCode session。
+
+    空闲 TTL 由存储的过期时间实现，不做 LRU；过期的 session 不会触发淘汰回调，
+    只有被新 session 替换时才会。存储不可用时按未命中处理（新建 session）。
+    """
+
+    def __init__(self, store, idle_ttl: float = 1800, on_evict=None, namespace: str = "session:"):
+        self.store = store
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "replaced": 0, "errors": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _store_key(self, key: tuple) -> str:
+        return self.namespace + json.dumps(list(key), ensure_ascii=False)
+
+    def _load(self, key: tuple) -> list | None:
+        try:
+            raw = self.store.get(self._store_key(key))
+        except StateStoreError as e:
+            self._count("errors")
+            logger.warning(f"[OpenCode] 共享 session 表不可用: {e}")
+            return None
+        return json.loads(raw) if raw else None
+
+    def get(self, key: tuple, api_url: str) -> str | None:
+        """返回 key 对应且属于 api_url 的 session id，并重置其空闲 TTL"""
+        entry = self._load(key)
+        if entry is None or entry[0] != api_url:
+            self._count("misses")
+            return None
+        self._count("hits")
+        try:
+            self.store.touch(self._store_key(key), self.idle_ttl)
+        except StateStoreError:
+            self._count("errors")
+        return entry[1]
+
+    def put(self, key: tuple, api_url: str, session_id: str) -> None:
+        value = json.dumps([api_url, session_id])
+        try:
+            old = self.store.update(self._store_key(key), lambda current: (value, current), self.idle_ttl)
+        except StateStoreError as e:
+            self._count("errors")
+            logger.warning(f"[OpenCode] 无法记录 session {session_id}: {e}")
+            return
+        old = json.loads(old) if old else None
+        if old is not None and old[1] != session_id:
+            self._count("replaced")
+            _notify_evicted(self.on_evict, [(old[0], old[1])])
+
+    def backend_of(self, key: tuple) -> str | None:
+        """key 当前 session 所在的 api_url，不计入命中统计"""
+        entry = self._load(key)
+        return entry[0] if entry else None
+
+    def discard(self, key: tuple) -> None:
+        try:
+            self.store.delete(self._store_key(key))
+        except StateStoreError:
+            self._count("errors")
+
+    def __len__(self) -> int:
+        try:
+            return self.store.count(self.namespace)
+        except StateStoreError:
+            return 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        return {"size": len(self), "backend": "shared", "idle_ttl": self.idle_ttl, **counters}
+
+
+_registry: SessionRegistry | SharedSessionRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def _delete_in_background(api_url: str, session_id: str) -> None:
+    from opencode_client import delete_opencode_session
+
+    threading.Thread(
+        target=delete_opencode_session, args=(api_url, session_id), daemon=True
+    ).start()
+
+
+def get_session_registry() -> SessionRegistry | SharedSessionRegistry:
+    """进程内共享的 session 表，首次调用时按配置创建；配置了 WEWORK_STATE_STORE 时各 worker 共享"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            on_evict = _delete_in_background if get_opencode_session_delete_on_evict() else None
+            if is_shared():
+                _registry = SharedSessionRegistry(
+                    get_state_store(), idle_ttl=get_opencode_session_idle_ttl(), on_evict=on_evict
+                )
+            else:
+                _registry = SessionRegistry(
+                    max_size=get_opencode_session_max(),
+                    idle_ttl=get_opencode_session_idle_ttl(),
+                    on_evict=on_evict,
+                )
+        return _registry
+
+
+def session_key_for(message_obj: dict, agent_name: str) -> tuple | None:
+    """回调消息对应的会话键；未开启复用或缺少发送者时返回 None"""
+    if not get_opencode_session_reuse() or not isinstance(message_obj, dict):
+        return None
+    from_user = message_obj.get("FromUserName")
+    if not from_user:
+        return None
+    return (from_user, message_obj.get("AgentID"), agent_name)
+
+
+def in_conversation(session_key: tuple | None) -> bool:
+    """会话键已有复用中的 session：后续消息可能依赖上下文，不应与他人合并或使用缓存回答"""
+    if session_key is None:
+        return False
+    return get_session_registry().backend_of(session_key) is not None
@@ -0,0 +1,562 @@
+"""
+OpenCode 流式回复
+
+async 回复模式下，在 POST /session/{id}/message 的同时订阅 OpenCode 的 SSE 事件流
+（GET /event），按 session 过滤 message.part.updated 事件，逐步拼出助手回复。
+ProgressiveReply 决定何时把已生成的部分推给用户：回复超过
+OPENCODE_STREAM_FIRST_CHUNK_SECONDS 秒仍未完成时推送已完成的段落，之后每累计
+OPENCODE_STREAM_MIN_CHUNK_CHARS 个字符的完整段落推送一次；message 接口返回后
+补发剩余部分。
+
+stream_opencode() / stream_opencode_async() 是生成器，依次产出要推送的文本片段，
+由 async_reply 的 dispatcher 逐段发送。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+import httpx
+import requests
+
+from config import (
+    get_opencode_stream_first_chunk_seconds,
+    get_opencode_stream_min_chunk_chars,
+)
+from http_transport import get_async_client, get_async_timeout, get_session, get_timeout
+from opencode_client import (
+    _create_session,
+    _agent_missing_reply,
+    _create_session_async,
+    _extract_reply_text_from_response,
+    _find_session,
+    _get_async_auth,
+    _get_auth,
+    _send_message,
+    _send_message_async,
+    ask_opencode,
+    ask_opencode_async,
+)
+from opencode_agents import agent_missing
+from opencode_breaker import BreakerCall, get_breaker, is_open
+from opencode_sessions import get_session_registry
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+FALLBACK = "OpenCode 暂时不可用，请稍后再试。"
+
+# 保留最近多少次流式请求的耗时用于计算分位数
+_LATENCY_WINDOW = 1024
+
+
+def _iter_raw_lines(resp):
+    """
+    逐行读取流式响应。``iter_lines()`` 会凑满 chunk_size 才返回，
+    这里用 read1() 读到多少处理多少，事件到达即可解析。
+    """
+    buffer = b""
+    while True:
+        data = resp.raw.read1(8192)
+        if not data:
+            break
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def iter_sse_data(lines):
+    """把 SSE 文本行解析为 data 字段的 JSON 对象；注释行与无法解析的事件被忽略"""
+    data = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r")
+        if not line:
+            if data:
+                try:
+                    yield json.loads("\n".join(data))
+                except ValueError:
+                    logger.debug(f"[OpenCode] 忽略无法解析的事件: {data}")
+                data = []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if field == "data":
+            data.append(value[1:] if value.startswith(" ") else value)
+
+
+class StreamAssembler:
+    """根据事件流拼出某个 session 的助手回复文本"""
+
+    def __init__(self, session_id: str, prompt: str):
+        self.session_id = session_id
+        self.prompt = prompt.strip()
+        self.roles: dict[str, str] = {}
+        # part id -> [message id, text]，按首次出现的顺序
+        self.parts: OrderedDict[str, list] = OrderedDict()
+        self.first_text_at: float | None = None
+        self.idle = False
+
+    def feed(self, event: dict) -> bool:
+        """处理一个事件，返回回复文本是否可能有变化"""
+        if not isinstance(event, dict):
+            return False
+        kind = event.get("type")
+        props = event.get("properties") or {}
+        if kind == "message.updated":
+            info = props.get("info") or {}
+            if info.get("sessionID") != self.session_id or not info.get("id"):
+                return False
+            self.roles[info["id"]] = info.get("role")
+            return True
+        if kind == "message.part.updated":
+            part = props.get("part") or {}
+            if part.get("sessionID") != self.session_id or part.get("type") != "text":
+                return False
+            self.parts[part.get("id")] = [part.get("messageID"), part.get("text") or ""]
+        elif kind == "message.part.delta":
+            if props.get("sessionID") != self.session_id or props.get("field", "text") != "text":
+                return False
+            entry = self.parts.setdefault(props.get("partID"), [props.get("messageID"), ""])
+            entry[1] += props.get("delta") or ""
+        elif kind == "session.idle":
+            if props.get("sessionID") == self.session_id:
+                self.idle = True
+            return False
+        else:
+            return False
+        if self.first_text_at is None and self.text:
+            self.first_text_at = time.monotonic()
+        return True
+
+    @property
+    def text(self) -> str:
+        """与 _extract_reply_text_from_response 一致：取助手消息的第一个非空文本 part"""
+        for message_id, text in self.parts.values():
+            role = self.roles.get(message_id)
+            if role == "user" or (role is None and text.strip() == self.prompt):
+                continue
+            if text.strip():
+                return text
+        return ""
+
+
+class ProgressiveReply:
+    """决定何时推送已生成的部分回复，并在最后给出剩余内容"""
+
+    def __init__(self, first_chunk_seconds: float, min_chunk_chars: int, started_at: float | None = None):
+        self.first_chunk_seconds = first_chunk_seconds
+        self.min_chunk_chars = min_chunk_chars
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.pushed = ""
+        self.chunks = 0
+
+    def wait_timeout(self, now: float) -> float | None:
+        """首段推送时间点之前，最多等待到该时间点再检查一次"""
+        remaining = self.started_at + self.first_chunk_seconds - now
+        return remaining if remaining > 0 else None
+
+    def take(self, text: str, now: float) -> str | None:
+        """返回现在应推送的片段（只推送完整的段落或行），没有则返回 None"""
+        if now - self.started_at < self.first_chunk_seconds:
+            return None
+        pending = text[len(self.pushed):]
+        cut = pending.rfind("\n\n")
+        if cut < 0 and not self.chunks:
+            cut = pending.rfind("\n")
+        if cut <= 0:
+            return None
+        chunk = pending[:cut].strip()
+        if not chunk or (self.chunks and len(chunk) < self.min_chunk_chars):
+            return None
+        self.pushed = text[: len(self.pushed) + cut]
+        self.chunks += 1
+        return chunk
+
+    def remainder(self, final_text: str) -> str:
+        """完整回复中尚未推送的部分"""
+        pushed = self.pushed.strip()
+        if not pushed:
+            return final_text
+        if final_text.startswith(pushed):
+            return final_text[len(pushed):].strip()
+        logger.warning("[OpenCode] 完整回复与已推送的流式内容不一致，发送完整回复")
+        return final_text
+
+
+class StreamStats:
+    """流式回复的首字节时间（TTFB）与推送计数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"streams": 0, "chunks": 0, "fallbacks": 0}
+        # 发出 message 请求到事件流中出现第一段回复文本
+        self._ttfb = deque(maxlen=_LATENCY_WINDOW)
+        # 发出 message 请求到第一段部分回复被推送
+        self._first_chunk = deque(maxlen=_LATENCY_WINDOW)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def observe(self, started_at: float, first_text_at: float | None, first_chunk_at: float | None) -> None:
+        with self._lock:
+            self._counters["streams"] += 1
+            if first_text_at is not None:
+                self._ttfb.append(first_text_at - started_at)
+            if first_chunk_at is not None:
+                self._first_chunk.append(first_chunk_at - started_at)
+
+    @staticmethod
+    def _summary(values) -> dict:
+        ordered = sorted(values)
+        if not ordered:
+            return {"count": 0, "p50": 0.0, "p95": 0.0}
+        pick = lambda pct: ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+        return {"count": len(ordered), "p50": pick(50), "p95": pick(95)}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "ttfb": self._summary(self._ttfb),
+                "first_chunk": self._summary(self._first_chunk),
+            }
+
+
+_stats = StreamStats()
+
+
+def get_stream_stats() -> StreamStats:
+    return _stats
+
+
+def _resolve(api_url, agent_name):
+    api_url = (api_url or os.environ.get("OPENCODE_API_URL", "http://127.0.0.1:4096")).rstrip("/")
+    agent_name = agent_name or os.environ.get("OPENCODE_AGENT_NAME", "docs-searcher")
+    return api_url, agent_name
+
+
+def _close_stream(resp) -> None:
+    """关闭事件流；先 shutdown 底层 socket，唤醒阻塞在读取上的线程"""
+    try:
+        resp.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    resp.close()
+
+
+def _admit(api_url: str) -> BreakerCall | None:
+    """
+    流式请求交给后端前向熔断器登记，与 ask_opencode() 一样记录结果；
+    None 表示熔断器不再放行（例如半开时探测名额刚被用完）。
+    订阅事件流失败时改用 ask_opencode()，由它自己登记，因此在订阅之后才调用。
+    """
+    breaker = get_breaker(api_url)
+    if breaker is not None and not breaker.allow():
+        metrics.FAILURES.inc(reason="opencode_circuit_open")
+        return None
+    return BreakerCall(breaker)
+
+
+def _abandoned(call: BreakerCall, error: BaseException) -> None:
+    """流式过程中被中断：调用方不再读取（关闭生成器或取消任务）不算后端失败。"""
+    call.ok = isinstance(error, (GeneratorExit, asyncio.CancelledError))
+    call.finish()
+
+
+def stream_opencode(
+    user_message: str,
+    api_url: str | None = None,
+    agent_name: str | None = None,
+    session_key: tuple | None = None,
+):
+    """
+    流式版本的 ask_opencode()：生成器，依次产出要推送给用户的文本片段。
+    事件流不可用时退化为一次 ask_opencode() 调用。
+    """
+    api_url, agent_name = _resolve(api_url, agent_name)
+    if not (user_message and user_message.strip()):
+        yield "请发送要咨询的内容。"
+        return
+    if agent_missing(api_url, agent_name):
+        yield _agent_missing_reply(agent_name)
+        return
+    if is_open(api_url):
+        metrics.FAILURES.inc(reason="opencode_circuit_open")
+        yield FALLBACK
+        return
+    text = user_message.strip()
+    auth = _get_auth()
+    registry = get_session_registry() if session_key is not None else None
+
+    try:
+        session_id, reused = _find_session(registry, session_key, api_url, agent_name)
+        warm = bool(session_id) and not reused
+        if not session_id:
+            session_id = _create_session(api_url, tracing.session_title("Wework Robot"), auth)
+        events = None
+        if session_id:
+            with metrics.http_call("opencode", "event") as call:
+                events = get_session().get(
+                    f"{api_url}/event", stream=True, auth=auth, timeout=get_timeout("opencode.event")
+                )
+                call.status = events.status_code
+            events.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"[OpenCode] 无法订阅事件流，改用普通请求: {e}")
+        _stats.count("fallbacks")
+        yield ask_opencode(user_message, api_url, agent_name, session_key)
+        return
+    call = _admit(api_url)
+    if call is None:
+        if events is not None:
+            _close_stream(events)
+        yield FALLBACK
+        return
+    if not session_id:
+        call.finish()
+        yield FALLBACK
+        return
+
+    assembler = StreamAssembler(session_id, text)
+    cond = threading.Condition()
+    state = {"version": 0, "done": False, "result": None, "error": None}
+
+    def read_events():
+        try:
+            for event in iter_sse_data(_iter_raw_lines(events)):
+                with cond:
+                    if assembler.feed(event):
+                        state["version"] += 1
+                        cond.notify_all()
+        except Exception as e:
+            if not state["done"]:
+                logger.debug(f"[OpenCode] 事件流中断: {e}")
+
+    def post_message():
+        try:
+            result = _send_message(api_url, session_id, agent_name, text, auth)
+        except Exception as e:
+            result, state["error"] = None, e
+        with cond:
+            state["result"], state["done"] = result, True
+            cond.notify_all()
+
+    progress = ProgressiveReply(
+        get_opencode_stream_first_chunk_seconds(), get_opencode_stream_min_chunk_chars()
+    )
+    first_chunk_at = None
+    threading.Thread(target=read_events, name="opencode-events", daemon=True).start()
+    threading.Thread(target=tracing.bind(post_message), name="opencode-message", daemon=True).start()
+    try:
+        seen = -1
+        while True:
+            with cond:
+                if not state["done"] and state["version"] == seen:
+                    cond.wait(progress.wait_timeout(time.monotonic()))
+                seen, done, streamed = state["version"], state["done"], assembler.text
+            if done:
+                break
+            chunk = progress.take(streamed, time.monotonic())
+            if chunk:
+                if first_chunk_at is None:
+                    first_chunk_at = time.monotonic()
+                _stats.count("chunks")
+                yield chunk
+    except BaseException as e:
+        _abandoned(call, e)
+        raise
+    finally:
+        with cond:
+            state["done"] = True
+        _close_stream(events)
+    _stats.observe(progress.started_at, assembler.first_text_at, first_chunk_at)
+
+    error = state["error"]
+    if error is not None:
+        if (
+            (reused or warm)
+            and not progress.chunks
+            and isinstance(error, requests.exceptions.HTTPError)
+            and error.response is not None
+            and error.response.status_code == 404
+        ):
+            logger.info(f"[OpenCode] 复用的 session {session_id} 已失效，重新创建")
+            # 后端正常应答，只是 session 已不存在
+            call.ok = True
+            call.finish()
+            if registry is not None:
+                registry.discard(session_key)
+            yield ask_opencode(user_message, api_url, agent_name, session_key)
+            return
+        call.finish()
+        logger.error(f"[OpenCode] 流式请求失败: {error}")
+        yield FALLBACK
+        return
+    call.ok = True
+    call.finish()
+    if registry is not None:
+        registry.put(session_key, api_url, session_id)
+    tracing.annotate(session_id=session_id, session_reused=reused)
+    final = _extract_reply_text_from_response(state["result"]) or assembler.text.strip()
+    if not final:
+        logger.warning(f"[OpenCode] 无法从响应中解析回复文本: {state['result']}")
+        final = FALLBACK
+    yield progress.remainder(final)
+
+
+async def stream_opencode_async(
+    user_message: str,
+    api_url: str | None = None,
+    agent_name: str | None = None,
+    session_key: tuple | None = None,
+):
+    """stream_opencode() 的异步版本（async generator），供 ASGI 服务使用"""
+    api_url, agent_name = _resolve(api_url, agent_name)
+    if not (user_message and user_message.strip()):
+        yield "请发送要咨询的内容。"
+        return
+    # agent 列表、session 表与预热池是同步调用，放到线程中执行，不阻塞事件循环
+    if await asyncio.to_thread(agent_missing, api_url, agent_name):
+        yield _agent_missing_reply(agent_name)
+        return
+    if is_open(api_url):
+        metrics.FAILURES.inc(reason="opencode_circuit_open")
+        yield FALLBACK
+        return
+    text = user_message.strip()
+    auth = _get_async_auth()
+    registry = get_session_registry() if session_key is not None else None
+    client = get_async_client()
+
+    try:
+        session_id, reused = await asyncio.to_thread(
+            _find_session, registry, session_key, api_url, agent_name
+        )
+        warm = bool(session_id) and not reused
+        if not session_id:
+            session_id = await _create_session_async(
+                api_url, tracing.session_title("Wework Robot"), auth
+            )
+        events = None
+        if session_id:
+            request = client.build_request(
+                "GET", f"{api_url}/event", timeout=get_async_timeout("opencode.event")
+            )
+            with metrics.http_call("opencode", "event") as call:
+                events = await client.send(request, auth=auth, stream=True)
+                call.status = events.status_code
+            events.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"[OpenCode] 无法订阅事件流，改用普通请求: {e}")
+        _stats.count("fallbacks")
+        yield await ask_opencode_async(user_message, api_url, agent_name, session_key)
+        return
+    call = _admit(api_url)
+    if call is None:
+        if events is not None:
+            await events.aclose()
+        yield FALLBACK
+        return
+    if not session_id:
+        call.finish()
+        yield FALLBACK
+        return
+
+    assembler = StreamAssembler(session_id, text)
+    changed = asyncio.Event()
+
+    async def read_events():
+        try:
+            async for event in _aiter_sse_data(events.aiter_lines()):
+                if assembler.feed(event):
+                    changed.set()
+        except httpx.HTTPError as e:
+            logger.debug(f"[OpenCode] 事件流中断: {e}")
+
+    progress = ProgressiveReply(
+        get_opencode_stream_first_chunk_seconds(), get_opencode_stream_min_chunk_chars()
+    )
+    first_chunk_at = None
+    reader = asyncio.create_task(read_events())
+    post = asyncio.create_task(_send_message_async(api_url, session_id, agent_name, text, auth))
+    try:
+        while True:
+            changed.clear()
+            chunk = progress.take(assembler.text, time.monotonic())
+            if chunk:
+                if first_chunk_at is None:
+                    first_chunk_at = time.monotonic()
+                _stats.count("chunks")
+                yield chunk
+            if post.done():
+                break
+            waiter = asyncio.ensure_future(changed.wait())
+            await asyncio.wait(
+                {post, waiter},
+                timeout=progress.wait_timeout(time.monotonic()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            waiter.cancel()
+    except BaseException as e:
+        _abandoned(call, e)
+        raise
+    finally:
+        reader.cancel()
+        if not post.done():
+            post.cancel()
+        await events.aclose()
+    _stats.observe(progress.started_at, assembler.first_text_at, first_chunk_at)
+
+    error = post.exception() if not post.cancelled() else None
+    if error is not None:
+        if (
+            (reused or warm)
+            and not progress.chunks
+            and isinstance(error, httpx.HTTPStatusError)
+            and error.response.status_code == 404
+        ):
+            logger.info(f"[OpenCode] 复用的 session {session_id} 已失效，重新创建")
+            call.ok = True
+            call.finish()
+            if registry is not None:
+                await asyncio.to_thread(registry.discard, session_key)
+            yield await ask_opencode_async(user_message, api_url, agent_name, session_key)
+            return
+        call.finish()
+        logger.error(f"[OpenCode] 流式请求失败: {error}")
+        yield FALLBACK
+        return
+    call.ok = True
+    call.finish()
+    if registry is not None:
+        await asyncio.to_thread(registry.put, session_key, api_url, session_id)
+    tracing.annotate(session_id=session_id, session_reused=reused)
+    result = post.result()
+    final = _extract_reply_text_from_response(result) or assembler.text.strip()
+    if not final:
+        logger.warning(f"[OpenCode] 无法从响应中解析回复文本: {result}")
+        final = FALLBACK
+    yield progress.remainder(final)
+
+
+async def _aiter_sse_data(lines):
+    """iter_sse_data() 的异步版本"""
+    buffered = []
+    async for line in lines:
+        buffered.append(line)
+        if not line.rstrip("\r"):
+            for event in iter_sse_data(buffered):
+                yield event
+            buffered = []
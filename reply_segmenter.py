@@ -0,0 +1,131 @@
+"""
+Split long replies into WeCom-sized text messages.
+
+WeCom text messages are limited to 2048 *bytes* of UTF-8, so a Chinese answer
+hits the limit at roughly 680 characters. ``split_reply`` cuts a reply into
+parts within that budget, preferring paragraph boundaries and keeping fenced
+code blocks together (an oversized block is split by lines and its fences are
+re-opened in every part). Parts are numbered ``(1/3)`` so the reader can tell
+when the answer is complete.
+"""
+
+MAX_TEXT_BYTES = 2048
+
+_FENCE = "```"
+_PARAGRAPH_SEP = "\n\n"
+# room for a "(999/999)\n" part number
+_NUMBER_RESERVE = 12
+
+
+def utf8_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def truncate_utf8(text: str, max_bytes: int = MAX_TEXT_BYTES) -> str:
+    """Longest prefix of ``text`` that fits in ``max_bytes`` without splitting a character."""
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes].decode("utf-8", "ignore")
+
+
+def _blocks(text: str) -> list[tuple[str, bool]]:
+    """Paragraphs and fenced code blocks as (text, is_code)."""
+    blocks: list[tuple[str, bool]] = []
+    current: list[str] = []
+    in_code = False
+
+    def flush(is_code: bool) -> None:
+        if current and "".join(current).strip():
+            blocks.append(("\n".join(current).strip("\n"), is_code))
+        current.clear()
+
+    for line in text.split("\n"):
+        if line.lstrip().startswith(_FENCE):
+            if in_code:
+                current.append(line)
+                flush(True)
+                in_code = False
+            else:
+                flush(False)
+                current.append(line)
+                in_code = True
+        elif in_code:
+            current.append(line)
+        elif not line.strip():
+            flush(False)
+        else:
+            current.append(line)
+    flush(in_code)
+    return blocks
+
+
+def _hard_split(line: str, budget: int) -> list[str]:
+    pieces = []
+    while utf8_len(line) > budget:
+        head = truncate_utf8(line, budget)
+        pieces.append(head)
+        line = line[len(head):]
+    pieces.append(line)
+    return pieces
+
+
+def _split_lines(lines: list[str], budget: int) -> list[str]:
+    """Greedily pack lines (joined by newlines) into pieces of at most ``budget`` bytes."""
+    pieces: list[str] = []
+    current = ""
+    for line in lines:
+        for segment in _hard_split(line, budget):
+            candidate = f"{current}\n{segment}" if current else segment
+            if current and utf8_len(candidate) > budget:
+                pieces.append(current)
+                current = segment
+            else:
+                current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _split_block(block: str, is_code: bool, budget: int) -> list[str]:
+    if utf8_len(block) <= budget:
+        return [block]
+    lines = block.split("\n")
+    if not is_code:
+        return _split_lines(lines, budget)
+    opening = lines[0]
+    body = lines[1:-1] if len(lines) > 1 and lines[-1].lstrip().startswith(_FENCE) else lines[1:]
+    overhead = utf8_len(opening) + utf8_len(_FENCE) + 2
+    return [f"{opening}\n{piece}\n{_FENCE}" for piece in _split_lines(body, budget - overhead)]
+
+
+def split_reply(text: str, max_bytes: int = MAX_TEXT_BYTES, numbered: bool = True) -> list[str]:
+    """
+    Split ``text`` into parts of at most ``max_bytes`` UTF-8 bytes.
+
+    :param numbered: Prefix every part with ``(i/n)`` when there is more than one.
+    :return: The parts in order; ``[]`` for an empty reply.
+    """
+    text = (text or "").strip()
+    if not text:
+        return []
+    if utf8_len(text) <= max_bytes:
+        return [text]
+
+    budget = max_bytes - (_NUMBER_RESERVE if numbered else 0)
+    parts: list[str] = []
+    current = ""
+    for block, is_code in _blocks(text):
+        for piece in _split_block(block, is_code, budget):
+            candidate = f"{current}{_PARAGRAPH_SEP}{piece}" if current else piece
+            if current and utf8_len(candidate) > budget:
+                parts.append(current)
+                current = piece
+            else:
+                current = candidate
+    if current:
+        parts.append(current)
+
+    if numbered and len(parts) > 1:
+        parts = [f"({i}/{len(parts)})\n{part}" for i, part in enumerate(parts, 1)]
+    return parts
@@ -0,0 +1,178 @@
+"""
+Near-duplicate question matching for the answer cache.
+
+Questions are reduced to a set of features that ignore word order and
+question phrasing: latin words, plus the characters and character bigrams of
+each CJK run, after dropping interrogatives and fillers ("怎么", "如何", "how",
+"do", ...). "怎么配置X" and "X 如何配置" therefore produce the same set.
+
+A latin word weighs as much as one CJK character in that set, so "怎么配置nginx网关"
+and "怎么配置redis网关" look alike. Product names, versions and other latin /
+identifier tokens therefore have to match exactly (``identifier_tokens``)
+before a similar question counts as a hit.
+
+``MinHashIndex`` stores a 64-value MinHash signature per question in one flat
+``array`` and finds candidates with LSH banding (16 bands of 4 rows), so a
+lookup touches 16 dict buckets instead of scanning every question. Candidates
+are ranked by the fraction of equal signature values, which estimates the
+Jaccard similarity of their feature sets. Pure Python, no network, no model.
+"""
+
+import hashlib
+import re
+import struct
+import sys
+from array import array
+
+NUM_PERM = 64
+BAND_ROWS = 4
+
+_TOKEN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9_][a-z0-9_.+#-]*")
+_CJK_STOPWORDS = (
+    "请问", "能不能", "是不是", "怎么样", "怎么", "如何", "怎样", "一下", "可以", "是否", "我想", "我要",
+)
+_CJK_TRAILING_PARTICLES = "吗呢吧啊呀"
+_LATIN_STOPWORDS = frozenset(
+    "a an the how do does did i we you to can could should would is are was be "
+    "please in on of for with what my me it".split()
+)
+# one 64-byte blake2b digest yields 16 32-bit hash values
+_SALTS = tuple(f"minhash{i}".encode() for i in range(NUM_PERM // 16))
+_UNPACK = struct.Struct("<16I").unpack
+
+
+def question_features(text: str) -> set[str]:
+    """Order-insensitive feature set of an already normalized question."""
+    features = set()
+    for token in _TOKEN_RE.findall(text):
+        if token[0].isascii():
+            if token not in _LATIN_STOPWORDS:
+                features.add(token)
+            continue
+        for word in _CJK_STOPWORDS:
+            token = token.replace(word, " ")
+        for run in token.split():
+            run = run.rstrip(_CJK_TRAILING_PARTICLES)
+            features.update(run)
+            features.update(run[i:i + 2] for i in range(len(run) - 1))
+    return features or {text}
+
+
+def identifier_tokens(text: str) -> frozenset[str]:
+    """Latin / identifier words of an already normalized question, minus stopwords."""
+    return frozenset(
+        token for token in _TOKEN_RE.findall(text)
+        if token[0].isascii() and token not in _LATIN_STOPWORDS
+    )
+
+
+def minhash(features: set[str]) -> array:
+    rows = []
+    for feature in features:
+        data = feature.encode("utf-8")
+        row = ()
+        for salt in _SALTS:
+            row += _UNPACK(hashlib.blake2b(data, digest_size=64, salt=salt).digest())
+        rows.append(row)
+    return array("I", map(min, zip(*rows)))
+
+
+class MinHashIndex:
+    """LSH index of question signatures keyed by an opaque string (the cache key)."""
+
+    def __init__(self, band_rows: int = BAND_ROWS):
+        """:param band_rows: Signature values per LSH band; fewer rows find less similar pairs."""
+        if NUM_PERM % band_rows:
+            raise ValueError(f"band_rows must divide {NUM_PERM}")
+        self.num_perm = NUM_PERM
+        self.band_rows = band_rows
+        self._bands = [dict() for _ in range(NUM_PERM // band_rows)]
+        self._sigs = array("I")
+        self._keys: list[str | None] = []
+        self._ids: dict[str, int] = {}
+        self._free: list[int] = []
+
+    def signature(self, text: str) -> array:
+        return minhash(question_features(text))
+
+    def _band_keys(self, sig: array):
+        r = self.band_rows
+        for b in range(len(self._bands)):
+            yield b, hash(tuple(sig[b * r:(b + 1) * r]))
+
+    def add(self, key: str, sig: array) -> None:
+        self.remove(key)
+        if self._free:
+            slot = self._free.pop()
+            self._sigs[slot * self.num_perm:(slot + 1) * self.num_perm] = sig
+            self._keys[slot] = key
+        else:
+            slot = len(self._keys)
+            self._sigs.extend(sig)
+            self._keys.append(key)
+        self._ids[key] = slot
+        for b, h in self._band_keys(sig):
+            bucket = self._bands[b].get(h)
+            if bucket is None:
+                self._bands[b][h] = slot  # a lone id, a list only on collision
+            elif isinstance(bucket, list):
+                bucket.append(slot)
+            else:
+                self._bands[b][h] = [bucket, slot]
+
+    def remove(self, key: str) -> bool:
+        slot = self._ids.pop(key, None)
+        if slot is None:
+            return False
+        sig = self._sigs[slot * self.num_perm:(slot + 1) * self.num_perm]
+        for b, h in self._band_keys(sig):
+            bucket = self._bands[b].get(h)
+            if bucket == slot:
+                del self._bands[b][h]
+            elif isinstance(bucket, list) and slot in bucket:
+                bucket.remove(slot)
+                if len(bucket) == 1:
+                    self._bands[b][h] = bucket[0]
+        self._keys[slot] = None
+        self._free.append(slot)
+        return True
+
+    def query(self, sig: array, threshold: float, accept=None) -> tuple[str, float] | None:
+        """Most similar indexed key with estimated similarity >= threshold, or None."""
+        candidates = set()
+        for b, h in self._band_keys(sig):
+            bucket = self._bands[b].get(h)
+            if bucket is None:
+                continue
+            if isinstance(bucket, list):
+                candidates.update(bucket)
+            else:
+                candidates.add(bucket)
+        best = None
+        n = self.num_perm
+        for slot in candidates:
+            key = self._keys[slot]
+            if accept is not None and not accept(key):
+                continue
+            stored = self._sigs[slot * n:(slot + 1) * n]
+            score = sum(a == b for a, b in zip(sig, stored)) / n
+            if score >= threshold and (best is None or score > best[1]):
+                best = (key, score)
+        return best
+
+    def clear(self) -> None:
+        self.__init__(self.band_rows)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def approx_bytes(self) -> int:
+        """Rough memory held by the index structures (excluding the key strings)."""
+        size = sys.getsizeof(self._sigs) + sys.getsizeof(self._keys) + sys.getsizeof(self._ids)
+        for band in self._bands:
+            size += sys.getsizeof(band)
+            for h, bucket in band.items():
+                size += sys.getsizeof(h)
+                if isinstance(bucket, list):
+                    size += sys.getsizeof(bucket)
+        return size
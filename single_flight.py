@@ -0,0 +1,147 @@
+"""
+In-flight coalescing of identical questions.
+
+In a busy group several people often ask the same thing within seconds, and
+each ask would start its own agent run. ``SingleFlight`` lets the first caller
+for a key (normalized question + agent name) run OpenCode while concurrent
+callers with the same key wait for, and share, its answer. Only the leader's
+OpenCode session sees the exchange.
+
+Questions shorter than ``OPENCODE_SINGLE_FLIGHT_MIN_CHARS`` ("继续", "详细点")
+depend on each user's conversation and are never coalesced, nor is any
+question asked in a conversation that already has an OpenCode session: a
+follow-up such as "那第二个呢？" only makes sense in its own context.
+"""
+
+import asyncio
+import logging
+import threading
+
+import metrics
+from answer_cache import normalize_question
+from config import get_single_flight_enabled, get_single_flight_min_chars
+from opencode_sessions import in_conversation
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[tuple, _Call] = {}
+        self._async_calls: dict[tuple, asyncio.Future] = {}
+        self._counters = {"leaders": 0, "coalesced": 0}
+
+    def _joined(self, key) -> None:
+        self._counters["coalesced"] += 1
+        metrics.SINGLE_FLIGHT_COALESCED.inc()
+        logger.info("[SingleFlight] joined in-flight call for %r", key[-1][:40])
+
+    def do(self, key: tuple, fn):
+        """Return ``fn()``, or the result of an identical call already running."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters["leaders"] += 1
+            else:
+                self._joined(key)
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: tuple, fn):
+        """``do()`` for a coroutine function, on the running event loop."""
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop),) + key
+        with self._lock:
+            future = self._async_calls.get(loop_key)
+            leader = future is None
+            if leader:
+                future = self._async_calls[loop_key] = loop.create_future()
+                self._counters["leaders"] += 1
+            else:
+                self._joined(key)
+        if not leader:
+            # shield: a cancelled follower must not cancel the shared result
+            return await asyncio.shield(future)
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: the leader raises it itself
+            raise
+        finally:
+            with self._lock:
+                del self._async_calls[loop_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._calls) + len(self._async_calls)
+            return {"in_flight": in_flight, **self._counters}
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
+
+
+def flight_key(user_message: str, agent_name: str) -> tuple | None:
+    """Coalescing key, or None when the question must not be shared."""
+    if not get_single_flight_enabled():
+        return None
+    normalized = normalize_question(user_message)
+    if len(normalized) < get_single_flight_min_chars():
+        return None
+    return (agent_name, normalized)
+
+
+def ask_coalesced(ask, user_message: str, agent_name: str, **kwargs) -> str:
+    """
+    ``ask(user_message=..., agent_name=..., **kwargs)`` shared with identical
+    concurrent asks, unless ``kwargs["session_key"]`` is mid-conversation.
+    """
+    call = lambda: ask(user_message=user_message, agent_name=agent_name, **kwargs)
+    key = flight_key(user_message, agent_name)
+    if key is None or in_conversation(kwargs.get("session_key")):
+        return call()
+    return _single_flight.do(key, call)
+
+
+async def ask_coalesced_async(ask, user_message: str, agent_name: str, **kwargs) -> str:
+    """Async variant of ``ask_coalesced`` for ``ask_opencode_async``."""
+    call = lambda: ask(user_message=user_message, agent_name=agent_name, **kwargs)
+    key = flight_key(user_message, agent_name)
+    # the session table may live in a shared store: look it up off the event loop
+    if key is None or await asyncio.to_thread(in_conversation, kwargs.get("session_key")):
+        return await call()
+    return await _single_flight.do_async(key, call)
@@ -0,0 +1,366 @@
+"""
+Key-value store for state that several worker processes must agree on.
+
+With one process, callback dedup, the OpenCode session table and the WeCom
+send rate limits live in memory. Under several gunicorn / uvicorn workers, or
+on several hosts, each worker would keep its own copy: a WeCom retry landing
+on another worker is answered twice, a conversation loses its OpenCode
+session when the next message goes to another worker, and every worker sends
+its own 20 messages per minute to the same robot.
+
+``WEWORK_STATE_STORE`` selects the store: ``memory`` (default, process-local)
+or ``redis://[:password@]host:port/db`` for any server speaking the Redis
+protocol. The client is a small RESP implementation over a socket pool and
+only uses GET / SET / DEL / PEXPIRE / SCAN and WATCH / MULTI / EXEC.
+
+Every key is prefixed with ``WEWORK_STATE_PREFIX`` so several deployments can
+share one server. Store errors raise ``StateStoreError``; callers fail open
+(treat the state as absent) rather than refusing callbacks.
+"""
+
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import unquote, urlparse
+
+from config import get_state_prefix, get_state_store_timeout, get_state_store_url
+
+logger = logging.getLogger(__name__)
+
+# optimistic transactions retried this many times before giving up
+_UPDATE_RETRIES = 32
+
+
+class StateStoreError(Exception):
+    """The shared store could not be reached or rejected a command."""
+
+
+class _ReplyError(StateStoreError):
+    """Error reply from the server; the connection is still usable."""
+
+
+def _glob_escape(text: str) -> str:
+    return re.sub(r"([\\*?\[\]])", r"\\\1", text)
+
+
+class MemoryStateStore:
+    """Process-local store with per-key TTL; the default for a single process."""
+
+    shared = False
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._data: dict[str, tuple[str, float | None]] = {}
+        self._lock = threading.Lock()
+
+    def _get_locked(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item[0]
+
+    def _set_locked(self, key: str, value: str, ttl: float | None) -> None:
+        self._data[key] = (value, None if ttl is None else time.monotonic() + ttl)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            return self._get_locked(self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        with self._lock:
+            self._set_locked(self.prefix + key, value, ttl)
+
+    def add(self, key: str, value: str, ttl: float | None = None) -> bool:
+        """Store ``value`` only if ``key`` is absent; True when stored."""
+        with self._lock:
+            if self._get_locked(self.prefix + key) is not None:
+                return False
+            self._set_locked(self.prefix + key, value, ttl)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(self.prefix + key, None)
+
+    def touch(self, key: str, ttl: float) -> bool:
+        """Reset the TTL of an existing key; False if it is absent."""
+        with self._lock:
+            value = self._get_locked(self.prefix + key)
+            if value is None:
+                return False
+            self._set_locked(self.prefix + key, value, ttl)
+            return True
+
+    def update(self, key: str, fn, ttl: float | None = None):
+        """
+        Atomically replace the value of ``key``.
+
+        ``fn(current) -> (new_value, result)`` gets the current value (or None);
+        a ``new_value`` of None leaves the key unchanged. Returns ``result``.
+        """
+        with self._lock:
+            new_value, result = fn(self._get_locked(self.prefix + key))
+            if new_value is not None:
+                self._set_locked(self.prefix + key, new_value, ttl)
+            return result
+
+    def count(self, key_prefix: str) -> int:
+        """Number of live keys starting with ``key_prefix``."""
+        full = self.prefix + key_prefix
+        with self._lock:
+            keys = [key for key in self._data if key.startswith(full)]
+            return sum(1 for key in keys if self._get_locked(key) is not None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "keys": len(self._data)}
+
+    def close(self) -> None:
+        pass
+
+
+class _Connection:
+    """One RESP2 connection."""
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+
+    def command(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.sock.sendall(b"".join(parts))
+        return self._read()
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by the state store")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise _ReplyError(body.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("connection closed by the state store")
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise ConnectionError(f"unexpected reply from the state store: {line[:40]!r}")
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisStateStore:
+    """Store shared through a Redis-protocol server; connections are pooled per process."""
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "", timeout: float = 1.0, max_idle: int = 16):
+        """
+        :param url: ``redis://[:password@]host[:port][/db]``.
+        :param prefix: Prepended to every key.
+        :param timeout: Connect and read timeout in seconds.
+        :param max_idle: Idle connections kept for reuse.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"unsupported state store URL: {url!r}")
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.strip("/") or 0)
+        self._password = unquote(parsed.password) if parsed.password else None
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle: list[_Connection] = []
+        self._lock = threading.Lock()
+        self._counters = {"commands": 0, "connects": 0, "errors": 0, "conflicts": 0}
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def _connect(self) -> _Connection:
+        conn = _Connection(self.host, self.port, self.timeout)
+        try:
+            if self._password:
+                conn.command("AUTH", self._password)
+            if self.db:
+                conn.command("SELECT", self.db)
+        except Exception:
+            conn.close()
+            raise
+        self._count("connects")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        try:
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        except _ReplyError:
+            self._release(conn)
+            self._count("errors")
+            raise
+        except OSError as e:
+            if conn is not None:
+                conn.close()
+            self._count("errors")
+            raise StateStoreError(f"state store {self.host}:{self.port} unavailable: {e}") from e
+        else:
+            self._release(conn)
+
+    def _release(self, conn: _Connection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _execute(self, *args):
+        self._count("commands")
+        try:
+            with self._connection() as conn:
+                return conn.command(*args)
+        except _ReplyError:
+            raise
+        except StateStoreError:
+            # the pooled connection may have gone stale; retry once on a fresh one
+            with self._connection() as conn:
+                return conn.command(*args)
+
+    @staticmethod
+    def _px(ttl: float) -> int:
+        return max(1, int(ttl * 1000))
+
+    def get(self, key: str) -> str | None:
+        return self._execute("GET", self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        if ttl is None:
+            self._execute("SET", self.prefix + key, value)
+        else:
+            self._execute("SET", self.prefix + key, value, "PX", self._px(ttl))
+
+    def add(self, key: str, value: str, ttl: float | None = None) -> bool:
+        args = ["SET", self.prefix + key, value, "NX"]
+        if ttl is not None:
+            args += ["PX", self._px(ttl)]
+        return self._execute(*args) == "OK"
+
+    def delete(self, key: str) -> None:
+        self._execute("DEL", self.prefix + key)
+
+    def touch(self, key: str, ttl: float) -> bool:
+        return self._execute("PEXPIRE", self.prefix + key, self._px(ttl)) == 1
+
+    def update(self, key: str, fn, ttl: float | None = None):
+        """``MemoryStateStore.update()`` as a WATCH / MULTI / EXEC transaction, retried on conflict."""
+        full = self.prefix + key
+        self._count("commands")
+        with self._connection() as conn:
+            for attempt in range(_UPDATE_RETRIES):
+                if attempt:
+                    # jittered backoff so contending workers stop colliding
+                    time.sleep(random.uniform(0, 0.001 * attempt))
+                conn.command("WATCH", full)
+                try:
+                    new_value, result = fn(conn.command("GET", full))
+                except Exception:
+                    conn.command("UNWATCH")
+                    raise
+                if new_value is None:
+                    conn.command("UNWATCH")
+                    return result
+                conn.command("MULTI")
+                if ttl is None:
+                    conn.command("SET", full, new_value)
+                else:
+                    conn.command("SET", full, new_value, "PX", self._px(ttl))
+                if conn.command("EXEC") is not None:
+                    return result
+                self._count("conflicts")
+        raise StateStoreError(f"update of {key!r} kept conflicting")
+
+    def count(self, key_prefix: str) -> int:
+        pattern = _glob_escape(self.prefix + key_prefix) + "*"
+        total, cursor = 0, "0"
+        while True:
+            cursor, keys = self._execute("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            total += len(keys)
+            if cursor == "0":
+                return total
+
+    def ping(self) -> bool:
+        return self._execute("PING") == "PONG"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "redis",
+                "server": f"{self.host}:{self.port}/{self.db}",
+                "idle_connections": len(self._idle),
+                **self._counters,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def build_state_store(url: str, prefix: str = "", timeout: float = 1.0):
+    """``MemoryStateStore`` for ``memory``, ``RedisStateStore`` for a ``redis://`` URL."""
+    if url in ("", "memory"):
+        return MemoryStateStore(prefix=prefix)
+    return RedisStateStore(url, prefix=prefix, timeout=timeout)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_state_store():
+    """Process-wide store built from ``WEWORK_STATE_STORE`` on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = build_state_store(
+                get_state_store_url(), prefix=get_state_prefix(), timeout=get_state_store_timeout()
+            )
+            if _store.shared:
+                logger.info("[State] sharing state through %s", _store.stats()["server"])
+        return _store
+
+
+def is_shared() -> bool:
+    """Whether workers share state (a store other than ``memory`` is configured)."""
+    return get_state_store_url() not in ("", "memory")
@@ -0,0 +1,60 @@
+"""Synchronous test client for the ASGI app, mirroring Flask's test_client()."""
+
+import asyncio
+import json
+import threading
+
+import httpx
+
+
+class AsgiResponse:
+    def __init__(self, resp: httpx.Response):
+        self.status_code = resp.status_code
+        self.data = resp.content
+        self.headers = resp.headers
+
+    def get_json(self):
+        return json.loads(self.data)
+
+
+class AsgiTestClient:
+    """
+    Drive an ASGI app from synchronous tests.
+
+    The app runs on an event loop in a background thread, so tasks it spawns
+    (e.g. async reply jobs) keep running between requests.
+    """
+
+    def __init__(self, asgi_app):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self._client = self.run(self._make_client(asgi_app))
+
+    @staticmethod
+    async def _make_client(asgi_app):
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url="http://testserver")
+
+    def run(self, coro, timeout: float = 30):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def get(self, url, headers=None):
+        return AsgiResponse(self.run(self._client.get(url, headers=headers)))
+
+    def post(self, url, data=None, content_type=None, headers=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers["Content-Type"] = content_type
+        return AsgiResponse(self.run(self._client.post(url, content=data, headers=headers)))
+
+    def close(self):
+        async def shutdown():
+            from http_transport import close_async_client
+
+            await self._client.aclose()
+            await close_async_client()
+
+        self.run(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+        self.loop.close()
@@ -0,0 +1,128 @@
+"""Shared fixtures: reset process-wide state and run tests against both server variants."""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def reset_app_state(monkeypatch):
+    import answer_cache
+    import app
+    import asgi_app
+    import http_transport
+    import job_journal
+    import metrics
+    import opencode_admission
+    import opencode_agents
+    import opencode_backends
+    import opencode_breaker
+    import opencode_review
+    import opencode_session_pool
+    import opencode_sessions
+    import single_flight
+    import state_store
+    import tracing
+    import wework_send_queue
+
+    monkeypatch.setattr(app, "_dispatcher", None)
+    monkeypatch.setattr(app, "_crypto", None)
+    monkeypatch.setattr(app, "_crypto_credentials", None)
+    monkeypatch.setattr(app, "_dedup", None)
+    monkeypatch.setattr(app, "_dedup_initialized", False)
+    monkeypatch.setattr(asgi_app, "_dispatcher", None)
+    monkeypatch.setattr(opencode_sessions, "_registry", None)
+    monkeypatch.setattr(wework_send_queue, "_queue", None)
+    monkeypatch.setattr(tracing, "_exporter", None)
+    monkeypatch.setattr(answer_cache, "_cache", None)
+    monkeypatch.setattr(opencode_admission, "_limiters", {})
+    monkeypatch.setattr(opencode_backends, "_pool", None)
+    monkeypatch.setattr(opencode_breaker, "_breakers", {})
+    monkeypatch.setattr(opencode_session_pool, "_pool", None)
+    monkeypatch.setattr(opencode_agents, "_catalog", None)
+    monkeypatch.setattr(opencode_review, "_dispatcher", None)
+    # the agent catalog sends its own GET /agent; tests of it enable it explicitly
+    monkeypatch.setenv("OPENCODE_AGENT_CATALOG_TTL", "0")
+    monkeypatch.setattr(job_journal, "_journal", None)
+    monkeypatch.setattr(state_store, "_store", None)
+    http_transport.reset_latencies()
+    monkeypatch.setattr(single_flight, "_single_flight", single_flight.SingleFlight())
+    metrics.REGISTRY.clear()
+    yield
+    if wework_send_queue._queue is not None:
+        wework_send_queue._queue.close()
+    if tracing._exporter is not None:
+        tracing._exporter.close()
+    if opencode_backends._pool is not None:
+        opencode_backends._pool.stop()
+    if opencode_session_pool._pool is not None:
+        opencode_session_pool._pool.stop()
+    if opencode_agents._catalog is not None:
+        opencode_agents._catalog.stop()
+    if opencode_review._dispatcher is not None:
+        opencode_review._dispatcher.close()
+    if job_journal._journal is not None:
+        job_journal._journal.close()
+    if state_store._store is not None:
+        state_store._store.close()
+
+
+@pytest.fixture
+def fake_redis():
+    """A local Redis-protocol server for the shared state store."""
+    from tests.stubs import FakeRedis
+
+    with FakeRedis() as server:
+        yield server
+
+
+@pytest.fixture(params=["flask", "asgi"])
+def server_variant(request):
+    """Name of the server variant under test: the Flask (WSGI) app or the ASGI app."""
+    return request.param
+
+
+@pytest.fixture
+def app_client(server_variant):
+    """Test client for the selected server variant (Flask test_client() interface)."""
+    if server_variant == "flask":
+        from app import app
+
+        app.config["TESTING"] = True
+        yield app.test_client()
+        return
+
+    from asgi_app import app
+    from tests.asgi_client import AsgiTestClient
+
+    client = AsgiTestClient(app)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def patch_ask(monkeypatch):
+    """Replace the OpenCode call of both variants with a sync ``fn(**kwargs)``."""
+
+    def patch(fn):
+        async def ask_async(**kwargs):
+            return fn(**kwargs)
+
+        monkeypatch.setattr("app.ask_opencode", fn)
+        monkeypatch.setattr("asgi_app.ask_opencode_async", ask_async)
+
+    return patch
+
+
+@pytest.fixture
+def wait_async_replies(app_client, server_variant):
+    """Wait until the async-mode dispatcher of the selected variant is idle."""
+
+    def wait(timeout: float = 10) -> bool:
+        if server_variant == "flask":
+            import app
+
+            return app._dispatcher.wait_idle(timeout)
+        import asgi_app
+
+        return app_client.run(asgi_app._dispatcher.wait_idle(timeout))
+
+    return wait
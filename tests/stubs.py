@@ -0,0 +1,569 @@
+"""Local fake OpenCode / WeCom (qyapi) HTTP servers, Redis and app worker processes for end-to-end tests."""
+
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+
+class _Server(ThreadingHTTPServer):
+    # default listen backlog of 5 drops connections under concurrent load
+    request_queue_size = 128
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients going away (e.g. a worker process being stopped) is not an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubServer:
+    """Run a ThreadingHTTPServer on 127.0.0.1 in a background thread."""
+
+    def __init__(self):
+        self.requests = []
+        self.connections = 0
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                parsed = urlparse(self.path)
+                body = None
+                if raw:
+                    try:
+                        body = json.loads(raw.decode("utf-8"))
+                    except ValueError:
+                        body = raw.decode("utf-8", "replace")
+                req = {
+                    "method": self.command,
+                    "path": parsed.path,
+                    "query": {k: v[0] for k, v in parse_qs(parsed.query).items()},
+                    "headers": dict(self.headers),
+                    "json": body,
+                }
+                stub.record(req)
+                events = stub.open_stream(req)
+                if events is not None:
+                    self._write_events(events)
+                    return
+                status, payload = stub.handle(req)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_events(self, events):
+                # server-sent events; None from the iterator writes a keep-alive comment
+                self.close_connection = True
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    for event in events:
+                        if event is None:
+                            self.wfile.write(b": ping\n\n")
+                        else:
+                            data = json.dumps(event, ensure_ascii=False)
+                            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                except OSError:
+                    pass
+                finally:
+                    events.close()
+
+            do_GET = do_POST = do_DELETE = do_PATCH = _dispatch
+
+        self.httpd = _Server(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+
+    def record(self, req: dict) -> None:
+        with self._lock:
+            self.requests.append(req)
+
+    def calls(self, method: str, path_prefix: str) -> list[dict]:
+        with self._lock:
+            return [
+                r for r in self.requests
+                if r["method"] == method and r["path"].startswith(path_prefix)
+            ]
+
+    def handle(self, req: dict) -> tuple[int, object]:
+        return 404, {"error": "not found"}
+
+    def open_stream(self, req: dict):
+        """Return a generator of SSE events to stream ``req`` instead of ``handle``."""
+        return None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeOpenCode(StubServer):
+    """
+    Minimal OpenCode serve: /session, /session/{id}/message, /agent, /event.
+
+    With ``stream_chunks`` the message handler publishes the answer on /event
+    piece by piece (``chunk_delay`` apart) before returning it; the reply is
+    then the concatenation of the chunks. ``session_latency`` delays
+    ``POST /session``, ``latency`` each message.
+    """
+
+    def __init__(
+        self, reply="stub answer", latency=0.0, agents=("docs-searcher",),
+        stream_chunks=None, chunk_delay=0.0, session_latency=0.0,
+    ):
+        super().__init__()
+        self.reply = reply
+        self.latency = latency
+        self.session_latency = session_latency
+        self.agents = list(agents)
+        self.stream_chunks = list(stream_chunks) if stream_chunks else None
+        self.chunk_delay = chunk_delay
+        # while set, GET /agent (the health probe) answers 503
+        self.unhealthy = False
+        self._next_session = 0
+        self._next_message = 0
+        self._subscribers: list[queue.Queue] = []
+
+    def publish(self, event: dict) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            q.put(event)
+
+    def open_stream(self, req):
+        if req["method"] != "GET" or req["path"] != "/event":
+            return None
+        q: queue.Queue = queue.Queue()
+        with self._lock:
+            self._subscribers.append(q)
+        return self._events(q)
+
+    def _events(self, q):
+        try:
+            yield {"type": "server.connected", "properties": {}}
+            while not self.stopping.is_set():
+                try:
+                    yield q.get(timeout=0.1)
+                except queue.Empty:
+                    yield None
+        finally:
+            with self._lock:
+                self._subscribers.remove(q)
+
+    def _stream_answer(self, session_id: str, prompt: str) -> str:
+        with self._lock:
+            self._next_message += 2
+            user_id, assistant_id = f"msg-{self._next_message - 1}", f"msg-{self._next_message}"
+        for message_id, role in ((user_id, "user"), (assistant_id, "assistant")):
+            self.publish({"type": "message.updated", "properties": {
+                "info": {"id": message_id, "sessionID": session_id, "role": role}}})
+        self.publish({"type": "message.part.updated", "properties": {"part": {
+            "id": f"prt-{user_id}", "sessionID": session_id, "messageID": user_id,
+            "type": "text", "text": prompt}}})
+        text = ""
+        for chunk in self.stream_chunks:
+            time.sleep(self.chunk_delay)
+            text += chunk
+            self.publish({"type": "message.part.updated", "properties": {"part": {
+                "id": f"prt-{assistant_id}", "sessionID": session_id, "messageID": assistant_id,
+                "type": "text", "text": text}, "delta": chunk}})
+        self.publish({"type": "session.idle", "properties": {"sessionID": session_id}})
+        return text
+
+    def handle(self, req):
+        path = req["path"]
+        if req["method"] == "GET" and path == "/agent":
+            if self.unhealthy:
+                return 503, {"error": "unavailable"}
+            return 200, [{"name": name} for name in self.agents]
+        if req["method"] == "POST" and path == "/session":
+            if self.session_latency:
+                time.sleep(self.session_latency)
+            with self._lock:
+                self._next_session += 1
+                sid = f"ses-{self._next_session}"
+            return 200, {"id": sid, "title": (req["json"] or {}).get("title")}
+        if req["method"] == "POST" and path.startswith("/session/") and path.endswith("/message"):
+            if self.latency:
+                time.sleep(self.latency)
+            if self.stream_chunks is not None:
+                prompt = (req["json"] or {}).get("parts", [{}])[0].get("text", "")
+                reply = self._stream_answer(path.split("/")[2], prompt)
+            else:
+                reply = self.reply(req) if callable(self.reply) else self.reply
+            return 200, {"parts": [{"type": "text", "text": reply}]}
+        if req["method"] == "PATCH" and path.startswith("/session/"):
+            return 200, {"id": path.split("/")[2], "title": (req["json"] or {}).get("title")}
+        if req["method"] == "DELETE" and path.startswith("/session/"):
+            return 200, True
+        return 404, {"error": "not found"}
+
+
+class FakeQyapi(StubServer):
+    """Minimal qyapi: gettoken, app message/send and robot webhook/send."""
+
+    def __init__(self, send_errcodes=None):
+        super().__init__()
+        # errcodes returned by successive send calls before falling back to 0
+        self.send_errcodes = list(send_errcodes or [])
+        self.tokens_issued = 0
+
+    def _next_errcode(self) -> int:
+        with self._lock:
+            return self.send_errcodes.pop(0) if self.send_errcodes else 0
+
+    def handle(self, req):
+        path = req["path"]
+        if path == "/cgi-bin/gettoken":
+            with self._lock:
+                self.tokens_issued += 1
+                token = f"token-{self.tokens_issued}"
+            return 200, {"errcode": 0, "access_token": token, "expires_in": 7200}
+        if path in ("/cgi-bin/message/send", "/cgi-bin/webhook/send"):
+            errcode = self._next_errcode()
+            return 200, {"errcode": errcode, "errmsg": "ok" if errcode == 0 else "error"}
+        return 404, {"errcode": 404}
+
+    def sent_texts(self, path: str = "/cgi-bin/message/send") -> list[str]:
+        return [r["json"]["text"]["content"] for r in self.calls("POST", path)]
+
+
+class _Simple(str):
+    """RESP simple string reply."""
+
+
+class _Error(str):
+    """RESP error reply."""
+
+
+def _glob_regex(pattern: str) -> re.Pattern:
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        elif c == "*":
+            out.append(".*")
+        elif c == "?":
+            out.append(".")
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile("".join(out), re.DOTALL)
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, _Error):
+        return b"-%s\r\n" % value.encode()
+    if isinstance(value, _Simple):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(v) for v in value)
+    data = str(value).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class FakeRedis:
+    """
+    In-process Redis-protocol server with the commands ``state_store`` uses:
+    PING, AUTH, SELECT, GET, SET (NX / XX / PX / EX), DEL, PEXPIRE, SCAN and
+    WATCH / MULTI / EXEC. Everything runs under one lock, like Redis' single
+    thread.
+    """
+
+    def __init__(self):
+        self.data: dict[str, tuple[str, float | None]] = {}
+        self.versions: dict[str, int] = {}
+        self.commands: list[str] = []
+        self._lock = threading.Lock()
+        self._sockets = set()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with fake._lock:
+                    fake._sockets.add(self.connection)
+                session = {"watched": None, "queued": None}
+                try:
+                    while True:
+                        args = fake._read_command(self.rfile)
+                        if args is None:
+                            return
+                        self.wfile.write(_encode(fake.execute(args, session)))
+                except (OSError, ValueError):
+                    return
+                finally:
+                    with fake._lock:
+                        fake._sockets.discard(self.connection)
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"redis://127.0.0.1:{self.port}/0"
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+
+    @staticmethod
+    def _read_command(rfile) -> list[str] | None:
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("inline commands are not supported")
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def _live(self, key: str) -> str | None:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item[0]
+
+    def _write(self, key: str, item) -> None:
+        if item is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = item
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def execute(self, args: list[str], session: dict):
+        name = args[0].upper()
+        with self._lock:
+            self.commands.append(name)
+            if session["queued"] is not None and name not in ("EXEC", "DISCARD", "MULTI", "WATCH"):
+                session["queued"].append(args)
+                return _Simple("QUEUED")
+            if name == "WATCH":
+                session["watched"] = session["watched"] or {}
+                for key in args[1:]:
+                    session["watched"][key] = self.versions.get(key, 0)
+                return _Simple("OK")
+            if name == "UNWATCH":
+                session["watched"] = None
+                return _Simple("OK")
+            if name == "MULTI":
+                session["queued"] = []
+                return _Simple("OK")
+            if name == "DISCARD":
+                session["queued"] = session["watched"] = None
+                return _Simple("OK")
+            if name == "EXEC":
+                queued, watched = session["queued"] or [], session["watched"] or {}
+                session["queued"] = session["watched"] = None
+                if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                    return None
+                return [self._run(cmd) for cmd in queued]
+            return self._run(args)
+
+    def _run(self, args: list[str]):
+        name, rest = args[0].upper(), args[1:]
+        if name == "PING":
+            return _Simple("PONG")
+        if name in ("AUTH", "SELECT"):
+            return _Simple("OK")
+        if name == "GET":
+            return self._live(rest[0])
+        if name == "SET":
+            key, value, options = rest[0], rest[1], [o.upper() for o in rest[2:]]
+            expires = None
+            if "PX" in options:
+                expires = time.monotonic() + int(rest[2 + options.index("PX") + 1]) / 1000
+            if "EX" in options:
+                expires = time.monotonic() + int(rest[2 + options.index("EX") + 1])
+            exists = self._live(key) is not None
+            if ("NX" in options and exists) or ("XX" in options and not exists):
+                return None
+            self._write(key, (value, expires))
+            return _Simple("OK")
+        if name == "DEL":
+            removed = [key for key in rest if self._live(key) is not None]
+            for key in removed:
+                self._write(key, None)
+            return len(removed)
+        if name == "PEXPIRE":
+            value = self._live(rest[0])
+            if value is None:
+                return 0
+            self._write(rest[0], (value, time.monotonic() + int(rest[1]) / 1000))
+            return 1
+        if name == "SCAN":
+            options = [o.upper() for o in rest]
+            pattern = rest[options.index("MATCH") + 1] if "MATCH" in options else "*"
+            regex = _glob_regex(pattern)
+            keys = [k for k in list(self.data) if regex.fullmatch(k) and self._live(k) is not None]
+            return ["0", keys]
+        if name == "FLUSHALL":
+            for key in list(self.data):
+                self._write(key, None)
+            return _Simple("OK")
+        return _Error(f"ERR unknown command '{name}'")
+
+    def drop_connections(self) -> None:
+        """Close every client connection, as a server restart would."""
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(2)
+            except OSError:
+                pass
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.drop_connections()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+_ROOT = Path(__file__).resolve().parent.parent
+
+_WORKER_SCRIPTS = {
+    "wsgi": (
+        "import sys\n"
+        "from werkzeug.serving import make_server\n"
+        "from wsgi import application\n"
+        "make_server('127.0.0.1', int(sys.argv[1]), application, threaded=True).serve_forever()\n"
+    ),
+    "asgi": (
+        "import sys, uvicorn\n"
+        "uvicorn.run('asgi_app:app', host='127.0.0.1', port=int(sys.argv[1]), log_level='warning')\n"
+    ),
+}
+
+
+class WorkerProcess:
+    """
+    The app served by a real server in a child process: ``wsgi`` (``wsgi.py``
+    on werkzeug's threaded server) or ``asgi`` (``asgi_app`` on uvicorn).
+    """
+
+    def __init__(self, kind: str, env: dict):
+        self.kind = kind
+        self.env = env
+        self.proc: subprocess.Popen | None = None
+        self.url = ""
+        self._log = None
+
+    def start(self, timeout: float = 20.0):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # a file, not a pipe: request logging would fill an unread pipe and stall the server
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", _WORKER_SCRIPTS[self.kind], str(port)],
+            cwd=_ROOT, env=self.env, stdout=subprocess.DEVNULL, stderr=self._log,
+        )
+        self.url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.kind} worker exited: {self.log()[-2000:]}")
+            try:
+                with urllib.request.urlopen(f"{self.url}/health", timeout=1) as resp:
+                    if resp.status == 200:
+                        return self
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"{self.kind} worker did not start")
+
+    def log(self) -> str:
+        """What the worker wrote to stderr so far."""
+        self._log.seek(0)
+        return self._log.read().decode("utf-8", "replace")
+
+    def rss_bytes(self) -> int:
+        try:
+            with open(f"/proc/{self.proc.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return 0
+
+    def stop(self) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,182 @@
+"""Tests for the repeated-question answer cache."""
+
+import json
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache, normalize_question
+from tests.test_webhook_handler import DummyCrypt
+
+CALLBACK = "/webhook/wework?msg_signature=ok-sign&timestamp=1&nonce=2"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_normalize_question():
+    assert normalize_question("  How do I   configure X？ ") == "how do i configure x"
+    assert normalize_question("ＡＢＣ 怎么配置。") == "abc 怎么配置"
+
+
+def test_lru_ttl_and_non_answers():
+    clock = Clock()
+    cache = AnswerCache(max_size=2, ttl=60, clock=clock)
+    assert cache.put("how to configure x", "docs", "answer x")
+    assert cache.get("How to configure X?", "docs") == "answer x"
+    assert cache.get("how to configure x", "other-agent") is None
+
+    cache.put("question two", "docs", "answer 2")
+    cache.get("how to configure x", "docs")  # x is now most recently used
+    cache.put("question three", "docs", "answer 3")
+    assert cache.get("question two", "docs") is None
+    assert cache.get("how to configure x", "docs") == "answer x"
+
+    clock.now += 61
+    assert cache.get("how to configure x", "docs") is None
+
+    assert not cache.put("question four", "docs", "OpenCode 暂时不可用，请稍后再试。")
+    assert not cache.put("继续", "docs", "context dependent")  # shorter than min_chars
+    from opencode_client import _agent_missing_reply
+
+    assert not cache.put("question five", "typo", _agent_missing_reply("typo"))
+    assert cache.stats()["evicted"] == 1
+
+
+def test_persistence_and_docs_version(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = AnswerCache(path=path, version="v1")
+    cache.put("how to configure x", "docs", "answer x")
+
+    assert AnswerCache(path=path, version="v1").get("how to configure x", "docs") == "answer x"
+    assert AnswerCache(path=path, version="v2").get("how to configure x", "docs") is None
+
+    assert cache.set_version("v2")
+    assert len(cache) == 0
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {"version": "v2", "entries": []}
+
+
+def test_invalidate():
+    cache = AnswerCache()
+    cache.put("question one", "a", "1")
+    cache.put("question one", "b", "1b")
+    cache.put("question two", "a", "2")
+    assert cache.invalidate(question="Question one?", agent_name="a") == 1
+    assert cache.invalidate(agent_name="a") == 1
+    assert cache.invalidate() == 1
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def cached_client(monkeypatch, app_client, patch_ask):
+    dummy = DummyCrypt()
+    asked = []
+    monkeypatch.setattr("app._build_crypto", lambda: dummy)
+    ask = lambda **kw: asked.append(kw) or "答案"
+
+    async def ask_async(**kw):
+        return ask(**kw)
+
+    monkeypatch.setattr("async_reply.ask_opencode", ask)
+    monkeypatch.setattr("async_reply.ask_opencode_async", ask_async)
+    patch_ask(ask)
+    monkeypatch.setenv("ANSWER_CACHE", "1")
+    return app_client, dummy, asked
+
+
+def test_repeated_question_is_answered_from_cache(cached_client):
+    c, dummy, asked = cached_client
+    for _ in range(3):
+        assert c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json").status_code == 200
+    assert len(asked) == 1
+    assert [json.loads(call[0])["Content"] for call in dummy.encrypt_calls] == ["答案"] * 3
+    stats = c.get("/health").get_json()["answer_cache"]
+    assert stats["hits"] == 2 and stats["stores"] == 1
+
+
+def test_follow_up_in_a_conversation_is_neither_cached_nor_served(cached_client):
+    from opencode_sessions import get_session_registry
+
+    c, dummy, asked = cached_client
+    # zhangsan already talks to the agent: "你好机器人" may depend on that context
+    get_session_registry().put(("zhangsan", 1000002, "docs-searcher"), "http://oc", "ses-1")
+    for _ in range(2):
+        assert c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json").status_code == 200
+    assert len(asked) == 2
+    assert answer_cache._cache is None or len(answer_cache._cache) == 0
+
+
+def test_async_mode_answers_cache_hit_passively(cached_client, monkeypatch, wait_async_replies):
+    c, dummy, asked = cached_client
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "async")
+
+    async def deliver_async(msg, reply):
+        return True
+
+    monkeypatch.setattr("async_reply.deliver_reply", lambda msg, reply: True)
+    monkeypatch.setattr("async_reply.deliver_reply_async", deliver_async)
+
+    r = c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json")
+    assert r.data == b""  # first time: ack, answer pushed by a worker
+    assert wait_async_replies(timeout=5)
+
+    r = c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json")
+    assert json.loads(dummy.encrypt_calls[-1][0])["Content"] == "答案"
+    assert len(asked) == 1
+
+
+def test_admin_invalidate_endpoint(cached_client, monkeypatch):
+    c, _, asked = cached_client
+    c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json")
+    path = "/admin/answer-cache/invalidate"
+    assert c.post(path).status_code == 403
+
+    monkeypatch.setenv("ADMIN_TOKEN", "s3cret")
+    r = c.post(path, data=json.dumps({"question": "你好机器人"}), content_type="application/json",
+               headers={"X-Admin-Token": "s3cret"})
+    assert r.status_code == 200
+    assert r.get_json()["removed"] == 1
+
+    c.post(CALLBACK, data='{"encrypt":"x"}', content_type="application/json")
+    assert len(asked) == 2
+
+
+def test_saves_are_batched(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    cache = AnswerCache(path=path, save_interval=60)
+    saves = []
+    real_save = cache._save
+    monkeypatch.setattr(cache, "_save", lambda: saves.append(1) or real_save())
+    for i in range(20):
+        cache.put(f"question {i}", "docs", f"answer {i}")
+    assert saves == []  # waiting for the timer
+
+    cache.flush()
+    assert len(saves) == 1
+    assert AnswerCache(path=path).get("question 19", "docs") == "answer 19"
+    cache.flush()  # nothing pending
+    assert len(saves) == 1
+
+    # invalidations are written at once, so dropped answers never come back
+    cache.invalidate("question 0")
+    assert len(saves) == 2
+    assert AnswerCache(path=path).get("question 0", "docs") is None
+
+
+def test_pending_changes_are_saved_by_the_timer(tmp_path):
+    import time
+
+    path = str(tmp_path / "cache.json")
+    cache = AnswerCache(path=path, save_interval=0.05)
+    cache.put("how to configure x", "docs", "answer x")
+    for _ in range(100):
+        if AnswerCache(path=path).get("how to configure x", "docs"):
+            break
+        time.sleep(0.02)
+    assert AnswerCache(path=path).get("how to configure x", "docs") == "answer x"
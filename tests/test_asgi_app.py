@@ -0,0 +1,118 @@
+"""ASGI-specific tests: many slow agent runs parked on one event loop."""
+
+import asyncio
+import json
+import time
+
+import httpx
+
+from tests.stubs import FakeOpenCode
+
+
+class EchoCrypt:
+    def DecryptMsg(self, post_data, msg_signature, timestamp, nonce):
+        user = json.loads(post_data)["user"]
+        return 0, json.dumps({"FromUserName": user, "ToUserName": "wwcorp", "Content": "hi"})
+
+    def EncryptMsg(self, sReplyMsg, sNonce, timestamp=None):
+        return 0, sReplyMsg
+
+
+def test_concurrent_slow_agent_runs_do_not_need_threads(monkeypatch):
+    import asgi_app
+
+    monkeypatch.setattr("app._build_crypto", lambda: EchoCrypt())
+    monkeypatch.setenv("OPENCODE_SESSION_REUSE", "0")
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+
+    concurrency, latency = 40, 0.5
+    with FakeOpenCode(reply="slow answer", latency=latency) as stub:
+        monkeypatch.setenv("OPENCODE_API_URL", stub.url)
+
+        async def run():
+            transport = httpx.ASGITransport(app=asgi_app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+                return await asyncio.gather(
+                    *(
+                        client.post(
+                            "/webhook/wework?msg_signature=s&timestamp=1&nonce=2",
+                            content=json.dumps({"user": f"u{i}"}),
+                        )
+                        for i in range(concurrency)
+                    )
+                )
+
+        start = time.monotonic()
+        responses = asyncio.run(run())
+        elapsed = time.monotonic() - start
+
+    assert all(r.status_code == 200 for r in responses)
+    assert {json.loads(r.text)["ToUserName"] for r in responses} == {f"u{i}" for i in range(concurrency)}
+    assert all(json.loads(r.text)["Content"] == "slow answer" for r in responses)
+    # all runs overlap on a single thread: far less than concurrency * latency
+    assert elapsed < concurrency * latency / 4
+
+
+def test_slow_state_store_calls_do_not_stall_the_event_loop(monkeypatch):
+    import asgi_app
+
+    real_prepare = asgi_app.callback_app._prepare_callback
+
+    def slow_prepare(*args):
+        time.sleep(0.3)  # e.g. a dedup claim against a slow Redis
+        return real_prepare(*args)
+
+    monkeypatch.setattr(asgi_app.callback_app, "_prepare_callback", slow_prepare)
+    monkeypatch.setattr("app._build_crypto", lambda: EchoCrypt())
+    monkeypatch.setattr("asgi_app.ask_opencode_async", lambda **kw: asyncio.sleep(0, "answer"))
+
+    ticks = asyncio.run(_ticks_while(lambda: asgi_app.handle_webhook("POST", {}, json.dumps({"user": "u1"}))))
+    assert ticks >= 10
+
+
+async def _ticks_while(start):
+    """10ms loop ticks counted while ``start()`` is awaited; few ticks means the loop was blocked."""
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    tick = asyncio.create_task(ticker())
+    await start()
+    tick.cancel()
+    return ticks
+
+
+def test_backend_choice_and_health_do_not_stall_the_event_loop(monkeypatch):
+    import app as callback_app
+    import asgi_app
+    from opencode_backends import routed_async
+    from opencode_sessions import get_session_registry
+
+    registry = get_session_registry()
+    real_backend_of = registry.backend_of
+
+    def slow_backend_of(key):
+        time.sleep(0.3)  # e.g. a shared state store lookup
+        return real_backend_of(key)
+
+    monkeypatch.setattr(registry, "backend_of", slow_backend_of)
+
+    async def ask(**kwargs):
+        return kwargs["api_url"]
+
+    ticks = asyncio.run(_ticks_while(lambda: routed_async(ask)(session_key=("u", "docs"))))
+    assert ticks >= 10
+
+    real_health = callback_app._health_body
+    monkeypatch.setattr(callback_app, "_health_body", lambda d=None: time.sleep(0.3) or real_health(d))
+
+    async def health():
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+            assert (await client.get("/health")).status_code == 200
+
+    assert asyncio.run(_ticks_while(health)) >= 10
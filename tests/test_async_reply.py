@@ -0,0 +1,65 @@
+"""Unit tests for the ack-then-push ReplyDispatcher."""
+
+import threading
+
+from async_reply import ReplyDispatcher
+
+
+def test_dispatcher_runs_handler_and_delivers():
+    delivered = []
+    d = ReplyDispatcher(
+        workers=2,
+        queue_size=10,
+        handler=lambda msg, text: f"answer:{text}",
+        deliver=lambda msg, reply: delivered.append((msg["FromUserName"], reply)) or True,
+    )
+    try:
+        assert d.submit({"FromUserName": "u1"}, "q1")
+        assert d.submit({"FromUserName": "u2"}, "q2")
+        assert d.wait_idle(timeout=5)
+    finally:
+        d.shutdown(timeout=5)
+
+    assert sorted(delivered) == [("u1", "answer:q1"), ("u2", "answer:q2")]
+    stats = d.stats()
+    assert stats["submitted"] == 2
+    assert stats["delivered"] == 2
+    assert stats["failed"] == 0
+    assert stats["queue_depth"] == 0
+
+
+def test_dispatcher_rejects_when_queue_full():
+    release = threading.Event()
+    d = ReplyDispatcher(
+        workers=1,
+        queue_size=1,
+        handler=lambda msg, text: release.wait(5) and "ok",
+        deliver=lambda msg, reply: True,
+    )
+    try:
+        assert d.submit({}, "busy")
+        # wait until the single worker picked up the first job
+        for _ in range(500):
+            if d.stats()["in_flight"] == 1:
+                break
+            threading.Event().wait(0.01)
+        assert d.submit({}, "queued")
+        assert d.submit({}, "overflow") is False
+        assert d.stats()["rejected"] == 1
+    finally:
+        release.set()
+        d.wait_idle(timeout=5)
+        d.shutdown(timeout=5)
+
+
+def test_dispatcher_counts_failed_jobs():
+    def boom(msg, text):
+        raise RuntimeError("agent exploded")
+
+    d = ReplyDispatcher(workers=1, queue_size=5, handler=boom, deliver=lambda m, r: True)
+    try:
+        d.submit({}, "q")
+        assert d.wait_idle(timeout=5)
+    finally:
+        d.shutdown(timeout=5)
+    assert d.stats()["failed"] == 1
@@ -0,0 +1,123 @@
+"""Unit tests for callback de-duplication."""
+
+import threading
+import time
+
+import pytest
+
+from callback_dedup import (
+    PENDING,
+    CallbackDedup,
+    MemoryDedupBackend,
+    SharedDedupBackend,
+    SqliteDedupBackend,
+    dedup_key,
+)
+from state_store import RedisStateStore
+
+
+@pytest.fixture(params=["memory", "sqlite", "shared"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryDedupBackend(max_size=3)
+    elif request.param == "sqlite":
+        yield SqliteDedupBackend(str(tmp_path / "dedup.sqlite3"), max_size=3)
+    else:
+        store = RedisStateStore(request.getfixturevalue("fake_redis").url, prefix="test:")
+        yield SharedDedupBackend(store)
+        store.close()
+
+
+def test_dedup_key_prefers_msgid():
+    assert dedup_key({"MsgId": "123", "FromUserName": "u", "CreateTime": 1}) == "msgid:123"
+    assert dedup_key({"FromUserName": "u", "CreateTime": 1}) == "user:u:1"
+    assert dedup_key({"FromUserName": "u"}) is None
+    assert dedup_key(None) is None
+
+
+def test_backend_add_is_set_if_absent(backend):
+    assert backend.add("k", PENDING, 60) is True
+    assert backend.add("k", PENDING, 60) is False
+    backend.set("k", "done", 60)
+    assert backend.get("k") == "done"
+
+
+def test_backend_entries_expire(backend):
+    assert backend.add("k", "v", 0.05)
+    time.sleep(0.1)
+    assert backend.get("k") is None
+    assert backend.add("k", "v2", 60) is True
+
+
+def test_memory_backend_evicts_lru():
+    b = MemoryDedupBackend(max_size=2)
+    b.add("a", "1", 60)
+    b.add("b", "2", 60)
+    b.get("a")
+    b.add("c", "3", 60)
+    assert b.get("b") is None
+    assert b.get("a") == "1"
+    assert len(b) == 2
+
+
+def test_retry_attaches_to_in_flight_result(backend):
+    dedup = CallbackDedup(backend, ttl=60)
+    assert dedup.claim("msgid:1") is True
+    assert dedup.claim("msgid:1") is False
+
+    threading.Timer(0.1, dedup.resolve, args=("msgid:1", "answer")).start()
+    assert dedup.attach("msgid:1", timeout=2) == "answer"
+    # a later retry gets the completed result without waiting
+    assert dedup.attach("msgid:1", timeout=0) == "answer"
+
+    stats = dedup.stats()
+    assert stats["misses"] == 1
+    assert stats["hits_in_flight"] == 1
+    assert stats["hits_completed"] == 1
+    assert stats["hits"] == 2
+
+
+def test_attach_times_out_while_pending(backend):
+    dedup = CallbackDedup(backend, ttl=60)
+    dedup.claim("msgid:2")
+    assert dedup.attach("msgid:2", timeout=0.1) is None
+    assert dedup.stats()["wait_timeouts"] == 1
+
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    worker_a = CallbackDedup(SqliteDedupBackend(path), ttl=60)
+    worker_b = CallbackDedup(SqliteDedupBackend(path), ttl=60)
+    assert worker_a.claim("msgid:9") is True
+    assert worker_b.claim("msgid:9") is False
+    worker_a.resolve("msgid:9", "from a")
+    assert worker_b.attach("msgid:9", timeout=1) == "from a"
+
+
+def test_shared_backend_is_shared_between_workers(fake_redis):
+    worker_a = CallbackDedup(SharedDedupBackend(RedisStateStore(fake_redis.url)), ttl=60)
+    worker_b = CallbackDedup(SharedDedupBackend(RedisStateStore(fake_redis.url)), ttl=60)
+    assert worker_a.claim("msgid:9") is True
+    assert worker_b.claim("msgid:9") is False
+    threading.Timer(0.1, worker_a.resolve, args=("msgid:9", "from a")).start()
+    assert worker_b.attach("msgid:9", timeout=2) == "from a"
+    assert worker_b.stats()["size"] == 1
+
+
+def test_shared_backend_fails_open_when_store_is_down(fake_redis):
+    dedup = CallbackDedup(SharedDedupBackend(RedisStateStore(fake_redis.url, timeout=0.2)), ttl=60)
+    fake_redis.stop()
+    # both deliveries are answered rather than both refused
+    assert dedup.claim("msgid:10") is True
+    assert dedup.claim("msgid:10") is True
+    dedup.resolve("msgid:10", "answer")
+    assert dedup.attach("msgid:10", timeout=0) is None
+
+
+def test_released_claim_can_be_claimed_again(backend):
+    dedup = CallbackDedup(backend, ttl=60)
+    assert dedup.claim("msgid:1") is True
+    dedup.release("msgid:1")
+    assert dedup.attach("msgid:1", timeout=0) is None
+    assert dedup.claim("msgid:1") is True
+    assert dedup.stats()["released"] == 1
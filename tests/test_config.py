@@ -16,6 +16,11 @@ def clear_env(monkeypatch):
         "WEWORK_CORP_ID",
         "OPENCODE_SERVER_USERNAME",
         "OPENCODE_SERVER_PASSWORD",
+        "WEWORK_REPLY_MODE",
+        "WEWORK_ASYNC_WORKERS",
+        "WEWORK_ASYNC_QUEUE_SIZE",
+        "WEWORK_DEDUP_BACKEND",
+        "WEWORK_DEDUP_TTL",
     ):
         monkeypatch.delenv(key, raising=False)
 
@@ -71,3 +76,47 @@ def test_get_wework_receive_id_priority(monkeypatch):
 
     monkeypatch.setenv("WEWORK_RECEIVE_ID", "override-id")
     assert get_wework_receive_id() == "override-id"
+
+
+def test_get_wework_reply_mode(monkeypatch):
+    from config import get_wework_reply_mode
+
+    assert get_wework_reply_mode() == "passive"
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "ASYNC")
+    assert get_wework_reply_mode() == "async"
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "bogus")
+    assert get_wework_reply_mode() == "passive"
+
+
+def test_async_pool_settings(monkeypatch):
+    from config import get_async_queue_size, get_async_worker_count
+
+    assert get_async_worker_count() == 4
+    assert get_async_queue_size() == 100
+    monkeypatch.setenv("WEWORK_ASYNC_WORKERS", "0")
+    monkeypatch.setenv("WEWORK_ASYNC_QUEUE_SIZE", "not-a-number")
+    assert get_async_worker_count() == 1
+    assert get_async_queue_size() == 100
+
+
+def test_dedup_settings(monkeypatch):
+    from config import get_dedup_backend, get_dedup_ttl
+
+    assert get_dedup_backend() == "memory"
+    assert get_dedup_ttl() == 600.0
+    monkeypatch.setenv("WEWORK_DEDUP_BACKEND", "SQLite")
+    monkeypatch.setenv("WEWORK_DEDUP_TTL", "30")
+    assert get_dedup_backend() == "sqlite"
+    assert get_dedup_ttl() == 30.0
+
+
+def test_max_wait_is_capped_in_passive_mode(monkeypatch):
+    from config import get_opencode_max_wait_seconds
+
+    monkeypatch.delenv("OPENCODE_MAX_WAIT_SECONDS", raising=False)
+    assert get_opencode_max_wait_seconds() == 3.0
+    monkeypatch.setenv("OPENCODE_MAX_WAIT_SECONDS", "1")
+    assert get_opencode_max_wait_seconds() == 1.0
+    monkeypatch.delenv("OPENCODE_MAX_WAIT_SECONDS")
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "async")
+    assert get_opencode_max_wait_seconds() == 30.0
@@ -1,9 +1,12 @@
 """E2E: callback decrypt -> OpenCode call -> encrypted passive reply."""
 
 import json
+import time
 
 import pytest
 
+from http_transport import get_session
+
 
 class FakeCrypt:
     def __init__(self):
@@ -36,6 +39,8 @@ def setup_e2e(monkeypatch):
         post_calls.append({"url": url, "json": kwargs.get("json")})
         if url.endswith("/session"):
             class R:
+                status_code = 200
+
                 def raise_for_status(self):
                     return None
 
@@ -45,6 +50,8 @@ def setup_e2e(monkeypatch):
             return R()
         if "/session/s-1/message" in url:
             class R:
+                status_code = 200
+
                 def raise_for_status(self):
                     return None
 
@@ -55,7 +62,7 @@ def setup_e2e(monkeypatch):
         raise RuntimeError(f"unexpected url: {url}")
 
     monkeypatch.setattr("app._build_crypto", lambda: fake_crypt)
-    monkeypatch.setattr("opencode_client.requests.post", fake_post)
+    monkeypatch.setattr(get_session(), "post", fake_post)
     return fake_crypt, post_calls
 
 
@@ -80,3 +87,113 @@ def test_e2e_enterprise_callback_flow(setup_e2e):
     passive_reply = json.loads(fake_crypt.encrypted_payload)
     assert passive_reply["ToUserName"] == "lisi"
     assert "docs/README.md" in passive_reply["Content"]
+
+
+@pytest.fixture
+def stub_env(monkeypatch):
+    """Fake OpenCode + qyapi servers wired in through the environment."""
+    from tests.stubs import FakeOpenCode, FakeQyapi
+
+    fake_crypt = FakeCrypt()
+    monkeypatch.setattr("app._build_crypto", lambda: fake_crypt)
+    with FakeOpenCode(reply="文档在 docs/README.md", latency=0.2) as opencode, FakeQyapi() as qyapi:
+        monkeypatch.setenv("OPENCODE_API_URL", opencode.url)
+        monkeypatch.setenv("WEWORK_API_BASE", qyapi.url)
+        monkeypatch.setenv("WEWORK_RECEIVE_ID", "wwcorp")
+        monkeypatch.setenv("WEWORK_CORP_SECRET", "secret")
+        monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+        yield fake_crypt, opencode, qyapi
+
+
+def test_e2e_passive_reply_with_stub_opencode(stub_env, app_client):
+    fake_crypt, opencode, _ = stub_env
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    assert r.status_code == 200
+    assert "encrypt" in r.data.decode("utf-8")
+    assert [c["path"] for c in opencode.calls("POST", "/session")] == [
+        "/session",
+        "/session/ses-1/message",
+    ]
+    passive_reply = json.loads(fake_crypt.encrypted_payload)
+    assert passive_reply["ToUserName"] == "lisi"
+    assert "docs/README.md" in passive_reply["Content"]
+
+
+def test_e2e_async_ack_then_push(stub_env, app_client, wait_async_replies, monkeypatch):
+    """Async mode: callback acks immediately, answer is pushed via fake qyapi."""
+    fake_crypt, opencode, qyapi = stub_env
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "async")
+
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    # acked before the (slow) agent answered; no passive reply encrypted
+    assert r.status_code == 200
+    assert r.data == b""
+    assert fake_crypt.encrypted_payload is None
+
+    assert wait_async_replies(timeout=10)
+
+    assert len(opencode.calls("POST", "/session")) == 2
+    assert qyapi.sent_texts() == ["文档在 docs/README.md"]
+    sent = qyapi.calls("POST", "/cgi-bin/message/send")[0]["json"]
+    assert sent["touser"] == "lisi"
+    assert sent["agentid"] == 1000002
+
+    health = app_client.get("/health").get_json()
+    assert health["reply_mode"] == "async"
+    assert health["async_queue"]["delivered"] == 1
+
+
+LONG_REPLY = "\n\n".join(f"第{i}段：" + "OpenCode 的回答内容" * 30 for i in range(8))
+
+
+def test_e2e_long_passive_reply_is_pushed_in_numbered_parts(stub_env, app_client, monkeypatch):
+    from reply_segmenter import split_reply
+
+    fake_crypt, opencode, qyapi = stub_env
+    opencode.reply = LONG_REPLY
+    monkeypatch.setenv("WEWORK_SEND_BURST", "10")
+    expected = len(split_reply(LONG_REPLY))
+
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    # too long for one passive reply: ack, then push every part in order
+    assert r.status_code == 200
+    assert r.data == b""
+    assert fake_crypt.encrypted_payload is None
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and len(qyapi.sent_texts()) < expected:
+        time.sleep(0.02)
+    texts = qyapi.sent_texts()
+    assert len(texts) == expected > 1
+    assert all(len(t.encode("utf-8")) <= 2048 for t in texts)
+    assert [t.split("\n", 1)[0] for t in texts] == [f"({i}/{len(texts)})" for i in range(1, len(texts) + 1)]
+    assert "\n\n".join(t.split("\n", 1)[1] for t in texts) == LONG_REPLY
+
+
+def test_e2e_long_passive_reply_is_truncated_without_app_secret(stub_env, app_client, monkeypatch):
+    fake_crypt, opencode, qyapi = stub_env
+    opencode.reply = LONG_REPLY
+    monkeypatch.delenv("WEWORK_CORP_SECRET")
+
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    assert r.status_code == 200
+    content = json.loads(fake_crypt.encrypted_payload)["Content"]
+    assert len(content.encode("utf-8")) <= 2048
+    assert content.startswith("第0段") and content.endswith("（回复过长，已截断）")
+    assert qyapi.sent_texts() == []
@@ -0,0 +1,102 @@
+"""Unit tests for the shared pooled HTTP transport."""
+
+import pytest
+import requests
+
+import http_transport
+from tests.stubs import FakeOpenCode
+
+
+@pytest.fixture(autouse=True)
+def fresh_session():
+    http_transport.reset_session()
+    yield
+    http_transport.reset_session()
+
+
+def test_get_session_is_shared():
+    assert http_transport.get_session() is http_transport.get_session()
+
+
+def test_pool_sizes_from_env(monkeypatch):
+    monkeypatch.setenv("HTTP_POOL_CONNECTIONS", "3")
+    monkeypatch.setenv("HTTP_POOL_MAXSIZE", "7")
+    adapter = http_transport.get_session().get_adapter("http://example.com")
+    assert adapter._pool_connections == 3
+    assert adapter._pool_maxsize == 7
+
+
+def test_timeouts_are_split_per_endpoint(monkeypatch):
+    assert http_transport.get_timeout("opencode.session") == (5.0, 30.0)
+    assert http_transport.get_timeout("opencode.message") == (5.0, 300.0)
+    monkeypatch.setenv("HTTP_CONNECT_TIMEOUT", "1.5")
+    monkeypatch.setenv("OPENCODE_MESSAGE_TIMEOUT", "120")
+    assert http_transport.get_timeout("opencode.message") == (1.5, 120.0)
+    assert http_transport.get_timeout("wework.send") == (1.5, 10.0)
+
+
+def test_basic_auth_is_cached():
+    a = http_transport.get_basic_auth("opencode", "pw")
+    assert a is http_transport.get_basic_auth("opencode", "pw")
+    assert a is not http_transport.get_basic_auth("opencode", "other")
+
+
+def test_ask_opencode_reuses_connections(monkeypatch):
+    from opencode_client import ask_opencode
+
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+    with FakeOpenCode(reply="pong") as stub:
+        for _ in range(5):
+            assert ask_opencode("ping", api_url=stub.url, agent_name="docs-searcher") == "pong"
+        assert len(stub.requests) == 10
+        # all ten requests rode the same keep-alive connection
+        assert stub.connections == 1
+
+
+def test_read_timeout_adapts_to_observed_p99(monkeypatch):
+    import metrics
+
+    monkeypatch.setenv("OPENCODE_ADAPTIVE_TIMEOUT", "1")
+    monkeypatch.setenv("OPENCODE_ADAPTIVE_TIMEOUT_MIN_SAMPLES", "10")
+    for i in range(100):
+        with metrics.http_call("opencode", "message", "http://oc") as call:
+            call.status = 200
+        http_transport._latencies[("opencode.message", "http://oc")].samples[-1] = 4.0 + i / 100
+    # p99 (~4.98s) x 3, within [OPENCODE_ADAPTIVE_TIMEOUT_MIN, OPENCODE_MESSAGE_TIMEOUT]
+    assert http_transport.get_timeout("opencode.message", "http://oc")[1] == pytest.approx(4.98 * 3)
+    assert http_transport.get_timeout("opencode.session", "http://oc") == (5.0, 30.0)  # no samples yet
+    # other backends and MR reviews keep their own windows
+    assert http_transport.get_timeout("opencode.message", "http://oc2") == (5.0, 300.0)
+    assert http_transport.get_timeout("opencode.review", "http://oc") == (5.0, 300.0)
+
+    monkeypatch.setenv("OPENCODE_MESSAGE_TIMEOUT", "12")
+    assert http_transport.get_timeout("opencode.message", "http://oc")[1] == 12.0
+    monkeypatch.setenv("OPENCODE_ADAPTIVE_TIMEOUT", "0")
+    monkeypatch.delenv("OPENCODE_MESSAGE_TIMEOUT")
+    assert http_transport.get_timeout("opencode.message", "http://oc")[1] == 300.0
+
+
+def test_adaptive_timeout_is_off_by_default():
+    import metrics
+
+    for _ in range(50):
+        with metrics.http_call("opencode", "message", "http://oc") as call:
+            call.status = 200
+    assert http_transport.get_timeout("opencode.message", "http://oc") == (5.0, 300.0)
+
+
+def test_timeouts_count_as_the_configured_timeout(monkeypatch):
+    import metrics
+
+    monkeypatch.setenv("OPENCODE_ADAPTIVE_TIMEOUT", "1")
+    for _ in range(25):
+        with metrics.http_call("opencode", "message", "http://oc") as call:
+            call.status = 200
+    assert http_transport.get_timeout("opencode.message", "http://oc")[1] == 10.0
+
+    # runs longer than the cut time out; they pull the timeout back up
+    for _ in range(5):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            with metrics.http_call("opencode", "message", "http://oc"):
+                raise requests.exceptions.ReadTimeout()
+    assert http_transport.get_timeout("opencode.message", "http://oc")[1] == 300.0
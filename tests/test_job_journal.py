@@ -0,0 +1,186 @@
+"""Tests for the durable async-mode job journal."""
+
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from async_reply import AsyncioReplyDispatcher, ReplyDispatcher
+from job_journal import JobJournal, JournalError
+
+MSG = {"MsgId": "1", "FromUserName": "zhangsan", "AgentID": 1000002, "Content": "q"}
+
+
+def _rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT id, status, attempts FROM reply_jobs ORDER BY id").fetchall()
+
+
+def test_unfinished_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    journal = JobJournal(path, max_attempts=2)
+    ids = [journal.append({**MSG, "MsgId": str(i)}, f"q{i}") for i in range(3)]
+    journal.complete(ids[1], ok=True)
+    journal.close()
+
+    journal = JobJournal(path, max_attempts=2)
+    assert [(job_id, msg["MsgId"], text) for job_id, msg, text in journal.pending()] == [
+        (ids[0], "0", "q0"), (ids[2], "2", "q2"),
+    ]
+    assert journal.append(MSG, "new") == ids[-1] + 1
+    journal.close()
+
+    journal = JobJournal(path, max_attempts=2)
+    assert [job[2] for job in journal.pending()] == ["q0", "q2", "new"]
+    journal.close()
+    journal = JobJournal(path, max_attempts=2)
+    assert [job[2] for job in journal.pending()] == ["new"]  # q0 / q2 replayed twice already
+    assert journal.stats()["unfinished"] == 1
+    journal.close()
+
+
+def test_concurrent_appends_share_commits(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    threads = [threading.Thread(target=lambda: [journal.append(MSG, "q") for _ in range(25)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = journal.stats()
+    assert stats["appended"] == 200 and stats["unfinished"] == 200
+    assert stats["commits"] < 200
+    journal.close()
+
+
+def test_compaction_removes_finished_jobs(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    journal = JobJournal(path, compact_every=2)
+    ids = [journal.append(MSG, f"q{i}") for i in range(3)]
+    journal.complete(ids[0], ok=True)
+    journal.complete(ids[1], ok=False)
+    journal.flush()
+    assert _rows(path) == [(ids[2], "accepted", 0)]
+    assert journal.stats()["compactions"] == 2  # once on open, once after two completions
+    journal.close()
+
+
+def _break_commits(journal):
+    def fail(ops):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    journal._commit = fail
+
+
+def test_failed_commit_is_raised_to_appenders(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    _break_commits(journal)
+    with pytest.raises(JournalError):
+        journal.append(MSG, "q")
+
+    async def main():
+        with pytest.raises(JournalError):
+            await journal.append_async(MSG, "q")
+
+    asyncio.run(main())
+    journal.append(MSG, "q", wait=False)  # not waited for: only logged
+    journal.flush()
+    journal.close()
+
+
+def test_dispatchers_answer_jobs_the_journal_could_not_record(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    _break_commits(journal)
+    delivered = []
+    dispatcher = ReplyDispatcher(workers=1, handler=lambda m, q: f"answer {q}",
+                                 deliver=lambda m, r: delivered.append(r) or True, journal=journal)
+    assert dispatcher.submit(MSG, "q1")
+    assert dispatcher.wait_idle(5)
+    assert dispatcher.stats()["unjournaled"] == 1
+    dispatcher.shutdown(1)
+
+    async def handler(message_obj, user_message):
+        return f"answer {user_message}"
+
+    async def deliver(message_obj, reply):
+        delivered.append(reply)
+        return True
+
+    async def main():
+        dispatcher = AsyncioReplyDispatcher(workers=1, handler=handler, deliver=deliver, journal=journal)
+        assert await dispatcher.submit_async(MSG, "q2")
+        assert await dispatcher.wait_idle(5)
+        return dispatcher.stats()["unjournaled"]
+
+    assert asyncio.run(main()) == 1
+    assert delivered == ["answer q1", "answer q2"]
+    journal.close()
+
+
+def test_reply_dispatcher_journals_and_replays(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    journal = JobJournal(path)
+    release = threading.Event()
+    crashed = ReplyDispatcher(workers=1, handler=lambda m, q: release.wait(5) and "late", deliver=lambda m, r: True,
+                              journal=journal)
+    assert crashed.submit(MSG, "q1") and crashed.submit(MSG, "q2")
+    journal.flush()
+    assert [status for _, status, _ in _rows(path)] == ["accepted", "accepted"]
+    journal.close()  # the "process" dies with both jobs unfinished
+    release.set()
+
+    delivered = []
+    journal = JobJournal(path)
+    dispatcher = ReplyDispatcher(workers=2, handler=lambda m, q: f"answer {q}",
+                                 deliver=lambda m, r: delivered.append(r) or True, journal=journal)
+    assert dispatcher.replay() == 2
+    assert dispatcher.wait_idle(5)
+    assert sorted(delivered) == ["answer q1", "answer q2"]
+    journal.flush()
+    assert journal.stats()["unfinished"] == 0
+    dispatcher.shutdown(1)
+    journal.close()
+
+
+def test_asyncio_dispatcher_journals_and_replays(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    journal = JobJournal(path)
+    journal.append(MSG, "left over")
+    delivered = []
+
+    async def handler(message_obj, user_message):
+        return f"answer {user_message}"
+
+    async def deliver(message_obj, reply):
+        delivered.append(reply)
+        return True
+
+    async def main():
+        dispatcher = AsyncioReplyDispatcher(workers=2, handler=handler, deliver=deliver, journal=journal)
+        assert dispatcher.replay() == 1
+        assert await dispatcher.submit_async(MSG, "new")
+        assert await dispatcher.wait_idle(5)
+
+    asyncio.run(main())
+    assert sorted(delivered) == ["answer left over", "answer new"]
+    journal.flush()
+    assert [status for _, status, _ in _rows(path)] == ["delivered", "delivered"]
+    journal.close()
+
+
+def test_recover_jobs_on_startup(tmp_path, monkeypatch):
+    import app
+
+    path = str(tmp_path / "jobs.sqlite3")
+    journal = JobJournal(path)
+    journal.append(MSG, "q")
+    journal.close()
+
+    pushed = []
+    monkeypatch.setenv("JOB_JOURNAL_PATH", path)
+    monkeypatch.setattr("async_reply.ask_opencode", lambda **kw: "answer")
+    monkeypatch.setattr("async_reply.deliver_reply", lambda msg, reply: pushed.append(reply) or True)
+    assert app.recover_jobs() == 1
+    assert app._dispatcher.wait_idle(5)
+    assert pushed == ["answer"]
+    app._dispatcher.shutdown(1)
@@ -0,0 +1,207 @@
+"""Tests for merging a sender's rapid consecutive messages into one agent run."""
+
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+from async_reply import AsyncioReplyDispatcher, ReplyDispatcher
+from job_journal import JobJournal
+from message_debounce import MessageDebouncer, build_debouncer, debounce_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def _msg(user="zhangsan", **extra):
+    return {"FromUserName": user, "AgentID": 1000002, **extra}
+
+
+def test_batch_window_extends_up_to_max_window():
+    clock = FakeClock()
+    d = MessageDebouncer(window=0.5, max_window=1.2, max_messages=10, clock=clock)
+
+    batch = d.add(_msg(), "我想问下")
+    assert batch is not None
+    assert d.remaining(batch) == pytest.approx(0.5)
+    clock.now += 0.4
+    assert d.add(_msg(), "nginx 网关") is None
+    assert d.remaining(batch) == pytest.approx(0.5)
+    clock.now += 0.4
+    assert d.add(_msg(), "怎么配置超时？") is None
+    # capped at 1.2s after the first message
+    assert d.remaining(batch) == pytest.approx(0.4)
+    assert d.pop_due() == []
+
+    clock.now += 0.4
+    assert d.pop_due() == [batch]
+    assert d.merged(batch)[1] == "我想问下\nnginx 网关\n怎么配置超时？"
+    # the next message starts a new batch
+    assert d.add(_msg(), "谢谢") is not batch
+
+    stats = d.stats()
+    assert stats["batches"] == 2
+    assert stats["merged"] == 2
+    assert stats["wait_max"] == pytest.approx(1.2)
+
+
+def test_senders_and_chats_are_batched_separately():
+    d = MessageDebouncer(window=1.0, clock=FakeClock())
+    first = d.add(_msg("zhangsan"), "a")
+    assert d.add(_msg("lisi"), "b") is not None
+    assert d.add(_msg("zhangsan", ChatId="wrkchat"), "c") is not None
+    assert d.add(_msg("zhangsan"), "d") is None
+    assert d.merged(first)[1] == "a\nd"
+    assert d.open_count() == 3
+
+
+def test_full_batch_and_anonymous_messages_are_due_at_once():
+    d = MessageDebouncer(window=1.0, max_messages=2, clock=FakeClock())
+    batch = d.add(_msg(), "a")
+    assert d.add(_msg(), "b") is None
+    assert d.remaining(batch) == 0
+
+    anonymous = d.add({"Content": "x"}, "x")
+    assert d.remaining(anonymous) == 0
+    assert debounce_key({"Content": "x"}) is None
+    assert d.add({"Content": "y"}, "y") is not None
+    assert len(d.pop_due()) == 3
+
+
+def test_build_debouncer_from_env(monkeypatch):
+    monkeypatch.delenv("WEWORK_DEBOUNCE_MS", raising=False)
+    assert build_debouncer() is None
+    monkeypatch.setenv("WEWORK_DEBOUNCE_MS", "800")
+    monkeypatch.setenv("WEWORK_DEBOUNCE_MAX_MS", "2000")
+    monkeypatch.setenv("WEWORK_DEBOUNCE_MAX_MESSAGES", "5")
+    d = build_debouncer()
+    assert (d.window, d.max_window, d.max_messages) == (0.8, 2.0, 5)
+
+
+def test_thread_dispatcher_answers_a_batch_once(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    asked, delivered = [], []
+    d = ReplyDispatcher(
+        workers=2,
+        queue_size=10,
+        handler=lambda msg, text: asked.append(text) or f"answer:{text}",
+        deliver=lambda msg, reply: delivered.append((msg["FromUserName"], reply)) or True,
+        journal=journal,
+        debouncer=MessageDebouncer(window=0.2),
+    )
+    try:
+        for text in ("部署", "k8s", "怎么回滚"):
+            assert d.submit(_msg("zhangsan"), text)
+        assert d.submit(_msg("lisi"), "你好")
+        assert d.wait_idle(timeout=5)
+    finally:
+        d.shutdown(timeout=5)
+
+    assert sorted(asked) == ["你好", "部署\nk8s\n怎么回滚"]
+    assert sorted(delivered) == [("lisi", "answer:你好"), ("zhangsan", "answer:部署\nk8s\n怎么回滚")]
+    stats = d.stats()
+    assert (stats["submitted"], stats["delivered"]) == (4, 2)
+    assert stats["debounce"]["merged"] == 2
+    assert stats["debounce"]["wait_p50"] >= 0.2
+    # every merged message's journal entry is finished with its batch
+    journal.flush()
+    with sqlite3.connect(journal.path) as conn:
+        assert [s for (s,) in conn.execute("SELECT status FROM reply_jobs")] == ["delivered"] * 4
+    journal.close()
+
+
+def test_thread_dispatcher_counts_open_batches_against_queue_size():
+    d = ReplyDispatcher(
+        workers=1, queue_size=2, handler=lambda msg, text: text, deliver=lambda msg, reply: True,
+        debouncer=MessageDebouncer(window=0.2),
+    )
+    try:
+        assert d.submit(_msg("a"), "1")
+        assert d.submit(_msg("b"), "2")
+        assert d.submit(_msg("c"), "3") is False
+        assert d.wait_idle(timeout=5)
+    finally:
+        d.shutdown(timeout=5)
+    assert d.stats()["rejected"] == 1
+
+
+def test_asyncio_dispatcher_answers_a_batch_once():
+    asked, delivered = [], []
+
+    async def handler(msg, text):
+        asked.append(text)
+        return f"answer:{text}"
+
+    async def deliver(msg, reply):
+        delivered.append(reply)
+        return True
+
+    async def main():
+        d = AsyncioReplyDispatcher(
+            workers=2, handler=handler, deliver=deliver, debouncer=MessageDebouncer(window=0.1)
+        )
+        assert d.submit(_msg(), "第一句")
+        await asyncio.sleep(0.05)
+        assert d.submit(_msg(), "第二句")
+        assert await d.wait_idle(5)
+        return d.stats()
+
+    stats = asyncio.run(main())
+    assert asked == ["第一句\n第二句"]
+    assert delivered == ["answer:第一句\n第二句"]
+    assert stats["debounce"]["merged"] == 1
+    assert stats["debounce"]["wait_p50"] >= 0.15
+
+
+class SequenceCrypt:
+    """Decrypts each callback to the next message of one sender."""
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+
+    def DecryptMsg(self, post_data, msg_signature, timestamp, nonce):
+        text = self.texts.pop(0)
+        message = {"FromUserName": "lisi", "MsgType": "text", "Content": text, "MsgId": text, "AgentID": 1000002}
+        return 0, json.dumps(message, ensure_ascii=False)
+
+    def EncryptMsg(self, reply, nonce, timestamp=None):
+        return 0, '{"encrypt":"ENC","msgsignature":"SIG","timestamp":"T","nonce":"N"}'
+
+
+def test_webhook_acks_each_message_and_asks_once(app_client, wait_async_replies, monkeypatch):
+    from tests.stubs import FakeQyapi
+
+    asked = []
+
+    def ask(**kwargs):
+        asked.append(kwargs["user_message"])
+        return "好的"
+
+    async def ask_async(**kwargs):
+        return ask(**kwargs)
+
+    monkeypatch.setattr("async_reply.ask_opencode", ask)
+    monkeypatch.setattr("async_reply.ask_opencode_async", ask_async)
+    monkeypatch.setattr("app._build_crypto", lambda: SequenceCrypt(["我想问下", "发布流程", "在哪看？"]))
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "async")
+    monkeypatch.setenv("WEWORK_DEBOUNCE_MS", "300")
+    monkeypatch.setenv("WEWORK_RECEIVE_ID", "wwcorp")
+    monkeypatch.setenv("WEWORK_CORP_SECRET", "secret")
+    with FakeQyapi() as qyapi:
+        monkeypatch.setenv("WEWORK_API_BASE", qyapi.url)
+        for _ in range(3):
+            r = app_client.post("/webhook/wework?msg_signature=s&timestamp=1&nonce=n", data='{"encrypt":"x"}')
+            assert r.status_code == 200
+            assert r.data == b""
+        assert wait_async_replies(timeout=10)
+        assert qyapi.sent_texts() == ["好的"]
+
+    assert asked == ["我想问下\n发布流程\n在哪看？"]
+    debounce = app_client.get("/health").get_json()["async_queue"]["debounce"]
+    assert (debounce["batches"], debounce["merged"]) == (1, 2)
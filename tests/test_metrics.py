@@ -0,0 +1,118 @@
+"""Tests for the Prometheus metrics and the /metrics endpoint."""
+
+import re
+
+import metrics
+from tests.stubs import FakeOpenCode
+from tests.test_e2e import FakeCrypt
+
+
+def _sample(text: str, name: str, **labels) -> float | None:
+    """Value of one sample in an exposition-format body (None when absent)."""
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        m = re.match(r"^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$", line)
+        if not m or m.group(1) != name:
+            continue
+        found = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', m.group(2) or ""))
+        if found == {k: str(v) for k, v in labels.items()}:
+            return float(m.group(3))
+    return None
+
+
+def test_render_counter_gauge_and_histogram():
+    registry = metrics.Registry()
+    counter = metrics.Counter("t_requests", "Requests.", ("code",), registry=registry)
+    gauge = metrics.Gauge("t_in_flight", "In flight.", registry=registry)
+    hist = metrics.Histogram("t_seconds", "Latency.", registry=registry, buckets=(0.1, 1.0))
+    counter.inc(code="200")
+    counter.inc(2, code="200")
+    gauge.inc()
+    hist.observe(0.05)
+    hist.observe(0.5)
+    hist.observe(5)
+
+    text = registry.render()
+    assert "# TYPE t_requests counter" in text
+    assert 't_requests_total{code="200"} 3' in text
+    assert "t_in_flight 1" in text
+    assert 't_seconds_bucket{le="0.1"} 1' in text
+    assert 't_seconds_bucket{le="1"} 2' in text
+    assert 't_seconds_bucket{le="+Inf"} 3' in text
+    assert "t_seconds_count 3" in text
+    assert _sample(text, "t_seconds_sum") == 5.55
+
+
+def test_http_call_records_status_and_errors():
+    with metrics.http_call("svc", "ep") as call:
+        call.status = 201
+    try:
+        with metrics.http_call("svc", "ep"):
+            raise TimeoutError("slow")
+    except TimeoutError:
+        pass
+    assert metrics.HTTP_RESPONSES.value(service="svc", endpoint="ep", status="201") == 1
+    assert metrics.HTTP_RESPONSES.value(service="svc", endpoint="ep", status="timeout") == 1
+    assert metrics.HTTP_IN_FLIGHT.value(service="svc", endpoint="ep") == 0
+    assert metrics.HTTP_SECONDS.count(service="svc", endpoint="ep") == 2
+
+
+def test_metrics_endpoint_after_callback(monkeypatch, app_client):
+    monkeypatch.setattr("app._build_crypto", lambda: FakeCrypt())
+    monkeypatch.setenv("OPENCODE_SESSION_REUSE", "0")
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+    with FakeOpenCode(reply="ok") as opencode:
+        monkeypatch.setenv("OPENCODE_API_URL", opencode.url)
+        r = app_client.post(
+            "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+            data='{"encrypt":"xxx"}',
+            content_type="application/json",
+        )
+    assert r.status_code == 200
+
+    r = app_client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = r.data.decode("utf-8")
+    assert _sample(text, "wework_robot_callbacks_total", method="POST") == 1
+    assert _sample(text, "wework_robot_callbacks_in_flight") == 0
+    for stage in ("decrypt", "parse", "opencode", "reply_build", "encrypt", "callback"):
+        assert _sample(text, "wework_robot_stage_seconds_count", stage=stage) == 1, stage
+    assert _sample(
+        text, "wework_robot_http_responses_total",
+        service="opencode", endpoint="message", status="200",
+    ) == 1
+
+
+def test_failures_are_counted(monkeypatch, app_client):
+    class BrokenCrypt(FakeCrypt):
+        def DecryptMsg(self, *args):
+            return -40007, None
+
+    monkeypatch.setattr("app._build_crypto", lambda: BrokenCrypt())
+    r = app_client.post(
+        "/webhook/wework?msg_signature=bad&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    assert r.status_code == 403
+    text = app_client.get("/metrics").data.decode("utf-8")
+    assert _sample(text, "wework_robot_failures_total", reason="decrypt_failed") == 1
+
+
+def test_opencode_error_status_is_recorded(monkeypatch):
+    from opencode_client import ask_opencode
+
+    class FailingOpenCode(FakeOpenCode):
+        def handle(self, req):
+            if req["path"].endswith("/message"):
+                return 503, {"error": "overloaded"}
+            return super().handle(req)
+
+    monkeypatch.setenv("OPENCODE_SESSION_REUSE", "0")
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+    with FailingOpenCode() as opencode:
+        ask_opencode("hi", opencode.url)
+    assert metrics.HTTP_RESPONSES.value(service="opencode", endpoint="message", status="503") == 1
+    assert metrics.FAILURES.value(reason="opencode_http_error") == 1
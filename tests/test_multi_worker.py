@@ -0,0 +1,85 @@
+"""Several worker processes coordinating through a shared state store (local fake Redis)."""
+
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+from tests.stubs import FakeOpenCode, WorkerProcess
+from wework_crypto import FastWXBizJsonMsgCrypt
+
+TOKEN = "QDG6eK"
+AES_KEY = "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C"
+RECEIVE_ID = "wx5823bf96d3bd56c7"
+
+
+@pytest.fixture(params=["wsgi", "asgi"])
+def workers(request, fake_redis):
+    opencode = FakeOpenCode(reply=lambda req: "answer to " + req["json"]["parts"][0]["text"], latency=0.5)
+    opencode.start()
+    env = {
+        k: v for k, v in os.environ.items()
+        if not k.startswith(("WEWORK_", "OPENCODE_", "ANSWER_CACHE", "JOB_JOURNAL"))
+    }
+    env.update(
+        WEWORK_TOKEN=TOKEN,
+        WEWORK_ENCODING_AES_KEY=AES_KEY,
+        WEWORK_RECEIVE_ID=RECEIVE_ID,
+        WEWORK_STATE_STORE=fake_redis.url,
+        OPENCODE_API_URL=opencode.url,
+    )
+    procs = []
+    try:
+        for _ in range(2):
+            procs.append(WorkerProcess(request.param, env).start())
+        yield [proc.url for proc in procs], opencode
+    finally:
+        for proc in procs:
+            proc.stop()
+        opencode.stop()
+
+
+def _callback(worker_url: str, msg_id: str, content: str) -> str:
+    crypt = FastWXBizJsonMsgCrypt(TOKEN, AES_KEY, RECEIVE_ID)
+    message = {
+        "ToUserName": RECEIVE_ID, "FromUserName": "lisi", "CreateTime": 1700000000,
+        "MsgType": "text", "Content": content, "MsgId": msg_id, "AgentID": 1000002,
+    }
+    _, encrypted = crypt.EncryptMsg(json.dumps(message, ensure_ascii=False), "nonce", "1700000000")
+    envelope = json.loads(encrypted)
+    r = requests.post(
+        f"{worker_url}/webhook/wework",
+        params={"msg_signature": envelope["msgsignature"], "timestamp": envelope["timestamp"], "nonce": "nonce"},
+        data=json.dumps({"encrypt": envelope["encrypt"]}),
+        timeout=10,
+    )
+    assert r.status_code == 200
+    reply = json.loads(r.text)
+    ret, plain = crypt.DecryptMsg(
+        json.dumps({"encrypt": reply["encrypt"]}), reply["msgsignature"], reply["timestamp"], reply["nonce"]
+    )
+    assert ret == 0
+    return json.loads(plain)["Content"]
+
+
+def test_workers_share_dedup_and_sessions(workers):
+    (worker_a, worker_b), opencode = workers
+
+    # WeCom retries the callback on the other worker while the first is still answering
+    replies = {}
+    first = threading.Thread(target=lambda: replies.__setitem__("a", _callback(worker_a, "1", "怎么部署")))
+    first.start()
+    time.sleep(0.2)
+    replies["b"] = _callback(worker_b, "1", "怎么部署")
+    first.join()
+    assert replies == {"a": "answer to 怎么部署", "b": "answer to 怎么部署"}
+    assert len(opencode.calls("POST", "/session/")) == 1
+
+    # the follow-up lands on the other worker and continues the same OpenCode session
+    assert _callback(worker_b, "2", "然后呢") == "answer to 然后呢"
+    assert [r["path"] for r in opencode.calls("POST", "/session")] == [
+        "/session", "/session/ses-1/message", "/session/ses-1/message",
+    ]
@@ -0,0 +1,112 @@
+"""Tests for OpenCode admission control and load shedding."""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from opencode_admission import (
+    BUSY_REPLY,
+    PRIORITY_DIRECT,
+    PRIORITY_GROUP,
+    AdmissionLimiter,
+    admitted,
+    admitted_async,
+    get_limiter,
+    message_priority,
+)
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_rejects_when_queue_full_and_after_max_wait():
+    limiter = AdmissionLimiter(max_concurrent=1, max_waiting=1, max_wait=0.05)
+    assert limiter.acquire()
+    with ThreadPoolExecutor(1) as pool:
+        queued = pool.submit(limiter.acquire)
+        _wait_for(lambda: limiter.stats()["waiting"] == 1)
+        assert not limiter.acquire()  # queue full: rejected at once
+        assert not queued.result()  # waited longer than max_wait
+    limiter.release()
+
+    stats = limiter.stats()
+    assert (stats["active"], stats["waiting"]) == (0, 0)
+    assert (stats["rejected_full"], stats["rejected_timeout"]) == (1, 1)
+
+
+def test_released_slot_goes_to_direct_messages_first():
+    limiter = AdmissionLimiter(max_concurrent=1, max_waiting=4, max_wait=5)
+    assert limiter.acquire()
+    order = []
+
+    def enter(name, priority):
+        assert limiter.acquire(priority)
+        order.append(name)
+        limiter.release()
+
+    with ThreadPoolExecutor(3) as pool:
+        for i, (name, priority) in enumerate(
+            [("group-1", PRIORITY_GROUP), ("group-2", PRIORITY_GROUP), ("dm", PRIORITY_DIRECT)]
+        ):
+            pool.submit(enter, name, priority)
+            _wait_for(lambda: limiter.stats()["waiting"] == i + 1)
+        limiter.release()
+    assert order == ["dm", "group-1", "group-2"]
+    assert limiter.stats()["admitted"] == 4
+
+
+def test_async_waiters_share_slots_with_threads():
+    limiter = AdmissionLimiter(max_concurrent=1, max_waiting=2, max_wait=5)
+    assert limiter.acquire()
+
+    async def main():
+        task = asyncio.create_task(limiter.acquire_async())
+        await asyncio.sleep(0.02)
+        assert limiter.stats()["waiting"] == 1
+        threading.Timer(0.02, limiter.release).start()
+        return await task
+
+    assert asyncio.run(main())
+    assert limiter.stats()["active"] == 1
+
+
+def test_admitted_replies_busy_when_saturated(monkeypatch):
+    monkeypatch.setenv("OPENCODE_MAX_CONCURRENCY", "1")
+    monkeypatch.setenv("OPENCODE_MAX_WAITING", "0")
+    release = threading.Event()
+    ask = admitted(lambda **kw: release.wait(5) and "answer")
+
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(ask, api_url="http://oc:4096/")
+        _wait_for(lambda: get_limiter("http://oc:4096").stats()["active"] == 1)
+        assert ask(api_url="http://oc:4096") == BUSY_REPLY
+        assert admitted(lambda **kw: "other")(api_url="http://other:4096") == "other"  # per backend
+        release.set()
+        assert first.result() == "answer"
+
+    async def ask_async(**kw):
+        return "answer"
+
+    assert asyncio.run(admitted_async(ask_async)(api_url="http://oc:4096")) == "answer"
+
+
+def test_disabled_and_priority(monkeypatch):
+    monkeypatch.setenv("OPENCODE_MAX_CONCURRENCY", "0")
+    assert get_limiter() is None
+    assert admitted(lambda **kw: "answer")(api_url="u") == "answer"
+
+    assert message_priority({"FromUserName": "u"}) == PRIORITY_DIRECT
+    assert message_priority({"chattype": "group", "chatid": "c"}) == PRIORITY_GROUP
+    monkeypatch.setenv("OPENCODE_DM_PRIORITY", "0")
+    assert message_priority({"FromUserName": "u"}) == PRIORITY_GROUP
+
+
+def test_health_reports_admission(app_client, monkeypatch):
+    get_limiter("http://oc:4096")
+    stats = app_client.get("/health").get_json()["opencode_admission"]["http://oc:4096"]
+    assert stats["max_concurrent"] == 8 and stats["rejected_full"] == 0
@@ -0,0 +1,107 @@
+"""Tests for the cached agent catalog and per-chat agent overrides."""
+
+import pytest
+
+import opencode_agents
+from opencode_agents import AgentCatalog, agent_for
+from tests.stubs import FakeOpenCode
+
+URL = "http://oc"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeAgents:
+    def __init__(self, *names):
+        self.names = list(names)
+        self.fail = False
+        self.calls = 0
+
+    def __call__(self, api_url):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("refused")
+        return [{"name": name} for name in self.names]
+
+
+def test_exists_is_unknown_until_loaded_and_kept_across_failures():
+    agents, clock = FakeAgents("docs-searcher"), FakeClock()
+    catalog = AgentCatalog([URL], ttl=60, list_agents=agents, clock=clock)
+    assert catalog.exists("docs-searcher", URL) is None
+    assert catalog.check(URL, "typo")  # unknown: fail open
+
+    catalog.refresh_all()
+    assert catalog.exists("docs-searcher", URL + "/") is True
+    assert catalog.exists("typo", URL) is False
+    assert not catalog.check(URL, "typo")
+
+    # a failed reload keeps the last known list
+    agents.fail = True
+    assert not catalog.refresh(URL)
+    assert catalog.exists("docs-searcher", URL) is True
+    stats = catalog.stats()
+    assert (stats["rejected"], stats["backends"][URL]["errors"]) == (1, 1)
+
+
+def test_exists_without_backend_checks_any_backend():
+    catalog = AgentCatalog([URL, "http://oc2"], list_agents=FakeAgents("a"))
+    assert catalog.exists("a") is None
+    catalog.record("http://oc2", [{"name": "b"}])
+    assert catalog.exists("b") is True
+    assert catalog.exists("a") is False
+
+
+@pytest.fixture
+def catalog_enabled(monkeypatch):
+    with FakeOpenCode(reply="ok", agents=("docs-searcher", "code-reviewer")) as stub:
+        monkeypatch.setenv("OPENCODE_API_URL", stub.url)
+        monkeypatch.setenv("OPENCODE_AGENT_NAME", "docs-searcher")
+        monkeypatch.setenv("OPENCODE_AGENT_CATALOG_TTL", "300")
+        yield stub
+
+
+def test_missing_agent_fails_fast_without_creating_a_session(catalog_enabled):
+    from opencode_client import ask_opencode
+
+    opencode = catalog_enabled
+    reply = ask_opencode("hi", api_url=opencode.url, agent_name="typo")
+    assert "typo" in reply and "不存在" in reply
+    assert opencode.calls("POST", "/session") == []
+    assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher") == "ok"
+    # loaded once at startup, not per call
+    assert len(opencode.calls("GET", "/agent")) == 1
+
+
+def test_review_with_missing_agent_is_skipped(catalog_enabled, monkeypatch):
+    from opencode_client import send_opencode_review
+
+    monkeypatch.setenv("OPENCODE_ENABLED", "1")
+    monkeypatch.setenv("OPENCODE_AGENT_NAME", "typo")
+    assert send_opencode_review("https://git.example.com/g/p/-/merge_requests/1") is None
+    assert catalog_enabled.calls("POST", "/session") == []
+
+
+def test_overrides_route_by_chat_then_sender(catalog_enabled, monkeypatch):
+    monkeypatch.setenv("OPENCODE_AGENT_OVERRIDES", "wrkSFfCgAA=code-reviewer, lisi=code-reviewer, zhaoliu=typo")
+    assert agent_for({"ChatId": "wrkSFfCgAA", "FromUserName": "zhangsan"}) == "code-reviewer"
+    assert agent_for({"FromUserName": "lisi"}) == "code-reviewer"
+    assert agent_for({"FromUserName": "wangwu"}) == "docs-searcher"
+    # an override no backend serves falls back to the default
+    assert agent_for({"FromUserName": "zhaoliu"}) == "docs-searcher"
+
+
+def test_probe_updates_the_catalog(catalog_enabled):
+    from opencode_client import probe_opencode
+
+    opencode = catalog_enabled
+    catalog = opencode_agents.get_agent_catalog()
+    opencode.agents.append("new-agent")
+    assert catalog.exists("new-agent", opencode.url) is False
+    assert probe_opencode(opencode.url)
+    assert catalog.exists("new-agent", opencode.url) is True
@@ -1,10 +1,12 @@
 """Unit tests for opencode_client.ask_opencode and reply extraction."""
 import pytest
 
+from http_transport import get_session
+
 
 @pytest.fixture
 def mock_requests(monkeypatch):
-    """Mock requests.post and requests.get."""
+    """Mock post and get on the shared HTTP session."""
     post_calls = []
     get_calls = []
 
@@ -29,8 +31,8 @@ def mock_requests(monkeypatch):
         get_calls.append({"url": url})
         return None
 
-    monkeypatch.setattr("opencode_client.requests.post", fake_post)
-    monkeypatch.setattr("opencode_client.requests.get", fake_get)
+    monkeypatch.setattr(get_session(), "post", fake_post)
+    monkeypatch.setattr(get_session(), "get", fake_get)
     return {"post": post_calls, "get": get_calls}
 
 
@@ -0,0 +1,119 @@
+"""Tests for routing across several (stub) OpenCode servers."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import pytest
+
+from opencode_backends import BackendPool, get_backend_pool, routed
+from opencode_client import ask_opencode, probe_opencode
+from tests.stubs import FakeOpenCode
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    with ExitStack() as stack:
+        stubs = [stack.enter_context(FakeOpenCode(reply=f"answer {i}", latency=0.2)) for i in range(3)]
+        monkeypatch.setenv("OPENCODE_API_URLS", ",".join(s.url for s in stubs))
+        monkeypatch.setenv("OPENCODE_HEALTH_INTERVAL", "0")
+        monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+        yield stubs
+
+
+def _messages(stub):
+    return len(stub.calls("POST", "/session/"))
+
+
+def test_least_outstanding_spreads_concurrent_asks(servers):
+    ask = routed(ask_opencode)
+    with ThreadPoolExecutor(6) as pool:
+        replies = list(pool.map(lambda i: ask(user_message=f"q{i}", agent_name="docs-searcher"), range(6)))
+    assert sorted(replies) == ["answer 0", "answer 0", "answer 1", "answer 1", "answer 2", "answer 2"]
+    assert [_messages(s) for s in servers] == [2, 2, 2]
+    assert all(b["outstanding"] == 0 for b in get_backend_pool().stats()["backends"].values())
+
+
+def test_reused_session_stays_on_its_backend(servers):
+    ask = routed(ask_opencode)
+    key = ("zhangsan", 1000002, "docs-searcher")
+    first = ask(user_message="q", agent_name="docs-searcher", session_key=key)
+    for _ in range(3):
+        assert ask(user_message="again", agent_name="docs-searcher", session_key=key) == first
+    home = servers[int(first[-1])]
+    assert [_messages(s) for s in servers if s is not home] == [0, 0]
+    assert sum(r["path"] == "/session" for r in home.calls("POST", "/session")) == 1
+    assert get_backend_pool().stats()["affinity"] == 3
+
+
+def test_unhealthy_backend_is_ejected_and_readmitted(servers):
+    key = ("zhangsan", 1000002, "docs-searcher")
+    ask = routed(ask_opencode)
+    home = servers[int(ask(user_message="q", agent_name="docs-searcher", session_key=key)[-1])]
+
+    pool = get_backend_pool()
+    home.unhealthy = True
+    pool.probe_all()
+    assert pool.stats()["backends"][home.url]["healthy"]  # one failure is not enough
+    pool.probe_all()
+    assert not pool.stats()["backends"][home.url]["healthy"]
+
+    before = _messages(home)
+    for i in range(4):
+        ask(user_message=f"q{i}", agent_name="docs-searcher", session_key=key if i == 0 else None)
+    assert _messages(home) == before  # the affine conversation moved to another server too
+
+    home.unhealthy = False
+    pool.probe_all()
+    pool.probe_all()
+    stats = pool.stats()["backends"][home.url]
+    assert stats["healthy"] and stats["ejections"] == 1
+
+
+def test_all_ejected_still_routes():
+    pool = BackendPool(["http://a", "http://b"], threshold=1, interval=0, probe=lambda url: False)
+    pool.probe_all()
+    assert {pool.acquire(), pool.acquire()} == {"http://a", "http://b"}
+
+
+def test_background_probe_ejects(servers, monkeypatch):
+    monkeypatch.setenv("OPENCODE_HEALTH_INTERVAL", "0.02")
+    monkeypatch.setenv("OPENCODE_HEALTH_THRESHOLD", "1")
+    servers[1].unhealthy = True
+    pool = get_backend_pool()
+    deadline = time.monotonic() + 5
+    while pool.stats()["backends"][servers[1].url]["healthy"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert probe_opencode(servers[0].url) and not probe_opencode(servers[1].url)
+
+
+def test_health_lists_backends(servers, app_client):
+    backends = app_client.get("/health").get_json()["opencode_backends"]["backends"]
+    assert sorted(backends) == sorted(s.url for s in servers)
+
+
+def test_open_breaker_is_skipped(monkeypatch):
+    from opencode_breaker import get_breaker
+
+    pool = BackendPool(["http://a", "http://b"], interval=0, probe=lambda url: True)
+    breaker = get_breaker("http://a")
+    for _ in range(5):
+        breaker.record(False, 0.1)
+    assert {pool.acquire() for _ in range(4)} == {"http://b"}
+
+
+def test_half_open_breaker_without_probes_left_is_skipped(monkeypatch):
+    from opencode_breaker import get_breaker
+
+    monkeypatch.setenv("OPENCODE_BREAKER_OPEN_SECONDS", "0")
+    monkeypatch.setenv("OPENCODE_BREAKER_PROBES", "1")
+    pool = BackendPool(["http://a", "http://b"], interval=0, probe=lambda url: True)
+    breaker = get_breaker("http://a")
+    for _ in range(5):
+        breaker.record(False, 0.1)
+    # half-open at once; its one probe is taken
+    assert breaker.allow()
+    assert {pool.acquire() for _ in range(4)} == {"http://b"}
+    breaker.record(True, 0.1)
+    assert "http://a" in {pool.acquire() for _ in range(4)}
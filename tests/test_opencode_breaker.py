@@ -0,0 +1,86 @@
+"""Tests for the per-backend OpenCode circuit breaker."""
+
+import time
+
+from opencode_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from opencode_client import ask_opencode
+from tests.stubs import FakeOpenCode
+
+FALLBACK = "OpenCode 暂时不可用，请稍后再试。"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_opens_on_failure_rate_and_recovers_through_half_open():
+    clock = Clock()
+    breaker = CircuitBreaker("http://oc", window=10, min_calls=4, failure_rate=0.5,
+                             open_seconds=30, probes=2, clock=clock)
+    for ok in (True, False, True):
+        breaker.record(ok, 0.1)
+    assert breaker.state == CLOSED  # fewer than min_calls
+    breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()  # only two probes
+    breaker.record(True, 0.1)
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+    stats = breaker.stats()
+    assert (stats["opened"], stats["rejected"], stats["calls"]) == (1, 2, 0)
+
+
+def test_failed_probe_reopens_and_slow_calls_trip():
+    clock = Clock()
+    breaker = CircuitBreaker("http://oc", min_calls=2, slow_seconds=10, open_seconds=5, clock=clock)
+    breaker.record(True, 12.0)
+    breaker.record(True, 11.0)
+    assert breaker.state == OPEN
+
+    clock.now += 5
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 2
+
+
+def test_ask_opencode_fails_fast_while_open(monkeypatch):
+    monkeypatch.setenv("OPENCODE_BREAKER_MIN_CALLS", "2")
+    monkeypatch.setenv("OPENCODE_BREAKER_OPEN_SECONDS", "0.2")
+    monkeypatch.setenv("OPENCODE_BREAKER_PROBES", "1")
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+    with FakeOpenCode(reply="answer") as server:
+        server.handle = lambda req: (500, {"error": "down"})
+        assert ask_opencode("q1", api_url=server.url) == FALLBACK
+        assert ask_opencode("q2", api_url=server.url) == FALLBACK
+        seen = len(server.requests)
+        assert ask_opencode("q3", api_url=server.url) == FALLBACK
+        assert len(server.requests) == seen  # short-circuited, no request sent
+
+        del server.handle  # back to answering
+        time.sleep(0.25)
+        assert ask_opencode("q4", api_url=server.url) == "answer"  # half-open probe
+        assert ask_opencode("q5", api_url=server.url) == "answer"
+
+
+def test_health_reports_breakers(monkeypatch, app_client):
+    from opencode_breaker import get_breaker
+
+    get_breaker("http://oc:4096")
+    assert app_client.get("/health").get_json()["opencode_breakers"]["http://oc:4096"]["state"] == CLOSED
+
+
+def test_slow_calls_do_not_trip_by_default():
+    breaker = CircuitBreaker("http://oc", min_calls=2)
+    for _ in range(5):
+        breaker.record(True, 280.0)
+    assert breaker.state == CLOSED
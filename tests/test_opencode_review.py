@@ -0,0 +1,111 @@
+"""Tests for concurrent dispatch of many MR reviews."""
+
+import threading
+import time
+
+import pytest
+
+from opencode_review import ReviewDispatcher, send_opencode_reviews
+from tests.stubs import FakeOpenCode
+
+MR = "https://gitlab.example.com/group/project/-/merge_requests/{}"
+
+
+class FakeReview:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.urls = []
+        self.active = 0
+        self.peak = 0
+        # reviews of this URL wait for ``release``
+        self.held = None
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, mr_url):
+        with self._lock:
+            self.urls.append(mr_url)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            if mr_url == self.held:
+                self.release.wait(5)
+            time.sleep(self.delay)
+            if mr_url.endswith("/bad"):
+                raise RuntimeError("boom")
+            return None if mr_url.endswith("/empty") else {"info": {}}
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+@pytest.fixture(autouse=True)
+def review_enabled(monkeypatch):
+    monkeypatch.setenv("OPENCODE_ENABLED", "1")
+
+
+def test_results_follow_input_order_and_duplicates_run_once():
+    review = FakeReview(delay=0.02)
+    dispatcher = ReviewDispatcher(concurrency=3, review=review)
+    urls = [MR.format(i) for i in range(6)] + [MR.format(0) + "/", " " + MR.format(1)]
+    results = dispatcher.review_many(urls)
+    dispatcher.close()
+
+    assert [r["url"] for r in results] == urls
+    assert [r["status"] for r in results] == ["ok"] * 6 + ["duplicate"] * 2
+    assert sorted(review.urls) == sorted(MR.format(i) for i in range(6))
+    assert review.peak == 3
+    assert results[0]["title"] == "project/-/merge_requests/0"
+    assert all(r["seconds"] >= 0.02 for r in results[:6])
+    assert dispatcher.stats()["ok"] == 6
+
+
+def test_failures_are_reported_per_url():
+    dispatcher = ReviewDispatcher(concurrency=2, review=FakeReview())
+    results = dispatcher.review_many([MR.format(1), MR.format("bad"), MR.format("empty")])
+    dispatcher.close()
+    assert [r["status"] for r in results] == ["ok", "failed", "failed"]
+    assert results[1]["error"] == "boom"
+
+
+def test_review_still_running_from_an_earlier_batch_is_skipped():
+    review = FakeReview()
+    review.held = MR.format(1)
+    dispatcher = ReviewDispatcher(concurrency=2, review=review)
+    first = threading.Thread(target=dispatcher.review_many, args=([MR.format(1)],))
+    first.start()
+    for _ in range(200):
+        if review.urls:
+            break
+        time.sleep(0.01)
+
+    results = dispatcher.review_many([MR.format(1), MR.format(2)])
+    assert [r["status"] for r in results] == ["in_progress", "ok"]
+    assert dispatcher.in_progress() == [MR.format(1)]
+    review.release.set()
+    first.join(5)
+    assert dispatcher.in_progress() == []
+    dispatcher.close()
+
+
+def test_disabled_batch_sends_nothing(monkeypatch):
+    monkeypatch.setenv("OPENCODE_ENABLED", "0")
+    review = FakeReview()
+    dispatcher = ReviewDispatcher(review=review)
+    assert [r["status"] for r in dispatcher.review_many([MR.format(1)])] == ["disabled"]
+    assert review.urls == []
+    dispatcher.close()
+
+
+def test_reviews_run_concurrently_against_opencode(monkeypatch):
+    with FakeOpenCode(latency=0.2, agents=("code-reviewer",)) as opencode:
+        monkeypatch.setenv("OPENCODE_API_URL", opencode.url)
+        monkeypatch.setenv("OPENCODE_AGENT_NAME", "code-reviewer")
+        monkeypatch.setenv("OPENCODE_REVIEW_CONCURRENCY", "4")
+        start = time.monotonic()
+        results = send_opencode_reviews([MR.format(i) for i in range(4)])
+        elapsed = time.monotonic() - start
+
+    assert [r["status"] for r in results] == ["ok"] * 4
+    assert elapsed < 0.6
+    assert len(opencode.calls("POST", "/session/")) == 4
@@ -0,0 +1,249 @@
+"""Tests for the pool of pre-created OpenCode sessions."""
+
+import time
+
+import pytest
+
+from opencode_session_pool import SessionPool, get_session_pool
+from tests.stubs import FakeOpenCode
+
+URL = "http://oc"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeServer:
+    def __init__(self):
+        self.created = 0
+        self.deleted = []
+        self.fail = False
+
+    def create(self, api_url):
+        if self.fail:
+            raise ConnectionError("refused")
+        self.created += 1
+        return f"ses-{self.created}"
+
+    def delete(self, api_url, session_id):
+        self.deleted.append(session_id)
+
+
+def _pool(server, clock, **kwargs):
+    return SessionPool(create=server.create, delete=server.delete, clock=clock, **kwargs)
+
+
+def test_take_hands_out_pre_created_sessions_once():
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=1, max_size=4)
+    pool.warm(URL, "docs-searcher")
+    pool.refill()
+    assert pool.take(URL, "docs-searcher") == "ses-1"
+    assert pool.take(URL, "docs-searcher") is None
+    # other agents have their own sessions
+    assert pool.take(URL, "reviewer") is None
+
+    pool.refill()
+    assert pool.take(URL + "/", "docs-searcher") == "ses-2"
+    stats = pool.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+    assert stats["groups"][f"{URL} reviewer"]["idle"] == 1
+
+
+def test_target_size_follows_new_conversation_rate():
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=1, max_size=4, lead_time=60)
+    pool.warm(URL, "a")
+    pool.refill()
+    assert pool.stats()["groups"][f"{URL} a"]["target"] == 1
+
+    # 15 new conversations in five minutes: 3 expected per minute
+    for _ in range(15):
+        pool.take(URL, "a")
+        clock.now += 1
+    pool.refill()
+    group = pool.stats()["groups"][f"{URL} a"]
+    assert (group["target"], group["idle"]) == (3, 3)
+
+    for _ in range(100):
+        pool.take(URL, "a")
+    assert pool.stats()["groups"][f"{URL} a"]["target"] == 4
+
+    # traffic stops: back to the minimum once the arrivals age out
+    clock.now += 400
+    assert pool.stats()["groups"][f"{URL} a"]["target"] == 1
+
+
+def test_stale_sessions_are_deleted_and_replaced():
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=2, max_size=2, ttl=60)
+    pool.warm(URL, "a")
+    pool.refill()
+    clock.now += 61
+    # never handed out once expired
+    assert pool.take(URL, "a") is None
+    pool.refill()
+    assert server.deleted == ["ses-1", "ses-2"]
+    assert pool.take(URL, "a") == "ses-3"
+    assert pool.stats()["groups"][f"{URL} a"]["expired"] == 2
+
+
+def test_stop_deletes_idle_sessions():
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=2, max_size=4)
+    pool.warm(URL, "docs-searcher")
+    pool.refill()
+    assert pool.take(URL, "docs-searcher") == "ses-1"
+    pool.stop()
+    # the taken session belongs to a conversation now; only the idle one is deleted
+    assert server.deleted == ["ses-2"]
+    assert pool.stats()["groups"][f"{URL} docs-searcher"]["idle"] == 0
+
+
+def test_stop_waits_for_an_in_flight_refill():
+    import threading
+
+    server, clock = FakeServer(), FakeClock()
+    creating, release = threading.Event(), threading.Event()
+    real_create = server.create
+
+    def slow_create(api_url):
+        creating.set()
+        release.wait(5)
+        return real_create(api_url)
+
+    server.create = slow_create
+    pool = _pool(server, clock, min_size=2, max_size=4)
+    pool.warm(URL, "docs-searcher")
+    refill = threading.Thread(target=pool.refill)
+    refill.start()
+    assert creating.wait(5)
+    stop = threading.Thread(target=pool.stop)
+    stop.start()
+    while not pool._stop.is_set():
+        time.sleep(0.01)
+    release.set()
+    stop.join(5)
+    refill.join(5)
+    # the session created while stopping is deleted; no further one is created
+    assert server.created == 1 and server.deleted == ["ses-1"]
+
+
+def test_asgi_shutdown_stops_the_pool(monkeypatch):
+    import asyncio
+
+    import asgi_app
+    import opencode_session_pool
+
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=1)
+    pool.warm(URL, "docs-searcher")
+    pool.refill()
+    monkeypatch.setattr(opencode_session_pool, "_pool", pool)
+
+    async def run():
+        messages = [{"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await asgi_app.app({"type": "lifespan"}, receive, send)
+        return sent
+
+    assert asyncio.run(run()) == ["lifespan.shutdown.complete"]
+    assert server.deleted == ["ses-1"]
+
+
+def test_failed_creation_is_counted_and_retried_next_round():
+    server, clock = FakeServer(), FakeClock()
+    pool = _pool(server, clock, min_size=2, max_size=2)
+    pool.warm(URL, "a")
+    server.fail = True
+    pool.refill()
+    group = pool.stats()["groups"][f"{URL} a"]
+    assert (group["idle"], group["failed"]) == (0, 1)
+
+    server.fail = False
+    pool.refill()
+    assert pool.stats()["groups"][f"{URL} a"]["idle"] == 2
+
+
+def test_saved_latency_is_estimated_from_creation_time():
+    def slow_create(api_url):
+        time.sleep(0.05)
+        return "ses-slow"
+
+    pool = SessionPool(create=slow_create, delete=lambda url, sid: None, min_size=1)
+    pool.warm(URL, "a")
+    pool.refill()
+    assert pool.take(URL, "a") == "ses-slow"
+    stats = pool.stats()
+    assert stats["create_seconds_p50"] >= 0.05
+    assert stats["saved_seconds"] >= 0.05
+
+
+@pytest.fixture
+def pooled_opencode(monkeypatch):
+    with FakeOpenCode(reply="ok") as stub:
+        monkeypatch.setenv("OPENCODE_API_URL", stub.url)
+        monkeypatch.setenv("OPENCODE_AGENT_NAME", "docs-searcher")
+        monkeypatch.setenv("OPENCODE_SESSION_POOL_MAX", "2")
+        pool = get_session_pool()
+        for _ in range(200):
+            if pool.stats()["groups"][f"{stub.url} docs-searcher"]["idle"]:
+                break
+            time.sleep(0.01)
+        yield stub, pool
+
+
+def test_new_conversation_starts_on_a_pre_created_session(pooled_opencode):
+    from opencode_client import ask_opencode
+
+    opencode, pool = pooled_opencode
+    assert [r["path"] for r in opencode.calls("POST", "/session")] == ["/session"]
+    key = ("lisi", 1000002, "docs-searcher")
+    assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=key) == "ok"
+    # the follow-up reuses the handed-out session
+    assert ask_opencode("more", api_url=opencode.url, agent_name="docs-searcher", session_key=key) == "ok"
+    messages = [r["path"] for r in opencode.calls("POST", "/session/")]
+    assert messages == ["/session/ses-1/message"] * 2
+    assert pool.stats()["hits"] == 1
+
+
+def test_pre_created_session_gone_on_server_is_recreated(pooled_opencode):
+    from opencode_client import ask_opencode
+
+    opencode, _ = pooled_opencode
+    real_handle = opencode.handle
+
+    def handle(req):
+        if req["path"] == "/session/ses-1/message":
+            return 404, {"error": "not found"}
+        return real_handle(req)
+
+    opencode.handle = handle
+    assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=("u",)) == "ok"
+    assert opencode.calls("POST", "/session/")[-1]["path"] != "/session/ses-1/message"
+
+
+def test_pre_created_session_is_titled_with_the_trace_id(pooled_opencode):
+    import tracing
+    from opencode_client import ask_opencode
+
+    opencode, _ = pooled_opencode
+    with tracing.start_trace("trace-abc"):
+        assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=("u",)) == "ok"
+    for _ in range(200):
+        if opencode.calls("PATCH", "/session/ses-1"):
+            break
+        time.sleep(0.01)
+    assert opencode.calls("PATCH", "/session/ses-1")[0]["json"] == {"title": "Wework Robot [trace-abc]"}
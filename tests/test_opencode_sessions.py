@@ -0,0 +1,151 @@
+"""Unit tests for the per-user OpenCode session registry."""
+
+import time
+
+import pytest
+
+from opencode_sessions import SessionRegistry, SharedSessionRegistry, session_key_for
+from state_store import RedisStateStore
+from tests.stubs import FakeOpenCode
+
+
+def test_registry_hit_and_miss():
+    reg = SessionRegistry(max_size=10, idle_ttl=60)
+    key = ("lisi", 1000002, "docs-searcher")
+    assert reg.get(key, "http://oc") is None
+    reg.put(key, "http://oc", "ses-1")
+    assert reg.get(key, "http://oc") == "ses-1"
+    # a session belongs to the server that created it
+    assert reg.get(key, "http://other") is None
+    assert reg.stats()["hits"] == 1
+    assert reg.stats()["misses"] == 2
+
+
+def test_registry_lru_eviction_calls_on_evict():
+    evicted = []
+    reg = SessionRegistry(max_size=2, idle_ttl=60, on_evict=lambda url, sid: evicted.append(sid))
+    reg.put(("a",), "http://oc", "ses-a")
+    reg.put(("b",), "http://oc", "ses-b")
+    reg.get(("a",), "http://oc")
+    reg.put(("c",), "http://oc", "ses-c")
+    assert evicted == ["ses-b"]
+    assert reg.get(("b",), "http://oc") is None
+    assert reg.stats()["evicted_lru"] == 1
+
+
+def test_registry_idle_ttl():
+    evicted = []
+    reg = SessionRegistry(max_size=10, idle_ttl=0.05, on_evict=lambda url, sid: evicted.append(sid))
+    reg.put(("a",), "http://oc", "ses-a")
+    time.sleep(0.1)
+    assert reg.get(("a",), "http://oc") is None
+    assert evicted == ["ses-a"]
+    assert reg.stats()["evicted_idle"] == 1
+
+
+def test_shared_registry_is_shared_between_workers(fake_redis):
+    evicted = []
+    worker_a = SharedSessionRegistry(RedisStateStore(fake_redis.url), idle_ttl=60)
+    worker_b = SharedSessionRegistry(
+        RedisStateStore(fake_redis.url), idle_ttl=60, on_evict=lambda url, sid: evicted.append(sid)
+    )
+    key = ("lisi", 1000002, "docs-searcher")
+    worker_a.put(key, "http://oc", "ses-1")
+    assert worker_b.get(key, "http://oc") == "ses-1"
+    assert worker_b.get(key, "http://other") is None
+    assert worker_b.backend_of(key) == "http://oc"
+    # replacing the session hands the old one to the eviction callback
+    worker_b.put(key, "http://oc", "ses-2")
+    assert evicted == ["ses-1"]
+    assert worker_a.get(key, "http://oc") == "ses-2"
+    worker_a.discard(key)
+    assert worker_b.get(key, "http://oc") is None
+    assert worker_b.stats()["size"] == 0
+
+
+def test_shared_registry_idle_ttl_and_outage(fake_redis):
+    reg = SharedSessionRegistry(RedisStateStore(fake_redis.url, timeout=0.2), idle_ttl=0.2)
+    reg.put(("a",), "http://oc", "ses-a")
+    time.sleep(0.12)
+    assert reg.get(("a",), "http://oc") == "ses-a"  # a hit resets the idle TTL
+    time.sleep(0.12)
+    assert reg.get(("a",), "http://oc") == "ses-a"
+    time.sleep(0.3)
+    assert reg.get(("a",), "http://oc") is None
+    fake_redis.stop()
+    reg.put(("a",), "http://oc", "ses-b")
+    assert reg.get(("a",), "http://oc") is None
+    assert reg.stats()["errors"] >= 2
+
+
+def test_session_key_for(monkeypatch):
+    msg = {"FromUserName": "lisi", "AgentID": 1000002}
+    assert session_key_for(msg, "docs-searcher") == ("lisi", 1000002, "docs-searcher")
+    assert session_key_for({}, "docs-searcher") is None
+    monkeypatch.setenv("OPENCODE_SESSION_REUSE", "0")
+    assert session_key_for(msg, "docs-searcher") is None
+
+
+@pytest.fixture
+def opencode(monkeypatch):
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+    with FakeOpenCode(reply="ok") as stub:
+        yield stub
+
+
+def test_ask_opencode_reuses_session_for_follow_ups(opencode):
+    from opencode_client import ask_opencode
+
+    key = ("lisi", 1000002, "docs-searcher")
+    for _ in range(3):
+        assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=key) == "ok"
+    posts = [r["path"] for r in opencode.calls("POST", "/session")]
+    assert posts == ["/session"] + ["/session/ses-1/message"] * 3
+
+
+def test_ask_opencode_recreates_session_gone_on_server(opencode):
+    from opencode_client import ask_opencode
+    from opencode_sessions import get_session_registry
+
+    key = ("lisi", 1000002, "docs-searcher")
+    get_session_registry().put(key, opencode.url, "ses-gone")
+    real_handle = opencode.handle
+    opencode.handle = lambda req: (
+        (404, {"error": "no session"}) if "/ses-gone/" in req["path"] else real_handle(req)
+    )
+    assert ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=key) == "ok"
+    assert get_session_registry().get(key, opencode.url) == "ses-1"
+
+
+def test_evicted_session_is_deleted_on_server(opencode, monkeypatch):
+    from opencode_client import ask_opencode
+    from opencode_sessions import get_session_registry
+
+    monkeypatch.setenv("OPENCODE_SESSION_MAX", "1")
+    monkeypatch.setenv("OPENCODE_SESSION_DELETE_ON_EVICT", "1")
+    ask_opencode("hi", api_url=opencode.url, agent_name="a", session_key=("u1", 1, "a"))
+    ask_opencode("hi", api_url=opencode.url, agent_name="a", session_key=("u2", 1, "a"))
+    assert len(get_session_registry()) == 1
+    for _ in range(100):
+        if opencode.calls("DELETE", "/session/"):
+            break
+        time.sleep(0.01)
+    assert [r["path"] for r in opencode.calls("DELETE", "/session/")] == ["/session/ses-1"]
+
+
+def test_registry_is_shared_when_state_store_is_configured(opencode, fake_redis, monkeypatch):
+    from opencode_client import ask_opencode
+    import opencode_sessions
+    import state_store
+
+    monkeypatch.setenv("WEWORK_STATE_STORE", fake_redis.url)
+    key = ("lisi", 1000002, "docs-searcher")
+    ask_opencode("hi", api_url=opencode.url, agent_name="docs-searcher", session_key=key)
+    # another worker: fresh process-wide registry and store, same server
+    monkeypatch.setattr(opencode_sessions, "_registry", None)
+    state_store._store.close()
+    monkeypatch.setattr(state_store, "_store", None)
+    ask_opencode("again", api_url=opencode.url, agent_name="docs-searcher", session_key=key)
+    assert isinstance(opencode_sessions.get_session_registry(), SharedSessionRegistry)
+    posts = [r["path"] for r in opencode.calls("POST", "/session")]
+    assert posts == ["/session", "/session/ses-1/message", "/session/ses-1/message"]
@@ -0,0 +1,155 @@
+"""Tests for streaming OpenCode answers over the /event stream."""
+
+import asyncio
+import time
+
+import pytest
+
+import opencode_stream
+from opencode_stream import (
+    ProgressiveReply,
+    StreamAssembler,
+    iter_sse_data,
+    stream_opencode,
+    stream_opencode_async,
+)
+from tests.stubs import FakeOpenCode
+
+PARAGRAPHS = ["第一段：安装步骤。\n\n", "第二段：配置说明。\n\n", "第三段：常见问题。"]
+
+
+@pytest.fixture(autouse=True)
+def stream_env(monkeypatch):
+    monkeypatch.setattr(opencode_stream, "_stats", opencode_stream.StreamStats())
+    monkeypatch.setenv("OPENCODE_STREAM_FIRST_CHUNK_SECONDS", "0")
+    monkeypatch.setenv("OPENCODE_STREAM_MIN_CHUNK_CHARS", "1")
+    monkeypatch.delenv("OPENCODE_SERVER_PASSWORD", raising=False)
+
+
+def test_iter_sse_data_parses_events_and_skips_comments():
+    lines = [
+        b": ping",
+        b"",
+        b'data: {"type": "a"}',
+        b"",
+        b"data: not json",
+        b"",
+        b'data: {"type":',
+        b'data: "b"}',
+        b"",
+    ]
+    assert list(iter_sse_data(lines)) == [{"type": "a"}, {"type": "b"}]
+
+
+def _part(session, message, text, part="p1"):
+    return {"type": "message.part.updated", "properties": {"part": {
+        "id": part, "sessionID": session, "messageID": message, "type": "text", "text": text}}}
+
+
+def test_assembler_filters_session_and_user_parts():
+    asm = StreamAssembler("ses-1", "hello")
+    asm.feed({"type": "message.updated", "properties": {"info": {"id": "m1", "sessionID": "ses-1", "role": "user"}}})
+    asm.feed(_part("ses-1", "m1", "hello", part="u"))
+    asm.feed(_part("ses-2", "m9", "other session"))
+    assert asm.text == ""
+    asm.feed(_part("ses-1", "m2", "Hi"))
+    asm.feed({"type": "message.part.delta", "properties": {
+        "sessionID": "ses-1", "messageID": "m2", "partID": "p1", "field": "text", "delta": " there"}})
+    assert asm.text == "Hi there"
+    assert asm.first_text_at is not None
+    asm.feed({"type": "session.idle", "properties": {"sessionID": "ses-1"}})
+    assert asm.idle
+
+
+def test_progressive_reply_pushes_complete_paragraphs_only():
+    progress = ProgressiveReply(first_chunk_seconds=5, min_chunk_chars=20, started_at=0.0)
+    text = "para one\n\npara two is longer\n\npartial"
+    assert progress.take(text, now=1.0) is None  # before the first-chunk deadline
+    assert progress.wait_timeout(1.0) == 4.0
+    assert progress.take(text, now=6.0) == "para one\n\npara two is longer"
+    assert progress.take(text + " more\n\nx", now=7.0) is None  # below min_chunk_chars
+    assert progress.remainder(text + " more") == "partial more"
+
+
+def test_progressive_reply_remainder_without_pushes_is_full_text():
+    progress = ProgressiveReply(first_chunk_seconds=5, min_chunk_chars=10, started_at=0.0)
+    assert progress.remainder("whole answer") == "whole answer"
+
+
+def test_stream_opencode_yields_paragraphs_progressively():
+    with FakeOpenCode(stream_chunks=PARAGRAPHS, chunk_delay=0.15) as stub:
+        start = time.monotonic()
+        arrivals = []
+        for chunk in stream_opencode("怎么安装？", api_url=stub.url):
+            arrivals.append((time.monotonic() - start, chunk))
+
+    assert [c for _, c in arrivals] == ["第一段：安装步骤。", "第二段：配置说明。", "第三段：常见问题。"]
+    # the first paragraph is pushed well before the whole answer is done
+    assert arrivals[0][0] < arrivals[-1][0] - 0.2
+    stats = opencode_stream.get_stream_stats().snapshot()
+    assert stats["streams"] == 1
+    assert stats["chunks"] == 2
+    assert stats["ttfb"]["count"] == 1 and stats["ttfb"]["p50"] < arrivals[-1][0]
+
+
+def test_stream_opencode_fast_answer_is_one_message(monkeypatch):
+    monkeypatch.setenv("OPENCODE_STREAM_FIRST_CHUNK_SECONDS", "10")
+    with FakeOpenCode(stream_chunks=PARAGRAPHS, chunk_delay=0.01) as stub:
+        chunks = list(stream_opencode("怎么安装？", api_url=stub.url))
+    assert chunks == ["".join(PARAGRAPHS)]
+
+
+def test_stream_opencode_falls_back_without_event_endpoint():
+    with FakeOpenCode(reply="plain answer") as stub:
+        stub.open_stream = lambda req: None  # /event -> 404
+        chunks = list(stream_opencode("hi", api_url=stub.url))
+    assert chunks == ["plain answer"]
+    assert opencode_stream.get_stream_stats().snapshot()["fallbacks"] == 1
+
+
+def test_stream_failures_open_the_breaker(monkeypatch):
+    from opencode_breaker import get_breaker
+
+    monkeypatch.setenv("OPENCODE_BREAKER_MIN_CALLS", "2")
+    with FakeOpenCode(stream_chunks=PARAGRAPHS) as stub:
+        real_handle = stub.handle
+        stub.handle = lambda req: (500, {"error": "boom"}) if req["path"].endswith("/message") else real_handle(req)
+
+        async def collect():
+            return [chunk async for chunk in stream_opencode_async("hi", api_url=stub.url)]
+
+        assert list(stream_opencode("hi", api_url=stub.url)) == [opencode_stream.FALLBACK]
+        assert asyncio.run(collect()) == [opencode_stream.FALLBACK]
+        assert get_breaker(stub.url).state == "open"
+        sent = len(stub.calls("POST", "/session"))
+        # an open breaker fails fast without touching the backend
+        assert list(stream_opencode("hi", api_url=stub.url)) == [opencode_stream.FALLBACK]
+        assert len(stub.calls("POST", "/session")) == sent
+
+
+def test_stream_opencode_async_yields_paragraphs_progressively():
+    async def collect(url):
+        return [chunk async for chunk in stream_opencode_async("怎么安装？", api_url=url)]
+
+    with FakeOpenCode(stream_chunks=PARAGRAPHS, chunk_delay=0.1) as stub:
+        chunks = asyncio.run(collect(stub.url))
+    assert chunks == ["第一段：安装步骤。", "第二段：配置说明。", "第三段：常见问题。"]
+
+
+def test_dispatcher_pushes_each_chunk_and_records_first_reply(monkeypatch):
+    from async_reply import ReplyDispatcher
+
+    monkeypatch.setenv("OPENCODE_STREAM", "1")
+    delivered = []
+    with FakeOpenCode(stream_chunks=PARAGRAPHS, chunk_delay=0.1) as stub:
+        monkeypatch.setenv("OPENCODE_API_URL", stub.url)
+        dispatcher = ReplyDispatcher(workers=1, deliver=lambda msg, text: delivered.append(text) or True)
+        dispatcher.submit({"FromUserName": "zhangsan"}, "怎么安装？")
+        assert dispatcher.wait_idle(timeout=5)
+        dispatcher.shutdown()
+
+    assert delivered == ["第一段：安装步骤。", "第二段：配置说明。", "第三段：常见问题。"]
+    stats = dispatcher.stats()
+    assert stats["delivered"] == 1
+    assert stats["messages_sent"] == 3
+    assert 0 < stats["first_reply_p50"] < stats["latency_p50"]
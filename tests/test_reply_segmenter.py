@@ -0,0 +1,54 @@
+"""Tests for splitting long replies on UTF-8 byte boundaries."""
+
+from reply_segmenter import MAX_TEXT_BYTES, split_reply, truncate_utf8, utf8_len
+
+
+def test_short_reply_is_one_unnumbered_part():
+    assert split_reply("  你好  ") == ["你好"]
+    assert split_reply("") == []
+
+
+def test_truncate_utf8_never_splits_a_character():
+    assert truncate_utf8("中文", 4) == "中"
+    assert truncate_utf8("abc", 10) == "abc"
+
+
+def test_chinese_paragraphs_split_within_byte_budget():
+    paragraphs = [f"第{i}段：" + "企业微信回复内容" * 40 for i in range(10)]
+    text = "\n\n".join(paragraphs)
+    assert len(text) < 4000 < utf8_len(text)  # under 4000 chars, over the byte limit
+
+    parts = split_reply(text)
+    assert len(parts) > 1
+    assert all(utf8_len(p) <= MAX_TEXT_BYTES for p in parts)
+    assert [p.split("\n", 1)[0] for p in parts] == [f"({i}/{len(parts)})" for i in range(1, len(parts) + 1)]
+    # paragraphs are kept whole and in order
+    bodies = "\n\n".join(p.split("\n", 1)[1] for p in parts)
+    assert bodies == text
+
+
+def test_code_block_is_kept_together_when_it_fits():
+    code = "```python\n" + "\n".join(f"print({i})" for i in range(50)) + "\n```"
+    text = "说明" * 500 + "\n\n" + code + "\n\n" + "结尾"
+    parts = split_reply(text, max_bytes=1200)
+    assert any(code in p for p in parts)
+    assert all(utf8_len(p) <= 1200 for p in parts)
+
+
+def test_oversized_code_block_is_refenced_in_every_part():
+    code = "```sh\n" + "\n".join(f"echo line-{i}" for i in range(200)) + "\n```"
+    parts = split_reply(code, max_bytes=500)
+    assert len(parts) > 1
+    for part in parts:
+        body = part.split("\n", 1)[1]
+        assert body.startswith("```sh\n") and body.endswith("\n```")
+        assert utf8_len(part) <= 500
+    lines = [l for p in parts for l in p.split("\n")[2:-1]]
+    assert lines == [f"echo line-{i}" for i in range(200)]
+
+
+def test_single_huge_line_is_hard_split():
+    text = "长" * 2000  # 6000 bytes, no line breaks
+    parts = split_reply(text, numbered=False)
+    assert all(utf8_len(p) <= MAX_TEXT_BYTES for p in parts)
+    assert "".join(parts) == text
@@ -0,0 +1,66 @@
+"""Tests for near-duplicate question matching."""
+
+from answer_cache import AnswerCache, lookup_answer, normalize_question
+from similarity_index import MinHashIndex, question_features
+
+
+def _features(text):
+    return question_features(normalize_question(text))
+
+
+def test_paraphrases_share_features():
+    assert _features("怎么配置X") == _features("X 如何配置？")
+    assert _features("How do I configure nginx?") == _features("configure nginx")
+    assert _features("怎么配置X") != _features("怎么删除X")
+
+
+def test_index_query_add_remove():
+    index = MinHashIndex()
+    for i, text in enumerate(["怎么配置网关超时", "如何部署服务到k8s", "日志保存在哪里"]):
+        index.add(f"k{i}", index.signature(normalize_question(text)))
+
+    key, score = index.query(index.signature(normalize_question("网关超时如何配置")), 0.7)
+    assert key == "k0" and score < 1.0
+    assert index.query(index.signature(normalize_question("数据库密码怎么改")), 0.7) is None
+    assert index.query(index.signature("网关超时配置"), 0.7, accept=lambda k: k != "k0") is None
+
+    assert index.remove("k0")
+    assert index.query(index.signature("网关超时配置"), 0.7) is None
+    index.add("k3", index.signature("网关超时配置"))  # reuses the freed slot
+    assert len(index) == 3
+    assert index.query(index.signature("网关超时配置"), 0.7)[0] == "k3"
+
+
+def test_answer_cache_matches_near_duplicates():
+    cache = AnswerCache(similarity_threshold=0.7)
+    cache.put("怎么配置网关超时", "docs", "改 gateway.timeout")
+
+    answer, similar_to, score = cache.match("网关超时如何配置", "docs")
+    assert (answer, similar_to) == ("改 gateway.timeout", "怎么配置网关超时")
+    assert 0.7 <= score < 1.0
+    assert cache.match("网关超时如何配置", "other") is None
+    assert cache.get("网关超时如何配置", "docs") is None  # exact lookups only
+    assert cache.stats()["similar_hits"] == 1
+
+    cache.invalidate()
+    assert cache.match("网关超时如何配置", "docs") is None
+
+
+def test_lookup_answer_tags_similar_hits(monkeypatch):
+    monkeypatch.setenv("ANSWER_CACHE", "1")
+    monkeypatch.setenv("ANSWER_CACHE_SIMILAR", "1")
+    from answer_cache import get_answer_cache
+
+    get_answer_cache().put("怎么配置X", "docs", "答案")
+    assert lookup_answer("怎么配置X", "docs") == "答案"
+    tagged = lookup_answer("X 如何配置", "docs")
+    assert tagged.startswith("（相似问题「怎么配置x」的缓存回答）")
+    assert tagged.endswith("答案")
+
+
+def test_questions_about_different_products_do_not_match():
+    cache = AnswerCache(similarity_threshold=0.7)
+    cache.put("怎么配置nginx网关", "docs", "nginx 的配置")
+    assert cache.match("怎么配置redis网关", "docs") is None
+    assert cache.match("怎么配置 nginx 2 网关", "docs") is None
+    assert cache.match("nginx网关如何配置", "docs")[0] == "nginx 的配置"
@@ -0,0 +1,119 @@
+"""Tests for coalescing identical concurrent questions."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import single_flight
+from single_flight import SingleFlight, ask_coalesced, ask_coalesced_async, flight_key
+
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight()
+    release = threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        release.wait(5)
+        return "answer"
+
+    with ThreadPoolExecutor(5) as pool:
+        futures = [pool.submit(flight.do, ("docs", "q"), fn) for _ in range(5)]
+        while flight.stats()["coalesced"] < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        assert [f.result() for f in futures] == ["answer"] * 5
+
+    assert len(runs) == 1
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 4}
+    assert flight.do(("docs", "q"), lambda: "again") == "again"  # finished calls are not reused
+
+
+def test_errors_fan_out_to_waiters():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("boom")
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flight.do, ("a", "q"), fail)
+        started.wait(5)
+        follower = pool.submit(flight.do, ("a", "q"), lambda: "unused")
+        while flight.stats()["coalesced"] < 1:
+            threading.Event().wait(0.01)
+        release.set()
+        for f in (leader, follower):
+            with pytest.raises(RuntimeError):
+                f.result()
+
+
+def test_flight_key(monkeypatch):
+    assert flight_key("How to configure X?", "docs") == ("docs", "how to configure x")
+    assert flight_key("继续", "docs") is None  # context dependent
+    monkeypatch.setenv("OPENCODE_SINGLE_FLIGHT", "0")
+    assert flight_key("How to configure X?", "docs") is None
+
+
+def test_ask_coalesced_async_and_different_agents():
+    runs = []
+
+    async def ask(**kw):
+        runs.append(kw["agent_name"])
+        await asyncio.sleep(0.05)
+        return f"answer from {kw['agent_name']}"
+
+    async def main():
+        return await asyncio.gather(
+            *(ask_coalesced_async(ask, user_message="怎么配置网关", agent_name="docs", api_url="u")
+              for _ in range(3)),
+            ask_coalesced_async(ask, user_message="怎么配置网关", agent_name="ops", api_url="u"),
+        )
+
+    replies = asyncio.run(main())
+    assert replies == ["answer from docs"] * 3 + ["answer from ops"]
+    assert sorted(runs) == ["docs", "ops"]
+    assert single_flight.get_single_flight().stats()["coalesced"] == 2
+
+
+def test_asks_within_a_conversation_are_not_coalesced():
+    from opencode_sessions import get_session_registry
+
+    key = ("zhangsan", 1000002, "docs")
+    get_session_registry().put(key, "http://oc", "ses-1")
+    release = threading.Event()
+    runs = []
+
+    def ask(**kw):
+        runs.append(kw["session_key"])
+        release.wait(0.2)
+        return "a"
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [
+            pool.submit(ask_coalesced, ask, user_message="那第二个呢？", agent_name="docs", session_key=k)
+            for k in (key, ("lisi", 1000002, "docs"))
+        ]
+        assert [f.result() for f in futures] == ["a", "a"]
+    assert sorted(runs) == sorted([key, ("lisi", 1000002, "docs")])
+    assert single_flight.get_single_flight().stats()["coalesced"] == 0
+
+
+def test_disabled_runs_every_call(monkeypatch):
+    monkeypatch.setenv("OPENCODE_SINGLE_FLIGHT", "0")
+    runs = []
+    ask = lambda **kw: runs.append(kw) or "a"
+    assert ask_coalesced(ask, user_message="question", agent_name="docs") == "a"
+    assert len(runs) == 1
+    assert single_flight.get_single_flight().stats()["leaders"] == 0
+
+
+def test_health_reports_single_flight(app_client):
+    assert app_client.get("/health").get_json()["single_flight"] == {
+        "in_flight": 0, "leaders": 0, "coalesced": 0,
+    }
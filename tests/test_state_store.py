@@ -0,0 +1,99 @@
+"""Tests for the shared state store: in-memory and Redis protocol (against a local fake)."""
+
+import threading
+import time
+
+import pytest
+
+from state_store import (
+    MemoryStateStore,
+    RedisStateStore,
+    StateStoreError,
+    build_state_store,
+    get_state_store,
+)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request):
+    if request.param == "memory":
+        yield MemoryStateStore(prefix="t[1]:")
+        return
+    store = RedisStateStore(request.getfixturevalue("fake_redis").url, prefix="t[1]:")
+    yield store
+    store.close()
+
+
+def test_get_set_add_delete(store):
+    assert store.get("k") is None
+    assert store.add("k", "first", ttl=60) is True
+    assert store.add("k", "second", ttl=60) is False
+    assert store.get("k") == "first"
+    store.set("k", "新值")
+    assert store.get("k") == "新值"
+    store.delete("k")
+    assert store.get("k") is None
+
+
+def test_ttl_and_touch(store):
+    store.set("k", "v", ttl=0.15)
+    time.sleep(0.1)
+    assert store.touch("k", 0.15) is True
+    time.sleep(0.1)
+    assert store.get("k") == "v"
+    time.sleep(0.1)
+    assert store.get("k") is None
+    assert store.touch("k", 1) is False
+
+
+def test_count_matches_prefix_literally(store):
+    for key in ("session:[a]", "session:*", "dedup:1"):
+        store.set(key, "v")
+    assert store.count("session:") == 2
+    assert store.count("session:[") == 1
+    assert store.count("dedup:") == 1
+
+
+def test_concurrent_updates_are_atomic(store):
+    def increment(current):
+        value = int(current or 0) + 1
+        return str(value), value
+
+    threads = [
+        threading.Thread(target=lambda: [store.update("n", increment) for _ in range(50)])
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get("n") == "200"
+    # returning None as the new value leaves the key alone
+    assert store.update("n", lambda current: (None, current)) == "200"
+
+
+def test_redis_store_reconnects_after_server_drops_connections(fake_redis):
+    store = RedisStateStore(fake_redis.url)
+    store.set("k", "v")
+    fake_redis.drop_connections()
+    assert store.get("k") == "v"
+    assert store.stats()["connects"] == 2
+
+
+def test_redis_store_raises_when_unreachable(fake_redis):
+    store = RedisStateStore(fake_redis.url, timeout=0.2)
+    fake_redis.stop()
+    with pytest.raises(StateStoreError):
+        store.get("k")
+
+
+def test_build_state_store(monkeypatch, fake_redis):
+    assert isinstance(build_state_store("memory"), MemoryStateStore)
+    assert isinstance(build_state_store(fake_redis.url), RedisStateStore)
+    with pytest.raises(ValueError):
+        build_state_store("rediss://example:6380")
+
+    monkeypatch.setenv("WEWORK_STATE_STORE", fake_redis.url)
+    monkeypatch.setenv("WEWORK_STATE_PREFIX", "bot:")
+    get_state_store().set("k", "v")
+    assert "bot:k" in fake_redis.data
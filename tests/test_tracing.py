@@ -0,0 +1,101 @@
+"""Tests for request tracing: trace ID propagation and JSON-lines span export."""
+
+import json
+import threading
+
+import pytest
+
+import tracing
+from tests.test_e2e import stub_env  # noqa: F401  (fixture)
+
+
+def _spans(path) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setenv("TRACE_EXPORT_PATH", str(path))
+    return path
+
+
+def test_spans_are_nested_and_exported(trace_file):
+    with tracing.start_trace("t-1"):
+        with tracing.span("outer", a=1) as outer:
+            with tracing.span("inner"):
+                tracing.annotate(session_id="ses-9")
+            outer.set(b=2)
+
+            worker = threading.Thread(target=tracing.bind(lambda: tracing.record("in_thread", 0.5)))
+            worker.start()
+            worker.join()
+
+    spans = {s["name"]: s for s in _spans(trace_file)}
+    assert set(spans) == {"outer", "inner", "in_thread"}
+    assert all(s["trace_id"] == "t-1" for s in spans.values())
+    assert spans["outer"]["parent_id"] is None
+    assert spans["inner"]["parent_id"] == spans["outer"]["span_id"]
+    assert spans["in_thread"]["parent_id"] == spans["outer"]["span_id"]
+    assert spans["outer"]["attrs"] == {"a": 1, "b": 2}
+    assert spans["inner"]["attrs"] == {"session_id": "ses-9"}
+    assert spans["in_thread"]["duration"] == 0.5
+
+
+def test_nothing_is_recorded_outside_a_trace_or_without_export(tmp_path, monkeypatch):
+    with tracing.span("orphan") as s:
+        s.set(x=1)
+    monkeypatch.delenv("TRACE_EXPORT_PATH", raising=False)
+    with tracing.start_trace():
+        assert tracing.current_trace_id() is not None
+        with tracing.span("unexported"):
+            pass
+    assert tracing.current_trace_id() is None
+    assert tracing._exporter is None
+
+
+def test_passive_callback_is_traced_end_to_end(stub_env, app_client, trace_file):
+    _, opencode, _ = stub_env
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    assert r.status_code == 200
+    trace_id = r.headers["X-Trace-Id"]
+
+    # propagated to OpenCode: request headers and the new session's title
+    for call in opencode.calls("POST", "/session"):
+        assert call["headers"]["X-Trace-Id"] == trace_id
+    assert opencode.calls("POST", "/session")[0]["json"]["title"] == f"Wework Robot [{trace_id}]"
+
+    spans = _spans(trace_file)
+    assert {s["trace_id"] for s in spans} == {trace_id}
+    by_name = {s["name"]: s for s in spans}
+    for name in ("callback", "decrypt", "parse", "opencode", "opencode.session",
+                 "opencode.message", "reply_build", "encrypt"):
+        assert name in by_name, name
+    assert by_name["callback"]["attrs"]["from_user"] == "lisi"
+    assert by_name["opencode"]["attrs"]["session_id"] == "ses-1"
+    assert by_name["opencode.message"]["parent_id"] == by_name["opencode"]["span_id"]
+    assert by_name["opencode.message"]["attrs"]["status"] == 200
+
+
+def test_async_reply_send_shares_the_callback_trace(
+    stub_env, app_client, wait_async_replies, trace_file, monkeypatch
+):
+    _, _, qyapi = stub_env
+    monkeypatch.setenv("WEWORK_REPLY_MODE", "async")
+    r = app_client.post(
+        "/webhook/wework?msg_signature=ok&timestamp=1&nonce=2",
+        data='{"encrypt":"xxx"}',
+        content_type="application/json",
+    )
+    trace_id = r.headers["X-Trace-Id"]
+    assert wait_async_replies(timeout=10)
+
+    spans = [s for s in _spans(trace_file) if s["trace_id"] == trace_id]
+    names = {s["name"] for s in spans}
+    assert {"callback", "queue_wait", "reply_job", "opencode.message", "wework.message.send"} <= names
+    assert qyapi.calls("POST", "/cgi-bin/message/send")[0]["headers"]["X-Trace-Id"] == trace_id
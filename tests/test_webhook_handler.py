@@ -35,15 +35,29 @@ class DummyCrypt:
         return 0, '{"encrypt":"cipher","msgsignature":"abc","timestamp":"1","nonce":"2"}'
 
 
-@pytest.fixture
-def client(monkeypatch):
-    from app import app
+class RetryCrypt(DummyCrypt):
+    """Every delivery decrypts to the same message, as a WeCom retry does."""
+
+    def DecryptMsg(self, post_data, msg_signature, timestamp, nonce):
+        return 0, json.dumps(
+            {
+                "ToUserName": "wwcorp",
+                "FromUserName": "zhangsan",
+                "MsgType": "text",
+                "Content": "你好机器人",
+                "MsgId": "7000000001",
+                "AgentID": 1000002,
+            },
+            ensure_ascii=False,
+        )
+
 
+@pytest.fixture
+def client(monkeypatch, app_client, patch_ask):
     dummy = DummyCrypt()
-    app.config["TESTING"] = True
     monkeypatch.setattr("app._build_crypto", lambda: dummy)
-    monkeypatch.setattr("app.ask_opencode", lambda **kwargs: "这是 AI 回复")
-    return app.test_client(), dummy
+    patch_ask(lambda **kwargs: "这是 AI 回复")
+    return app_client, dummy
 
 
 def test_health(client):
@@ -84,3 +98,164 @@ def test_callback_post_encrypt_reply(client):
     reply_plaintext = json.loads(dummy.encrypt_calls[0][0])
     assert reply_plaintext["Content"] == "这是 AI 回复"
     assert reply_plaintext["ToUserName"] == "zhangsan"
+
+
+def test_callback_retry_reuses_first_reply(monkeypatch, app_client, patch_ask):
+    dummy = RetryCrypt()
+    asked = []
+    monkeypatch.setattr("app._build_crypto", lambda: dummy)
+    patch_ask(lambda **kwargs: asked.append(kwargs) or "第一次回复")
+    c = app_client
+
+    for _ in range(3):
+        r = c.post(
+            "/webhook/wework?msg_signature=ok-sign&timestamp=1&nonce=2",
+            data='{"encrypt":"xxx"}',
+            content_type="application/json",
+        )
+        assert r.status_code == 200
+
+    assert len(asked) == 1
+    assert len(dummy.encrypt_calls) == 3
+    assert all(json.loads(call[0])["Content"] == "第一次回复" for call in dummy.encrypt_calls)
+
+    dedup = c.get("/health").get_json()["dedup"]
+    assert dedup["misses"] == 1
+    assert dedup["hits_completed"] == 2
+
+
+def test_failed_first_delivery_releases_its_claim(monkeypatch, app_client, patch_ask):
+    monkeypatch.setattr("app._build_crypto", RetryCrypt)
+    calls = []
+
+    def ask(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return "重试后的回复"
+
+    patch_ask(ask)
+    url = "/webhook/wework?msg_signature=ok-sign&timestamp=1&nonce=2"
+    with pytest.raises(RuntimeError):
+        app_client.post(url, data='{"encrypt":"xxx"}', content_type="application/json")
+
+    # the retry is answered instead of waiting for a claim that will never resolve
+    r = app_client.post(url, data='{"encrypt":"xxx"}', content_type="application/json")
+    assert r.status_code == 200
+    assert len(calls) == 2
+    dedup = app_client.get("/health").get_json()["dedup"]
+    assert (dedup["misses"], dedup["released"]) == (2, 1)
+
+
+@pytest.fixture
+def counted_crypto(monkeypatch, patch_ask):
+    builds = []
+
+    def build():
+        builds.append(DummyCrypt())
+        return builds[-1]
+
+    monkeypatch.setattr("app._build_crypto", build)
+    monkeypatch.setattr("app._load_env_file", lambda override=False: None)
+    patch_ask(lambda **kwargs: "这是 AI 回复")
+    monkeypatch.setenv("WEWORK_TOKEN", "t1")
+    monkeypatch.setenv("WEWORK_ENCODING_AES_KEY", "k1")
+    monkeypatch.setenv("WEWORK_RECEIVE_ID", "r1")
+    return builds
+
+
+def test_crypto_is_built_once(counted_crypto, app_client):
+    c = app_client
+    for _ in range(3):
+        r = c.get("/webhook/wework?msg_signature=ok-sign&timestamp=1&nonce=2&echostr=E")
+        assert r.status_code == 200
+    assert len(counted_crypto) == 1
+
+
+def test_crypto_cache_is_thread_safe(counted_crypto):
+    import threading
+
+    import app as app_module
+
+    barrier = threading.Barrier(8)
+    seen = []
+
+    def worker():
+        barrier.wait()
+        seen.append(app_module._get_crypto())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(counted_crypto) == 1
+    assert all(obj is seen[0] for obj in seen)
+
+
+def test_reload_rebuilds_only_when_credentials_change(counted_crypto, monkeypatch):
+    import app as app_module
+
+    first = app_module._get_crypto()
+    assert app_module.reload_crypto() is False
+    assert app_module._get_crypto() is first
+
+    monkeypatch.setenv("WEWORK_TOKEN", "t2")
+    assert app_module.reload_crypto() is True
+    assert app_module._get_crypto() is not first
+    assert len(counted_crypto) == 2
+
+
+def test_admin_reload_endpoint(counted_crypto, monkeypatch, app_client):
+    c = app_client
+    assert c.post("/admin/reload-config").status_code == 403  # disabled without ADMIN_TOKEN
+
+    monkeypatch.setenv("ADMIN_TOKEN", "s3cret")
+    assert c.post("/admin/reload-config", headers={"X-Admin-Token": "nope"}).status_code == 403
+    r = c.post("/admin/reload-config", headers={"Authorization": "Bearer s3cret"})
+    assert r.status_code == 200
+    assert r.get_json()["rebuilt"] is True
+
+    r = c.post("/admin/reload-config", headers={"X-Admin-Token": "s3cret"})
+    assert r.get_json()["rebuilt"] is False
+
+
+def test_sighup_triggers_reload(counted_crypto, monkeypatch):
+    import os
+    import signal
+    import time
+
+    import app as app_module
+
+    if not hasattr(signal, "SIGHUP"):
+        pytest.skip("SIGHUP not available")
+    previous = signal.getsignal(signal.SIGHUP)
+    try:
+        app_module._get_crypto()
+        monkeypatch.setenv("WEWORK_TOKEN", "rotated")
+        app_module.install_reload_signal()
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(200):
+            if len(counted_crypto) == 2:
+                break
+            time.sleep(0.01)
+        assert len(counted_crypto) == 2
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+
+def test_index_and_unknown_routes(app_client):
+    r = app_client.get("/")
+    assert r.status_code == 200
+    assert r.get_json()["callback"] == "/webhook/wework"
+    assert app_client.get("/nope").status_code == 404
+
+
+def test_malformed_body_is_not_a_server_error(client):
+    c, _ = client
+    r = c.post(
+        "/webhook/wework?msg_signature=bad-sign&timestamp=1&nonce=2",
+        data=b'{"encrypt":"\xff\xfe"}',
+        content_type="application/json",
+    )
+    assert r.status_code == 403
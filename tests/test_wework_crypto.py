@@ -0,0 +1,145 @@
+"""Tests for the in-repo WeCom callback crypto, cross-checked with the official code."""
+
+import base64
+import json
+
+import pytest
+
+from wework_crypto import (
+    WXBizMsgCrypt_DecryptAES_Error,
+    WXBizMsgCrypt_ParseJson_Error,
+    WXBizMsgCrypt_ValidateCorpid_Error,
+    WXBizMsgCrypt_ValidateSignature_Error,
+    FastWXBizJsonMsgCrypt,
+    FormatException,
+    _signature,
+    get_official_wxbiz_class,
+    get_wxbiz_class,
+)
+
+TOKEN = "QDG6eK"
+AES_KEY = "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C"
+RECEIVE_ID = "wx5823bf96d3bd56c7"
+
+MESSAGES = [
+    "",
+    "hello",
+    json.dumps({"MsgType": "text", "Content": "帮我查文档"}, ensure_ascii=False),
+    "x" * 31,
+    "y" * 32,
+    "长" * 700,  # ~2 KB of UTF-8
+]
+
+
+def _official_or_skip():
+    try:
+        return get_official_wxbiz_class()
+    except ImportError:
+        pytest.skip("official weworkapi_python source not checked out")
+
+
+@pytest.fixture
+def fast():
+    return FastWXBizJsonMsgCrypt(TOKEN, AES_KEY, RECEIVE_ID)
+
+
+def _callback_body(encrypted_reply: str) -> tuple[str, str, str, str]:
+    data = json.loads(encrypted_reply)
+    body = json.dumps({"encrypt": data["encrypt"]})
+    return body, data["msgsignature"], data["timestamp"], data["nonce"]
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_encrypt_decrypt_roundtrip(fast, message):
+    ret, encrypted = fast.EncryptMsg(message, "nonce-1", "1700000000")
+    assert ret == 0
+    body, signature, ts, nonce = _callback_body(encrypted)
+    assert ts == "1700000000" and nonce == "nonce-1"
+    ret, plain = fast.DecryptMsg(body, signature, ts, nonce)
+    assert ret == 0
+    assert plain == message
+
+
+def test_ciphertext_layout(fast):
+    from Crypto.Cipher import AES
+
+    ret, encrypted = fast.EncryptMsg("abc", "n", "1")
+    raw = AES.new(fast.key, AES.MODE_CBC, fast.key[:16]).decrypt(
+        base64.b64decode(json.loads(encrypted)["encrypt"])
+    )
+    assert len(raw) % 32 == 0
+    assert raw[:16].isdigit()
+    assert raw[16:20] == (3).to_bytes(4, "big")
+    assert raw[20:23] == b"abc"
+    assert raw[23:23 + len(RECEIVE_ID)] == RECEIVE_ID.encode()
+
+
+def test_chained_encryptor_matches_fresh_cbc(fast):
+    """Successive (and concurrent) encryptions each decrypt with a fresh IV-based cipher."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from Crypto.Cipher import AES
+
+    def encrypt(i):
+        return i, json.loads(fast.EncryptMsg(f"message {i}", "n", "1")[1])["encrypt"]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(encrypt, range(64)))
+    for i, encrypt_b64 in results:
+        raw = AES.new(fast.key, AES.MODE_CBC, fast.key[:16]).decrypt(base64.b64decode(encrypt_b64))
+        assert raw[20:20 + len(f"message {i}")] == f"message {i}".encode()
+
+
+def test_verify_url(fast):
+    _, encrypted = fast.EncryptMsg("echo-123", "n", "1")
+    echostr = json.loads(encrypted)["encrypt"]
+    signature = _signature(TOKEN, "2", "n2", echostr)
+    assert fast.VerifyURL(signature, "2", "n2", echostr) == (0, "echo-123")
+    assert fast.VerifyURL("bad", "2", "n2", echostr) == (WXBizMsgCrypt_ValidateSignature_Error, None)
+
+
+def test_error_codes(fast):
+    assert fast.DecryptMsg("not json", "s", "1", "n") == (WXBizMsgCrypt_ParseJson_Error, None)
+
+    _, encrypted = fast.EncryptMsg("hi", "n", "1")
+    body, signature, ts, nonce = _callback_body(encrypted)
+    assert fast.DecryptMsg(body, "bad", ts, nonce)[0] == WXBizMsgCrypt_ValidateSignature_Error
+
+    other = FastWXBizJsonMsgCrypt(TOKEN, AES_KEY, "another-corp")
+    assert other.DecryptMsg(body, signature, ts, nonce)[0] == WXBizMsgCrypt_ValidateCorpid_Error
+
+    garbage = base64.b64encode(b"short").decode()
+    sig = _signature(TOKEN, "1", "n", garbage)
+    assert fast.DecryptMsg(json.dumps({"encrypt": garbage}), sig, "1", "n")[0] == WXBizMsgCrypt_DecryptAES_Error
+
+
+def test_invalid_aes_key():
+    with pytest.raises(FormatException):
+        FastWXBizJsonMsgCrypt(TOKEN, "too-short", RECEIVE_ID)
+
+
+def test_get_wxbiz_class_defaults_to_fast(monkeypatch):
+    monkeypatch.delenv("WEWORK_CRYPTO_IMPL", raising=False)
+    assert get_wxbiz_class() is FastWXBizJsonMsgCrypt
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_cross_check_with_official(fast, message):
+    official = _official_or_skip()(TOKEN, AES_KEY, RECEIVE_ID)
+
+    # fast -> official
+    ret, encrypted = fast.EncryptMsg(message, "n1", "1700000001")
+    assert ret == 0
+    assert official.DecryptMsg(*_callback_body(encrypted)) == (0, message)
+
+    # official -> fast
+    ret, encrypted = official.EncryptMsg(message, "n2", "1700000002")
+    assert ret == 0
+    assert fast.DecryptMsg(*_callback_body(encrypted)) == (0, message)
+
+    # identical error codes on tampered input
+    body, signature, ts, nonce = _callback_body(encrypted)
+    assert fast.DecryptMsg(body, "bad", ts, nonce) == official.DecryptMsg(body, "bad", ts, nonce)
+    echostr = json.loads(body)["encrypt"]
+    sig = _signature(TOKEN, ts, nonce, echostr)
+    assert fast.VerifyURL(sig, ts, nonce, echostr) == official.VerifyURL(sig, ts, nonce, echostr)
@@ -1,6 +1,8 @@
 """Unit tests for wework_send.send_wework_text."""
 import pytest
 
+from http_transport import get_session
+
 
 @pytest.fixture
 def mock_post(monkeypatch):
@@ -12,7 +14,7 @@ def mock_post(monkeypatch):
             def raise_for_status(self): pass
             def json(self): return {"errcode": 0}
         return R()
-    monkeypatch.setattr("wework_send.requests.post", fake_post)
+    monkeypatch.setattr(get_session(), "post", fake_post)
     return calls
 
 
@@ -25,6 +27,13 @@ def test_send_wework_text_success(mock_post):
     assert mock_post[0]["json"]["text"]["content"] == "hello"
 
 
+def test_send_wework_text_truncates_on_utf8_byte_limit(mock_post):
+    from wework_send import send_wework_text
+    send_wework_text("https://example.com/hook", "中" * 2048)
+    content = mock_post[0]["json"]["text"]["content"]
+    assert content == "中" * 682  # 2046 bytes; the 683rd character would exceed 2048
+
+
 def test_send_wework_text_empty_content_returns_false(mock_post):
     from wework_send import send_wework_text
     ok = send_wework_text("https://example.com/hook", "")
@@ -46,7 +55,69 @@ def test_send_wework_text_api_errcode_nonzero(monkeypatch):
             def raise_for_status(self): pass
             def json(self): return {"errcode": 40001}
         return R()
-    monkeypatch.setattr("wework_send.requests.post", fake_post)
+    monkeypatch.setattr(get_session(), "post", fake_post)
     from wework_send import send_wework_text
     ok = send_wework_text("https://example.com/hook", "hi")
     assert ok is False
+
+
+def test_send_wework_app_text_against_fake_qyapi():
+    from tests.stubs import FakeQyapi
+    from wework_send import send_wework_app_text
+
+    with FakeQyapi() as qyapi:
+        ok = send_wework_app_text("lisi", 1000002, "hi", "wwcorp", "secret", qyapi.url)
+        assert ok is True
+        ok = send_wework_app_text("lisi", 1000002, "again", "wwcorp", "secret", qyapi.url)
+        assert ok is True
+        # token is cached between sends
+        assert len(qyapi.calls("GET", "/cgi-bin/gettoken")) == 1
+        sends = qyapi.calls("POST", "/cgi-bin/message/send")
+        assert sends[0]["json"]["touser"] == "lisi"
+        assert sends[0]["json"]["agentid"] == 1000002
+        assert qyapi.sent_texts() == ["hi", "again"]
+
+
+def test_send_wework_app_text_refreshes_expired_token():
+    from tests.stubs import FakeQyapi
+    from wework_send import send_wework_app_text
+
+    with FakeQyapi(send_errcodes=[42001]) as qyapi:
+        ok = send_wework_app_text("lisi", 1, "hi", "wwcorp", "secret2", qyapi.url)
+        assert ok is True
+        assert len(qyapi.calls("GET", "/cgi-bin/gettoken")) == 2
+        assert len(qyapi.calls("POST", "/cgi-bin/message/send")) == 2
+
+
+def test_slow_gettoken_does_not_block_other_apps(monkeypatch):
+    import threading
+    import time
+
+    import wework_send
+    from wework_send import get_access_token
+
+    monkeypatch.setitem(wework_send._token_cache, ("http://q", "wwcorp", "cached"), ("token-b", float("inf")))
+    started, release = threading.Event(), threading.Event()
+
+    def slow_get(url, *args, **kwargs):
+        started.set()
+        release.wait(5)
+        class R:
+            status_code = 200
+            def raise_for_status(self): pass
+            def json(self): return {"errcode": 0, "access_token": "token-a", "expires_in": 7200}
+        return R()
+
+    monkeypatch.setattr(get_session(), "get", slow_get)
+    fetch = threading.Thread(target=get_access_token, args=("wwcorp", "slow", "http://q"))
+    fetch.start()
+    try:
+        assert started.wait(5)
+        # the other app's cached token is served while the fetch is in flight
+        start = time.monotonic()
+        assert get_access_token("wwcorp", "cached", "http://q") == "token-b"
+        assert time.monotonic() - start < 1
+    finally:
+        release.set()
+        fetch.join(5)
+    assert get_access_token("wwcorp", "slow", "http://q") == "token-a"
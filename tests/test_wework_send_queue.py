@@ -0,0 +1,176 @@
+"""Tests for the rate-limited WeCom send queue, against a local fake qyapi."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from state_store import MemoryStateStore, RedisStateStore
+from tests.stubs import FakeQyapi
+from wework_send import post_wework_text
+from wework_send_queue import SendQueue, SharedTokenBucket, TokenBucket, webhook_destination
+
+
+@pytest.fixture
+def qyapi():
+    with FakeQyapi() as server:
+        yield server
+
+
+def _webhook(qyapi, key="k1"):
+    return f"{qyapi.url}/cgi-bin/webhook/send?key={key}"
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate_per_minute=60, burst=2, now=0.0)
+    assert bucket.take(0.0) and bucket.take(0.0)
+    assert not bucket.take(0.0)
+    assert bucket.wait_time(0.0) == pytest.approx(1.0)
+    assert bucket.wait_time(0.5) == pytest.approx(0.5)
+    assert bucket.take(1.0)
+
+
+def test_shared_token_bucket_allows_burst_then_rate():
+    clock = [100.0]
+    store = MemoryStateStore()
+    workers = [SharedTokenBucket(store, "chat", 60, 2, clock=lambda: clock[0]) for _ in range(2)]
+    assert workers[0].take(0) and workers[1].take(0)
+    assert not workers[0].take(0) and not workers[1].take(0)
+    assert workers[1].wait_time(0) == pytest.approx(1.0)
+    clock[0] += 0.5
+    assert workers[0].wait_time(0) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert workers[1].take(0)
+    assert not workers[0].take(0)
+
+
+def test_webhook_destination_uses_key():
+    assert webhook_destination("https://x/cgi-bin/webhook/send?key=abc") == "webhook:abc"
+
+
+def test_pending_messages_to_one_chat_are_coalesced(qyapi):
+    queue = SendQueue(rate_per_minute=60, burst=1)
+    url = _webhook(qyapi)
+    send = lambda text: post_wework_text(url, text)
+    try:
+        first = queue.submit(webhook_destination(url), "msg 0", send)
+        assert first.result(timeout=5)
+        # the only token is spent: these wait for the refill and go out together
+        with queue._cond:
+            futures = [queue.submit(webhook_destination(url), f"msg {i}", send) for i in range(1, 4)]
+        assert all(f.result(timeout=5) for f in futures)
+    finally:
+        queue.close()
+
+    texts = qyapi.sent_texts("/cgi-bin/webhook/send")
+    assert texts == ["msg 0", "msg 1\n\nmsg 2\n\nmsg 3"]
+    stats = queue.stats()
+    assert stats["sent"] == 4 and stats["sends"] == 2 and stats["coalesced"] == 2
+
+
+def test_coalescing_respects_byte_limit(qyapi):
+    queue = SendQueue(rate_per_minute=600, burst=1, max_bytes=30)
+    url = _webhook(qyapi)
+    send = lambda text: post_wework_text(url, text)
+    try:
+        with queue._cond:
+            futures = [queue.submit("chat", "中文消息", send) for _ in range(4)]  # 12 bytes each
+        assert all(f.result(timeout=5) for f in futures)
+    finally:
+        queue.close()
+    assert qyapi.sent_texts("/cgi-bin/webhook/send") == ["中文消息\n\n中文消息"] * 2
+
+
+def test_rate_limit_errcode_is_retried_with_backoff(qyapi):
+    qyapi.send_errcodes = [45009]
+    queue = SendQueue(rate_per_minute=6000, burst=5, backoff=0.05)
+    url = _webhook(qyapi)
+    try:
+        assert queue.submit("chat", "hello", lambda t: post_wework_text(url, t)).result(timeout=5)
+    finally:
+        queue.close()
+    assert qyapi.sent_texts("/cgi-bin/webhook/send") == ["hello", "hello"]
+    assert queue.stats()["retried"] == 1
+
+
+def test_gives_up_after_max_retries(qyapi):
+    qyapi.send_errcodes = [45009] * 5
+    queue = SendQueue(rate_per_minute=6000, burst=5, backoff=0.01, max_retries=2)
+    url = _webhook(qyapi)
+    try:
+        assert not queue.submit("chat", "hello", lambda t: post_wework_text(url, t)).result(timeout=5)
+    finally:
+        queue.close()
+    assert len(qyapi.calls("POST", "/cgi-bin/webhook/send")) == 3
+    assert queue.stats()["dropped_retries"] == 1
+
+
+def test_full_queue_drops_new_messages():
+    release = threading.Event()
+    queue = SendQueue(rate_per_minute=6000, burst=1, max_pending=2)
+
+    def slow_send(text):
+        release.wait(5)
+        return 0
+
+    try:
+        first = queue.submit("chat", "a", slow_send)
+        # wait until "a" is in flight, then fill the queue
+        for _ in range(100):
+            if queue.stats()["depth"] == 0:
+                break
+            threading.Event().wait(0.01)
+        waiting = [queue.submit("chat", t, slow_send) for t in ("b", "c")]
+        dropped = queue.submit("chat", "d", slow_send)
+        assert dropped.result(timeout=1) is False
+        release.set()
+        assert first.result(timeout=5) and all(f.result(timeout=5) for f in waiting)
+    finally:
+        release.set()
+        queue.close()
+    assert queue.stats()["dropped_full"] == 1
+
+
+def test_deliver_reply_goes_through_queue(monkeypatch, qyapi):
+    from async_reply import deliver_reply
+
+    monkeypatch.delenv("WEWORK_CORP_SECRET", raising=False)
+    monkeypatch.setenv("WEWORK_WEBHOOK_URL", _webhook(qyapi))
+    assert deliver_reply({"FromUserName": "u", "ChatId": "wrkSFfCgAA"}, "answer")
+    import wework_send_queue
+
+    assert wework_send_queue._queue.stats()["sent"] == 1
+    assert qyapi.sent_texts("/cgi-bin/webhook/send") == ["answer"]
+
+
+def test_private_reply_is_not_posted_to_the_group_webhook(monkeypatch, qyapi):
+    from async_reply import deliver_reply, deliver_reply_async
+
+    monkeypatch.delenv("WEWORK_CORP_SECRET", raising=False)
+    monkeypatch.setenv("WEWORK_WEBHOOK_URL", _webhook(qyapi))
+    assert not deliver_reply({"FromUserName": "u"}, "answer")
+    assert not asyncio.run(deliver_reply_async({"FromUserName": "u"}, "answer"))
+    assert qyapi.calls("POST", "/cgi-bin/webhook/send") == []
+
+
+def test_shared_rate_limit_spans_workers(fake_redis):
+    sent, lock = [], threading.Lock()
+
+    def send(text):
+        with lock:
+            sent.append((time.monotonic(), text))
+        return 0
+
+    # two workers, 600/min with a burst of 2: the third message must wait ~0.1s
+    workers = [SendQueue(rate_per_minute=600, burst=2, store=RedisStateStore(fake_redis.url)) for _ in range(2)]
+    try:
+        started = time.monotonic()
+        futures = [workers[i % 2].submit("chat", f"m{i}", send, coalesce=False) for i in range(4)]
+        assert all(f.result(timeout=5) for f in futures)
+    finally:
+        for worker in workers:
+            worker.close()
+    times = sorted(t - started for t, _ in sent)
+    assert len(times) == 4
+    assert times[2] >= 0.08 and times[3] >= 0.18
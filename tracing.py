@@ -0,0 +1,244 @@
+"""
+Request tracing with correlation IDs.
+
+Every WeCom callback runs inside ``start_trace()``, which assigns a trace ID
+held in a context variable. The ID follows the request through the OpenCode
+calls (``X-Trace-Id`` header on every outbound request, added by
+``http_transport``; suffix of new session titles) and the WeCom sends. asyncio
+tasks inherit it automatically; worker threads and the send queue pick it up
+through ``bind()`` / ``activate()``.
+
+``span()`` times one step (pipeline stages via ``metrics.stage``, HTTP hops via
+``metrics.http_call``). When ``TRACE_EXPORT_PATH`` is set, each finished span is
+appended to that file as one JSON object per line::
+
+    {"trace_id": "...", "span_id": "...", "parent_id": "...", "name": "opencode.message",
+     "start": 1760000000.123, "duration": 4.2, "thread": "...", "attrs": {...}}
+
+Spans of one callback share ``trace_id``, and ``parent_id`` links them into a
+tree for flamegraph-style tools. Without an export path only the trace ID is
+propagated and spans cost nothing.
+"""
+
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from config import get_trace_export_path
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "X-Trace-Id"
+
+# (trace_id, span_id of the innermost open span or None)
+_current: ContextVar[tuple[str, str | None] | None] = ContextVar("trace", default=None)
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def new_id() -> str:
+    return secrets.token_hex(8)
+
+
+class JsonLinesExporter:
+    """Append finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # line buffered: a crash loses at most the span being written
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def export(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def get_exporter() -> JsonLinesExporter | None:
+    """Exporter for ``TRACE_EXPORT_PATH``; None when span export is disabled."""
+    global _exporter
+    path = get_trace_export_path()
+    exporter = _exporter
+    if exporter is not None and exporter.path == path:
+        return exporter
+    with _exporter_lock:
+        if _exporter is not None and _exporter.path != path:
+            _exporter.close()
+            _exporter = None
+        if path and _exporter is None:
+            try:
+                _exporter = JsonLinesExporter(path)
+            except OSError as e:
+                logger.warning("[Trace] cannot open %s: %s", path, e)
+                return None
+        return _exporter
+
+
+class Span:
+    """A timed step of the current trace; ``set()`` adds attributes."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start", "attrs")
+
+    def __init__(self, trace_id, span_id, parent_id, name, attrs):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.attrs = attrs
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    trace_id = span_id = None
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+# the span yielded by the innermost span() of this context, for annotate()
+_current_span: ContextVar[Span | None] = ContextVar("trace_span", default=None)
+
+
+def current_trace_id() -> str | None:
+    ctx = _current.get()
+    return ctx[0] if ctx is not None else None
+
+
+def current():
+    """Opaque handle of the current trace position, for ``activate()`` in another thread."""
+    return _current.get(), _current_span.get()
+
+
+@contextmanager
+def activate(handle):
+    """Make a handle from ``current()`` the current trace position; no-op for None."""
+    if handle is None or handle[0] is None:
+        yield
+        return
+    token = _current.set(handle[0])
+    span_token = _current_span.set(handle[1])
+    try:
+        yield
+    finally:
+        _current_span.reset(span_token)
+        _current.reset(token)
+
+
+def bind(fn):
+    """Wrap ``fn`` so it runs in the current trace, e.g. as a thread target."""
+    handle = current()
+    if handle[0] is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with activate(handle):
+            return fn(*args, **kwargs)
+
+    return run
+
+
+@contextmanager
+def start_trace(trace_id: str | None = None):
+    """Start a new trace (e.g. one per callback); spans opened inside belong to it."""
+    token = _current.set((trace_id or new_id(), None))
+    span_token = _current_span.set(None)
+    try:
+        yield
+    finally:
+        _current_span.reset(span_token)
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time a step of the current trace. Yields an object with ``set(**attrs)``;
+    outside a trace, or with export disabled, nothing is recorded.
+    """
+    ctx = _current.get()
+    exporter = get_exporter() if ctx is not None else None
+    if exporter is None:
+        yield _NOOP
+        return
+    s = Span(ctx[0], new_id(), ctx[1], name, attrs)
+    token = _current.set((ctx[0], s.span_id))
+    span_token = _current_span.set(s)
+    started = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        _current_span.reset(span_token)
+        _current.reset(token)
+        _export(exporter, s, duration)
+
+
+def record(name: str, duration: float, **attrs) -> None:
+    """Record an already measured step that ended now (e.g. queue wait)."""
+    ctx = _current.get()
+    exporter = get_exporter() if ctx is not None else None
+    if exporter is None:
+        return
+    s = Span(ctx[0], new_id(), ctx[1], name, attrs)
+    s.start -= duration
+    _export(exporter, s, duration)
+
+
+def _export(exporter: JsonLinesExporter, s: Span, duration: float) -> None:
+    try:
+        exporter.export(
+            {
+                "trace_id": s.trace_id,
+                "span_id": s.span_id,
+                "parent_id": s.parent_id,
+                "name": s.name,
+                "start": round(s.start, 6),
+                "duration": round(duration, 6),
+                "thread": threading.current_thread().name,
+                "attrs": s.attrs,
+            }
+        )
+    except (OSError, ValueError) as e:
+        logger.warning("[Trace] export failed: %s", e)
+
+
+def annotate(**attrs) -> None:
+    """Add attributes (msg_id, session_id, ...) to the innermost open span."""
+    s = _current_span.get()
+    if s is not None:
+        s.set(**attrs)
+
+
+def inject(headers) -> None:
+    """Add ``X-Trace-Id`` to an outgoing request's headers when a trace is active."""
+    trace_id = current_trace_id()
+    if trace_id is not None:
+        headers[TRACE_HEADER] = trace_id
+
+
+def session_title(title: str) -> str:
+    """OpenCode session title carrying the trace ID that created the session."""
+    trace_id = current_trace_id()
+    return f"{title} [{trace_id}]" if trace_id else title
@@ -1,11 +1,161 @@
-"""Load WXBizJsonMsgCrypt directly from official weworkapi_python source tree."""
+"""
+WeCom callback crypto.
+
+``FastWXBizJsonMsgCrypt`` is an in-repo, API-compatible replacement for the
+official ``WXBizJsonMsgCrypt`` (``VerifyURL`` / ``DecryptMsg`` / ``EncryptMsg``
+with the same return codes). It decodes the AES key and expands the AES key
+schedule once per instance and works on bytes end to end:
+
+- CBC decryption is done as one ECB pass XOR-ed with the shifted ciphertext,
+  reusing a single ECB cipher object.
+- CBC encryption reuses one chained CBC cipher object. Its chaining value
+  after the previous message is folded into the first (random) block, so the
+  output is the same as a fresh cipher started from the fixed IV.
+
+The official implementation from ``weworkapi_python/callback_json_python3``
+can still be selected with ``WEWORK_CRYPTO_IMPL=official``.
+"""
 
 from __future__ import annotations
 
+import base64
+import hashlib
 import importlib
+import json
+import os
+import secrets
+import struct
 import sys
+import threading
+import time
 from pathlib import Path
 
+from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+# Return codes, identical to the official ierror module.
+WXBizMsgCrypt_OK = 0
+WXBizMsgCrypt_ValidateSignature_Error = -40001
+WXBizMsgCrypt_ParseJson_Error = -40002
+WXBizMsgCrypt_ComputeSignature_Error = -40003
+WXBizMsgCrypt_IllegalAesKey = -40004
+WXBizMsgCrypt_ValidateCorpid_Error = -40005
+WXBizMsgCrypt_EncryptAES_Error = -40006
+WXBizMsgCrypt_DecryptAES_Error = -40007
+WXBizMsgCrypt_IllegalBuffer = -40008
+
+# WeCom pads to 32-byte blocks (not the AES block size of 16).
+_PAD_BLOCK = 32
+_PADDINGS = [bytes([n]) * n for n in range(_PAD_BLOCK + 1)]
+_LEN = struct.Struct(">I")
+
+_RESPONSE_TEMPLATE = """{
+        "encrypt": "%s",
+        "msgsignature": "%s",
+        "timestamp": "%s",
+        "nonce": "%s"
+    }"""
+
+
+class FormatException(Exception):
+    pass
+
+
+def _signature(token: str, timestamp: str, nonce: str, encrypt: str) -> str:
+    parts = sorted((token, str(timestamp), str(nonce), encrypt))
+    return hashlib.sha1("".join(parts).encode()).hexdigest()
+
+
+class FastWXBizJsonMsgCrypt:
+    """Drop-in replacement for the official WXBizJsonMsgCrypt."""
+
+    def __init__(self, sToken: str, sEncodingAESKey: str, sReceiveId: str):
+        try:
+            self.key = base64.b64decode(sEncodingAESKey + "=")
+            assert len(self.key) == 32
+        except Exception:
+            raise FormatException("[error]: EncodingAESKey unvalid !")
+        self.m_sToken = sToken
+        self.m_sReceiveId = sReceiveId
+        self._iv = self.key[:16]
+        self._receive_id = sReceiveId.encode()
+        self._ecb = AES.new(self.key, AES.MODE_ECB)
+        self._cbc = AES.new(self.key, AES.MODE_CBC, self._iv)
+        self._chain = self._iv
+        self._encrypt_lock = threading.Lock()
+
+    def _decrypt(self, encrypt: str) -> tuple[int, str | None]:
+        try:
+            cipher_bytes = base64.b64decode(encrypt)
+            # CBC: P[i] = D(C[i]) ^ C[i-1], with C[-1] = IV
+            plain = strxor(self._ecb.decrypt(cipher_bytes), self._iv + cipher_bytes[:-16])
+        except Exception:
+            return WXBizMsgCrypt_DecryptAES_Error, None
+        try:
+            view = memoryview(plain)
+            pad = plain[-1]
+            # 16 random bytes | 4-byte big-endian length | message | receive id | padding
+            (msg_len,) = _LEN.unpack_from(view, 16)
+            end = 20 + msg_len
+            receive_id = view[end: len(plain) - pad]
+            content = str(view[20:end], "utf-8")
+        except Exception:
+            return WXBizMsgCrypt_IllegalBuffer, None
+        if receive_id != self._receive_id:
+            return WXBizMsgCrypt_ValidateCorpid_Error, None
+        return WXBizMsgCrypt_OK, content
+
+    def _encrypt(self, text: str) -> tuple[int, str | None]:
+        body = text.encode()
+        # 16 ASCII digits, same shape as the official random prefix
+        prefix = str(secrets.randbelow(9 * 10**15) + 10**15).encode()
+        raw = b"".join((prefix, _LEN.pack(len(body)), body, self._receive_id))
+        raw += _PADDINGS[_PAD_BLOCK - len(raw) % _PAD_BLOCK]
+        try:
+            with self._encrypt_lock:
+                # The chained cipher XORs the first block with the previous
+                # ciphertext block; pre-XOR it so the result matches IV chaining.
+                first = strxor(strxor(raw[:16], self._iv), self._chain)
+                ciphertext = self._cbc.encrypt(first + raw[16:])
+                self._chain = ciphertext[-16:]
+        except Exception:
+            return WXBizMsgCrypt_EncryptAES_Error, None
+        return WXBizMsgCrypt_OK, base64.b64encode(ciphertext).decode()
+
+    def VerifyURL(self, sMsgSignature, sTimeStamp, sNonce, sEchoStr):
+        try:
+            signature = _signature(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
+        except Exception:
+            return WXBizMsgCrypt_ComputeSignature_Error, None
+        if signature != sMsgSignature:
+            return WXBizMsgCrypt_ValidateSignature_Error, None
+        return self._decrypt(sEchoStr)
+
+    def EncryptMsg(self, sReplyMsg, sNonce, timestamp=None):
+        ret, encrypt = self._encrypt(sReplyMsg)
+        if ret != 0:
+            return ret, None
+        if timestamp is None:
+            timestamp = str(int(time.time()))
+        try:
+            signature = _signature(self.m_sToken, timestamp, sNonce, encrypt)
+        except Exception:
+            return WXBizMsgCrypt_ComputeSignature_Error, None
+        return ret, _RESPONSE_TEMPLATE % (encrypt, signature, timestamp, sNonce)
+
+    def DecryptMsg(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
+        try:
+            encrypt = json.loads(sPostData)["encrypt"]
+        except Exception:
+            return WXBizMsgCrypt_ParseJson_Error, None
+        try:
+            signature = _signature(self.m_sToken, sTimeStamp, sNonce, encrypt)
+        except Exception:
+            return WXBizMsgCrypt_ComputeSignature_Error, None
+        if signature != sMsgSignature:
+            return WXBizMsgCrypt_ValidateSignature_Error, None
+        return self._decrypt(encrypt)
+
 
 def _load_from_local_repo():
     """Load from ./weworkapi_python/callback_json_python3."""
@@ -23,7 +173,13 @@ def _load_from_local_repo():
     return mod.WXBizJsonMsgCrypt
 
 
-def get_wxbiz_class():
+def get_official_wxbiz_class():
     return _load_from_local_repo()
 
-__all__ = ["get_wxbiz_class"]
+
+def get_wxbiz_class():
+    if os.environ.get("WEWORK_CRYPTO_IMPL", "fast").strip().lower() == "official":
+        return get_official_wxbiz_class()
+    return FastWXBizJsonMsgCrypt
+
+__all__ = ["FastWXBizJsonMsgCrypt", "get_official_wxbiz_class", "get_wxbiz_class"]
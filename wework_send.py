@@ -1,13 +1,41 @@
 """
-Send text messages to Enterprise WeChat group via webhook.
-URL format: https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=KEY
-Rate limit: 20 messages per minute per robot.
+Send text messages to Enterprise WeChat.
+
+- Group robot webhook: https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=KEY
+  Rate limit: 20 messages per minute per robot.
+- Self-built app active send: /cgi-bin/message/send?access_token=TOKEN
+  Used by the async reply mode to push answers back to the user.
+
+The ``*_async`` variants use the httpx client of the ASGI server.
+
+Content over 2048 UTF-8 bytes is truncated on a character boundary; long
+replies should be cut with ``reply_segmenter.split_reply`` first.
 """
 import logging
+import threading
+import time
+
+import httpx
 import requests
 
+import metrics
+from http_transport import get_async_client, get_async_timeout, get_session, get_timeout
+from reply_segmenter import MAX_TEXT_BYTES, truncate_utf8
+
 logger = logging.getLogger(__name__)
 
+# errcodes meaning the cached access_token is no longer usable
+_TOKEN_EXPIRED_ERRCODES = (40014, 42001)
+# errcodes returned when a robot / app exceeds its send frequency limit
+RATE_LIMIT_ERRCODES = (45009,)
+# pseudo errcode for failures that never got an API answer
+SEND_FAILED = -1
+
+_token_lock = threading.Lock()
+_token_cache: dict[tuple[str, str, str], tuple[str, float]] = {}
+# serialises gettoken per app; ``_token_lock`` is never held across HTTP calls
+_fetch_locks: dict[tuple[str, str, str], threading.Lock] = {}
+
 
 def send_wework_text(webhook_url: str, content: str) -> bool:
     """
@@ -17,6 +45,210 @@ def send_wework_text(webhook_url: str, content: str) -> bool:
     :param content: Message content (UTF-8, max 2048 bytes).
     :return: True if sent successfully, False otherwise.
     """
+    return post_wework_text(webhook_url, content) == 0
+
+
+def post_wework_text(webhook_url: str, content: str) -> int:
+    """``send_wework_text`` returning the API errcode (``SEND_FAILED`` for local/transport errors)."""
+    if not webhook_url or not webhook_url.strip():
+        logger.error("[Wework] webhook_url is empty")
+        return SEND_FAILED
+    if not content or not str(content).strip():
+        logger.warning("[Wework] content is empty, not sending")
+        return SEND_FAILED
+
+    payload = {"msgtype": "text", "text": {"content": truncate_utf8(str(content), MAX_TEXT_BYTES)}}
+    try:
+        with metrics.http_call("wework", "webhook.send") as call:
+            resp = get_session().post(
+                webhook_url.strip(),
+                json=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=get_timeout("wework.send"),
+            )
+            call.status = resp.status_code
+        resp.raise_for_status()
+        data = resp.json()
+    except requests.exceptions.RequestException as e:
+        logger.exception("[Wework] send failed: %s", e)
+        return SEND_FAILED
+    errcode = data.get("errcode", SEND_FAILED)
+    metrics.WEWORK_ERRCODES.inc(api="webhook.send", errcode=errcode)
+    if errcode != 0:
+        logger.error("[Wework] API error: %s", data)
+    return errcode
+
+
+def _cached_token(cache_key: tuple[str, str, str]) -> str | None:
+    with _token_lock:
+        cached = _token_cache.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+    return None
+
+
+def _store_token(cache_key: tuple[str, str, str], token: str, expires_in: int) -> None:
+    # refresh a little before the server-side expiry
+    with _token_lock:
+        _token_cache[cache_key] = (token, time.monotonic() + max(expires_in - 300, 60))
+
+
+def _fetch_lock(cache_key: tuple[str, str, str]) -> threading.Lock:
+    with _token_lock:
+        return _fetch_locks.setdefault(cache_key, threading.Lock())
+
+
+def get_access_token(
+    corp_id: str, corp_secret: str, api_base: str, force_refresh: bool = False
+) -> str | None:
+    """
+    Return a cached access_token for the self-built app, fetching a new one when needed.
+
+    :param corp_id: CorpID of the enterprise.
+    :param corp_secret: Secret of the self-built app.
+    :param api_base: API root, e.g. https://qyapi.weixin.qq.com
+    :param force_refresh: Ignore the cached token (used after a token-expired errcode).
+    :return: access_token, or None if it could not be obtained.
+    """
+    cache_key = (api_base, corp_id, corp_secret)
+    if not force_refresh:
+        token = _cached_token(cache_key)
+        if token:
+            return token
+    # only callers of the same app wait for the fetch; other apps keep reading the cache
+    with _fetch_lock(cache_key):
+        if not force_refresh:
+            token = _cached_token(cache_key)
+            if token:
+                return token
+        try:
+            with metrics.http_call("wework", "gettoken") as call:
+                resp = get_session().get(
+                    f"{api_base}/cgi-bin/gettoken",
+                    params={"corpid": corp_id, "corpsecret": corp_secret},
+                    timeout=get_timeout("wework.token"),
+                )
+                call.status = resp.status_code
+            resp.raise_for_status()
+            data = resp.json()
+        except requests.exceptions.RequestException as e:
+            logger.error("[Wework] gettoken failed: %s", e)
+            return None
+        token = data.get("access_token")
+        if data.get("errcode", 0) != 0 or not token:
+            logger.error("[Wework] gettoken error: %s", data)
+            return None
+        _store_token(cache_key, token, int(data.get("expires_in", 7200)))
+        return token
+
+
+def send_wework_app_text(
+    to_user: str,
+    agent_id,
+    content: str,
+    corp_id: str,
+    corp_secret: str,
+    api_base: str = "https://qyapi.weixin.qq.com",
+) -> bool:
+    """
+    Actively send a text message to a user through the self-built app.
+
+    :param to_user: UserID of the receiver (FromUserName of the callback).
+    :param agent_id: AgentID of the self-built app.
+    :param content: Message content (UTF-8, max 2048 bytes).
+    :return: True if sent successfully, False otherwise.
+    """
+    return post_wework_app_text(to_user, agent_id, content, corp_id, corp_secret, api_base) == 0
+
+
+def post_wework_app_text(
+    to_user: str,
+    agent_id,
+    content: str,
+    corp_id: str,
+    corp_secret: str,
+    api_base: str = "https://qyapi.weixin.qq.com",
+) -> int:
+    """``send_wework_app_text`` returning the API errcode (``SEND_FAILED`` for local/transport errors)."""
+    if not to_user:
+        logger.error("[Wework] to_user is empty")
+        return SEND_FAILED
+    if not content or not str(content).strip():
+        logger.warning("[Wework] content is empty, not sending")
+        return SEND_FAILED
+    if not corp_id or not corp_secret:
+        logger.error("[Wework] corp_id / corp_secret not configured")
+        return SEND_FAILED
+
+    payload = {
+        "touser": to_user,
+        "msgtype": "text",
+        "agentid": agent_id,
+        "text": {"content": truncate_utf8(str(content), MAX_TEXT_BYTES)},
+    }
+    for attempt in range(2):
+        token = get_access_token(corp_id, corp_secret, api_base, force_refresh=attempt > 0)
+        if not token:
+            return SEND_FAILED
+        try:
+            with metrics.http_call("wework", "message.send") as call:
+                resp = get_session().post(
+                    f"{api_base}/cgi-bin/message/send",
+                    params={"access_token": token},
+                    json=payload,
+                    headers={"Content-Type": "application/json"},
+                    timeout=get_timeout("wework.send"),
+                )
+                call.status = resp.status_code
+            resp.raise_for_status()
+            data = resp.json()
+        except requests.exceptions.RequestException as e:
+            logger.exception("[Wework] app send failed: %s", e)
+            return SEND_FAILED
+        errcode = data.get("errcode", SEND_FAILED)
+        metrics.WEWORK_ERRCODES.inc(api="message.send", errcode=errcode)
+        if errcode == 0:
+            return 0
+        if errcode in _TOKEN_EXPIRED_ERRCODES and attempt == 0:
+            logger.info("[Wework] access_token expired, refreshing")
+            continue
+        logger.error("[Wework] app send API error: %s", data)
+        return errcode
+    return SEND_FAILED
+
+
+async def get_access_token_async(
+    corp_id: str, corp_secret: str, api_base: str, force_refresh: bool = False
+) -> str | None:
+    """Async variant of ``get_access_token``; shares its token cache."""
+    cache_key = (api_base, corp_id, corp_secret)
+    if not force_refresh:
+        token = _cached_token(cache_key)
+        if token:
+            return token
+    try:
+        with metrics.http_call("wework", "gettoken") as call:
+            resp = await get_async_client().get(
+                f"{api_base}/cgi-bin/gettoken",
+                params={"corpid": corp_id, "corpsecret": corp_secret},
+                timeout=get_async_timeout("wework.token"),
+            )
+            call.status = resp.status_code
+        resp.raise_for_status()
+        data = resp.json()
+    except httpx.HTTPError as e:
+        logger.error("[Wework] gettoken failed: %s", e)
+        return None
+    token = data.get("access_token")
+    if data.get("errcode", 0) != 0 or not token:
+        logger.error("[Wework] gettoken error: %s", data)
+        return None
+    _store_token(cache_key, token, int(data.get("expires_in", 7200)))
+    return token
+
+
+async def send_wework_text_async(webhook_url: str, content: str) -> bool:
+    """Async variant of ``send_wework_text``."""
     if not webhook_url or not webhook_url.strip():
         logger.error("[Wework] webhook_url is empty")
         return False
@@ -24,20 +256,77 @@ def send_wework_text(webhook_url: str, content: str) -> bool:
         logger.warning("[Wework] content is empty, not sending")
         return False
 
-    payload = {"msgtype": "text", "text": {"content": str(content)[:2048]}}
+    payload = {"msgtype": "text", "text": {"content": truncate_utf8(str(content), MAX_TEXT_BYTES)}}
     try:
-        resp = requests.post(
-            webhook_url.strip(),
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=10,
-        )
+        with metrics.http_call("wework", "webhook.send") as call:
+            resp = await get_async_client().post(
+                webhook_url.strip(), json=payload, timeout=get_async_timeout("wework.send")
+            )
+            call.status = resp.status_code
         resp.raise_for_status()
         data = resp.json()
-        if data.get("errcode") != 0:
-            logger.error("[Wework] API error: %s", data)
+    except httpx.HTTPError as e:
+        logger.error("[Wework] send failed: %s", e)
+        return False
+    metrics.WEWORK_ERRCODES.inc(api="webhook.send", errcode=data.get("errcode"))
+    if data.get("errcode") != 0:
+        logger.error("[Wework] API error: %s", data)
+        return False
+    return True
+
+
+async def send_wework_app_text_async(
+    to_user: str,
+    agent_id,
+    content: str,
+    corp_id: str,
+    corp_secret: str,
+    api_base: str = "https://qyapi.weixin.qq.com",
+) -> bool:
+    """Async variant of ``send_wework_app_text``."""
+    if not to_user:
+        logger.error("[Wework] to_user is empty")
+        return False
+    if not content or not str(content).strip():
+        logger.warning("[Wework] content is empty, not sending")
+        return False
+    if not corp_id or not corp_secret:
+        logger.error("[Wework] corp_id / corp_secret not configured")
+        return False
+
+    payload = {
+        "touser": to_user,
+        "msgtype": "text",
+        "agentid": agent_id,
+        "text": {"content": truncate_utf8(str(content), MAX_TEXT_BYTES)},
+    }
+    for attempt in range(2):
+        token = await get_access_token_async(
+            corp_id, corp_secret, api_base, force_refresh=attempt > 0
+        )
+        if not token:
             return False
-        return True
-    except requests.exceptions.RequestException as e:
-        logger.exception("[Wework] send failed: %s", e)
+        try:
+            with metrics.http_call("wework", "message.send") as call:
+                resp = await get_async_client().post(
+                    f"{api_base}/cgi-bin/message/send",
+                    params={"access_token": token},
+                    json=payload,
+                    timeout=get_async_timeout("wework.send"),
+                )
+                call.status = resp.status_code
+            resp.raise_for_status()
+            data = resp.json()
+        except httpx.HTTPError as e:
+            logger.error("[Wework] app send failed: %s", e)
+            return False
+        errcode = data.get("errcode")
+        metrics.WEWORK_ERRCODES.inc(api="message.send", errcode=errcode)
+        if errcode == 0:
+            return True
+        if errcode in _TOKEN_EXPIRED_ERRCODES and attempt == 0:
+            logger.info("[Wework] access_token expired, refreshing")
+            continue
+        logger.error("[Wework] app send API error: %s", data)
         return False
+    return False
@@ -0,0 +1,419 @@
+"""
+Rate-limited outbound queue for WeCom sends.
+
+Group robots accept 20 messages per minute per webhook key; going faster
+returns errcode 45009 and the message is lost. ``SendQueue`` keeps one token
+bucket and one bounded FIFO per destination (webhook key, or app + user):
+
+- a message is sent only when its destination has a token;
+- messages that piled up for the same destination are coalesced into one
+  send (joined by a blank line, within the 2048-byte text limit); the
+  numbered parts of one long reply are never merged;
+- rate-limit errcodes are retried with exponential backoff, the messages
+  staying at the head of their queue;
+- at most one send per destination is in flight, so order is preserved.
+
+With ``WEWORK_STATE_STORE`` configured the token buckets are kept in the
+shared store, so the per-destination limit holds across all workers; the
+queues themselves stay per worker.
+
+Callers block on (or await) a future that resolves to True once the message
+went out. All parts of a long reply are queued at once, so they go out
+back to back without a round trip to the caller in between.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from config import (
+    get_wework_send_backoff,
+    get_wework_send_burst,
+    get_wework_send_max_retries,
+    get_wework_send_queue_size,
+    get_wework_send_rate_per_minute,
+    get_wework_send_wait_seconds,
+)
+from reply_segmenter import MAX_TEXT_BYTES
+from state_store import StateStoreError, get_state_store, is_shared
+import tracing
+from wework_send import RATE_LIMIT_ERRCODES, post_wework_app_text, post_wework_text
+
+logger = logging.getLogger(__name__)
+
+_SEPARATOR = "\n\n"
+
+
+class TokenBucket:
+    """Classic token bucket: ``burst`` tokens, refilled at ``rate_per_minute``."""
+
+    def __init__(self, rate_per_minute: float, burst: int, now: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SharedTokenBucket:
+    """
+    ``TokenBucket`` kept in the shared state store, so every worker draws on
+    the same per-destination budget.
+
+    Implemented as GCRA: the store holds the destination's theoretical
+    arrival time, advanced by one emission interval per send. Uses wall-clock
+    time, which must be in sync across hosts. Fails open when the store is
+    unreachable.
+    """
+
+    def __init__(self, store, key: str, rate_per_minute: float, burst: int, clock=time.time):
+        self.store = store
+        self.key = "ratelimit:" + key
+        self.interval = 60.0 / rate_per_minute
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self._clock = clock
+
+    def _wait(self, tat: float, now: float) -> float:
+        return max(0.0, max(tat, now) - now - self.tolerance)
+
+    def wait_time(self, now: float) -> float:
+        try:
+            current = self.store.get(self.key)
+        except StateStoreError as e:
+            logger.warning("[Wework] shared rate limit unavailable, sending anyway: %s", e)
+            return 0.0
+        return self._wait(float(current or 0), self._clock())
+
+    def take(self, now: float) -> bool:
+        def advance(current):
+            now = self._clock()
+            tat = max(float(current or 0), now)
+            if self._wait(tat, now) > 0:
+                return None, False
+            return repr(tat + self.interval), True
+
+        try:
+            return self.store.update(self.key, advance, ttl=self.tolerance + self.interval)
+        except StateStoreError as e:
+            logger.warning("[Wework] shared rate limit unavailable, sending anyway: %s", e)
+            return True
+
+    def full(self, now: float) -> bool:
+        # the state lives in the store, so an idle destination can always be dropped locally
+        return True
+
+
+class _Destination:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.pending: deque = deque()  # (text, future, send, coalesce)
+        self.busy = False
+        self.not_before = 0.0
+        self.attempts = 0
+
+
+class SendQueue:
+    """Per-destination token buckets plus bounded queues, drained by one scheduler thread."""
+
+    def __init__(
+        self,
+        rate_per_minute: float = 20.0,
+        burst: int = 3,
+        max_pending: int = 100,
+        max_retries: int = 3,
+        backoff: float = 2.0,
+        workers: int = 4,
+        max_bytes: int = MAX_TEXT_BYTES,
+        clock=time.monotonic,
+        store=None,
+    ):
+        """
+        :param store: Shared state store; when given, the token buckets live there
+            and are shared by every worker.
+        """
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._store = store
+        self._destinations: dict[str, _Destination] = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wework-send")
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self._counters = {
+            "submitted": 0,
+            "sent": 0,
+            "sends": 0,
+            "coalesced": 0,
+            "retried": 0,
+            "failed": 0,
+            "dropped_full": 0,
+            "dropped_retries": 0,
+        }
+
+    def submit(self, key: str, text: str, send, coalesce: bool = True) -> Future:
+        """
+        Queue ``text`` for destination ``key``.
+
+        :param send: ``send(text) -> errcode`` performing the actual API call.
+        :param coalesce: Whether this message may be merged with its neighbours.
+        :return: Future resolving to True when sent, False when dropped or failed.
+        """
+        future: Future = Future()
+        with self._cond:
+            self._start_locked()
+            dest = self._destinations.get(key)
+            if dest is None:
+                dest = _Destination(self._bucket(key))
+                self._destinations[key] = dest
+            if len(dest.pending) >= self.max_pending:
+                self._counters["dropped_full"] += 1
+                logger.warning("[Wework] send queue for %s full, dropping message", key)
+                future.set_result(False)
+                return future
+            dest.pending.append((text, future, send, coalesce))
+            self._counters["submitted"] += 1
+            self._cond.notify()
+        return future
+
+    def _bucket(self, key: str):
+        if self._store is not None:
+            return SharedTokenBucket(self._store, key, self.rate_per_minute, self.burst)
+        return TokenBucket(self.rate_per_minute, self.burst, self._clock())
+
+    def _start_locked(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="wework-send-scheduler", daemon=True)
+            self._thread.start()
+
+    def _take_batch(self, dest: _Destination) -> list:
+        """Pop the head message plus following ones that fit in one text message."""
+        batch = [dest.pending.popleft()]
+        size = len(batch[0][0].encode("utf-8"))
+        while dest.pending and batch[-1][3] and dest.pending[0][3]:
+            extra = len(dest.pending[0][0].encode("utf-8")) + len(_SEPARATOR)
+            if size + extra > self.max_bytes:
+                break
+            batch.append(dest.pending.popleft())
+            size += extra
+        return batch
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._closed:
+                now = self._clock()
+                timeout = None
+                for key, dest in list(self._destinations.items()):
+                    if dest.busy:
+                        continue
+                    if not dest.pending:
+                        if dest.bucket.full(now):
+                            del self._destinations[key]
+                        continue
+                    wait = max(dest.not_before - now, dest.bucket.wait_time(now))
+                    if wait <= 0 and not dest.bucket.take(now):
+                        # a shared bucket can be drained by another worker in between
+                        wait = max(dest.bucket.wait_time(now), 0.01)
+                    if wait > 0:
+                        timeout = wait if timeout is None else min(timeout, wait)
+                        continue
+                    dest.busy = True
+                    self._executor.submit(self._send_batch, key, dest, self._take_batch(dest))
+                self._cond.wait(timeout)
+
+    def _send_batch(self, key: str, dest: _Destination, batch: list) -> None:
+        text = _SEPARATOR.join(item[0] for item in batch)
+        try:
+            errcode = batch[0][2](text)
+        except Exception:
+            logger.exception("[Wework] queued send to %s failed", key)
+            errcode = None
+        results = []
+        with self._cond:
+            dest.busy = False
+            self._counters["sends"] += 1
+            if errcode == 0:
+                dest.attempts = 0
+                self._counters["sent"] += len(batch)
+                self._counters["coalesced"] += len(batch) - 1
+                results = [(item[1], True) for item in batch]
+            elif errcode in RATE_LIMIT_ERRCODES and dest.attempts < self.max_retries:
+                dest.attempts += 1
+                dest.not_before = self._clock() + self.backoff * 2 ** (dest.attempts - 1)
+                self._counters["retried"] += 1
+                logger.warning(
+                    "[Wework] rate limited on %s (errcode %s), retry %d in %.1fs",
+                    key, errcode, dest.attempts, dest.not_before - self._clock(),
+                )
+                dest.pending.extendleft(reversed(batch))
+            else:
+                name = "dropped_retries" if errcode in RATE_LIMIT_ERRCODES else "failed"
+                dest.attempts = 0
+                self._counters[name] += len(batch)
+                results = [(item[1], False) for item in batch]
+            self._cond.notify()
+        for future, ok in results:
+            future.set_result(ok)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "depth": sum(len(d.pending) for d in self._destinations.values()),
+                "destinations": len(self._destinations),
+                "rate_per_minute": self.rate_per_minute,
+                **self._counters,
+            }
+
+
+_queue: SendQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_send_queue() -> SendQueue:
+    """Process-wide send queue, built from the environment on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = SendQueue(
+                rate_per_minute=get_wework_send_rate_per_minute(),
+                burst=get_wework_send_burst(),
+                max_pending=get_wework_send_queue_size(),
+                max_retries=get_wework_send_max_retries(),
+                backoff=get_wework_send_backoff(),
+                store=get_state_store() if is_shared() else None,
+            )
+        return _queue
+
+
+def webhook_destination(webhook_url: str) -> str:
+    """Rate-limit key of a robot webhook: its ``key`` parameter."""
+    url = (webhook_url or "").strip()
+    key = parse_qs(urlparse(url).query).get("key", [""])[0]
+    return f"webhook:{key or url}"
+
+
+def _parts(content) -> list[str]:
+    if isinstance(content, (list, tuple)):
+        return [str(part) for part in content if part and str(part).strip()]
+    return [str(content)] if content and str(content).strip() else []
+
+
+def _submit(key: str, parts: list[str], send) -> list[Future]:
+    queue = get_send_queue()
+    coalesce = len(parts) == 1
+    # the send runs on a queue thread; keep it in the caller's trace
+    send = tracing.bind(send)
+    return [queue.submit(key, part, send, coalesce=coalesce) for part in parts]
+
+
+def _submit_text(webhook_url: str, parts: list[str]) -> list[Future]:
+    return _submit(
+        webhook_destination(webhook_url), parts, lambda text: post_wework_text(webhook_url, text)
+    )
+
+
+def _submit_app_text(to_user, agent_id, parts, corp_id, corp_secret, api_base) -> list[Future]:
+    return _submit(
+        f"app:{corp_id}:{agent_id}:{to_user}",
+        parts,
+        lambda text: post_wework_app_text(to_user, agent_id, text, corp_id, corp_secret, api_base),
+    )
+
+
+def _wait(futures: list[Future]) -> bool:
+    deadline = time.monotonic() + get_wework_send_wait_seconds()
+    try:
+        results = [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+    except TimeoutError:
+        logger.warning("[Wework] queued message not sent in time, still queued")
+        return False
+    return bool(results) and all(results)
+
+
+async def _wait_async(futures: list[Future]) -> bool:
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(*(asyncio.wrap_future(f) for f in futures)),
+            timeout=get_wework_send_wait_seconds(),
+        )
+    except asyncio.TimeoutError:
+        logger.warning("[Wework] queued message not sent in time, still queued")
+        return False
+    return bool(results) and all(results)
+
+
+def queue_wework_text(webhook_url: str, content) -> bool:
+    """
+    ``send_wework_text`` through the rate-limited queue.
+
+    :param content: Message text, or the list of parts of one long reply.
+    """
+    parts = _parts(content)
+    return bool(parts) and _wait(_submit_text(webhook_url, parts))
+
+
+def queue_wework_app_text(
+    to_user: str,
+    agent_id,
+    content,
+    corp_id: str,
+    corp_secret: str,
+    api_base: str = "https://qyapi.weixin.qq.com",
+) -> bool:
+    """``send_wework_app_text`` through the rate-limited queue; ``content`` as in ``queue_wework_text``."""
+    parts = _parts(content)
+    return bool(parts) and _wait(
+        _submit_app_text(to_user, agent_id, parts, corp_id, corp_secret, api_base)
+    )
+
+
+async def queue_wework_text_async(webhook_url: str, content) -> bool:
+    parts = _parts(content)
+    return bool(parts) and await _wait_async(_submit_text(webhook_url, parts))
+
+
+async def queue_wework_app_text_async(
+    to_user: str,
+    agent_id,
+    content,
+    corp_id: str,
+    corp_secret: str,
+    api_base: str = "https://qyapi.weixin.qq.com",
+) -> bool:
+    parts = _parts(content)
+    return bool(parts) and await _wait_async(
+        _submit_app_text(to_user, agent_id, parts, corp_id, corp_secret, api_base)
+    )
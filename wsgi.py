@@ -0,0 +1,15 @@
+"""
+WSGI entry point for production servers, e.g.
+
+    gunicorn -w 4 -b 0.0.0.0:5000 wsgi:application
+
+Unlike ``python app.py`` (Flask's development server) this installs no SIGHUP
+handler, since gunicorn uses SIGHUP itself to reload its workers, and does not
+replay the job journal: every worker would replay the same file. Set
+``WEWORK_STATE_STORE`` so the workers share dedup, OpenCode sessions and send
+rate limits.
+"""
+
+from app import app as application
+
+__all__ = ["application"]